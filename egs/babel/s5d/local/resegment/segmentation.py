@@ -4,20 +4,22 @@
 # Apache 2.0
 
 from __future__ import division
-import os, glob, argparse, sys, re, time
+import os, glob, argparse, sys, re, time, io, bisect, traceback
 from argparse import ArgumentParser
+from collections import deque
+from multiprocessing import Pool
 
-use_numpy = True
-try:
-  import numpy as np
-except ImportError:
-  use_numpy = False
+import numpy as np
 
 # Global stats for analysis taking RTTM file as reference
 global_analysis_get_initial_segments = None
 global_analysis_set_nonspeech_proportion = None
 global_analysis_final = None
 
+# Configuration of the resegmentation jobs:
+# (options, phone_map, speech_cap, prediction_dir, temp_dir)
+global_config = None
+
 def mean(l):
   if len(l) > 0:
     return float(sum(l))/len(l)
@@ -150,7 +152,9 @@ class Analysis(object):
 
   # Print detailed stats of lengths of each of the 3 types of frames
   # in 8 kinds of segments
-  def write_type_stats(self, file_handle = sys.stderr):
+  def write_type_stats(self, file_handle = None):
+    if file_handle is None:
+      file_handle = sys.stderr
     for j in range(0,3):
       # 3 types of frames. Silence, noise, speech.
       # Typically, we store the number of frames of each type here.
@@ -162,19 +166,18 @@ class Analysis(object):
         max_length    = max([0]+self.type_counts[j][i])
         min_length    = min([10000]+self.type_counts[j][i])
         mean_length   = mean(self.type_counts[j][i])
-        if use_numpy:
-          try:
-            percentile25  = np.percentile(self.type_counts[j][i], 25)
-          except ValueError:
-            percentile25 = 0
-          try:
-            percentile50  = np.percentile(self.type_counts[j][i], 50)
-          except ValueError:
-            percentile50 = 0
-          try:
-            percentile75  = np.percentile(self.type_counts[j][i], 75)
-          except ValueError:
-            percentile75 = 0
+        try:
+          percentile25  = np.percentile(self.type_counts[j][i], 25)
+        except (ValueError, IndexError):
+          percentile25 = 0
+        try:
+          percentile50  = np.percentile(self.type_counts[j][i], 50)
+        except (ValueError, IndexError):
+          percentile50 = 0
+        try:
+          percentile75  = np.percentile(self.type_counts[j][i], 75)
+        except (ValueError, IndexError):
+          percentile75 = 0
 
         file_handle.write("File %s: %s : TypeStats: Type %d %d: Min: %4d Max: %4d Mean: %4d percentile25: %4d percentile50: %4d percentile75: %4d\n" % (self.file_id, self.prefix, j, i,  min_length, max_length, mean_length, percentile25, percentile50, percentile75))
       # End for loop over 9 different kinds of segments
@@ -184,24 +187,25 @@ class Analysis(object):
   # The stats include different statistical measures like mean, max, min
   # and median of the length of continuous regions of frames in
   # each of the 9 cells of the confusion matrix
-  def write_length_stats(self, file_handle = sys.stderr):
+  def write_length_stats(self, file_handle = None):
+    if file_handle is None:
+      file_handle = sys.stderr
     for i in range(0,9):
       self.max_length[i]    = max([0]+self.state_count[i])
       self.min_length[i]    = min([10000]+self.state_count[i])
       self.mean_length[i]   = mean(self.state_count[i])
-      if use_numpy:
-        try:
-          self.percentile25[i]  = np.percentile(self.state_count[i], 25)
-        except ValueError:
-          self.percentile25[i] = 0
-        try:
-          self.percentile50[i]  = np.percentile(self.state_count[i], 50)
-        except ValueError:
-          self.percentile50[i] = 0
-        try:
-          self.percentile75[i]  = np.percentile(self.state_count[i], 75)
-        except ValueError:
-          self.percentile75[i] = 0
+      try:
+        self.percentile25[i]  = np.percentile(self.state_count[i], 25)
+      except (ValueError, IndexError):
+        self.percentile25[i] = 0
+      try:
+        self.percentile50[i]  = np.percentile(self.state_count[i], 50)
+      except (ValueError, IndexError):
+        self.percentile50[i] = 0
+      try:
+        self.percentile75[i]  = np.percentile(self.state_count[i], 75)
+      except (ValueError, IndexError):
+        self.percentile75[i] = 0
 
       file_handle.write("File %s: %s : Length: Type %d: Min: %4d Max: %4d Mean: %4d percentile25: %4d percentile50: %4d percentile75: %4d\n" % (self.file_id, self.prefix, i,  self.min_length[i], self.max_length[i], self.mean_length[i], self.percentile25[i], self.percentile50[i], self.percentile75[i]))
     # End for loop over 9 cells
@@ -212,7 +216,9 @@ class Analysis(object):
   # Markers: Type <type>: <start_frame> (<num_of_frames>) (<hypothesized_phones>)
   # The hypothesized_phones can be looked at to see what phones are
   # present in the hypothesis from start_frame for num_of_frames frames.
-  def write_markers(self, file_handle = sys.stderr):
+  def write_markers(self, file_handle = None):
+    if file_handle is None:
+      file_handle = sys.stderr
     file_handle.write("Start frames of different segments:\n")
     for j in range(0,9):
       if self.phones[j] == []:
@@ -324,12 +330,145 @@ class Stats(object):
 # Timer class to time functions
 class Timer(object):
   def __enter__(self):
-    self.start = time.clock()
+    self.start = time.time()
     return self
   def __exit__(self, *args):
-    self.end = time.clock()
+    self.end = time.time()
     self.interval = self.end - self.start
 
+# Define Frame Type Constants
+# The predicted classes of the frames are stored as int8 arrays.
+# For joint segmentation, the classes 0...8 are 3 * c1 + c2, where c1 and
+# c2 are the classes (0 for silence, 1 for noise and 2 for speech) predicted
+# for this channel and for the other channel. For isolated segmentation, only
+# the classes 0, 4 and 8 are used. The non-speech frames 0...5 that are
+# included in the segments by set_nonspeech_proportion are converted
+# to 9...14 respectively.
+NUM_CLASSES = 15
+THIS_SILENCE = (0, 1, 2)
+THIS_NOISE = (3, 4, 5)
+THIS_SPEECH = (6, 7, 8)
+THIS_SPEECH_THAT_SIL = (6,)
+THIS_SPEECH_THAT_NOISE = (7,)
+THIS_SIL_CONVERT_THAT_SIL = (9,)
+THIS_SIL_CONVERT_THAT_NOISE = (10,)
+THIS_SIL_CONVERT = (9, 10, 11)
+THIS_SILENCE_CONVERT = (9, 10, 11)
+THIS_NOISE_CONVERT_THAT_SIL = (12,)
+THIS_NOISE_CONVERT_THAT_NOISE = (13,)
+THIS_NOISE_CONVERT = (12, 13, 14)
+THIS_NOISE_OR_SILENCE = THIS_NOISE + THIS_SILENCE
+THIS_SILENCE_OR_NOISE = THIS_NOISE + THIS_SILENCE
+THIS_CONVERT = THIS_SILENCE_CONVERT + THIS_NOISE_CONVERT
+THIS_SILENCE_PLUS = THIS_SILENCE + THIS_SILENCE_CONVERT
+THIS_NOISE_PLUS = THIS_NOISE + THIS_NOISE_CONVERT
+THIS_SPEECH_PLUS = THIS_SPEECH + THIS_CONVERT
+
+# Returns a boolean array which, indexed by an array of frame classes,
+# gives the mask of the frames whose class is one of 'classes'
+def class_mask(classes):
+  mask = np.zeros(NUM_CLASSES, dtype=bool)
+  mask[list(classes)] = True
+  return mask
+
+IS_SILENCE = class_mask(THIS_SILENCE)
+IS_NOISE = class_mask(THIS_NOISE)
+IS_SPEECH = class_mask(THIS_SPEECH)
+IS_SILENCE_OR_NOISE = class_mask(THIS_SILENCE_OR_NOISE)
+IS_CONVERT = class_mask(THIS_CONVERT)
+
+# Return the type of the transition from a frame of class a to a
+# frame of class b. The types are used to prioritize the merging of segments.
+# Returns None if the transition is not a valid one at a segment boundary.
+def transition_type(a, b):
+  if a in (THIS_SPEECH_THAT_NOISE + THIS_SPEECH_THAT_SIL) and b in (THIS_SPEECH_THAT_NOISE + THIS_SPEECH_THAT_SIL):
+    return 0
+  if a in THIS_SPEECH and b in THIS_SPEECH:
+    return 1
+  if a in (THIS_SPEECH + THIS_NOISE_CONVERT_THAT_SIL + THIS_NOISE_CONVERT_THAT_NOISE) and b in (THIS_SPEECH + THIS_NOISE_CONVERT_THAT_SIL + THIS_NOISE_CONVERT_THAT_NOISE):
+    return 2
+  if a in (THIS_SPEECH + THIS_NOISE_CONVERT) and b in (THIS_SPEECH + THIS_NOISE_CONVERT):
+    return 3
+  if a in (THIS_SPEECH + THIS_NOISE_CONVERT + THIS_SIL_CONVERT_THAT_SIL + THIS_SIL_CONVERT_THAT_NOISE) and b in (THIS_SPEECH + THIS_NOISE_CONVERT + THIS_SIL_CONVERT_THAT_SIL + THIS_SIL_CONVERT_THAT_NOISE):
+    return 4
+  if a in (THIS_SPEECH + THIS_CONVERT) and b in (THIS_SPEECH + THIS_CONVERT):
+    return 5
+  if a in THIS_SPEECH_PLUS and b in (THIS_SPEECH_PLUS + THIS_NOISE):
+    return 6
+  if a in THIS_SPEECH_PLUS and b in (THIS_SPEECH_PLUS + THIS_SILENCE):
+    return 7
+  if a in (THIS_SPEECH_PLUS + THIS_NOISE) and b in THIS_SPEECH_PLUS:
+    return 8
+  if a in (THIS_SPEECH_PLUS + THIS_SILENCE) and b in THIS_SPEECH_PLUS:
+    return 9
+  return None
+
+# Table of transition types indexed by [class of frame j-1, class of frame j]
+# -1 for the invalid transitions
+TRANSITION_TYPES = np.array([ [ -1 if transition_type(a, b) is None else transition_type(a, b)
+  for b in range(0, NUM_CLASSES) ] for a in range(0, NUM_CLASSES) ], dtype=np.int8)
+
+# Get the start frames and the lengths of the runs of equal values in the
+# array x
+def run_length_encode(x):
+  starts = np.flatnonzero(x[1:] != x[:-1]) + 1
+  starts = np.concatenate(([0], starts)) if len(x) > 0 else starts
+  lengths = np.diff(np.append(starts, len(x)))
+  return starts, lengths
+
+# Accumulate in the Analysis object a, the confusion matrix of the frame
+# categories C (an array of values 0...8), and the lengths, start frames and
+# the predicted phones of every run of frames of the same category except the
+# last one.
+def add_frame_analysis(a, C, P):
+  starts, lengths = run_length_encode(C)
+  for start, length in zip(starts[:-1].tolist(), lengths[:-1].tolist()):
+    c = C[start]
+    a.state_count[c].append(length)
+    a.markers[c].append(start)
+    a.phones[c].append(' '.join(set(P[start:start+length])))
+  a.confusion_matrix = np.bincount(C, minlength = 9).tolist()
+
+# Class to look up the nearest marker on either side of a frame in a
+# boolean array of segment start or end markers, while the markers are
+# being removed. The markers are never added.
+# The set markers are kept in the sorted list of their positions and the
+# removed ones are skipped using union-find with path compression.
+class MarkerIndex(object):
+  def __init__(self, markers):
+    self.markers = markers
+    self.positions = np.flatnonzero(markers).tolist()
+    self.prev = list(range(0, len(self.positions)))
+    self.next = list(range(0, len(self.positions)))
+
+  # Return the index in self.positions of the nearest set marker at or
+  # before (parent = self.prev) or at or after (parent = self.next) the
+  # index k. This will be -1 or len(self.positions) if there is none.
+  def find(self, parent, k):
+    r = k
+    while 0 <= r < len(parent) and parent[r] != r:
+      r = parent[r]
+    while 0 <= k < len(parent) and parent[k] != k:
+      parent[k], k = r, parent[k]
+    return r
+
+  # Return the last frame before n with a marker set or -1 if there is none
+  def last_before(self, n):
+    k = self.find(self.prev, bisect.bisect_left(self.positions, n) - 1)
+    return self.positions[k] if k >= 0 else -1
+
+  # Return the first frame after n with a marker set or None if there is none
+  def first_after(self, n):
+    k = self.find(self.next, bisect.bisect_right(self.positions, n))
+    return self.positions[k] if k < len(self.positions) else None
+
+  def remove(self, n):
+    if self.markers[n]:
+      self.markers[n] = False
+      k = bisect.bisect_left(self.positions, n)
+      self.prev[k] = k - 1
+      self.next[k] = k + 1
+
 # The main class for post-processing a file.
 # This does the segmentation either looking at the file isolated
 # or by looking at both classes simultaneously
@@ -338,12 +477,12 @@ class JointResegmenter(object):
 
     # Pointers to prediction arrays and Initialization
     self.P = P                    # Predicted phones
-    self.B = [ i for i in A ]     # Original predicted classes
-    self.A = A                    # Predicted classes
+    self.B = A.copy()             # Original predicted classes
+    self.A = A                    # Predicted classes (int8 array)
     self.file_id = f              # File name
     self.N = len(A)               # Length of the prediction (= Num of frames in the audio file)
-    self.S = [False] * self.N     # Array of Start boundary markers
-    self.E = [False] * (self.N+1) # Array of End boundary markers
+    self.S = np.zeros(self.N, dtype=bool)     # Array of Start boundary markers
+    self.E = np.zeros(self.N+1, dtype=bool)   # Array of End boundary markers
 
     self.phone_map = phone_map
     self.options = options
@@ -362,33 +501,15 @@ class JointResegmenter(object):
 
     # End of Configuration
 
-    # Define Frame Type Constants
-    self.THIS_SILENCE = ("0","1","2")
-    self.THIS_NOISE = ("3","4","5")
-    self.THIS_SPEECH = ("6", "7", "8")
-    self.THIS_SPEECH_THAT_SIL = ("6",)
-    self.THIS_SPEECH_THAT_NOISE = ("7",)
-    self.THIS_SIL_CONVERT_THAT_SIL = ("9",)
-    self.THIS_SIL_CONVERT_THAT_NOISE = ("10",)
-    self.THIS_SIL_CONVERT = ("9","10","11")
-    self.THIS_SILENCE_CONVERT = ("9","10","11")
-    self.THIS_NOISE_CONVERT_THAT_SIL = ("12",)
-    self.THIS_NOISE_CONVERT_THAT_NOISE = ("13",)
-    self.THIS_NOISE_CONVERT = ("12","13","14")
-    self.THIS_NOISE_OR_SILENCE = self.THIS_NOISE + self.THIS_SILENCE
-    self.THIS_SILENCE_OR_NOISE = self.THIS_NOISE + self.THIS_SILENCE
-    self.THIS_CONVERT = self.THIS_SILENCE_CONVERT + self.THIS_NOISE_CONVERT
-    self.THIS_SILENCE_PLUS = self.THIS_SILENCE + self.THIS_SILENCE_CONVERT
-    self.THIS_NOISE_PLUS = self.THIS_NOISE + self.THIS_NOISE_CONVERT
-    self.THIS_SPEECH_PLUS = self.THIS_SPEECH + self.THIS_CONVERT
-
     if stats != None:
       self.stats = stats
 
     self.reference = None
     if reference != None:
+      reference = np.array(reference, dtype=np.int8)
       if len(reference) < self.N:
-        self.reference = reference + ["0"] * (self.N - len(reference))
+        self.reference = np.concatenate((reference,
+          np.zeros(self.N - len(reference), dtype=np.int8)))
         assert (len(self.reference) == self.N)
       else:
         self.reference = reference
@@ -399,7 +520,7 @@ class JointResegmenter(object):
     self.A = self.A[0:N]
     self.S = self.S[0:N]
     self.E = self.E[0:N+1]
-    if sum(self.S) == sum(self.E) + 1:
+    if np.count_nonzero(self.S) == np.count_nonzero(self.E) + 1:
       self.E[N] = True
     self.N = N
 
@@ -436,105 +557,51 @@ class JointResegmenter(object):
       sys.stderr.write("\n")
       self.stats.reset()
 
+  # Return the start and end of each segment, where the end of a segment
+  # is the first end marker after its start
+  def get_segments(self):
+    segment_starts = np.flatnonzero(self.S)
+    segment_ends = np.flatnonzero(self.E)
+    i = np.searchsorted(segment_ends, segment_starts, side = 'right')
+    assert (np.all(i < len(segment_ends)))
+    return segment_starts, segment_ends[i]
+
   def get_initial_segments(self):
-    for i in range(0, self.N):
-      if (i > 0) and self.A[i-1] != self.A[i]:
-        # This frame is different from the previous frame.
-        if self.A[i] in self.THIS_SPEECH:
-          # This frame is speech.
-          if self.A[i-1] in self.THIS_SPEECH:
-            # Both this and the previous frames are speech
-            # But they are different. e.g. "8 7"
-            # So this is the end of the previous region and
-            # the beginning of the next region
-            self.S[i] = True
-            self.E[i] = True
-          else:
-            # The previous frame is non-speech, but not this one.
-            # So this frame is the beginning of a new segment
-            self.S[i] = True
-        else:
-          # This frame is non-speech
-          if self.A[i-1] in self.THIS_SPEECH:
-            # Previous frame is speech, but this one is not.
-            # So this frame is the end of the previous segment
-            self.E[i] = True
-      elif i == 0 and self.A[i] in self.THIS_SPEECH:
-        # The frame is speech. So this is the start of a new segment.
-        self.S[i] = True
-    if self.A[self.N-1] in self.THIS_SPEECH:
-      # Handle the special case where the last frame of file is not nonspeech
-      self.E[self.N] = True
-    assert(sum(self.S) == sum(self.E))
+    # A frame where the class changes is the beginning of a new segment if it
+    # is speech and the end of the previous segment if the previous frame
+    # is speech. e.g. "8 7" is the end of the previous region and the
+    # beginning of the next region.
+    speech = IS_SPEECH[self.A]
+    change = np.ones(self.N, dtype=bool)
+    change[1:] = self.A[1:] != self.A[:-1]
+    self.S[:] = change & speech
+    self.E[1:self.N] = change[1:] & speech[:-1]
+    # Handle the special case where the last frame of file is not nonspeech
+    self.E[self.N] = speech[self.N-1]
+    assert(np.count_nonzero(self.S) == np.count_nonzero(self.E))
 
     ###########################################################################
     # Analysis section
-    self.C = ["0"] * self.N
-    C = self.C
     a = Analysis(self.file_id, self.frame_shift,"Analysis after get_initial_segments")
 
-    if self.reference != None:
-      count = 0
-      for i in range(0,self.N):
-        if   self.reference[i] == "0" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "0"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_NOISE:
-          C[i] = "1"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "2"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "3"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_NOISE:
-          C[i] = "4"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "5"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SILENCE:
-          C[i] = "6"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_NOISE:
-          C[i] = "7"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "8"
-        if i > 0 and C[i-1] != C[i]:
-          a.state_count[int(C[i-1])].append(count)
-          a.markers[int(C[i-1])].append(i - count)
-          a.phones[int(C[i-1])].append(' '.join(set(self.P[i-count:i])))
-          count = 1
-        else:
-          count += 1
-
-      for j in range(0,9):
-        a.confusion_matrix[j] = sum([C[i] == str(j) for i in range(0,self.N)])
+    if self.reference is not None:
+      C = 3 * self.reference[0:self.N] + np.where(speech, 2, np.where(IS_NOISE[self.A], 1, 0))
+      add_frame_analysis(a, C, self.P)
 
       global_analysis_get_initial_segments.add(a)
 
-      if self.reference != None and self.options.verbose > 0:
+      if self.reference is not None and self.options.verbose > 0:
         a.write_confusion_matrix()
         a.write_length_stats()
-        if self.reference != None and self.options.verbose > 1:
+        if self.reference is not None and self.options.verbose > 1:
           a.write_markers()
     ###########################################################################
 
   def set_nonspeech_proportion(self):
-    num_speech_frames = 0
-    in_segment = False
-
-    # Active frames are the frames that are either segment starts
-    # or segment ends
-    active_frames = []
-    for n in range(0, self.N + 1):
-      if self.E[n]:
-        assert(in_segment)
-        in_segment = False
-        active_frames.append(n)
-      if n < self.N and self.S[n]:
-        assert(not in_segment)
-        in_segment = True
-        active_frames.append(n)
-      if n < self.N:
-        if in_segment:
-          # Count the number of speech frames
-          num_speech_frames += 1
-    assert (not in_segment)
+    # The segments are now exactly the runs of speech frames, separated
+    # by the runs of non-speech frames, the 'gaps'.
+    speech = IS_SPEECH[self.A]
+    num_speech_frames = int(np.count_nonzero(speech))
     if num_speech_frames == 0:
       sys.stderr.write("%s: Warning: no speech found for recording %s\n" % (sys.argv[0], self.file_id))
 
@@ -546,133 +613,134 @@ class JointResegmenter(object):
     # The number of frames currently in the segments
     num_segment_frames = num_speech_frames
 
+    starts, lengths = run_length_encode(speech)
+    nonspeech_runs = ~speech[starts]
+    gap_starts = starts[nonspeech_runs]
+    gap_ends = gap_starts + lengths[nonspeech_runs]
+
+    # The non-speech frames that are included in the segments are taken
+    # from the ends of the gaps. The unconverted frames of the gap g are
+    # left[g]...right[g]-1; the segment end marker before the gap is at
+    # left[g] and the segment start marker after it is at right[g].
+    left = gap_starts.tolist()
+    right = gap_ends.tolist()
+    # True at frame n if there is a transition from one type of non-speech
+    # (0, 1 ... 5) to another between the frames n-1 and n; the frame
+    # that is converted is then the start of a new segment.
+    class_change = np.zeros(self.N+1, dtype=bool)
+    class_change[1:self.N] = self.B[1:] != self.B[:-1]
+
+    # Active frames are the segment ends before the gaps and the segment starts
+    # after the gaps, in order. They are listed as (gap, side) where side is
+    # 0 for the segment end at the left of the gap and 1 for the segment start
+    # at its right.
+    active_frames = []
+    for g in range(0, len(left)):
+      if left[g] > 0:
+        active_frames.append((g, 0))
+      if right[g] < self.N:
+        active_frames.append((g, 1))
+
     count = 0
     while num_segment_frames < target_segment_frames:
       count += 1
       changed = False
-      for i in range(0, len(active_frames)):
-        # At each active frame, try include a nonspeech frame into
-        # segment. Thus padding the speech segments with some
-        # non-speech frames. These converted non-speech frames are
-        # labelled 9...14 depending on whether they were originally
-        # 0...5 respectively
-        n = active_frames[i]
-        if self.E[n] and n < self.N and not self.S[n]:
-          # This must be the beginning of a non-speech region.
-          # Include some of this non-speech in the segments
-          assert (self.A[n] not in self.THIS_SPEECH)
-
-          # Convert the non-speech frame to be included in segment
-          self.A[n] = str(int(self.B[n]) + 9)
-          if self.B[n-1] != self.B[n]:
-            # In this frame there is a transition from
-            # one type of non-speech (0, 1 ... 5) to another
-            # So its the start of a segment. Also add it to the
-            # end of the active frames list
-            self.S[n] = True
-            active_frames.append(n+1)
-          else:
-            # We need to extend the segment end since we have
-            # included a non-speeech frame. Remove the current segment end mark
-            # and one to the next frame
-            self.E[n] = False
-            active_frames[i] = n + 1
-          self.E[n+1] = True
-          # Increment the number of frames in the segments
-          num_segment_frames += 1
-          changed = True
-        if n < self.N and self.S[n] and n > 0 and not self.E[n]:
-          # This must be the beginning of a speech region.
-          # Include some non-speech before it into the segments
-          assert (self.A[n-1] not in self.THIS_SPEECH)
-          self.A[n-1] = str(int(self.B[n-1]) + 9)
-          if self.B[n-1] != self.B[n]:
-            self.E[n] = True
-            active_frames.append(n-1)
-          else:
-            self.S[n] = False
-            active_frames[i] = n - 1
-          self.S[n-1] = True
-          num_segment_frames += 1
-          changed = True
+      # At each active frame, try include a nonspeech frame into
+      # segment. Thus padding the speech segments with some
+      # non-speech frames. When a transition to another type of
+      # non-speech is crossed, the active frame is moved to the end
+      # of the list of active frames.
+      kept = []
+      moved = []
+      for g, side in active_frames:
+        if left[g] >= right[g]:
+          # The gap is already completely included in the segments
+          continue
+        if side == 0:
+          n = left[g]
+          left[g] = n + 1
+        else:
+          n = right[g]
+          right[g] = n - 1
+        if class_change[n]:
+          moved.append((g, side))
+        else:
+          kept.append((g, side))
+        # Increment the number of frames in the segments
+        num_segment_frames += 1
+        changed = True
         if num_segment_frames >= target_segment_frames:
           break
       if not changed:   # avoid an infinite loop. if no changes, then break.
         break
+      active_frames = kept + moved
     if num_segment_frames < target_segment_frames:
       proportion = float(num_segment_frames - num_speech_frames)/ num_segment_frames
       sys.stderr.write("%s: Warning: for recording %s, only got a proportion %f of non-speech frames, versus target %f\n" % (sys.argv[0], self.file_id, proportion, self.options.silence_proportion))
 
+    # Convert the non-speech frames included in segments to 9...14.
+    # The frames converted from the left of the gaps are the frames
+    # gap_starts[g]...left[g]-1 and those from the right of the gaps are the
+    # frames right[g]...gap_ends[g]-1.
+    left = np.array(left, dtype=gap_starts.dtype)
+    right = np.array(right, dtype=gap_ends.dtype)
+    left_converted = np.zeros(self.N+1, dtype=np.int32)
+    np.add.at(left_converted, gap_starts, 1)
+    np.add.at(left_converted, left, -1)
+    left_converted = np.cumsum(left_converted[0:self.N]) > 0
+    right_converted = np.zeros(self.N+1, dtype=np.int32)
+    np.add.at(right_converted, right, 1)
+    np.add.at(right_converted, gap_ends, -1)
+    right_converted = np.cumsum(right_converted[0:self.N]) > 0
+    converted = left_converted | right_converted
+    self.A[converted] = self.B[converted] + 9
+
+    # Within the converted frames, there is a segment boundary at each
+    # transition from one type of non-speech to another. The segments are
+    # ended at left[g] and started at right[g].
+    boundary = np.flatnonzero(left_converted)
+    boundary = np.concatenate((boundary, np.flatnonzero(right_converted) + 1))
+    self.S[boundary] = class_change[boundary]
+    self.E[boundary] = class_change[boundary]
+    self.E[left[gap_starts > 0]] = True
+    self.S[right[gap_ends < self.N]] = True
+
     ###########################################################################
     # Analysis section
-    self.C = ["0"] * self.N
-    C = self.C
     a = Analysis(self.file_id, self.frame_shift,"Analysis after set_nonspeech_proportion")
 
-    if self.reference != None:
-      count = 0
-      for i in range(0,self.N):
-        if   self.reference[i] == "0" and self.A[i] in (self.THIS_SILENCE + self.THIS_NOISE):
-          C[i] = "0"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_CONVERT:
-          C[i] = "1"
-        elif self.reference[i] == "0" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "2"
-        elif self.reference[i] == "1" and self.A[i] in (self.THIS_SILENCE + self.THIS_NOISE):
-          C[i] = "3"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_CONVERT:
-          C[i] = "4"
-        elif self.reference[i] == "1" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "5"
-        elif self.reference[i] == "2" and self.A[i] in (self.THIS_SILENCE + self.THIS_NOISE):
-          C[i] = "6"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_CONVERT:
-          C[i] = "7"
-        elif self.reference[i] == "2" and self.A[i] in self.THIS_SPEECH:
-          C[i] = "8"
-        if i > 0 and C[i-1] != C[i]:
-          a.state_count[int(C[i-1])].append(count)
-          a.markers[int(C[i-1])].append(i - count)
-          a.phones[int(C[i-1])].append(' '.join(set(self.P[i-count:i])))
-          count = 1
-        else:
-          count += 1
-
-      for j in range(0,9):
-        a.confusion_matrix[j] = sum([C[i] == str(j) for i in range(0,self.N)])
+    if self.reference is not None:
+      C = 3 * self.reference[0:self.N] + np.where(IS_SPEECH[self.A], 2, np.where(IS_CONVERT[self.A], 1, 0))
+      add_frame_analysis(a, C, self.P)
 
       global_analysis_set_nonspeech_proportion.add(a)
 
-      if self.reference != None and self.options.verbose > 0:
+      if self.reference is not None and self.options.verbose > 0:
         a.write_confusion_matrix()
         a.write_length_stats()
-        if self.reference != None and self.options.verbose > 1:
+        if self.reference is not None and self.options.verbose > 1:
           a.write_markers()
     ###########################################################################
 
   def merge_segments(self):
     # Get list of frames which have segment start and segment end
     # markers into separate lists
-    segment_starts = [i for i, val in enumerate(self.S) if val]
-    segment_ends = [i for i, val in enumerate(self.E) if val]
-    assert (sum(self.S) == sum(self.E))
+    segment_starts = np.flatnonzero(self.S)
+    segment_ends = np.flatnonzero(self.E)
+    assert (len(segment_starts) == len(segment_ends))
 
     if self.options.verbose > 3:
       sys.stderr.write("Length of segment starts before non-speech adding: %d\n" % len(segment_starts))
 
     if self.min_inter_utt_nonspeech_length > 0.0:
-      segment_starts = list(set([0] + segment_starts + segment_ends + [self.N]))
-      segment_starts.sort()
-      segment_starts.pop()
-      segment_ends= list(set([0] + segment_starts + segment_ends + [self.N]))
-      segment_ends.sort()
-      segment_ends.pop(0)
+      # Make the non-speech regions between the segments also segments
+      markers = np.union1d(np.union1d(segment_starts, segment_ends), [0, self.N])
+      segment_starts = markers[:-1]
+      segment_ends = markers[1:]
       if self.options.verbose > 3:
         sys.stderr.write("Length of segment starts after non-speech adding: %d\n" % len(segment_starts))
-      for i in segment_starts:
-        self.S[i] = True
-      for i in segment_ends:
-        self.E[i] = True
+      self.S[segment_starts] = True
+      self.E[segment_ends] = True
 
     # Just a check. There must always be equal number of segment starts
     # and segment ends
@@ -682,51 +750,33 @@ class JointResegmenter(object):
     # The list of boundaries is obtained in the following step along with
     # a few statistics like the type of segment on either side of the boundary
     # and the length of the segment on either side of it
-    boundaries = []
-    i = 0
-    j = 0
-    while i < len(segment_starts) and j < len(segment_ends):
-      if segment_ends[j] < segment_starts[i]:
-        # The segment end marker is before the segment start marker.
-        # This means that this segment end marker corresponds to a segment
-        # that is before the one indicated by the segment start marker.
-        # So advance the segment end pointer to the next segment end to
-        # check if that is a 'boundary'
-        j += 1
-      elif segment_ends[j] > segment_starts[i]:
-        # The segment end marker is after the segment start marker.
-        # This means that this segment end marker would corresponds
-        # to segment indicated by the segment start marker.
-        # So advance the segment start pointer to the next segment start to
-        # check if that is a 'boundary'
-        i += 1
-      else:
-        assert(i < len(segment_starts) and j < len(segment_ends))
-        # A boundary:
-        # Find the segment score as the min of lengths of the segments
-        # to the left and to the right.
-        # This segment score will be used to prioritize merging of
-        # the segment with its neighbor
-        assert ((j + 1) < len(segment_ends))
-        segment_score = min(segment_starts[i] - segment_starts[i-1], \
-            segment_ends[j+1] - segment_ends[j])
-        # Also find the type of tranisition of the segments at the boundary.
-        # This is also used to prioritize the merging of the segment
-        boundaries.append((segment_ends[j], segment_score, \
-            self.transition_type(segment_ends[j])))
-
-        # Sort the boundaries based on segment score
-        boundaries.sort(key = lambda x: x[1])
-        # Then sort based on the type of transition by keeping it still
-        # sorted within each transition type  based on segment score
-        boundaries.sort(key = lambda x: x[2])
-        i += 1
-        j += 1
-      # End if
-    # End while loop
+    boundaries = np.intersect1d(segment_starts, segment_ends)
+    i = np.searchsorted(segment_starts, boundaries)
+    j = np.searchsorted(segment_ends, boundaries)
+    assert (np.all(j + 1 < len(segment_ends)))
+    # Find the segment score as the min of lengths of the segments
+    # to the left and to the right.
+    # This segment score will be used to prioritize merging of
+    # the segment with its neighbor
+    segment_scores = np.minimum(boundaries - segment_starts[i-1],
+        segment_ends[j+1] - boundaries)
+    # Also find the type of tranisition of the segments at the boundary.
+    # This is also used to prioritize the merging of the segment
+    assert (np.all((self.A[boundaries-1] != self.A[boundaries]) | IS_CONVERT[self.A[boundaries]]))
+    transition_types = TRANSITION_TYPES[self.A[boundaries-1], self.A[boundaries]]
+    assert (np.all(transition_types >= 0))
+    # Sort the boundaries based on the type of transition and then
+    # on the segment score, keeping the boundaries with the same type
+    # and score in order
+    order = np.lexsort((boundaries, segment_scores, transition_types))
+    boundaries = list(zip(boundaries[order].tolist(),
+      segment_scores[order].tolist(), transition_types[order].tolist()))
 
     # Begin merging of segments by removing the start and end mark
     # at the boundary to be merged
+    starts_index = MarkerIndex(self.S)
+    ends_index = MarkerIndex(self.E)
+    silence_or_noise = IS_SILENCE_OR_NOISE[self.A]
     count = 0
     for b in boundaries:
       count += 1
@@ -740,34 +790,26 @@ class JointResegmenter(object):
 
       # Count the number of frames in the segment to the
       # left of the boundary
-      p = b[0] - 1
-      while p >= 0:
-        if self.S[p]:
-          break
-        p -= 1
-        # End if
-      # End while loop
+      p = starts_index.last_before(b[0])
       p_left = p
       segment_length += b[0] - p
 
       # Count the number of frames in the segment to the
       # right of the boundary
-      p = b[0] + 1
-      while p <= self.N:
-        if self.E[p]:
-          break
-        p += 1
-      assert (self.min_inter_utt_nonspeech_length == 0 or p == self.N or self.S[p] or self.A[p] in self.THIS_SILENCE_OR_NOISE)
+      p = ends_index.first_after(b[0])
+      if p is None:
+        p = self.N + 1
+      assert (self.min_inter_utt_nonspeech_length == 0 or p == self.N or self.S[p] or silence_or_noise[p])
 
-      if self.min_inter_utt_nonspeech_length > 0 and self.A[b[0]] in self.THIS_SILENCE_OR_NOISE:
+      if self.min_inter_utt_nonspeech_length > 0 and silence_or_noise[b[0]]:
         assert(b[2] == 6 or b[2] == 7)
         if (p - b[0]) > self.min_inter_utt_nonspeech_length:
           # This is a non-speech segment that is longer than the minimum
           # inter-utterance non-speech length.
           # Therefore treat this non-speech as inter-utterance non-speech and
           # remove it from the segments
-          self.S[b[0]] = False
-          self.E[p] = False
+          starts_index.remove(b[0])
+          ends_index.remove(p)
 
           # Count the number of times inter utt non-speech
           # length is greater than the set threshold
@@ -785,12 +827,9 @@ class JointResegmenter(object):
         # with the adjacent ones as long as the length of the
         # segment after merging to see if its within limits.
         p_temp = p
-        p += 1
-        while p <= self.N:
-          if self.E[p]:
-            break
-          p += 1
-        # End while loop
+        p = ends_index.first_after(p_temp)
+        if p is None:
+          p = max(p_temp + 1, self.N + 1)
         segment_length += p - b[0]
         if segment_length < self.max_frames:
           # Merge the non-speech segment with the segments
@@ -800,24 +839,24 @@ class JointResegmenter(object):
           self.stats.merge_nonspeech_segment += 1
 
           if p_temp < self.N:
-            self.S[p_temp] = False
-            self.E[p_temp] = False
-          self.S[b[0]] = False
-          self.E[b[0]] = False
+            starts_index.remove(p_temp)
+            ends_index.remove(p_temp)
+          starts_index.remove(b[0])
+          ends_index.remove(b[0])
           continue
         else:
           # The merged segment length is longer than max_frames.
           # Therefore treat this non-speech as inter-utterance non-speech and
           # remove it from the segments
-          self.S[b[0]] = False
-          self.E[p_temp] = False
+          starts_index.remove(b[0])
+          ends_index.remove(p_temp)
           continue
         # End if
       elif self.min_inter_utt_nonspeech_length > 0 and (b[2] == 8 or b[2] == 9):
         assert(p_left == 0)
         if b[0] - p_left > self.min_inter_utt_nonspeech_length:
-          self.S[p_left] = False
-          self.E[b[0]] = False
+          starts_index.remove(p_left)
+          ends_index.remove(b[0])
           continue
         # End if
       # End if
@@ -825,25 +864,25 @@ class JointResegmenter(object):
 
       if segment_length < self.max_frames:
         self.stats.merge_segments += 1
-        self.S[b[0]] = False
-        self.E[b[0]] = False
+        starts_index.remove(b[0])
+        ends_index.remove(b[0])
       # End if
     # End for loop over boundaries
 
-    assert (sum(self.S) == sum(self.E))
+    assert (np.count_nonzero(self.S) == np.count_nonzero(self.E))
 
     ###########################################################################
     # Analysis section
 
-    if self.reference != None and self.options.verbose > 3:
+    if self.reference is not None and self.options.verbose > 3:
       a = self.segmentation_analysis("Analysis after merge_segments")
       a.write_confusion_matrix()
 
-      if self.reference != None and self.options.verbose > 4:
+      if self.reference is not None and self.options.verbose > 4:
         a.write_type_stats()
       # End if
 
-      if self.reference != None and self.options.verbose > 4:
+      if self.reference is not None and self.options.verbose > 4:
         a.write_markers()
       # End if
     # End if
@@ -851,216 +890,129 @@ class JointResegmenter(object):
   # End function merge_segments
 
   def split_long_segments(self):
-    assert (sum(self.S) == sum(self.E))
-    for n in range(0, self.N):
-      if self.S[n]:
-        p = n + 1
-        while p <= self.N:
-          if self.E[p]:
-            break
-          p += 1
+    assert (np.count_nonzero(self.S) == np.count_nonzero(self.E))
+    segment_starts, segment_ends = self.get_segments()
+    long_segments = (segment_ends - segment_starts) > self.hard_max_frames
+    for n, p in zip(segment_starts[long_segments].tolist(),
+        segment_ends[long_segments].tolist()):
+      while p - n > self.hard_max_frames:
         segment_length = p - n
-        if segment_length > self.hard_max_frames:
-          # Count the number of times long segments are split
-          self.stats.split_segments += 1
-
-          num_pieces = int((float(segment_length)/self.hard_max_frames) + 0.99999)
-          sys.stderr.write("%s: Warning: for recording %s, " \
-              % (sys.argv[0], self.file_id) \
-              + "splitting segment of length %f seconds into %d pieces " \
-              % (segment_length * self.frame_shift, num_pieces) \
-              + "(--hard-max-segment-length %f)\n" \
-              % self.options.hard_max_segment_length)
-          frames_per_piece = int(segment_length/num_pieces)
-          for i in range(1,num_pieces):
-            q = n + i * frames_per_piece
-            self.S[q] = True
-            self.E[q] = True
-        if p - 1 > n:
-          n = p - 1
-    assert (sum(self.S) == sum(self.E))
+        # Count the number of times long segments are split
+        self.stats.split_segments += 1
+
+        num_pieces = int((float(segment_length)/self.hard_max_frames) + 0.99999)
+        sys.stderr.write("%s: Warning: for recording %s, " \
+            % (sys.argv[0], self.file_id) \
+            + "splitting segment of length %f seconds into %d pieces " \
+            % (segment_length * self.frame_shift, num_pieces) \
+            + "(--hard-max-segment-length %f)\n" \
+            % self.options.hard_max_segment_length)
+        frames_per_piece = int(segment_length/num_pieces)
+        for i in range(1,num_pieces):
+          q = n + i * frames_per_piece
+          self.S[q] = True
+          self.E[q] = True
+        if num_pieces == 1:
+          break
+        # The last piece is the longest one, and it may still need to be split
+        n += (num_pieces - 1) * frames_per_piece
+    assert (np.count_nonzero(self.S) == np.count_nonzero(self.E))
   # End function split_long_segments
 
   def remove_silence_only_segments(self):
-    for n in range(0, self.N):
-      # Run through to find a segment start
-      if self.S[n]:
-        p = n
-        saw_nonsilence = False
-        # From the segment start, go till the segment end to see
-        # if there is speech in it
-        while p <= self.N:
-          if self.E[p] and p != n:
-            break
-          if p < self.N and self.A[p] not in self.THIS_SILENCE:
-            saw_nonsilence = True
-          p += 1
-        # End of while loop through the segment
-        assert (p > self.N or self.E[p])
-        if not saw_nonsilence:
-          # Count the number of silence only segments
-          self.stats.silence_only += 1
-
-          self.S[n] = False
-          self.E[p] = False
-        # End if
-        if p - 1 > n:
-          # Go to the end of the segment since that segment is
-          # already processed
-          n = p - 1
-        # End if
-    if self.reference != None and self.options.verbose > 3:
+    # Find the segments that do not have any non-silence frames
+    segment_starts, segment_ends = self.get_segments()
+    num_nonsilence = np.concatenate(([0], np.cumsum(~IS_SILENCE[self.A])))
+    silence_only = num_nonsilence[segment_ends] == num_nonsilence[segment_starts]
+
+    # Count the number of silence only segments
+    self.stats.silence_only += int(np.count_nonzero(silence_only))
+
+    self.S[segment_starts[silence_only]] = False
+    self.E[segment_ends[silence_only]] = False
+
+    if self.reference is not None and self.options.verbose > 3:
       a = self.segmentation_analysis("Analysis after remove_silence_only_segments")
       a.write_confusion_matrix()
 
-      if self.reference != None and self.options.verbose > 4:
+      if self.reference is not None and self.options.verbose > 4:
         a.write_type_stats()
       # End if
 
-      if self.reference != None and self.options.verbose > 4:
+      if self.reference is not None and self.options.verbose > 4:
         a.write_markers()
       # End if
     # End if
   # End function remove_silence_only_segments
 
   def remove_noise_only_segments(self):
-    for n in range(0, self.N):
-      if self.S[n]:
-        p = n
-        saw_speech = False
-        while p <= self.N:
-          if self.E[p] and p != n:
-            break
-          if self.A[p] in self.THIS_SPEECH:
-            saw_speech = True
-          p += 1
-        assert (self.E[p])
-        if not saw_speech:
-          # Count the number of segments with no speech
-          self.stats.noise_only += 1
-          self.S[n] = False
-          self.E[p] = False
-        # End if
-        if p - 1 > n:
-          n = p - 1
-        # End if
-      # End if
-    # End for loop over frames
+    # Find the segments that do not have any speech frames
+    segment_starts, segment_ends = self.get_segments()
+    num_speech = np.concatenate(([0], np.cumsum(IS_SPEECH[self.A])))
+    noise_only = num_speech[segment_ends] == num_speech[segment_starts]
+
+    # Count the number of segments with no speech
+    self.stats.noise_only += int(np.count_nonzero(noise_only))
+
+    self.S[segment_starts[noise_only]] = False
+    self.E[segment_ends[noise_only]] = False
 
     ###########################################################################
     # Analysis section
 
-    if self.reference != None and self.options.verbose > 3:
+    if self.reference is not None and self.options.verbose > 3:
       a = self.segmentation_analysis("Analysis after remove_noise_only_segments")
       a.write_confusion_matrix()
 
-      if self.reference != None and self.options.verbose > 4:
+      if self.reference is not None and self.options.verbose > 4:
         a.write_type_stats()
       # End if
 
-      if self.reference != None and self.options.verbose > 4:
+      if self.reference is not None and self.options.verbose > 4:
         a.write_markers()
       # End if
     # End if
     ###########################################################################
   # End function remove_noise_only_segments
 
-  # Return the transition type from frame j-1 to frame j
-  def transition_type(self, j):
-    assert (j > 0)
-    assert (self.A[j-1] != self.A[j] or self.A[j] in self.THIS_CONVERT)
-    if self.A[j-1] in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL) and self.A[j] in (self.THIS_SPEECH_THAT_NOISE + self.THIS_SPEECH_THAT_SIL):
-      return 0
-    if self.A[j-1] in self.THIS_SPEECH and self.A[j] in self.THIS_SPEECH:
-      return 1
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_CONVERT_THAT_SIL + self.THIS_NOISE_CONVERT_THAT_NOISE) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_CONVERT_THAT_SIL + self.THIS_NOISE_CONVERT_THAT_NOISE):
-      return 2
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_CONVERT) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_CONVERT):
-      return 3
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_NOISE_CONVERT + self.THIS_SIL_CONVERT_THAT_SIL + self.THIS_SIL_CONVERT_THAT_NOISE) and self.A[j] in (self.THIS_SPEECH + self.THIS_NOISE_CONVERT + self.THIS_SIL_CONVERT_THAT_SIL + self.THIS_SIL_CONVERT_THAT_NOISE):
-      return 4
-    if self.A[j-1] in (self.THIS_SPEECH + self.THIS_CONVERT) and self.A[j] in (self.THIS_SPEECH + self.THIS_CONVERT):
-      return 5
-    if self.A[j-1] in self.THIS_SPEECH_PLUS and self.A[j] in (self.THIS_SPEECH_PLUS + self.THIS_NOISE):
-      return 6
-    if self.A[j-1] in self.THIS_SPEECH_PLUS and self.A[j] in (self.THIS_SPEECH_PLUS + self.THIS_SILENCE):
-      return 7
-    if self.A[j-1] in (self.THIS_SPEECH_PLUS + self.THIS_NOISE) and self.A[j] in self.THIS_SPEECH_PLUS:
-      return 8
-    if self.A[j-1] in (self.THIS_SPEECH_PLUS + self.THIS_SILENCE) and self.A[j] in self.THIS_SPEECH_PLUS:
-      return 9
-    assert (False)
-
   # Output the final segments
   def print_segments(self, out_file_handle = sys.stdout):
     # We also do some sanity checking here.
-    segments = []
-
     assert (self.N == len(self.S))
     assert (self.N + 1 == len(self.E))
 
-    max_end_time = 0
-    n = 0
-    while n < self.N:
-      if self.E[n] and not self.S[n]:
-        sys.stderr.write("%s: Error: Ending segment before starting it: n=%d\n" % (sys.argv[0], n))
-      if self.S[n]:
-        p = n + 1
-        while p < self.N and not self.E[p]:
-          assert (not self.S[p])
-          p += 1
-        assert (p == self.N or self.E[p])
-        segments.append((n,p))
-        max_end_time = p
-        if p < self.N and self.S[p]:
-          n = p - 1
-        else:
-          n = p
-      n += 1
+    # A segment ends at the first end marker after its start or at the
+    # end of the file.
+    segment_starts = np.flatnonzero(self.S)
+    segment_ends = np.flatnonzero(self.E[0:self.N])
+    i = np.searchsorted(segment_ends, segment_starts, side = 'right')
+    segment_ends = np.append(segment_ends, self.N)[i]
+    assert (np.all(segment_starts[1:] >= segment_ends[:-1]))
 
+    for n in np.setdiff1d(np.flatnonzero(self.E[0:self.N] & ~self.S), segment_ends).tolist():
+      sys.stderr.write("%s: Error: Ending segment before starting it: n=%d\n" % (sys.argv[0], n))
+
+    segments = list(zip(segment_starts.tolist(), segment_ends.tolist()))
     if len(segments) == 0:
       sys.stderr.write("%s: Warning: no segments for recording %s\n" % (sys.argv[0], self.file_id))
       sys.exit(1)
+    max_end_time = segments[-1][1]
 
     ############################################################################
     # Analysis section
 
-    self.C = ["0"] * self.N
-    C = self.C
     a = Analysis(self.file_id, self.frame_shift,"Analysis final")
 
-    if self.reference != None:
-      count = 0
-      in_seg = False
-      for i in range(0,self.N):
-        if in_seg and self.E[i]:
-          in_seg = False
-        if i == 0 and self.S[i]:
-          in_seg = True
-        if not in_seg and self.S[i]:
-          in_seg = True
-        if   self.reference[i] == "0" and not in_seg:
-          C[i] = "0"
-        elif self.reference[i] == "0" and in_seg:
-          C[i] = "2"
-        elif self.reference[i] == "1" and not in_seg:
-          C[i] = "3"
-        elif self.reference[i] == "1" and in_seg:
-          C[i] = "5"
-        elif self.reference[i] == "2" and not in_seg:
-          C[i] = "6"
-        elif self.reference[i] == "2" and in_seg:
-          C[i] = "8"
-        if i > 0 and C[i-1] != C[i]:
-          a.state_count[int(C[i-1])].append(count)
-          a.markers[int(C[i-1])].append(i - count)
-          a.phones[int(C[i-1])].append(' '.join(set(self.P[i-count:i])))
-          count = 1
-        else:
-          count += 1
-
-      for j in range(0,9):
-        a.confusion_matrix[j] = sum([C[i] == str(j) for i in range(0,self.N)])
+    if self.reference is not None:
+      # A frame is in a segment if the last start or end marker at or
+      # before it is a start marker
+      markers = np.full(self.N, -1, dtype=np.int8)
+      markers[self.E[0:self.N]] = 0
+      markers[self.S] = 1
+      last_marker = np.maximum.accumulate(np.where(markers >= 0, np.arange(self.N), -1))
+      in_seg = (last_marker >= 0) & (markers[last_marker] == 1)
+      C = 3 * self.reference[0:self.N] + np.where(in_seg, 2, 0)
+      add_frame_analysis(a, C, self.P)
 
       if self.options.verbose > 0:
         a.write_confusion_matrix()
@@ -1100,23 +1052,21 @@ class JointResegmenter(object):
 
     # First get the segment start and segment ends
     # Note that they are in sync by construction
-    segment_starts = [i for i in range(0,self.N) if self.S[i]]
-    segment_ends = [i for i in range(0,self.N+1) if self.E[i]]
+    segment_starts = np.flatnonzero(self.S).tolist()
+    segment_ends = np.flatnonzero(self.E).tolist()
+
+    # Cumulative counts of the frames that are silence, noise and speech in
+    # the reference
+    types = np.zeros((self.N + 1, 3), dtype=np.int64)
+    types[1:] = np.cumsum(self.reference[0:self.N,None] == np.arange(3), axis = 0)
 
     D = {}
     for i,st in enumerate(segment_starts):
       en = segment_ends[i]
-      types = {}
-      for val in self.reference[st:en]:
-        # The segment is defined by the indices st:en
-        # Count the number of frames in the segment that
-        # are silence, speech and noise in the reference.
-        types[val] = types.get(val,0) + 1
-      # End for loop over a particular segment
+      # The segment is defined by the indices st:en
       # Make a tuple out of the counts of the types of frames
-      D[st] = (en, types.get("0",0), types.get("1", 0), types.get("2", 0))
+      D[st] = (en,) + tuple((types[en] - types[st]).tolist())
     # End for loop over all segments
-
     a = Analysis(self.file_id, None, title)
     for st, info in D.items():
       en = info[0]
@@ -1185,93 +1135,152 @@ class JointResegmenter(object):
     return a
   # End function segmentation_analysis
 
+# Return the int8 array of the classes (0, 1 or 2) of the phones in the list A
+# and the array of the indexes of the phones in the sorted list of
+# distinct phones
+def get_phone_classes(A, phone_map):
+  phones, index = np.unique(np.array(A, dtype=str), return_inverse=True)
+  classes = np.array([ int(phone_map[p]) for p in phones.tolist() ], dtype=np.int8)
+  return classes[index], index
+
 def map_prediction(A1, A2, phone_map, speech_cap = None, f = None):
-  if A2 == None:
-    B = []
+  if A2 is None:
     # Isolated segmentation
-    prev_x = None
-    len_x = 0
-    i = 0
-    for x in A1:
-      if prev_x == None or x == prev_x:
-        len_x += 1
-      else:
-        assert (len_x > 0)
-        #sys.stderr.write("PHONE_LENGTH %s %d %s %d\n" % (prev_x, len_x, f, i - len_x))
-        if phone_map[prev_x] == "0":
-          B.extend(["0"] * len_x)
-        elif (speech_cap != None and len_x > speech_cap) or phone_map[prev_x] == "1":
-          B.extend(["4"] * len_x)
-        elif phone_map[prev_x] == "2":
-          B.extend(["8"] * len_x)
-        # End if
-        len_x = 1
-      # End if
-      prev_x = x
-      i += 1
-    # End for
     try:
-      assert (len_x > 0)
+      assert (len(A1) > 0)
     except AssertionError as e:
       repr(e)
       sys.stderr.write("In file %s\n" % f)
       sys.exit(1)
 
-    if phone_map[prev_x] == "0":
-      B.extend(["0"] * len_x)
-    elif (speech_cap != None and len_x > speech_cap) or phone_map[prev_x] == "1":
-      B.extend(["4"] * len_x)
-    elif phone_map[prev_x] == "2":
-      B.extend(["8"] * len_x)
-    # End if
-    return B
+    classes, index = get_phone_classes(A1, phone_map)
+    starts, lengths = run_length_encode(index)
+    # The runs of phones of classes 0, 1 and 2 map to 0, 4 and 8, except the
+    # runs of speech longer than speech_cap, which are taken as noise
+    run_classes = 4 * classes[starts]
+    if speech_cap != None:
+      run_classes[(lengths > speech_cap) & (run_classes != 0)] = 4
+    return np.repeat(run_classes, lengths)
   # End if (isolated segmentation)
 
   # Assuming len(A1) > len(A2)
   # Otherwise A1 and A2 must be interchanged before
   # passing to this function
-  B1 = []
-  B2 = []
-  for i in range(0, len(A2)):
-    if phone_map[A1[i]] == "0" and phone_map[A2[i]] == "0":
-      B1.append("0")
-      B2.append("0")
-    if phone_map[A1[i]] == "0" and phone_map[A2[i]] == "1":
-      B1.append("1")
-      B2.append("3")
-    if phone_map[A1[i]] == "0" and phone_map[A2[i]] == "2":
-      B1.append("2")
-      B2.append("6")
-    if phone_map[A1[i]] == "1" and phone_map[A2[i]] == "0":
-      B1.append("3")
-      B2.append("1")
-    if phone_map[A1[i]] == "1" and phone_map[A2[i]] == "1":
-      B1.append("4")
-      B2.append("4")
-    if phone_map[A1[i]] == "1" and phone_map[A2[i]] == "2":
-      B1.append("5")
-      B2.append("7")
-    if phone_map[A1[i]] == "2" and phone_map[A2[i]] == "0":
-      B1.append("6")
-      B2.append("2")
-    if phone_map[A1[i]] == "2" and phone_map[A2[i]] == "1":
-      B1.append("7")
-      B2.append("5")
-    if phone_map[A1[i]] == "2" and phone_map[A2[i]] == "2":
-      B1.append("8")
-      B2.append("8")
-  for i in range(len(A2), len(A1)):
-    if phone_map[A1[i]] == "0":
-      B1.append("0")
-      B2.append("0")
-    if phone_map[A1[i]] == "1":
-      B1.append("3")
-      B2.append("1")
-    if phone_map[A1[i]] == "2":
-      B1.append("6")
-      B2.append("2")
+  classes1, index1 = get_phone_classes(A1, phone_map)
+  classes2, index2 = get_phone_classes(A2, phone_map)
+  # The class of the frame is 3 * (class of this channel) + (class of the
+  # other channel); the other channel is taken to be silence beyond its end
+  B1 = 3 * classes1
+  B2 = classes1.copy()
+  B1[0:len(A2)] += classes2
+  B2[0:len(A2)] += 3 * classes2
   return (B1, B2)
 
+# Read the predicted phones of the file f
+def read_prediction(prediction_dir, f):
+  try:
+    return open(os.path.join(prediction_dir, f+".pred")).readline().strip().split()[1:]
+  except IndexError:
+    sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f))
+    sys.exit(1)
+
+# Read the reference classes of the file f, created by read_rttm_file
+def read_reference(temp_dir, f):
+  if temp_dir == None:
+    return None
+  try:
+    return open(os.path.join(temp_dir, f+".ref")).readline().strip().split()[1:]
+  except IOError:
+    return None
+
+# This sets up the configuration of the resegmentation jobs in the
+# worker processes
+def init_worker(options, phone_map, speech_cap, prediction_dir, temp_dir):
+  global global_config
+  global_config = (options, phone_map, speech_cap, prediction_dir, temp_dir)
+
+# Resegment a file, files = (f,), or a pair of the channel 1 and channel 2
+# files, files = (f1, f2). The segments and the messages that are written to
+# the standard error are returned as strings along with the analyses that are
+# to be added to the global analyses and the exit status, which is not 0
+# if the resegmentation failed.
+def resegment_files(files):
+  global global_analysis_get_initial_segments
+  global global_analysis_set_nonspeech_proportion
+  global global_analysis_final
+  options, phone_map, speech_cap, prediction_dir, temp_dir = global_config
+  saved_analyses = (global_analysis_get_initial_segments,
+      global_analysis_set_nonspeech_proportion, global_analysis_final)
+  global_analysis_get_initial_segments = Analysis("TOTAL_Get_Initial_Segments", options.frame_shift, "Global Analysis after get_initial_segments")
+  global_analysis_set_nonspeech_proportion = Analysis("TOTAL_set_nonspeech_proportion", options.frame_shift, "Global Analysis after set_nonspeech_proportion")
+  global_analysis_final = Analysis("TOTAL_Final", options.frame_shift, "Global Analysis Final")
+  analyses = (global_analysis_get_initial_segments,
+      global_analysis_set_nonspeech_proportion, global_analysis_final)
+  stats = Stats()
+
+  out_file = io.StringIO()
+  stderr = sys.stderr
+  sys.stderr = io.StringIO()
+  status = 0
+  try:
+    if len(files) == 1:
+      f = files[0]
+      A = read_prediction(prediction_dir, f)
+      B = map_prediction(A, None, phone_map, speech_cap, f)
+
+      reference = read_reference(temp_dir, f)
+      r = JointResegmenter(A, B, f, options, phone_map, stats, reference)
+      r.resegment()
+      r.print_segments(out_file)
+    else:
+      f1, f2 = files
+      A1 = read_prediction(prediction_dir, f1)
+      A2 = read_prediction(prediction_dir, f2)
+
+      if len(A1) < len(A2):
+        A3 = A1
+        A1 = A2
+        A2 = A3
+
+        f3 = f1
+        f1 = f2
+        f2 = f3
+      # End if
+
+      if (len(A1) - len(A2)) > options.max_length_diff/options.frame_shift:
+        sys.stderr.write( \
+            "%s: Warning: Lengths of %s and %s differ by more than %f. " \
+            % (sys.argv[0], f1,f2, options.max_length_diff) \
+            + "So using isolated resegmentation\n")
+        B1 = map_prediction(A1, None, phone_map, speech_cap)
+        B2 = map_prediction(A2, None, phone_map, speech_cap)
+      else:
+        B1,B2 = map_prediction(A1, A2, phone_map, speech_cap)
+      # End if
+
+      reference1 = read_reference(temp_dir, f1)
+      r1 = JointResegmenter(A1, B1, f1, options, phone_map, stats, reference1)
+      r1.resegment()
+      r1.print_segments(out_file)
+
+      reference2 = read_reference(temp_dir, f2)
+      r2 = JointResegmenter(A1, B2, f2, options, phone_map, stats, reference2)
+      r2.resegment()
+      r2.restrict(len(A2))
+      r2.print_segments(out_file)
+    # End if
+  except SystemExit as e:
+    status = e.code
+  except Exception:
+    sys.stderr.write(traceback.format_exc())
+    status = 1
+  finally:
+    log = sys.stderr.getvalue()
+    sys.stderr = stderr
+    (global_analysis_get_initial_segments,
+        global_analysis_set_nonspeech_proportion,
+        global_analysis_final) = saved_analyses
+  return (out_file.getvalue(), log, analyses, status)
 def main():
   parser = ArgumentParser(description='Get segmentation arguments')
   parser.add_argument('--verbose', type=int, \
@@ -1321,6 +1330,10 @@ def main():
   parser.add_argument('--speech-cap-length', type=float, default=None, \
       help="Maximum length in seconds of a particular speech phone prediction." \
       + "\nAny length above this will be considered as noise")
+  parser.add_argument('--num-jobs', type=int, \
+      dest='num_jobs', default=1, \
+      help="Number of processes over which the files (or the pairs of channel 1 " \
+      + "and channel 2 files for joint segmentation) are distributed (default: %(default)s)")
   parser.add_argument('prediction_dir', \
       help='Directory where the predicted phones (.pred files) are found')
   parser.add_argument('phone_map', \
@@ -1373,8 +1386,6 @@ def main():
   else:
     temp_dir = None
 
-  stats = Stats()
-
   pred_files = dict([ (f.split('/')[-1][0:-5], False) \
     for f in glob.glob(os.path.join(prediction_dir, "*.pred")) ])
 
@@ -1392,14 +1403,18 @@ def main():
     speech_cap = int(options.speech_cap_length/options.frame_shift)
   # End if
 
+
+  # Get the list of files and pairs of files to be resegmented
+  jobs = []
+  unmatched_file = None
   for f in pred_files:
     if pred_files[f]:
       continue
     if re.match(".*_"+channel1_file, f) is None:
       if re.match(".*_"+channel2_file, f) is None:
-        sys.stderr.write("%s does not match pattern .*_%s or .*_%s\n" \
-            % (f,channel1_file, channel2_file))
-        sys.exit(1)
+        # This is an error after the files before it are resegmented
+        unmatched_file = f
+        break
       else:
         f1 = f
         f2 = f
@@ -1411,86 +1426,48 @@ def main():
 
     if options.isolated_resegmentation or f2 not in pred_files or f1 not in pred_files:
       pred_files[f] = True
-      try:
-        A = open(os.path.join(prediction_dir, f+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f))
-        sys.exit(1)
-
-      B = map_prediction(A, None, phone_map, speech_cap, f)
-
-      if temp_dir != None:
-        try:
-          reference = open(os.path.join(temp_dir, f+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference = None
-      else:
-        reference = None
-      r = JointResegmenter(A, B, f, options, phone_map, stats, reference)
-      r.resegment()
-      r.print_segments(out_file)
+      jobs.append((f,))
     else:
       if pred_files[f1] and pred_files[f2]:
         continue
       pred_files[f1] = True
       pred_files[f2] = True
-      try:
-        A1 = open(os.path.join(prediction_dir, f1+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f1))
-        sys.exit(1)
-      try:
-        A2 = open(os.path.join(prediction_dir, f2+".pred")).readline().strip().split()[1:]
-      except IndexError:
-        sys.stderr.write("Incorrect format of file %s/%s.pred\n" % (prediction_dir, f2))
-        sys.exit(1)
-
-      if len(A1) < len(A2):
-        A3 = A1
-        A1 = A2
-        A2 = A3
-
-        f3 = f1
-        f1 = f2
-        f2 = f3
-      # End if
-
-      if (len(A1) - len(A2)) > options.max_length_diff/options.frame_shift:
-        sys.stderr.write( \
-            "%s: Warning: Lengths of %s and %s differ by more than %f. " \
-            % (sys.argv[0], f1,f2, options.max_length_diff) \
-            + "So using isolated resegmentation\n")
-        B1 = map_prediction(A1, None, phone_map, speech_cap)
-        B2 = map_prediction(A2, None, phone_map, speech_cap)
-      else:
-        B1,B2 = map_prediction(A1, A2, phone_map, speech_cap)
-      # End if
-
-      if temp_dir != None:
-        try:
-          reference1 = open(os.path.join(temp_dir, f1+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference1 = None
-      else:
-        reference1 = None
-      r1 = JointResegmenter(A1, B1, f1, options, phone_map, stats, reference1)
-      r1.resegment()
-      r1.print_segments(out_file)
-
-      if temp_dir != None:
-        try:
-          reference2 = open(os.path.join(temp_dir, f2+".ref")).readline().strip().split()[1:]
-        except IOError:
-          reference2= None
-      else:
-        reference2 = None
-      r2 = JointResegmenter(A1, B2, f2, options, phone_map, stats, reference2)
-      r2.resegment()
-      r2.restrict(len(A2))
-      r2.print_segments(out_file)
+      jobs.append((f1, f2))
     # End if
   # End for loop over files
 
+  def write_result(result):
+    segments, log, analyses, status = result
+    sys.stderr.write(log)
+    out_file.write(segments)
+    global_analysis_get_initial_segments.add(analyses[0])
+    global_analysis_set_nonspeech_proportion.add(analyses[1])
+    global_analysis_final.add(analyses[2])
+    if status != 0:
+      sys.exit(status)
+
+  config = (options, phone_map, speech_cap, prediction_dir, temp_dir)
+  if options.num_jobs > 1:
+    # The results are written in the order of the files. At most
+    # 2 * num_jobs results are kept in memory.
+    with Pool(options.num_jobs, initializer = init_worker, initargs = config) as pool:
+      pending = deque()
+      for files in jobs:
+        pending.append(pool.apply_async(resegment_files, (files,)))
+        if len(pending) >= 2 * options.num_jobs:
+          write_result(pending.popleft().get())
+      while pending:
+        write_result(pending.popleft().get())
+  else:
+    init_worker(*config)
+    for files in jobs:
+      write_result(resegment_files(files))
+
+  if unmatched_file != None:
+    sys.stderr.write("%s does not match pattern .*_%s or .*_%s\n" \
+        % (unmatched_file, channel1_file, channel2_file))
+    sys.exit(1)
+
   if options.reference_rttm != None:
     global_analysis_get_initial_segments.write_confusion_matrix(True)
     global_analysis_get_initial_segments.write_total_stats(True)
@@ -1506,4 +1483,3 @@ if __name__ == '__main__':
   with Timer() as t:
     main()
   sys.stderr.write("\nSegmentation done!\nTook %f sec\n" % t.interval)
-
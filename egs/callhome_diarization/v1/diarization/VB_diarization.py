@@ -154,8 +154,6 @@ def VB_diarization(X, m, invSigma, w, V, pi=None, gamma=None,
     Li[-1] += [DER(downsampler.T.dot(gamma), ref), DER(downsampler.T.dot(gamma), ref, xentropy=True)]
 
   ln_p = np.zeros_like(gamma)
-  tr = np.eye(minDur*maxSpeakers, k=1)
-  ip = np.zeros(minDur*maxSpeakers)
   for ii in range(maxIters):
     ELBO = 0                                                                   # objective function (11) (i.e. VB lower-bound on the evidence)
     sum_gamma_zeta =   zeta.T.dot(gamma).T                                     # corresponds to the last sum in eq. (26) for all 's'
@@ -167,17 +165,15 @@ def VB_diarization(X, m, invSigma, w, V, pi=None, gamma=None,
         ln_p[:,sid] = Fa * (G + rho.dot(a) - 0.5 * zeta.dot(mixture_sum.dot(((invL+np.outer(a,a)).astype(V.dtype).dot(V) * (invSigma.flat * V)).sum(0)))) #eq. (23)
         ELBO += Fb* 0.5 * (logdet(invL) - np.sum(np.diag(invL) + a**2, 0) + R)
 
-    # Construct transition probability matrix with linear chain of 'minDur'
-    # states for each of 'maxSpeaker' speaker. The last state in each chain has
-    # self-loop probability 'loopProb' and the transition probabilities to the
-    # initial chain states given by vector '(1-loopProb) * pi'. From all other,
-    # states, one must move to the next state in the chain with probability one.
-    tr[minDur-1::minDur,0::minDur]=(1-loopProb)*pi
-    tr[(np.arange(1,maxSpeakers+1)*minDur-1,)*2] += loopProb
-    ip[::minDur]=pi
+    # The HMM has a linear chain of 'minDur' states for each of 'maxSpeaker'
+    # speakers. The last state in each chain has self-loop probability 'loopProb'
+    # and the transition probabilities to the initial chain states given by
+    # vector '(1-loopProb) * pi'. From all other states, one must move to the
+    # next state in the chain with probability one. forward_backward_chain
+    # exploits this structure, see forward_backward for the general version.
     # per-frame HMM state posteriors. Note that we can have linear chain of minDur states
     # for each speaker.
-    gamma, tll, lf, lb = forward_backward(ln_p.repeat(minDur,axis=1), tr, ip) #, np.arange(1,maxSpeakers+1)*minDur-1)
+    gamma, tll, lf, lb = forward_backward_chain(ln_p.repeat(minDur,axis=1), pi, loopProb, minDur)
 
     # Right after updating q(Z), tll is E{log p(X|,Y,Z)} - KL{q(Z)||p(Z)}.
     # ELBO now contains -KL{q(Y)||p(Y)}. Therefore, ELBO+ttl is correct value for ELBO.
@@ -348,4 +344,90 @@ def forward_backward(lls, tr, ip):
 
     tll = logsumexp(lfw[-1])
     sp = np.exp(lfw + lbw - tll)
-    return sp, tll, lfw, lbw
\ No newline at end of file
+    return sp, tll, lfw, lbw
+
+
+def forward_backward_chain(lls, pi, loopProb, minDur):
+    """
+    Same as forward_backward for the HMM used in VB_diarization, i.e. with
+    transition matrix 'tr' and initial state probabilities 'ip' given by:
+        tr = np.eye(minDur*S, k=1)
+        tr[minDur-1::minDur,0::minDur] = (1-loopProb)*pi
+        tr[(np.arange(1,S+1)*minDur-1,)*2] += loopProb
+        ip[::minDur] = pi
+    The structure of 'tr' is used so that each frame takes O(S*minDur)
+    instead of O((S*minDur)**2) operations.
+    Inputs:
+        lls      - matrix of per-frame log HMM state output probabilities
+        pi       - vector of S speaker prior probabilities
+        loopProb - probability of not switching speakers between frames
+        minDur   - number of states in the chain of each speaker
+    Outputs:
+        same as forward_backward
+    """
+    sp, tll, lfw, lbw = forward_backward_chain_batch([lls], [pi], loopProb, minDur)
+    return sp[0], tll[0], lfw[0], lbw[0]
+
+
+def forward_backward_chain_batch(lls, pi, loopProb, minDur):
+    """
+    Runs forward_backward_chain for several recordings at once.
+    Inputs:
+        lls      - list of B matrices of per-frame log HMM state output
+                   probabilities (the numbers of frames may differ)
+        pi       - list of B vectors of speaker prior probabilities
+        loopProb - probability of not switching speakers between frames
+        minDur   - number of states in the chain of each speaker
+    Outputs:
+        lists of B elements of sp, tll, lfw, lbw as in forward_backward
+    """
+    lengths = np.array([len(x) for x in lls])
+    B, T, N = len(lls), lengths.max(), lls[0].shape[1]
+    S = N // minDur
+    # Pad all recordings to T frames. The frames beyond the end of a recording
+    # do not affect its forward probabilities and its backward probabilities
+    # are reset at its last frame.
+    lls_pad = np.zeros((B, T, N))
+    for b in range(B):
+        lls_pad[b, :lengths[b]] = lls[b]
+
+    with np.errstate(divide='ignore'):
+        lpi = np.log(np.array(pi))
+        lswitch = np.log(1-loopProb) + lpi   # B x S, log prob. of switching to each speaker
+        lloop = np.log(loopProb)
+
+    # forward and backward probabilities viewed as B x T x S x minDur
+    lfw = np.empty((B, T, S, minDur))
+    lbw = np.empty((B, T, S, minDur))
+    lls_pad = lls_pad.reshape(B, T, S, minDur)
+
+    lfw[:, 0] = -np.inf
+    lfw[:, 0, :, 0] = lpi
+    lfw[:, 0] += lls_pad[:, 0]
+    for ii in range(1, T):
+        prev, cur = lfw[:, ii-1], lfw[:, ii]
+        cur[:, :, 1:] = prev[:, :, :-1]
+        cur[:, :, 0] = lswitch + np.logaddexp.reduce(prev[:, :, -1], axis=1)[:, np.newaxis]
+        np.logaddexp(cur[:, :, -1], lloop + prev[:, :, -1], out=cur[:, :, -1])
+        cur += lls_pad[:, ii]
+
+    lbw[:, -1] = 0.0
+    for ii in reversed(range(T-1)):
+        nxt, cur = lls_pad[:, ii+1] + lbw[:, ii+1], lbw[:, ii]
+        cur[:, :, :-1] = nxt[:, :, 1:]
+        cur[:, :, -1] = np.logaddexp.reduce(lswitch + nxt[:, :, 0], axis=1)[:, np.newaxis]
+        np.logaddexp(cur[:, :, -1], lloop + nxt[:, :, -1], out=cur[:, :, -1])
+        ended = ii >= lengths-1
+        if ended.any():
+            cur[ended] = 0.0
+
+    lfw = lfw.reshape(B, T, N)
+    lbw = lbw.reshape(B, T, N)
+    sp, tll, lfw_out, lbw_out = [], [], [], []
+    for b in range(B):
+        tll_b = logsumexp(lfw[b, lengths[b]-1])
+        lfw_out.append(lfw[b, :lengths[b]])
+        lbw_out.append(lbw[b, :lengths[b]])
+        sp.append(np.exp(lfw_out[-1] + lbw_out[-1] - tll_b))
+        tll.append(tll_b)
+    return sp, tll, lfw_out, lbw_out
@@ -6,15 +6,25 @@
 # inputs for the VB system and creates the output RTTM file. The inputs include data directory
 # (data_dir), the rttm file to initialize the VB system(init_rttm_filename), the directory to
 # output the rttm prediction(output_dir), path to diagonal UBM model(dubm_model) and path to 
-# i-vector extractor model(ie_model).
+# i-vector extractor model(ie_model). The recordings can be processed in parallel
+# by several processes (--num-processes), which share the UBM and i-vector
+# extractor parameters.
 
 import os
 import numpy as np
+from multiprocessing import Pool
 import VB_diarization
 import kaldi_io
 import argparse
 from convert_VB_model import load_dubm, load_ivector_extractor 
 
+# Globals of the worker processes, set by init_worker().
+_args = None
+_model = None
+_utt2num_frames = None
+_rttm_index = None
+_feats_dict = None
+
 def get_utt_list(utt2spk_filename):
     with open(utt2spk_filename, 'r') as fh:
         content = fh.readlines()
@@ -44,42 +54,52 @@ def get_utt2feats(utt2feats_filename):
         utt2feats[line_split[0]] = line_split[1]
     return utt2feats
 
-def create_ref(uttname, utt2num_frames, full_rttm_filename):
+# Read the rttm file once and group its segments by recording.
+# Returns a dictionary: recording -> list of (start_frame, end_frame, spkname),
+# with the segments of each recording in file order.
+def get_rttm_index(rttm_filename):
+    rttm_index = {}
+    with open(rttm_filename, 'r') as fh:
+        for line in fh:
+            line_split = line.split()
+            start_time, duration = int(float(line_split[3]) * 100), int(float(line_split[4]) * 100)
+            rttm_index.setdefault(line_split[1], []).append(
+                (start_time, start_time + duration, line_split[7]))
+    return rttm_index
+
+def create_ref(uttname, utt2num_frames, rttm_index):
     num_frames = utt2num_frames[uttname]
+    segments = rttm_index.get(uttname, [])
 
     # We use 0 to denote silence frames and 1 to denote overlapping frames.
-    ref = np.zeros(num_frames)
+    # Speakers are numbered from 2 in the order of their first segment.
     speaker_dict = {}
-    num_spk = 0
+    for _, _, spkname in segments:
+        speaker_dict.setdefault(spkname, len(speaker_dict) + 2)
+    if len(segments) == 0:
+        return np.zeros(num_frames, dtype=int)
 
-    with open(full_rttm_filename, 'r') as fh:
-        content = fh.readlines()
-    for line in content:
-        line = line.strip('\n')
-        line_split = line.split()
-        uttname_line = line_split[1]
-        if uttname != uttname_line:
-            continue
-        start_time, duration = int(float(line_split[3]) * 100), int(float(line_split[4]) * 100)
-        end_time = start_time + duration
-        spkname = line_split[7]
-        if spkname not in speaker_dict.keys():
-            spk_idx = num_spk + 2
-            speaker_dict[spkname] = spk_idx
-            num_spk += 1
-        
-        for i in range(start_time, end_time):
-            if i < 0:
-                raise ValueError("Time index less than 0")
-            elif i >= num_frames:
-                print("Time index exceeds number of frames")
-                break
-            else:
-                if ref[i] == 0:
-                    ref[i] = speaker_dict[spkname] 
-                else:
-                    ref[i] = 1 # The overlapping speech is marked as 1.
-    return ref.astype(int)
+    start_time = np.array([seg[0] for seg in segments], dtype=np.int64)
+    end_time = np.array([seg[1] for seg in segments], dtype=np.int64)
+    spk_idx = np.array([speaker_dict[seg[2]] for seg in segments], dtype=np.int64)
+    nonempty = start_time < end_time
+    if np.any(start_time[nonempty] < 0):
+        raise ValueError("Time index less than 0")
+    for _ in range(np.count_nonzero(nonempty & (end_time > num_frames))):
+        print("Time index exceeds number of frames")
+    start_time = np.minimum(start_time[nonempty], num_frames)
+    end_time = np.minimum(end_time[nonempty], num_frames)
+    spk_idx = spk_idx[nonempty]
+
+    # Count the segments covering each frame and sum their speaker indexes;
+    # where exactly one segment covers a frame, the sum is its speaker index.
+    num_segs = np.cumsum(np.bincount(start_time, minlength=num_frames + 1)
+                         - np.bincount(end_time, minlength=num_frames + 1))[:num_frames]
+    spk_sum = np.cumsum(np.bincount(start_time, weights=spk_idx, minlength=num_frames + 1)
+                        - np.bincount(end_time, weights=spk_idx, minlength=num_frames + 1))[:num_frames]
+    ref = np.where(num_segs == 1, np.rint(spk_sum).astype(int), 0)
+    ref[num_segs > 1] = 1 # The overlapping speech is marked as 1.
+    return ref
 
 # create output rttm file
 def create_rttm_output(uttname, predicted_label, output_dir, channel):
@@ -109,6 +129,70 @@ def create_rttm_output(uttname, predicted_label, output_dir, channel):
             fh.write("SPEAKER {} {} {:.2f} {:.2f} <NA> <NA> {} <NA> <NA>\n".format(uttname, channel, start_frame / 100.0, duration / 100.0, label))
     return 0
 
+def init_worker(args, model, utt2num_frames, rttm_index, feats_dict):
+    global _args, _model, _utt2num_frames, _rttm_index, _feats_dict
+    _args = args
+    _model = model
+    _utt2num_frames = utt2num_frames
+    _rttm_index = rttm_index
+    _feats_dict = feats_dict
+
+# Run VB resegmentation on one recording and write its output rttm file
+# (and Q-matrix if --save-posterior is set).
+def resegment_utt(utt):
+    args = _args
+    m, iE, w, V, VtinvSigmaV = _model
+
+    # Get the alignments from the clustering result.
+    # In init_ref, 0 denotes the silence silence frames
+    # 1 denotes the overlapping speech frames, the speaker
+    # label starts from 2.
+    init_ref = create_ref(utt, _utt2num_frames, _rttm_index)
+
+    # load MFCC features
+    X = kaldi_io.read_mat(_feats_dict[utt]).astype(np.float64)
+    assert len(init_ref) == len(X)
+
+    # Keep only the voiced frames (0 denotes the silence 
+    # frames, 1 denotes the overlapping speech frames).
+    mask = (init_ref >= 2)
+    X_voiced = X[mask]
+    init_ref_voiced = init_ref[mask] - 2
+
+    if X_voiced.shape[0] == 0:
+        print("Warning: {} has no voiced frames in the initialization file".format(utt))
+        return
+
+    # Initialize the posterior of each speaker based on the clustering result.
+    if args.initialize:
+        q = VB_diarization.frame_labels2posterior_mx(init_ref_voiced, args.max_speakers)
+    else:
+        q = None
+    
+    # VB resegmentation
+
+    # q  - S x T matrix of posteriors attribution each frame to one of S possible
+    #      speakers, where S is given by opts.maxSpeakers
+    # sp - S dimensional column vector of ML learned speaker priors. Ideally, these
+    #      should allow to estimate # of speaker in the utterance as the
+    #      probabilities of the redundant speaker should converge to zero.
+    # Li - values of auxiliary function (and DER and frame cross-entropy between q
+    #      and reference if 'ref' is provided) over iterations.
+    q_out, sp_out, L_out = VB_diarization.VB_diarization(X_voiced, m, iE, w, V, pi=None, gamma=q, maxSpeakers=args.max_speakers, 
+                            maxIters=args.max_iters, VtinvSigmaV=VtinvSigmaV, downsample=args.downsample, alphaQInit=args.alphaQInit, 
+                            sparsityThr=args.sparsityThr, epsilon=args.epsilon, minDur=args.minDur, loopProb=args.loopProb, 
+                            statScale=args.statScale, llScale=args.llScale, ref=None, plot=False)
+    predicted_label_voiced = np.argmax(q_out, 1) + 2
+    predicted_label = (np.zeros(len(mask))).astype(int)
+    predicted_label[mask] = predicted_label_voiced
+
+    # Create the output rttm file
+    create_rttm_output(utt, predicted_label, args.output_dir, args.channel)
+    # Save Q-matrix.
+    if args.save_posterior:
+        with open(os.path.join(args.output_dir, '{}_q_out.npy'.format(utt)), 'wb') as f:
+            np.save(f, q_out)
+
 def main():
     parser = argparse.ArgumentParser(description='VB Resegmentation Wrapper')
     parser.add_argument('data_dir', type=str, help='Subset data directory')
@@ -148,6 +232,8 @@ def main():
                         help='Whether to initalize the speaker posterior')
     parser.add_argument('--save-posterior', action='store_true', help='Saves Q-matrix \
                         (can be used for overlap assignment)')
+    parser.add_argument('--num-processes', type=int, default=1,
+                        help='Number of recordings to process in parallel (default: 1)')
 
     args = parser.parse_args()
     print(args)
@@ -169,60 +255,26 @@ def main():
     iE = DUBM_INV_VARS
     w = DUBM_WEIGHTS
     V = IE_M
+    # VtinvSigmaV only depends on the model, so compute it once for all recordings.
+    VtinvSigmaV = VB_diarization.precalculate_VtinvSigmaV(V, iE)
+    model = (m, iE, w, V, VtinvSigmaV)
 
     # Load the MFCC features
     feats_dict = get_utt2feats("{}/feats.scp".format(args.data_dir))
 
-    for utt in utt_list:
-        # Get the alignments from the clustering result.
-        # In init_ref, 0 denotes the silence silence frames
-        # 1 denotes the overlapping speech frames, the speaker
-        # label starts from 2.
-        init_ref = create_ref(utt, utt2num_frames, args.init_rttm_filename)
-
-        # load MFCC features
-        X = kaldi_io.read_mat(feats_dict[utt]).astype(np.float64)
-        assert len(init_ref) == len(X)
-
-        # Keep only the voiced frames (0 denotes the silence 
-        # frames, 1 denotes the overlapping speech frames).
-        mask = (init_ref >= 2)
-        X_voiced = X[mask]
-        init_ref_voiced = init_ref[mask] - 2
-
-        if X_voiced.shape[0] == 0:
-            print("Warning: {} has no voiced frames in the initialization file".format(utt))
-            continue
+    # Read the initialization rttm file once for all recordings.
+    rttm_index = get_rttm_index(args.init_rttm_filename)
 
-        # Initialize the posterior of each speaker based on the clustering result.
-        if args.initialize:
-            q = VB_diarization.frame_labels2posterior_mx(init_ref_voiced, args.max_speakers)
-        else:
-            q = None
-        
-        # VB resegmentation
-
-        # q  - S x T matrix of posteriors attribution each frame to one of S possible
-        #      speakers, where S is given by opts.maxSpeakers
-        # sp - S dimensional column vector of ML learned speaker priors. Ideally, these
-        #      should allow to estimate # of speaker in the utterance as the
-        #      probabilities of the redundant speaker should converge to zero.
-        # Li - values of auxiliary function (and DER and frame cross-entropy between q
-        #      and reference if 'ref' is provided) over iterations.
-        q_out, sp_out, L_out = VB_diarization.VB_diarization(X_voiced, m, iE, w, V, pi=None, gamma=q, maxSpeakers=args.max_speakers, 
-                                maxIters=args.max_iters, VtinvSigmaV=None, downsample=args.downsample, alphaQInit=args.alphaQInit, 
-                                sparsityThr=args.sparsityThr, epsilon=args.epsilon, minDur=args.minDur, loopProb=args.loopProb, 
-                                statScale=args.statScale, llScale=args.llScale, ref=None, plot=False)
-        predicted_label_voiced = np.argmax(q_out, 1) + 2
-        predicted_label = (np.zeros(len(mask))).astype(int)
-        predicted_label[mask] = predicted_label_voiced
-
-        # Create the output rttm file
-        create_rttm_output(utt, predicted_label, args.output_dir, args.channel)
-        # Save Q-matrix.
-        if args.save_posterior:
-            with open(os.path.join(args.output_dir, '{}_q_out.npy'.format(utt)), 'wb') as f:
-                np.save(f, q_out)
+    init_args = (args, model, utt2num_frames, rttm_index, feats_dict)
+    if args.num_processes > 1 and len(utt_list) > 1:
+        with Pool(min(args.num_processes, len(utt_list)), initializer=init_worker,
+                  initargs=init_args) as pool:
+            for _ in pool.imap_unordered(resegment_utt, utt_list):
+                pass
+    else:
+        init_worker(*init_args)
+        for utt in utt_list:
+            resegment_utt(utt)
     return 0
 
 if __name__ == "__main__":
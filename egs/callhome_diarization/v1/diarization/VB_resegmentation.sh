@@ -8,6 +8,7 @@
 
 # Begin configuration section.
 nj=20
+num_processes=1
 cmd=run.pl
 stage=0
 max_speakers=10
@@ -41,6 +42,8 @@ if [ $# != 5 ]; then
   echo "Options: "
   echo "  --cmd (utils/run.pl|utils/queue.pl <queue opts>) # How to run jobs."
   echo "  --nj <num-jobs|20>                               # Number of parallel jobs to run."
+  echo "  --num-processes <n|1>                            # Number of recordings each job"
+  echo "                                                   # processes in parallel"
   echo "  --max-speakers <n|10>                            # Maximum number of speakers" 
   echo "                                                   # expected in the utterance" 
   echo "					           # (default: 10)"
@@ -121,7 +124,7 @@ if [ $stage -le 1 ]; then
       --max-iters $max_iters --downsample $downsample --alphaQInit $alphaQInit \
       --sparsityThr $sparsityThr --epsilon $epsilon --minDur $minDur \
       --loopProb $loopProb --statScale $statScale --llScale $llScale \
-      --channel $channel --initialize $initialize "$save_opts" \
+      --channel $channel --initialize $initialize --num-processes $num_processes "$save_opts" \
       $sdata/JOB $init_rttm_filename $output_dir/tmp $output_dir/tmp/dubm.tmp $output_dir/tmp/ie.tmp || exit 1;
 
   cat $output_dir/tmp/*_predict.rttm > $output_dir/VB_rttm
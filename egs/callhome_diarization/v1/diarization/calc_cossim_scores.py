@@ -8,7 +8,6 @@ import logging
 import sys
 import numpy as np
 import kaldi_io
-from scipy.spatial.distance import cosine, pdist, squareform
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
@@ -30,43 +29,146 @@ def ReadXvecs(rspec):
     return xvecs
 
 def Normalize(xvecs_in):
-    N = len(xvecs_in)
-    xvec_mean=np.zeros(xvecs_in[0].shape)
-    for i in range(N):
-        xvec_mean += xvecs_in[i]
-    xvec_mean /= N
-    xvecs = np.copy(xvecs_in)
-    for i in range(N):
-        xvecs[i] -= xvec_mean
-        xvecs[i] = xvecs[i] / np.linalg.norm(xvecs[i])
+    xvecs = np.array(xvecs_in, dtype=np.float32)
+    xvecs -= xvecs.mean(axis=0, dtype=np.float64)
+    xvecs /= np.linalg.norm(xvecs, axis=1, keepdims=True)
     return xvecs
 
 def CalcCosSim(vecs):
-    return 1 - squareform(pdist(np.asarray(vecs), 'cosine'))
+    vecs = np.asarray(vecs, dtype=np.float32)
+    S = np.empty((len(vecs), len(vecs)), dtype=np.float32)
+    for start, block in ScoreBlocks(CosSimScorer(vecs)):
+        S[start:start+len(block)] = block
+    return S
 
-def WriteDistMatrices(D, wark):
-    with common_lib.smart_open(wark, 'w') as f:
-        for id in sorted(D.keys()):
-            common_lib.write_matrix_ascii(f, D[id].tolist(), key=id)
+#   Scorers. A scorer is a tuple (left, right, bias, unit_diag) such that the score of
+#   the pair (i, j) is left[i].dot(right[j]) + bias[i] + bias[j]; if unit_diag is True
+#   the scores of the pairs (i, i) are set to 1.
+
+# Cosine similarity of vectors which are already normalized (see Normalize)
+def CosSimScorer(xvecs):
+    return (xvecs, xvecs, None, True)
+
+# PLDA log-likelihood ratio, as computed by Plda::LogLikelihoodRatio() for one enrollment
+# vector. The vectors are transformed as by Plda::TransformIvector() with length normalization.
+# plda: tuple (mean, transform, psi) returned by kaldi_io.read_plda
+def PldaScorer(xvecs, plda):
+    mean, transform, psi = plda
+    X = (np.asarray(xvecs, dtype=np.float64) - mean).dot(np.transpose(transform))
+    X *= np.sqrt(X.shape[1] / (X**2).dot(1.0 / (psi + 1.0)))[:, np.newaxis]
+    # given the class of the enrollment vector x the test vector y is distributed
+    # with mean a*x and variance var_given; otherwise its variance is var_without.
+    a = psi / (psi + 1.0)
+    var_given = 1.0 + a
+    var_without = 1.0 + psi
+    left = X * (a / var_given)
+    bias = -0.5 * (X**2).dot(a**2 / var_given) + 0.25 * np.sum(np.log(var_without) - np.log(var_given))
+    return (left.astype(np.float32), X.astype(np.float32), bias.astype(np.float32), False)
+
+# Yields the score matrix as blocks of 'block_size' rows: pairs (first row, block)
+def ScoreBlocks(scorer, block_size=4096):
+    left, right, bias, unit_diag = scorer
+    N = len(right)
+    for start in range(0, N, block_size):
+        end = min(start + block_size, N)
+        block = left[start:end].dot(right.T)
+        if bias is not None:
+            block += bias[start:end, np.newaxis]
+            block += bias[np.newaxis, :]
+        if unit_diag:
+            block[np.arange(end - start), np.arange(start, end)] = 1.0
+        yield start, block
+
+# Returns indices and scores of the k best scoring neighbors of every row sorted by
+# decreasing score, as two N x k matrices
+def TopKNeighbors(scorer, k, block_size=4096):
+    N = len(scorer[1])
+    k = min(k, N)
+    indices = np.empty((N, k), dtype=np.int32)
+    values = np.empty((N, k), dtype=np.float32)
+    for start, block in ScoreBlocks(scorer, block_size):
+        idx = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        val = np.take_along_axis(block, idx, axis=1)
+        order = np.argsort(-val, axis=1, kind='stable')
+        indices[start:start+len(block)] = np.take_along_axis(idx, order, axis=1)
+        values[start:start+len(block)] = np.take_along_axis(val, order, axis=1)
+    return indices, values
+
+#   Output routines
+
+def OpenOutput(wark, binary):
+    if not binary:
+        return common_lib.smart_open(wark, 'w')
+    if wark == '-' or wark == 'ark:-':
+        return open(sys.stdout.fileno(), 'wb', closefd=False)
+    return kaldi_io.open_or_fd(wark, 'wb')
+
+# Writes a matrix given as blocks of rows (see ScoreBlocks) in Kaldi matrix format
+def WriteMatrixBlocks(f, key, num_rows, num_cols, blocks, binary):
+    if binary:
+        f.write('{} \0BFM \4'.format(key).encode('latin1'))
+        f.write(np.array(num_rows, dtype=np.int32).tobytes())
+        f.write(b'\4')
+        f.write(np.array(num_cols, dtype=np.int32).tobytes())
+        for _, block in blocks:
+            f.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+        return
+    f.write('{0} [\n'.format(key))
+    for start, block in blocks:
+        lines = [' '.join(['{0:f}'.format(x) for x in row]) for row in block.tolist()]
+        if start + len(block) == num_rows:
+            lines[-1] += ' ]'
+        f.write('\n'.join(lines) + '\n')
+
+# Writes the neighbor lists of a recording as a Kaldi Posterior (a list of (index, score)
+# pairs for every row, see kaldi_io.write_post)
+def WriteNeighborLists(f, key, indices, values):
+    N, k = indices.shape
+    rows = np.zeros(N, dtype=[('size', 'i1'), ('len', '<i4'),
+                              ('pairs', [('size_idx', 'i1'), ('idx', '<i4'),
+                                         ('size_post', 'i1'), ('post', '<f4')], (k,))])
+    rows['size'] = 4
+    rows['len'] = k
+    rows['pairs']['size_idx'] = 4
+    rows['pairs']['idx'] = indices
+    rows['pairs']['size_post'] = 4
+    rows['pairs']['post'] = values
+    f.write('{} \0B\4'.format(key).encode('latin1'))
+    f.write(np.array(N, dtype=np.int32).tobytes())
+    f.write(rows.tobytes())
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Usage: calc_cossim_scores.py <reco2utt-rspec> <xvec-rspec> <simmat-wspec>\nComputes matrices of the cosine similarity scores between normalized x-vectors for each recording')
     parser.add_argument('reco2utt', type=str, help='Kaldi-style rspecifier of recording to segments correspondence')
     parser.add_argument('xvec_rspec', type=str, help='Kaldi-style rspecifier of segment xvectors to read')
     parser.add_argument('simmat_wark', type=str, help='Kaldi-style archive of similarity matrices to write')
+    parser.add_argument('--binary', action='store_true', help='Write matrices in binary format')
+    parser.add_argument('--top_k', type=int, default=0, help='If > 0, write only the top_k best scoring neighbors of every segment '
+                        'as a Kaldi Posterior archive (read by spec_clust.py --sparse_scores)')
+    parser.add_argument('--plda', type=str, default='', help='If given, compute PLDA log-likelihood ratios with this PLDA model '
+                        'instead of cosine similarities')
+    parser.add_argument('--block_size', type=int, default=4096, help='Number of rows of the score matrix computed at once')
     args = parser.parse_args()
 
 
-    logging.info('Computing cosine similarity matrix between ivectors')
+    logging.info('Computing {} matrix between ivectors'.format('PLDA score' if args.plda else 'cosine similarity'))
     logging.info('Parameters:')
     logging.info('Reco2Utt rspecifier: {}'.format(args.reco2utt))
     logging.info('Xvectors rspecifier: {}'.format(args.xvec_rspec))
 
     IDs = LoadReco2Utt(args.reco2utt)
     xvecs_all = ReadXvecs(args.xvec_rspec)
-    D = dict()
-    for reco_id in IDs:
-        xvecs = [ xvecs_all[id] for id in IDs[reco_id] ]
-        xvecs = Normalize(xvecs)                              # !!!! Normalize per recording (session) !!!!
-        D[reco_id] = CalcCosSim(xvecs)
-    WriteDistMatrices(D, args.simmat_wark)
+    plda = kaldi_io.read_plda(args.plda) if args.plda else None
+    with OpenOutput(args.simmat_wark, args.binary or args.top_k > 0) as f:
+        for reco_id in sorted(IDs.keys()):
+            xvecs = [ xvecs_all[id] for id in IDs[reco_id] ]
+            if plda is None:
+                scorer = CosSimScorer(Normalize(xvecs))       # !!!! Normalize per recording (session) !!!!
+            else:
+                scorer = PldaScorer(xvecs, plda)
+            if args.top_k > 0:
+                indices, values = TopKNeighbors(scorer, args.top_k, args.block_size)
+                WriteNeighborLists(f, reco_id, indices, values)
+            else:
+                WriteMatrixBlocks(f, reco_id, len(xvecs), len(xvecs),
+                                  ScoreBlocks(scorer, args.block_size), args.binary)
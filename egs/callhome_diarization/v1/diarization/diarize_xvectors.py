@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Apache 2.0.
+
+# This script runs the clustering back-end of the x-vector diarization recipes
+# in a single process, without intermediate files.  For every recording it
+# reads the x-vectors of its subsegments, computes the affinity matrix (cosine
+# similarities or PLDA scores, see calc_cossim_scores.py), clusters it with
+# NME spectral clustering (see spec_clust.py) or agglomerative clustering
+# (average linkage with a score threshold, like agglomerative-cluster),
+# optionally refines the labels with the Bayesian HMM (see vb_hmm_xvector.py)
+# and converts the labels to RTTM (see make_rttm.py).  This replaces
+# score_cossim.sh or score_plda.sh + scluster.sh or cluster.sh
+# [+ vb_hmm_xvector.sh].  The recordings are processed by a pool of
+# processes and written to the RTTM file in sorted order as soon as they are
+# done.  The time spent in every stage is reported at the end.
+#
+# Spectral clustering needs more than --max-neighbors segments to select the
+# number of neighbors, so recordings with fewer segments are clustered with
+# AHC instead.  With cosine scores this uses its own threshold
+# (--fallback-threshold): the x-vectors are normalized with the mean of the
+# recording, so the similarities of N segments of a single speaker average
+# about -1/(N-1) rather than being close to 1, and the AHC --threshold would
+# split short single-speaker recordings into several clusters.
+#
+# e.g.: diarization/diarize_xvectors.py --num-jobs 8 --reco2num-spk data/callhome1/reco2num_spk \
+#         exp/xvectors_callhome1/xvector.scp exp/xvectors_callhome1/segments \
+#         exp/xvectors_callhome1/results/rttm
+
+import sys
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import kaldi_io
+import scipy.cluster.hierarchy
+
+import calc_cossim_scores
+import spec_clust
+import make_rttm
+
+STAGES = ['read', 'score', 'cluster', 'vb', 'rttm']
+
+# Globals of the worker processes, set by init_worker().
+_args = None
+_plda = None
+_xvector_mean = None
+_arks = None
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""Diarizes recordings given the x-vectors of their
+            subsegments: scoring, clustering, optional VB-HMM refinement and
+            RTTM generation in one process.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--cluster-method", type=str, default="spectral",
+                        choices=["spectral", "ahc"],
+                        help="NME spectral clustering or agglomerative clustering")
+    parser.add_argument("--score-type", type=str, default="cosine",
+                        choices=["cosine", "plda"],
+                        help="Affinities: cosine similarities of the mean-normalized "
+                        "x-vectors of the recording or PLDA log-likelihood ratios")
+    parser.add_argument("--plda", type=str, default="",
+                        help="PLDA model, required by --score-type plda and --vb-hmm")
+    parser.add_argument("--reco2num-spk", type=str, default="",
+                        help="File containing mapping of recording ID to number "
+                        "of speakers. If not given, the number of speakers is "
+                        "estimated (spectral) or --threshold is used (ahc)")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="AHC: clusters are merged while their average score "
+                        "is at least this value")
+    parser.add_argument("--fallback-threshold", type=float, default=-0.1,
+                        help="Spectral, cosine scores: recordings with at most "
+                        "--max-neighbors segments are clustered with AHC, merging "
+                        "clusters while their average score is at least this value "
+                        "minus 1/(N-1) for N segments. With --score-type plda, "
+                        "--threshold is used")
+    parser.add_argument("--min-neighbors", type=int, default=3,
+                        help="Spectral: min number of neighbors for affinity matrix thresholding")
+    parser.add_argument("--max-neighbors", type=int, default=20,
+                        help="Spectral: max number of neighbors for affinity matrix thresholding")
+    parser.add_argument("--sparse-min-size", type=int, default=500,
+                        help="Spectral: use sparse affinity matrices for recordings "
+                        "with at least this many segments (0 means never)")
+    parser.add_argument("--vb-hmm", action="store_true",
+                        help="Refine the clustering with the Bayesian HMM")
+    parser.add_argument("--xvector-mean", type=str, default="",
+                        help="VB-HMM: mean subtracted from the x-vectors. If not "
+                        "given, the mean of all the input x-vectors is used "
+                        "(as ivector-subtract-global-mean in vb_hmm_xvector.sh)")
+    parser.add_argument("--init-smoothing", type=float, default=10,
+                        help="VB-HMM: smoothing of the initial hard assignments")
+    parser.add_argument("--loop-prob", type=float, default=0.85,
+                        help="VB-HMM: probability of not switching speakers between frames")
+    parser.add_argument("--fa", type=float, default=0.2,
+                        help="VB-HMM: scale sufficient statistics collected using UBM")
+    parser.add_argument("--fb", type=float, default=1,
+                        help="VB-HMM: speaker regularization coefficient Fb")
+    parser.add_argument("--rttm-channel", type=int, default=0,
+                        help="The value passed into the RTTM channel field.")
+    parser.add_argument("--num-jobs", type=int, default=1,
+                        help="Number of recordings processed in parallel")
+    parser.add_argument("xvector_scp", type=str,
+                        help="Scp file containing x-vectors for all subsegments")
+    parser.add_argument("segments", type=str,
+                        help="Segments file of the subsegments")
+    parser.add_argument("rttm_file", type=str,
+                        help="Output RTTM file")
+    args = parser.parse_args()
+    if (args.vb_hmm or args.score_type == "plda") and args.plda == "":
+        parser.error("--plda is required by --score-type plda and --vb-hmm")
+    return args
+
+def read_scp(scp_file):
+    seg2rxfile = {}
+    with open(scp_file, 'r') as f:
+        for line in f:
+            seg, rxfile = line.strip().split(None, 1)
+            seg2rxfile[seg] = rxfile
+    return seg2rxfile
+
+# Returns a dict: recording -> list of (segment, start, end), in the order of
+# the segments file.
+def read_segments(segments_file):
+    reco2segs = {}
+    with open(segments_file, 'r') as f:
+        for line in f:
+            seg, reco, start, end = line.strip().split()
+            reco2segs.setdefault(reco, []).append((seg, start, end))
+    return reco2segs
+
+def read_reco2num_spk(reco2num_spk_file):
+    reco2num_spk = {}
+    with open(reco2num_spk_file, 'r') as f:
+        for line in f:
+            reco, num_spk = line.strip().split()
+            reco2num_spk[reco] = int(num_spk)
+    return reco2num_spk
+
+def init_worker(args, plda, xvector_mean):
+    global _args, _plda, _xvector_mean, _arks
+    _args = args
+    _plda = plda
+    _xvector_mean = xvector_mean
+    _arks = {}
+
+# Reads the vectors of a list of rxfilenames of the form <ark>:<offset>,
+# keeping the archives open, since the x-vectors of a recording are usually
+# stored next to each other.
+def read_vectors(rxfiles):
+    vectors = []
+    for rxfile in rxfiles:
+        ark, sep, offset = rxfile.rpartition(':')
+        if sep == '' or not offset.isdigit() or ark.endswith('|'):
+            vectors.append(kaldi_io.read_vec_flt(rxfile))
+            continue
+        if ark not in _arks:
+            _arks[ark] = open(ark, 'rb')
+        _arks[ark].seek(int(offset))
+        vectors.append(kaldi_io.read_vec_flt(_arks[ark]))
+    return np.array(vectors)
+
+# Agglomerative clustering of a score matrix with average linkage, like
+# agglomerative-cluster: clusters are merged while their average score is at
+# least 'threshold', or until there are 'num_clusters' clusters if given.
+# Returns labels starting from 1.
+def ahc_cluster(scores, threshold, num_clusters=None):
+    N = scores.shape[0]
+    if N == 1:
+        return np.ones(1, dtype=np.int64)
+    costs = -scores[np.triu_indices(N, 1)].astype(np.float64)
+    # linkage needs nonnegative distances; average linkage is shift invariant
+    shift = costs.min()
+    Z = scipy.cluster.hierarchy.linkage(costs - shift, method='average')
+    if num_clusters is not None:
+        labels = scipy.cluster.hierarchy.fcluster(Z, num_clusters, criterion='maxclust')
+    else:
+        labels = scipy.cluster.hierarchy.fcluster(Z, -threshold - shift, criterion='distance')
+    # number the clusters in the order of their first segment
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse] + 1
+
+# Diarizes one recording. 'task' is a tuple
+# (recording, list of (segment, start, end, xvector rxfilename), number of speakers or None).
+# Returns (recording, number of segments, number of speakers, RTTM segments, dict: stage -> seconds).
+def diarize_recording(task):
+    reco, segs, num_spk = task
+    times = dict.fromkeys(STAGES, 0.0)
+
+    start_time = time.time()
+    xvectors = read_vectors([rxfile for _, _, _, rxfile in segs])
+    times['read'] = time.time() - start_time
+
+    start_time = time.time()
+    if _args.score_type == "cosine":
+        scorer = calc_cossim_scores.CosSimScorer(calc_cossim_scores.Normalize(xvectors))
+    else:
+        scorer = calc_cossim_scores.PldaScorer(xvectors, _plda)
+    scores = np.vstack([block for _, block in calc_cossim_scores.ScoreBlocks(scorer)])
+    times['score'] = time.time() - start_time
+
+    start_time = time.time()
+    if _args.cluster_method == "spectral" and len(segs) > _args.max_neighbors:
+        _, labels = spec_clust.ClusterRecording(
+            (reco, scores, num_spk, _args.min_neighbors, _args.max_neighbors,
+             _args.sparse_min_size))
+        labels = labels + 1
+    elif _args.cluster_method == "spectral":
+        # too few segments to select the number of neighbors; see the top of
+        # this file for the threshold of cosine scores.
+        if _args.score_type == "cosine":
+            threshold = _args.fallback_threshold - 1.0 / max(len(segs) - 1, 1)
+        else:
+            threshold = _args.threshold
+        print("{0}: only {1} segments, using AHC with threshold {2:.3f}".format(
+            reco, len(segs), threshold))
+        labels = ahc_cluster(scores, threshold, num_spk)
+    else:
+        labels = ahc_cluster(scores, _args.threshold, num_spk)
+    times['cluster'] = time.time() - start_time
+
+    if _args.vb_hmm:
+        # imported here, since VB_diarization needs numexpr
+        import vb_hmm_xvector
+        start_time = time.time()
+        seg_ids = [seg for seg, _, _, _ in segs]
+        seg2label = vb_hmm_xvector.vb_hmm(
+            seg_ids, list(labels), list(xvectors - _xvector_mean), _plda[2],
+            _args.init_smoothing, _args.loop_prob, _args.fa, _args.fb)
+        labels = np.array([seg2label[seg] for seg in seg_ids]) + 1
+        times['vb'] = time.time() - start_time
+
+    start_time = time.time()
+    rttm_segs = make_rttm.get_rttm_segments(
+        [(start, end, str(label)) for (_, start, end, _), label in zip(segs, labels)])
+    times['rttm'] = time.time() - start_time
+    return reco, len(segs), len(set(labels)), rttm_segs, times
+
+def main():
+    args = get_args()
+    total_start_time = time.time()
+
+    seg2rxfile = read_scp(args.xvector_scp)
+    reco2segs = read_segments(args.segments)
+    reco2num_spk = read_reco2num_spk(args.reco2num_spk) if args.reco2num_spk else {}
+    plda = kaldi_io.read_plda(args.plda) if args.plda else None
+    xvector_mean = None
+    if args.vb_hmm:
+        if args.xvector_mean:
+            xvector_mean = kaldi_io.read_vec_flt(args.xvector_mean)
+        else:
+            xvector_mean = np.mean([xvector for _, xvector in
+                                    kaldi_io.read_vec_flt_scp(args.xvector_scp)], axis=0)
+
+    tasks = []
+    num_missing = 0
+    for reco in sorted(reco2segs):
+        segs = []
+        for seg, start, end in reco2segs[reco]:
+            if seg not in seg2rxfile:
+                num_missing += 1
+                continue
+            segs.append((seg, start, end, seg2rxfile[seg]))
+        if len(segs) == 0:
+            print("Warning: no x-vectors for recording {0}".format(reco), file=sys.stderr)
+            continue
+        tasks.append((reco, segs, reco2num_spk.get(reco)))
+    if num_missing > 0:
+        print("Warning: {0} segments have no x-vectors".format(num_missing), file=sys.stderr)
+    load_time = time.time() - total_start_time
+
+    init_args = (args, plda, xvector_mean)
+    pool = None
+    if args.num_jobs > 1 and len(tasks) > 1:
+        pool = Pool(min(args.num_jobs, len(tasks)), initializer=init_worker,
+                    initargs=init_args)
+        results = pool.imap(diarize_recording, tasks)
+    else:
+        init_worker(*init_args)
+        results = map(diarize_recording, tasks)
+
+    stage_times = dict.fromkeys(STAGES, 0.0)
+    write_time = 0.0
+    with open(args.rttm_file, 'w', encoding='utf-8') as rttm_writer:
+        for reco, num_segs, num_spk, rttm_segs, times in results:
+            start_time = time.time()
+            make_rttm.write_rttm(rttm_writer, reco, rttm_segs, args.rttm_channel)
+            rttm_writer.flush()
+            write_time += time.time() - start_time
+            for stage in STAGES:
+                stage_times[stage] += times[stage]
+            print("{0}: {1} segments, {2} speakers, {3}".format(
+                reco, num_segs, num_spk,
+                ", ".join("{0} {1:.3f}s".format(stage, times[stage]) for stage in STAGES)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print("Diarized {0} recordings in {1:.3f}s".format(
+        len(tasks), time.time() - total_start_time))
+    print("Time per stage (summed over recordings): load {0:.3f}s, {1}, write {2:.3f}s".format(
+        load_time, ", ".join("{0} {1:.3f}s".format(stage, stage_times[stage]) for stage in STAGES),
+        write_time))
+
+if __name__ == "__main__":
+    main()
@@ -56,6 +56,42 @@ def get_args():
   args = parser.parse_args()
   return args
 
+def get_rttm_segments(segs):
+  """Takes a list of (start, end, label) tuples of strings for the segments
+  of one recording, in the order of the segments file, and returns the flat
+  segmentation in the same form, with contiguous segments of the same label
+  merged."""
+  # Cut up overlapping segments so they are contiguous
+  segs = list(segs)
+  contiguous_segs = []
+  for i in range(len(segs)-1):
+    start, end, label = segs[i]
+    next_start, next_end, next_label = segs[i+1]
+    if float(end) > float(next_start):
+      avg = str((float(next_start) + float(end)) / 2.0)
+      segs[i+1] = (avg, next_end, next_label)
+      contiguous_segs.append((start, avg, label))
+    else:
+      contiguous_segs.append((start, end, label))
+  contiguous_segs.append(segs[-1])
+
+  # Merge contiguous segments of the same label
+  merged_segs = []
+  for i in range(len(contiguous_segs)-1):
+    start, end, label = contiguous_segs[i]
+    next_start, next_end, next_label = contiguous_segs[i+1]
+    if float(end) == float(next_start) and label == next_label:
+      contiguous_segs[i+1] = (start, next_end, next_label)
+    else:
+      merged_segs.append((start, end, label))
+  merged_segs.append(contiguous_segs[-1])
+  return merged_segs
+
+def write_rttm(rttm_writer, reco, segs, rttm_channel):
+  for start, end, label in segs:
+    print("SPEAKER {0} {1} {2:7.3f} {3:7.3f} <NA> <NA> {4} <NA> <NA>".format(
+      reco, rttm_channel, float(start), float(end)-float(start), label), file=rttm_writer)
+
 def main():
   args = get_args()
 
@@ -72,57 +108,14 @@ def main():
     for line in segments_file:
       seg, reco, start, end = line.strip().split()
       try:
-        if reco in reco2segs:
-          reco2segs[reco] = reco2segs[reco] + " " + start + "," + end + "," + seg2label[seg]
-        else:
-          reco2segs[reco] = reco + " " + start + "," + end + "," + seg2label[seg]
+        reco2segs.setdefault(reco, []).append((start, end, seg2label[seg]))
       except KeyError:
         raise RuntimeError("Missing label for segment {0}".format(seg))
 
-  # Cut up overlapping segments so they are contiguous
-  contiguous_segs = []
-  for reco in sorted(reco2segs):
-    segs = reco2segs[reco].strip().split()
-    new_segs = ""
-    for i in range(1, len(segs)-1):
-      start, end, label = segs[i].split(',')
-      next_start, next_end, next_label = segs[i+1].split(',')
-      if float(end) > float(next_start):
-        done = False
-        avg = str((float(next_start) + float(end)) / 2.0)
-        segs[i+1] = ','.join([avg, next_end, next_label])
-        new_segs += " " + start + "," + avg + "," + label
-      else:
-        new_segs += " " + start + "," + end + "," + label
-    start, end, label = segs[-1].split(',')
-    new_segs += " " + start + "," + end + "," + label
-    contiguous_segs.append(reco + new_segs)
-
-  # Merge contiguous segments of the same label
-  merged_segs = []
-  for reco_line in contiguous_segs:
-    segs = reco_line.strip().split()
-    reco = segs[0]
-    new_segs = ""
-    for i in range(1, len(segs)-1):
-      start, end, label = segs[i].split(',')
-      next_start, next_end, next_label = segs[i+1].split(',')
-      if float(end) == float(next_start) and label == next_label:
-        segs[i+1] = ','.join([start, next_end, next_label])
-      else:
-        new_segs += " " + start + "," + end + "," + label
-    start, end, label = segs[-1].split(',')
-    new_segs += " " + start + "," + end + "," + label
-    merged_segs.append(reco + new_segs)
-
   with codecs.open(args.rttm_file, 'w', 'utf-8') as rttm_writer:
-    for reco_line in merged_segs:
-      segs = reco_line.strip().split()
-      reco = segs[0]
-      for i in range(1, len(segs)):
-        start, end, label = segs[i].strip().split(',')
-        print("SPEAKER {0} {1} {2:7.3f} {3:7.3f} <NA> <NA> {4} <NA> <NA>".format(
-          reco, args.rttm_channel, float(start), float(end)-float(start), label), file=rttm_writer)
+    for reco in sorted(reco2segs):
+      write_rttm(rttm_writer, reco, get_rttm_segments(reco2segs[reco]),
+                 args.rttm_channel)
 
 if __name__ == '__main__':
   main()
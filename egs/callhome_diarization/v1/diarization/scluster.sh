@@ -23,6 +23,8 @@ min_neighbors=3 # This is the min "p" value of number of neighbors to start
                 # by default.
 reco2num_spk=
 rttm_affix=
+sparse_scores=false # Set to true if the scores were computed by
+                    # diarization/score_cossim.sh with --top-k.
 
 # End configuration section.
 
@@ -46,6 +48,8 @@ if [ $# != 2 ]; then
   echo "  --reco2num-spk <reco2num-spk-file>               # File containing mapping of recording ID"
   echo "                                                   # to number of speakers. Used instead of threshold"
   echo "                                                   # as stopping criterion if supplied."
+  echo "  --sparse-scores <bool|false>                     # If true, the scores are the top-k neighbor lists"
+  echo "                                                   # written by diarization/score_cossim.sh --top-k"
   echo "  --cleanup <bool|false>                           # If true, remove temporary files"
   exit 1;
 fi
@@ -58,6 +62,11 @@ if [ ! $reco2num_spk == "" ]; then
   reco2num_spk_opts="--reco2num_spk $reco2num_spk"
 fi
 
+sparse_scores_opts=
+if $sparse_scores; then
+  sparse_scores_opts="--sparse_scores"
+fi
+
 mkdir -p $dir/tmp
 
 for f in $srcdir/scores.scp $srcdir/spk2utt $srcdir/utt2spk $srcdir/segments ; do
@@ -86,7 +95,7 @@ if [ $stage -le 0 ]; then
     utils/filter_scp.pl $sdata/$j/spk2utt $srcdir/scores.scp > $dir/scores.$j.scp
   done
   $cmd JOB=1:$nj $dir/log/spectral_cluster.JOB.log \
-    python3 diarization/spec_clust.py $reco2num_spk_opts --min_neighbors $min_neighbors \
+    python3 diarization/spec_clust.py $reco2num_spk_opts $sparse_scores_opts --min_neighbors $min_neighbors \
       scp:$dir/scores.JOB.scp ark,t:$sdata/JOB/spk2utt ark,t:$dir/labels.JOB || exit 1;
 fi
 
@@ -20,6 +20,9 @@ stage=0
 target_energy=0.1
 nj=10
 cleanup=true
+top_k=0         # If > 0, keep only the top_k most similar segments of every segment.
+                # The scores are then stored as a posterior archive; use
+                # diarization/scluster.sh --sparse-scores true to cluster them.
 # End configuration section.
 
 echo "$0 $@"  # Print the command line for logging
@@ -37,6 +40,7 @@ if [ $# != 2 ]; then
   echo "  --nj <n|10>                                      # Number of jobs (also see num-processes and num-threads)"
   echo "  --stage <stage|0>                                # To control partial reruns"
   echo "  --cleanup <bool|false>                           # If true, remove temporary files"
+  echo "  --top-k <n|0>                                    # If > 0, keep only the top-k scores of every segment"
   exit 1;
 fi
 
@@ -65,12 +69,19 @@ utils/split_data.sh $dir/tmp $nj || exit 1;
 mkdir -p $dir/log
 
 feats="scp:$sdata/JOB/feats.scp"
+if [ $top_k -gt 0 ]; then
+  score_opts="--top_k $top_k"
+  copy_scores=copy-post
+else
+  score_opts="--binary"
+  copy_scores=copy-feats
+fi
 if [ $stage -le 0 ]; then
   echo "$0: scoring xvectors"
   $cmd JOB=1:$nj $dir/log/cossim_scoring.JOB.log \
-      python diarization/calc_cossim_scores.py \
+      python diarization/calc_cossim_scores.py $score_opts \
       ark:$sdata/JOB/spk2utt "$feats" - \|\
-      copy-feats ark,t:- ark,scp:$dir/scores.JOB.ark,$dir/scores.JOB.scp || exit 1;
+      $copy_scores ark:- ark,scp:$dir/scores.JOB.ark,$dir/scores.JOB.scp || exit 1;
 fi
 
 if [ $stage -le 1 ]; then
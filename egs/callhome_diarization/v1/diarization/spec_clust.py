@@ -5,10 +5,15 @@
 
 import argparse
 import os
+import sys
 import numpy as np
+from multiprocessing import Pool
 from sklearn.cluster import k_means
 import kaldi_io
 import scipy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 from sklearn.cluster import SpectralClustering
 
 '''
@@ -20,6 +25,10 @@ from sklearn.cluster import SpectralClustering
  binarized) matrix is used.
  2. The original paper uses an unnormalized Laplacian for the clustering. Here, scikit-learn's version is used
  which performs normalization of the Laplacian.
+
+ The neighbors of every row are sorted once and shared by all values of p, and only the eigenvalues needed
+ for the eigengap are computed. For large matrices (see --sparse_min_size) the binarized and thresholded
+ affinities are kept as sparse matrices.
 '''
 
 #   Input-output routines
@@ -30,6 +39,16 @@ def LoadAffinityMatrix(file):
         Matrices[key] = np_arr
     return Matrices
 
+# Loads the neighbor lists written by calc_cossim_scores.py --top_k, i.e. for each row
+# of the similarity matrix a list of (column, similarity) pairs sorted by decreasing similarity.
+# Returns a dictionary: recording -> (columns, similarities), two N x k arrays (see SortNeighbors)
+def LoadNeighborLists(file):
+    Neighbors=dict()
+    for key, post in kaldi_io.read_post_scp(file):
+        arr = np.array(post, dtype=[('idx', np.int32), ('post', np.float32)])
+        Neighbors[key] = (arr['idx'], arr['post'])
+    return Neighbors
+
 def LoadReco2Utt(file):
     if ':' in file:
         file = file.split(':')[1]
@@ -61,59 +80,82 @@ def SaveLabels(IDs, labels, file):
 
 #   NME low-level operations
 
+# Returns the neighbors of every row of the affinity matrix sorted by decreasing affinity:
+# a tuple (column indices, affinities). Only the first columns of these matrices are used,
+# so they may also hold just the best few neighbors of every row (see LoadNeighborLists).
+def SortNeighbors(A):
+    order = np.argsort(A, axis=1)[:, ::-1]
+    return (order, np.take_along_axis(A, order, axis=1))
+
 # Prepares binarized(0/1) affinity matrix with p_neighbors non-zero elements in each row
-def get_kneighbors_conn(X_dist, p_neighbors):
-    X_dist_out = np.zeros_like(X_dist)
-    for i, line in enumerate(X_dist):
-        sorted_idx = np.argsort(line)
-        sorted_idx = sorted_idx[::-1]
-        indices = sorted_idx[:p_neighbors]
-        X_dist_out[indices, i] = 1
+def get_kneighbors_conn(X_dist, p_neighbors, neighbors=None, sparse=False):
+    if neighbors is None:
+        neighbors = SortNeighbors(X_dist)
+    order, values = neighbors
+    N = order.shape[0]
+    rows = order[:, :p_neighbors].ravel()
+    cols = np.repeat(np.arange(N), p_neighbors)
+    if sparse:
+        return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=values.dtype), (rows, cols)), shape=(N, N))
+    X_dist_out = np.zeros((N, N), dtype=values.dtype)
+    X_dist_out[rows, cols] = 1
     return X_dist_out
 
 # Thresolds affinity matrix to leave p maximum non-zero elements in each row
-def Threshold(A, p):
-    N = A.shape[0]
+def Threshold(A, p, neighbors=None, sparse=False):
+    if neighbors is None:
+        neighbors = SortNeighbors(A)
+    order, values = neighbors
+    N = order.shape[0]
+    thr = values[:, p]
+    # all the elements greater than thr are among the first p neighbors
+    mask = values[:, :p] > thr[:, np.newaxis]
+    rows = np.repeat(np.arange(N), p).reshape(N, p)[mask]
+    cols = order[:, :p][mask]
+    data = values[:, :p][mask].astype(np.float64)
+    if sparse:
+        return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(N, N))
     Ap = np.zeros((N,N))
-    for i in range(N):
-        thr = sorted(A[i,:], reverse=True)[p]
-        Ap[i,A[i,:]>thr] = A[i,A[i,:]>thr]
+    Ap[rows, cols] = data
     return Ap
 
 # Computes Laplacian of a matrix
 def Laplacian(A):
+    if scipy.sparse.issparse(A):
+        d = np.asarray(A.sum(axis=1)).ravel() - A.diagonal()
+        return (scipy.sparse.diags(d) - A).tocsr()
     d = np.sum(A, axis=1)-np.diag(A)
     D = np.diag(d)
     return D - A
 
+# Returns the start vector of the eigsh iterations for an N x N matrix. It is fixed, so that the
+# eigenvalues (and the selected p) do not depend on the ARPACK random state of the process, i.e. on
+# which recordings were clustered before in the same process
+def StartVector(N, dtype):
+    return np.random.RandomState(0).uniform(-1, 1, N).astype(dtype)
+
 # Calculates eigengaps (differences between adjacent eigenvalues sorted in descending order)
 def Eigengap(S):
     S = sorted(S)
     return np.diff(S)
 
 # Computes parameters of normalized eigenmaps for automatic thresholding selection
-def ComputeNMEParameters(A, p, max_num_clusters):
+def ComputeNMEParameters(A, p, max_num_clusters, neighbors=None, sparse=False):
     # p-Neighbour binarization
-    Ap = get_kneighbors_conn(A, p)
-    # Symmetrization
-    Ap = (Ap + np.transpose(Ap))/2
+    Ap = get_kneighbors_conn(A, p, neighbors, sparse)
+    # Symmetrization (the division upcasts sparse matrices to float64, so the type is restored)
+    Ap = ((Ap + Ap.T)/2).astype(Ap.dtype, copy=False)
     # Laplacian matrix computation
     Lp = Laplacian(Ap)
     # EigenValue Decomposition
-    S, eig_vecs = scipy.linalg.eigh(Lp)
-    # Eigengap computation
-    e = Eigengap(S)
-    g = np.max(e[:max_num_clusters])/(np.max(S)+1e-10)
-    N = Lp.shape[0]
-    # EigenValue Decomposition
     # Get max_num_clusters+1 lowest eigenvalues sorted in ascending order
-    S, _ = scipy.sparse.linalg.eigsh(-Lp, k=max_num_clusters+1, which='LA')
+    v0 = StartVector(Lp.shape[0], Lp.dtype)
+    S, _ = scipy.sparse.linalg.eigsh(-Lp, k=max_num_clusters+1, which='LA', v0=v0)
     S = -S[::-1]
     # Get largest eigenvalue
-    Smax, _ = scipy.sparse.linalg.eigsh(Lp, k=1, which='LA')
+    Smax, _ = scipy.sparse.linalg.eigsh(Lp, k=1, which='LA', v0=v0)
     # Eigengap computation
     e = Eigengap(S)
-    # g = np.max(e[:max_num_clusters])/(np.max(S)+1e-10)
     g = np.max(e[:max_num_clusters])/(Smax[0]+1e-10)
     r = p/g
     k = np.argmax(e[:max_num_clusters])
@@ -128,9 +170,13 @@ Parameters:
    max_num_clusters: maximum allowed number of clusters to generate
    pmax: maximum count for matrix binarization (should be at least 2)
    pbest: best count for matrix binarization (if 0, determined automatically)
+   sparse: use sparse affinity matrices
+   neighbors: sorted neighbors of every row (see SortNeighbors), used instead of A if given
 Returns: cluster assignments for every speaker embedding   
 '''
-def NME_SpectralClustering(A, num_clusters = None, max_num_clusters = 10, pbest = 0, pmin = 2, pmax = 20):
+def NME_SpectralClustering(A, num_clusters = None, max_num_clusters = 10, pbest = 0, pmin = 2, pmax = 20, sparse = False, neighbors = None):
+    if neighbors is None:
+        neighbors = SortNeighbors(A)
     # First estimate number of clusters by scanning different thresholds for
     # affinity matrix
     if pbest==0:
@@ -138,7 +184,7 @@ def NME_SpectralClustering(A, num_clusters = None, max_num_clusters = 10, pbest
         rbest = None
         kbest = None
         for p in range(pmin, pmax+1):
-            _, _, k, r = ComputeNMEParameters(A, p, max_num_clusters)
+            _, _, k, r = ComputeNMEParameters(A, p, max_num_clusters, neighbors, sparse)
             print('p={}, r={}'.format(p,r))
             if rbest is None or rbest > r:
                 rbest = r
@@ -146,11 +192,11 @@ def NME_SpectralClustering(A, num_clusters = None, max_num_clusters = 10, pbest
                 kbest = k
         print('Best number of neighbors is {}'.format(pbest))
     else:
-        _, _, kbest, _ = ComputeNMEParameters(A, pbest, max_num_clusters)
+        _, _, kbest, _ = ComputeNMEParameters(A, pbest, max_num_clusters, neighbors, sparse)
     
     num_clusters = num_clusters if num_clusters is not None else kbest+1
     print('Number of clusters: {}'.format(num_clusters))
-    return NME_SpectralClustering_sklearn(A, num_clusters, pbest)
+    return NME_SpectralClustering_sklearn(A, num_clusters, pbest, neighbors, sparse)
 
 '''
 Performs spectral clustering with Normalized Maximum Eigengap (NME) with fixed threshold and number of clusters
@@ -158,17 +204,128 @@ Parameters:
    A: affinity matrix (matrix of pairwise cosine similarities or PLDA scores between speaker embeddings)
    num_clusters: number of clusters to generate
    pbest: best count for matrix binarization
+   neighbors: sorted neighbors of every row (see SortNeighbors)
+   sparse: use sparse affinity matrix
 Returns: cluster assignments for every speaker embedding   
 '''
-def NME_SpectralClustering_sklearn(A, num_clusters, pbest):
-    Ap = Threshold(A, pbest)
-    Ap = (Ap + np.transpose(Ap)) / 2
+def NME_SpectralClustering_sklearn(A, num_clusters, pbest, neighbors=None, sparse=False):
+    Ap = Threshold(A, pbest, neighbors, sparse)
+    Ap = (Ap + Ap.T) / 2
     model = SpectralClustering(n_clusters = num_clusters, affinity='precomputed', random_state=0)
     labels = model.fit_predict(Ap)
     return labels
 
 
+# Clusters the affinity matrix of one recording. 'task' is a tuple
+# (recording id, affinity matrix or neighbor lists, number of clusters or None, pmin, pmax, sparse_min_size)
+def ClusterRecording(task):
+    id, A, num_clusters, pmin, pmax, sparse_min_size = task
+    if isinstance(A, tuple):
+        neighbors, A = A, None
+        assert neighbors[0].shape[1] > pmax, 'At least {} neighbors per segment expected for {}, {} found\n'.format(pmax + 1, id, neighbors[0].shape[1])
+    else:
+        neighbors = None
+    N = A.shape[0] if A is not None else neighbors[0].shape[0]
+    # the binarized and thresholded matrices are dense for small recordings, also when they
+    # are built from neighbor lists
+    sparse = sparse_min_size > 0 and N >= sparse_min_size
+    print('Start clustering for recording {}...'.format(id))
+    labels = NME_SpectralClustering(A, num_clusters = num_clusters, pmin = pmin, pmax = pmax, sparse = sparse, neighbors = neighbors)
+    print('Clustering done for recording {}'.format(id))
+    return id, labels
+
+
+# Self-check of the NME operations against the original per-row implementations, on random
+# recordings. The binarized and thresholded matrices must be identical, dense and sparse, and so
+# must the labels of the original algorithm, of the dense and sparse versions and of the versions
+# working on neighbor lists. The labels are compared for p >= 3: with 2 neighbors the binarized
+# graph usually falls apart into many pieces, whose repeated Laplacian eigenvalues make ARPACK
+# restart from random vectors, so that not even the original implementation gives reproducible
+# labels. Run as: spec_clust.py --test
+def test_library():
+    import io
+    import contextlib
+    import warnings
+
+    def get_kneighbors_conn_ref(X_dist, p_neighbors):
+        X_dist_out = np.zeros_like(X_dist)
+        for i, line in enumerate(X_dist):
+            sorted_idx = np.argsort(line)
+            sorted_idx = sorted_idx[::-1]
+            indices = sorted_idx[:p_neighbors]
+            X_dist_out[indices, i] = 1
+        return X_dist_out
+
+    def Threshold_ref(A, p):
+        N = A.shape[0]
+        Ap = np.zeros((N,N))
+        for i in range(N):
+            thr = sorted(A[i,:], reverse=True)[p]
+            Ap[i,A[i,:]>thr] = A[i,A[i,:]>thr]
+        return Ap
+
+    def NME_SpectralClustering_ref(A, max_num_clusters, pmin, pmax):
+        rbest = None
+        for p in range(pmin, pmax+1):
+            Ap = get_kneighbors_conn_ref(A, p)
+            Ap = (Ap + np.transpose(Ap))/2
+            Lp = np.diag(np.sum(Ap, axis=1)-np.diag(Ap)) - Ap
+            v0 = StartVector(Lp.shape[0], Lp.dtype)
+            S, _ = scipy.sparse.linalg.eigsh(-Lp, k=max_num_clusters+1, which='LA', v0=v0)
+            S = -S[::-1]
+            Smax, _ = scipy.sparse.linalg.eigsh(Lp, k=1, which='LA', v0=v0)
+            e = Eigengap(S)
+            r = p/(np.max(e[:max_num_clusters])/(Smax[0]+1e-10))
+            if rbest is None or rbest > r:
+                rbest = r
+                pbest = p
+                kbest = np.argmax(e[:max_num_clusters])
+        Ap = Threshold_ref(A, pbest)
+        Ap = (Ap + np.transpose(Ap)) / 2
+        model = SpectralClustering(n_clusters = kbest+1, affinity='precomputed', random_state=0)
+        return model.fit_predict(Ap)
+
+    rng = np.random.RandomState(0)
+    pmin, pmax = 3, 20
+    for N in (30, 60, 100):
+        for _ in range(5):
+            # x-vector like embeddings of 2-4 speakers and their cosine similarities
+            num_spk = rng.randint(2, 5)
+            X = rng.randn(num_spk, 16)[rng.randint(num_spk, size=N)] + 0.8 * rng.randn(N, 16)
+            X /= np.linalg.norm(X, axis=1, keepdims=True)
+            A = np.dot(X, X.T).astype(np.float32)
+            neighbors = SortNeighbors(A)
+            top_neighbors = (neighbors[0][:, :pmax+1], neighbors[1][:, :pmax+1])
+
+            for p in range(2, pmax+1):
+                ref = get_kneighbors_conn_ref(A, p)
+                for sparse in (False, True):
+                    Ap = get_kneighbors_conn(A, p, neighbors, sparse)
+                    Ap = Ap.toarray() if sparse else Ap
+                    assert Ap.dtype == ref.dtype and np.array_equal(Ap, ref)
+                ref = Threshold_ref(A, p)
+                for sparse in (False, True):
+                    Ap = Threshold(A, p, neighbors, sparse)
+                    Ap = Ap.toarray() if sparse else Ap
+                    assert Ap.dtype == ref.dtype and np.array_equal(Ap, ref)
+
+            with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                # sklearn warns about the graphs that are not fully connected
+                warnings.simplefilter('ignore')
+                ref = NME_SpectralClustering_ref(A, 10, pmin, pmax)
+                for sparse in (False, True):
+                    labels = NME_SpectralClustering(A, pmin = pmin, pmax = pmax, sparse = sparse)
+                    assert np.array_equal(labels, ref), 'N={} sparse={}: {} vs {}'.format(N, sparse, labels, ref)
+                    labels = NME_SpectralClustering(None, pmin = pmin, pmax = pmax, sparse = sparse, neighbors = top_neighbors)
+                    assert np.array_equal(labels, ref), 'N={} sparse={} (neighbor lists): {} vs {}'.format(N, sparse, labels, ref)
+    print('{}: self-check passed'.format(sys.argv[0]))
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--test']:
+        test_library()
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(description='Usage: spec_clust.py [options] <scores-rspec> <reco2utt-rspec> <labels-wspec>\n' +
                                                  'Performs spectral clustering of xvectors according to pairwise similarity scores\n' +
                                                  'Auto-selects binarization threshold')
@@ -179,6 +336,9 @@ if __name__ == '__main__':
     parser.add_argument('--max_neighbors', type=int, default=20, help='Maximum number of neighbors to threshold similarity matrix')
     parser.add_argument('--reco2num_spk', type=str, default='', help='Kaldi-style rspecifier of recording-to-numofspeakers correspondence')
     parser.add_argument('--num_clusters', type=int, default=None, help='Number of clusters to generate. Ignored if --reco2num_spk is given')
+    parser.add_argument('--num_jobs', type=int, default=1, help='Number of recordings to cluster in parallel')
+    parser.add_argument('--sparse_scores', action='store_true', help='Similarity scores are neighbor lists written by calc_cossim_scores.py --top_k')
+    parser.add_argument('--sparse_min_size', type=int, default=500, help='Use sparse affinity matrices for recordings with at least this many segments (0 means never)')
     args = parser.parse_args()
 
     assert args.max_neighbors > 1, 'Maximum number of neighpors should be at least 2, {} passed\n'.format(args.max_neighbors)
@@ -193,7 +353,7 @@ if __name__ == '__main__':
     print('Reco2NumSpk rspecifier: {}'.format(args.reco2num_spk))
 
     print('Loading affinity matrices...', end='')
-    Matrices = LoadAffinityMatrix(args.simmat_rspec)
+    Matrices = LoadNeighborLists(args.simmat_rspec) if args.sparse_scores else LoadAffinityMatrix(args.simmat_rspec)
     print('done')
     print('Loading Reco2Utt correspondence...', end='')
     IDs = LoadReco2Utt(args.reco2utt_rspec)
@@ -202,17 +362,20 @@ if __name__ == '__main__':
     if args.reco2num_spk != '':
         NumSpk = LoadReco2NumSpk(args.reco2num_spk)
 
-    Labels = dict()
+    tasks = []
     for id in IDs:
-        A = Matrices[id]
-        IDList = IDs[id]
-
         num_clusters = args.num_clusters if args.reco2num_spk == '' else NumSpk[id]
         assert num_clusters is None or num_clusters > 0, 'Positive number of clusters expected for {}, {} found\n'.format(id, num_clusters)
+        tasks.append((id, Matrices[id], num_clusters, args.min_neighbors, args.max_neighbors, args.sparse_min_size))
 
-        print('Start clustering for recording {}...'.format(id))
-        Labels[id] = NME_SpectralClustering(A, num_clusters = num_clusters, pmin = args.min_neighbors, pmax = args.max_neighbors)
-        print('Clustering done')
+    Labels = dict()
+    if args.num_jobs > 1 and len(tasks) > 1:
+        with Pool(min(args.num_jobs, len(tasks))) as pool:
+            for id, labels in pool.imap_unordered(ClusterRecording, tasks):
+                Labels[id] = labels
+    else:
+        for id, labels in map(ClusterRecording, tasks):
+            Labels[id] = labels
     print( 'Saving labels...')
     SaveLabels(IDs, Labels, args.labels_wspec)
     print('done')
@@ -1,39 +1,43 @@
 #!/usr/bin/env python
 # Copyright 2018 Johns Hopkins University (Author: Aswin Shanmugam Subramanian)
 # Apache 2.0
-# Works with both python2 and python3
 # This script assumes that WPE (nara_wpe) is installed locally using miniconda.
 # ../../../tools/extras/install_miniconda.sh and ../../../tools/extras/install_wpe.sh
 # needs to be run and this script needs to be launched run with that version of
 # python.
 # See local/run_wpe.sh for example.
+#
+# The channels of a file group (--files, or one line of --list) are
+# dereverberated together.  The STFT is processed in blocks of --block-length
+# seconds: the WPE filter of each block is estimated from the statistics of
+# that block, using the last taps + delay - 1 frames of the previous block as
+# history, so memory use does not depend on the length of the recording
+# (--block-length 0 processes the whole recording at once, as before).
+# A filter estimated from only a few frames removes most of the signal, so
+# blocks are at least min_block_length seconds long: a shorter remainder at
+# the end of the recording is merged into the previous block.
+# Reading + STFT, WPE and iSTFT + writing of consecutive blocks run in
+# separate threads, the frequency bins are split over --num-threads threads
+# and the file groups are distributed over --num-processes processes.
 
 import numpy as np
 import soundfile as sf
 import time
 import os, errno
-from tqdm import tqdm
+import sys
 import argparse
+import queue
+import resource
+import threading
+import traceback
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 # to avoid huge memory consumption we decided to use `wpe_v8` instead of the original wpe by
 # following the advice from Christoph Boeddeker at Paderborn University
 # https://github.com/chimechallenge/kaldi_chime6/commit/2ea6ac07ef66ad98602f073b24a233cb7f61605c#r36147334
 from nara_wpe.wpe import wpe_v8 as wpe
 from nara_wpe.utils import stft, istft
-from nara_wpe import project_root
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--files', '-f', nargs='+')
-args = parser.parse_args()
-
-input_files = args.files[:len(args.files)//2]
-output_files = args.files[len(args.files)//2:]
-out_dir = os.path.dirname(output_files[0])
-try:
-    os.makedirs(out_dir)
-except OSError as e:
-    if e.errno != errno.EEXIST:
-        raise
 
 stft_options = dict(
     size=512,
@@ -49,14 +53,229 @@ delay = 3
 iterations = 5
 taps = 10
 
-signal_list = [
-    sf.read(f)[0]
-    for f in input_files
-]
-y = np.stack(signal_list, axis=0)
-Y = stft(y, **stft_options).transpose(2, 0, 1)
-Z = wpe(Y, iterations=iterations, statistics_mode='full').transpose(1, 2, 0)
-z = istft(Z, size=stft_options['size'], shift=stft_options['shift'])
-
-for d in range(len(signal_list)):
-    sf.write(output_files[d], z[d,:], sampling_rate)
+# number of STFT frames of history a block needs from the previous one
+context = taps + delay - 1
+# minimum length of a block in seconds
+min_block_length = 5.0
+
+
+def get_num_frames(num_samples):
+    # number of frames of stft(..., fading=True, pad=True)
+    size, shift = stft_options['size'], stft_options['shift']
+    num_padded = num_samples + 2 * (size - shift)
+    return int(np.ceil(float(num_padded - size) / shift)) + 1
+
+
+def get_min_block_frames():
+    return int(min_block_length * sampling_rate) // stft_options['shift']
+
+
+def read_blocks(handles, num_frames, block_frames):
+    """Yields (first_frame, end_frame, num_context_frames, Y), where Y is the
+    STFT of frames [first_frame - num_context_frames, end_frame) with shape
+    (frequency, channel, frame).  The blocks have block_frames frames, except
+    the last one, which is extended to up to block_frames + min_block_frames
+    frames rather than leaving a remainder shorter than min_block_frames."""
+    size, shift = stft_options['size'], stft_options['shift']
+    overlap = size - shift
+    num_samples = handles[0].frames
+    bounds = list(range(0, num_frames, block_frames)) + [num_frames]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < get_min_block_frames():
+        del bounds[-2]
+    for t0, t1 in zip(bounds[:-1], bounds[1:]):
+        c = min(t0, context)
+        # sample range of the frames in the input signal; the signal is
+        # padded with 'overlap' zeros on both sides (fading=True).
+        begin = (t0 - c) * shift - overlap
+        end = (t1 - 1) * shift + size - overlap
+        y = np.zeros((len(handles), end - begin))
+        b, e = max(begin, 0), min(end, num_samples)
+        if e > b:
+            for d, handle in enumerate(handles):
+                handle.seek(b)
+                y[d, b - begin:e - begin] = handle.read(e - b)
+        options = dict(stft_options, fading=False, pad=False)
+        Y = stft(y, **options).transpose(2, 0, 1)
+        yield t0, t1, c, Y
+
+
+def dereverberate(Y, num_context_frames, executor, num_threads):
+    """Runs WPE on a block with shape (frequency, channel, frame) and returns
+    the frames after the context frames.  The first block of a recording has
+    no context and uses 'full' statistics; the statistics of the other blocks
+    ('valid') only include the frames which have full history."""
+    statistics_mode = 'valid' if num_context_frames > 0 else 'full'
+    Z = np.empty_like(Y)
+
+    def run(bins):
+        Z[bins] = wpe(Y[bins], taps=taps, delay=delay, iterations=iterations,
+                      statistics_mode=statistics_mode)
+
+    num_bins = Y.shape[0]
+    bounds = np.linspace(0, num_bins, num_threads + 1).astype(int)
+    list(executor.map(run, [slice(b, e) for b, e in zip(bounds[:-1], bounds[1:]) if e > b]))
+    return Z[:, :, num_context_frames:]
+
+
+def write_blocks(handles, num_frames, blocks):
+    """Overlap-adds the iSTFT of consecutive blocks (first_frame, end_frame, Z)
+    and writes the samples that are complete, without the fading padding."""
+    size, shift = stft_options['size'], stft_options['shift']
+    overlap = size - shift
+    end_sample = num_frames * shift
+    carry = None
+    for t0, t1, Z in blocks:
+        z = istft(Z.transpose(1, 2, 0), size=size, shift=shift, fading=False)
+        if carry is not None:
+            z[:, :overlap] += carry
+        # z starts at sample t0 * shift of the padded signal; samples after
+        # t1 * shift still get contributions from the next block.
+        carry = z[:, (t1 - t0) * shift:]
+        b = max(t0 * shift, overlap)
+        e = min(t1 * shift, end_sample)
+        if e > b:
+            for d, handle in enumerate(handles):
+                handle.write(z[d, b - t0 * shift:e - t0 * shift])
+
+
+def produce(blocks, out_queue, errors):
+    try:
+        for block in blocks:
+            out_queue.put(block)
+    except Exception:
+        traceback.print_exc()
+        errors.append(sys.exc_info()[1])
+    finally:
+        out_queue.put(None)
+
+
+def consume(in_queue, function, errors):
+    try:
+        function(iter(in_queue.get, None))
+    except Exception:
+        traceback.print_exc()
+        errors.append(sys.exc_info()[1])
+        # drain the queue, so that the producer does not block
+        for _ in iter(in_queue.get, None):
+            pass
+
+
+def process_files(files, block_length=0, num_threads=1):
+    """Dereverberates a file group: the first half of 'files' are the input
+    channels and the second half the corresponding output files.  At most 4
+    blocks (reading, WPE, writing and one in each queue) are in memory."""
+    start_time = time.time()
+    input_files = files[:len(files)//2]
+    output_files = files[len(files)//2:]
+    assert len(input_files) > 0 and len(input_files) == len(output_files), files
+    out_dir = os.path.dirname(output_files[0])
+    try:
+        os.makedirs(out_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    in_handles = [sf.SoundFile(f) for f in input_files]
+    num_samples = in_handles[0].frames
+    for f, handle in zip(input_files, in_handles):
+        if handle.frames != num_samples or handle.channels != 1:
+            raise ValueError('{}: expected a single channel with {} samples, got {} x {}'.format(
+                f, num_samples, handle.channels, handle.frames))
+    num_frames = get_num_frames(num_samples)
+    if block_length > 0:
+        block_frames = max(int(block_length * sampling_rate) // stft_options['shift'],
+                           get_min_block_frames())
+    else:
+        block_frames = num_frames
+    out_handles = [sf.SoundFile(f, 'w', samplerate=sampling_rate, channels=1)
+                   for f in output_files]
+
+    errors = []
+    read_queue = queue.Queue(maxsize=1)
+    write_queue = queue.Queue(maxsize=1)
+    reader = threading.Thread(target=produce, args=(
+        read_blocks(in_handles, num_frames, block_frames), read_queue, errors))
+    writer = threading.Thread(target=consume, args=(
+        write_queue, lambda blocks: write_blocks(out_handles, num_frames, blocks), errors))
+    reader.start()
+    writer.start()
+    try:
+        with ThreadPoolExecutor(num_threads) as executor:
+            for t0, t1, c, Y in iter(read_queue.get, None):
+                if not errors:
+                    write_queue.put((t0, t1, dereverberate(Y, c, executor, num_threads)))
+    except Exception:
+        # drain the queue, so that the reader does not block
+        for _ in iter(read_queue.get, None):
+            pass
+        raise
+    finally:
+        write_queue.put(None)
+        reader.join()
+        writer.join()
+        for handle in in_handles + out_handles:
+            handle.close()
+    if errors:
+        raise RuntimeError('WPE failed for {}'.format(' '.join(input_files)))
+
+    elapsed = time.time() - start_time
+    duration = float(num_samples) / sampling_rate
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return ('{}: {} channels, {:.1f} sec of audio processed in {:.1f} sec '
+            '(RTF {:.3f}), peak RSS {:.0f} MB'.format(
+                ' '.join(output_files), len(input_files), duration, elapsed,
+                elapsed / max(duration, 1e-6), peak_rss))
+
+
+def process_group(task):
+    files, block_length, num_threads = task
+    return process_files(files, block_length, num_threads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', '-f', nargs='+',
+                        help='Input files followed by the same number of output files')
+    parser.add_argument('--list', type=str,
+                        help='File with one file group (as in --files) per line')
+    parser.add_argument('--block-length', type=float, default=0,
+                        help='Length of the blocks in seconds, 0 processes the whole recording at once. '
+                        'Must be 0 or at least {} (a shorter remainder at the end of a recording is '
+                        'merged into the previous block)'.format(min_block_length))
+    parser.add_argument('--num-threads', type=int, default=1,
+                        help='Number of threads over which the frequency bins are split')
+    parser.add_argument('--num-processes', type=int, default=1,
+                        help='Number of file groups processed in parallel')
+    args = parser.parse_args()
+    if 0 < args.block_length < min_block_length:
+        parser.error('--block-length must be 0 or at least {} seconds, got {}'.format(
+            min_block_length, args.block_length))
+
+    groups = []
+    if args.files:
+        groups.append(args.files)
+    if args.list:
+        with open(args.list) as f:
+            groups.extend(line.split() for line in f if line.strip())
+    if not groups:
+        parser.error('no files given, use --files or --list')
+
+    tasks = [(files, args.block_length, args.num_threads) for files in groups]
+    start_time = time.time()
+    if args.num_processes > 1 and len(tasks) > 1:
+        pool = Pool(min(args.num_processes, len(tasks)))
+        results = pool.imap_unordered(process_group, tasks)
+    else:
+        pool = None
+        results = map(process_group, tasks)
+    for message in results:
+        print(message)
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    print('Processed {} file groups in {:.1f} sec{}'.format(
+        len(tasks), time.time() - start_time,
+        ', peak RSS of a worker process {:.0f} MB'.format(peak_rss) if pool is not None else ''))
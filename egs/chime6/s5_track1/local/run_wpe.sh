@@ -8,6 +8,12 @@
 # Config:
 nj=4
 cmd=run.pl
+num_processes=1   # number of file groups processed in parallel by each job
+num_threads=1     # number of threads over which the frequency bins are split
+block_length=60   # length of the WPE blocks in seconds (at least 5); 0 processes
+                  # whole files at once (the memory use then grows with the
+                  # length).  A remainder of less than 5 seconds at the end of
+                  # a file is processed with the previous block.
 
 . utils/parse_options.sh || exit 1;
 
@@ -17,6 +23,9 @@ if [ $# != 3 ]; then
    echo "main options (for others, see top of script file)"
    echo "  --cmd <cmd>                              # Command to run in parallel with"
    echo "  --nj 50                        # number of jobs for parallel processing"
+   echo "  --num-processes 1              # number of files processed in parallel by each job"
+   echo "  --num-threads 1                # number of threads used per file"
+   echo "  --block-length 60              # WPE block length in seconds, at least 5 (0 for whole files)"
    exit 1;
 fi
 
@@ -69,18 +78,9 @@ done
 utils/split_scp.pl $output_wavfiles $split_wavfiles || exit 1;
 
 echo -e "Dereverberation - $task - $array\n"
-# making a shell script for each job
-for n in `seq $nj`; do
-cat <<-EOF > $expdir/log/wpe.$n.sh
-while read line; do
-  $miniconda_dir/bin/python local/run_wpe.py \
-    --file \$line
-done < $output_wavfiles.$n
-EOF
-done
-
-chmod a+x $expdir/log/wpe.*.sh
 $cmd JOB=1:$nj $expdir/log/wpe.JOB.log \
-  $expdir/log/wpe.JOB.sh
+  $miniconda_dir/bin/python local/run_wpe.py \
+    --list $output_wavfiles.JOB --num-processes $num_processes \
+    --num-threads $num_threads --block-length $block_length
 
 echo "`basename $0` Done."
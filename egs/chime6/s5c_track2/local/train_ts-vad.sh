@@ -259,7 +259,7 @@ if [ $stage -le 5 ]; then
     done
 
     $train_cmd JOB=1:$nj_dense $outdir/log/prepare_targets.JOB.log \
-      python3 local/ts-vad/conv_vad_to_dense_targets.py $tmp/tmp_sess/ali_vad_targets_wk.JOB.ark "ark,t,scp:$outdir/dense_targets.JOB.ark,$outdir/dense_targets.JOB.scp" \
+      python3 local/ts-vad/conv_vad_to_dense_targets.py $tmp/tmp_sess/ali_vad_targets_wk.JOB.ark "ark,scp:$outdir/dense_targets.JOB.ark,$outdir/dense_targets.JOB.scp" \
       $tmp/tmp_sess/utt2spk_shuf1.JOB $tmp/tmp_sess/utt2spk_shuf2.JOB $tmp/tmp_sess/utt2spk_shuf3.JOB $tmp/tmp_sess/utt2spk_shuf4.JOB \
       data/${srcdata}_hires/segments $tmp/segments_wk_ali data/${srcdata}_hires/utt2num_frames || exit 1;
     cat $outdir/dense_targets.*.scp | sort > $targets
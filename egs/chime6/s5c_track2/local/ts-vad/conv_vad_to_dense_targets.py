@@ -3,242 +3,140 @@
 # Apache 2.0.
 
 """This script prepares overlapped 4-speaker dense targets for TS-VAD training
-   using segments and VAD alignment of kinect and worn utterances 
+   using segments and VAD alignment of kinect and worn utterances
    (VAD alignment from worn utterances is more reliable than from kinects,
    so we use large scaling factor for worn utterances).
    The resulting targets are 4 pairs of probabilities:
-   (sil_spk1, speech_spk1, sil_spk2, speech_spk2, sil_spk3, speech_spk3, sil_spk4, speech_spk4)"""
+   (sil_spk1, speech_spk1, sil_spk2, speech_spk2, sil_spk3, speech_spk3, sil_spk4, speech_spk4)
+   The number of heads is given by the number of utt2spk maps on the command line.
+   Sessions are processed independently (in parallel with --num_jobs > 1),
+   the targets are written as float matrices to the output wspecifier."""
 
 import os
 import argparse
+from multiprocessing import Pool
 import numpy as np
 from kaldiio import WriteHelper
 
-def ProcessSession(segments, writer, worn_scale):
-    segments.sort(key = lambda tup: tup[6])     #sort by start time
-    for i in range(len(segments)):
-        utt_id, spk, n_spk, n_spk2, n_spk3, n_spk4, start, end, vad_info, device = segments[i]
-        if n_spk == '':
-            continue
-
-        vad_info_dense = np.zeros((vad_info[0],8))
-
-        # looking for left-side overlappings
-        i1 = i-1
-        cnt = 0
-        nls=0
-        nl1=0
-        nl2=0
-        nl3=0
-        nl4=0
-        while i1>=0:
-            utt_id1, spk1, x, y, z, q, start1, end1, vad_info1, device1 = segments[i1]
-            if x != '':
-                i1 -= 1
-                continue
-            if end1 > start:
-                scale = 1
-                if device1 == 'W':
-                    scale = worn_scale
-                if spk1 == spk:
-                    nls+=1
-                if spk1 == n_spk:
-                    nl1+=1
-                    #print('utt {}, spk {}: left intersection with spk 1 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end,end1)-start):
-                        if vad_info1[start - start1 + k] == '1':
-                            vad_info_dense[k][1] += scale
-                        else:
-                            vad_info_dense[k][0] += scale
-                elif spk1 == n_spk2:
-                    nl2+=1
-                    #print('utt {}, spk {}: left intersection with spk 2 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end,end1)-start):
-                        if vad_info1[start - start1 + k] == '1':
-                            vad_info_dense[k][3] += scale
-                        else:
-                            vad_info_dense[k][2] += scale
-                elif spk1 == n_spk3:
-                    nl3+=1
-                    #print('utt {}, spk {}: left intersection with spk 3 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end,end1)-start):
-                        if vad_info1[start - start1 + k] == '1':
-                            vad_info_dense[k][5] += scale
-                        else:
-                            vad_info_dense[k][4] += scale
-                elif spk1 == n_spk4:
-                    nl4+=1
-                    #print('utt {}, spk {}: left intersection with spk 4 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end,end1)-start):
-                        if vad_info1[start - start1 + k] == '1':
-                            vad_info_dense[k][7] += scale
-                        else:
-                            vad_info_dense[k][6] += scale
-            else:
-                cnt += 1
-                if cnt==10:
-                    break
-            i1 -= 1
+def StripRevPrefix(spk_parts):
+    if spk_parts[0][:3]=='rev':
+        del spk_parts[0]
+    if len(spk_parts)>1 and spk_parts[1][:3]=='rev':
+        del spk_parts[1]
+    return '-'.join(spk_parts)
 
-        # looking for rights-side overlappings
-        i1 = i+1
-        cnt = 0
-        nrs=0
-        nr1=0
-        nr2=0
-        nr3=0
-        nr4=0
-        while i1<len(segments):
-            utt_id1, spk1, x, y, z, q, start1, end1, vad_info1, device1 = segments[i1]
-            if x != '':
-                i1 += 1
+def LoadHeadSpeakers(utt2spk):
+    n_speakers=dict()
+    with open(utt2spk,'r') as f:
+        for line in f:
+            uid, n_sid = line.strip().split()
+            n_spk = n_sid.split('_')[0]
+            n_speakers[uid] = StripRevPrefix(n_spk.split('-')[:-2])
+    return n_speakers
+
+class SessionIndex:
+    """VAD alignment segments of one session sorted by start time.
+       The alignments are stored as one concatenated boolean speech mask, so
+       that the part of a segment overlapping an utterance is an array slice."""
+    def __init__(self, segments):
+        segments = sorted(segments, key = lambda tup: tup[1])     #sort by start time
+        self.spks = [seg[0] for seg in segments]
+        self.starts = np.array([seg[1] for seg in segments], dtype=np.int64)
+        self.ends = np.array([seg[2] for seg in segments], dtype=np.int64)
+        self.scales = [seg[4] for seg in segments]
+        self.offsets = np.zeros(len(segments), dtype=np.int64)
+        np.cumsum(self.ends[:-1] - self.starts[:-1], out=self.offsets[1:])
+        if len(segments) > 0:
+            self.speech = np.concatenate([seg[3] for seg in segments])
+        else:
+            self.speech = np.zeros(0, dtype=bool)
+        # running maximum of end times: segments before the first position
+        # where it exceeds t all end at or before t.
+        self.max_ends = np.maximum.accumulate(self.ends) if len(segments) > 0 else self.ends
+
+    def Overlapping(self, start, end):
+        """Returns indices of segments intersecting frames [start, end)."""
+        lo = np.searchsorted(self.max_ends, start, side='right')
+        hi = np.searchsorted(self.starts, end, side='left')
+        if lo >= hi:
+            return np.zeros(0, dtype=np.int64)
+        return lo + np.flatnonzero(self.ends[lo:hi] > start)
+
+def ProcessSession(task):
+    """Computes dense targets for the utterances of one session.
+       Returns a list of (utt_id, targets), targets is None for utterances
+       which do not overlap with any VAD alignment of their own speaker."""
+    index, utts = task
+    utts = sorted(utts, key = lambda tup: tup[3])     #sort by start time
+    results = []
+    for utt_id, spk, head_spks, start, end in utts:
+        num_heads = len(head_spks)
+        vad_info_dense = np.zeros((end-start, num_heads, 2))
+        # the alignment of a speaker goes to the first head assigned to it
+        head_of_spk = dict()
+        for head in reversed(range(num_heads)):
+            head_of_spk[head_spks[head]] = head
+
+        has_self_overlap = False
+        for i in index.Overlapping(start, end):
+            spk1 = index.spks[i]
+            if spk1 == spk:
+                has_self_overlap = True
+            head = head_of_spk.get(spk1)
+            if head is None:
                 continue
-            if end > start1:
-                scale = 1
-                if device1 == 'W':
-                    scale = worn_scale
-                if spk1 == spk:
-                    nrs+=1
-                if spk1 == n_spk:
-                    nr1+=1
-                    #print('utt {}, spk {}: right intersection with spk 1 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end, end1)-start1):
-                        if vad_info1[k] == '1':
-                            vad_info_dense[start1-start+k][1] += scale
-                        else:
-                            vad_info_dense[start1-start+k][0] += scale
-                elif spk1 == n_spk2:
-                    nr2+=1
-                    #print('utt {}, spk {}: right intersection with spk 2 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end, end1)-start1):
-                        if vad_info1[k] == '1':
-                            vad_info_dense[start1-start+k][3] += scale
-                        else:
-                            vad_info_dense[start1-start+k][2] += scale
-                elif spk1 == n_spk3:
-                    nr3+=1
-                    #print('utt {}, spk {}: right intersection with spk 3 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end, end1)-start1):
-                        if vad_info1[k] == '1':
-                            vad_info_dense[start1-start+k][5] += scale
-                        else:
-                            vad_info_dense[start1-start+k][4] += scale
-                elif spk1 == n_spk4:
-                    nr4+=1
-                    #print('utt {}, spk {}: right intersection with spk 4 utt {}, adding scale {}'.format(utt_id,spk1,utt_id1,scale))
-                    for k in range(min(end, end1)-start1):
-                        if vad_info1[k] == '1':
-                            vad_info_dense[start1-start+k][7] += scale
-                        else:
-                            vad_info_dense[start1-start+k][6] += scale
-            else:
-                cnt += 1
-                if cnt==10:
-                    break
-            i1 += 1
-
-        for j in range(vad_info[0]):
-            for head in range(4):
-                total=vad_info_dense[j][2*head]+vad_info_dense[j][2*head+1]
-                if total == 0:
-                    vad_info_dense[j][2*head] = 1
-                    vad_info_dense[j][2*head+1] = 0
-                else:
-                    vad_info_dense[j][2*head] /= total
-                    vad_info_dense[j][2*head+1] /= total
-
-        #print("utt {}: {}+{}+{}+{} left-overlaps and {} left-self-overlaps, {}+{}+{}+{} right-overlaps and {} rights-self-overlaps".format(utt_id,nl1,nl2,nl3,nl4,nls,nr1,nr2,nr3,nr4,nrs))
-        if nls == 0 and nrs == 0:
-            print("WARNING: utt {} does not have targets!".format(utt_id))
+            b = max(start, index.starts[i])
+            e = min(end, index.ends[i])
+            offset = index.offsets[i] + b - index.starts[i]
+            speech = index.speech[offset:offset+e-b]
+            scale = index.scales[i]
+            vad_info_dense[b-start:e-start, head, 1] += scale * speech
+            vad_info_dense[b-start:e-start, head, 0] += scale * ~speech
+
+        if not has_self_overlap:
+            results.append((utt_id, None))
             continue
-        writer(utt_id, vad_info_dense)
+
+        total = vad_info_dense.sum(axis=2)
+        empty = (total == 0)
+        vad_info_dense[empty, 0] = 1
+        total[empty] = 1
+        vad_info_dense /= total[:, :, np.newaxis]
+        results.append((utt_id, vad_info_dense.reshape(end-start, 2*num_heads).astype(np.float32)))
+    return results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Usage: conv_vad_to_dense_targets.py <in-text-pos-vad-ali> <out-wspec> <utt2spk-1> <utt2spk-2> <utt2spk-3> <utt2spk-4> <segments-utt> <segments-ali> <utt2dur>')
     parser.add_argument('vad_ali', type=str)
     parser.add_argument('wspec', type=str)
-    parser.add_argument('utt2spk_n1', type=str)
-    parser.add_argument('utt2spk_n2', type=str)
-    parser.add_argument('utt2spk_n3', type=str)
-    parser.add_argument('utt2spk_n4', type=str)
+    parser.add_argument('utt2spk_n', type=str, nargs='+')
     parser.add_argument('segments_utt', type=str)
     parser.add_argument('segments_ali', type=str)
     parser.add_argument('utt2dur', type=str)
     parser.add_argument('--worn_scale', type=float, default=10)
+    parser.add_argument('--num_jobs', type=int, default=1)
 
     args = parser.parse_args()
 
     print('Options:')
     print('  Input vad ali in text format: {}'.format(args.vad_ali))
     print('  Output wspecifier: {}'.format(args.wspec))
-    print('  Utterance-to-spk map for head #1: {}'.format(args.utt2spk_n1))
-    print('  Utterance-to-spk map for head #2: {}'.format(args.utt2spk_n2))
-    print('  Utterance-to-spk map for head #3: {}'.format(args.utt2spk_n3))
-    print('  Utterance-to-spk map for head #4: {}'.format(args.utt2spk_n4))
+    for head, utt2spk in enumerate(args.utt2spk_n):
+        print('  Utterance-to-spk map for head #{}: {}'.format(head+1, utt2spk))
     print('  Segments for uid: {}'.format(args.segments_utt))
     print('  Segments for ali: {}'.format(args.segments_ali))
     print('  Utt2dur (in frames) for uid: {}'.format(args.utt2dur))
     print('  Worn scaling factor: {}'.format(args.worn_scale))
+    print('  Number of parallel jobs: {}'.format(args.num_jobs))
 
     assert os.path.exists(args.vad_ali), 'File does not exist {}'.format(args.vad_ali)
 
     print('Starting to convert')
 
-    print('Loading speaker info for head #1')
-    n_speakers=dict()
-    with open(args.utt2spk_n1,'r') as f:
-        for line in f:
-            uid, n_sid = line.strip().split()
-            n_spk = n_sid.split('_')[0]
-            n_spk_parts = n_spk.split('-')[:-2]
-            if n_spk_parts[0][:3]=='rev':
-                del n_spk_parts[0]
-            if len(n_spk_parts)>1 and n_spk_parts[1][:3]=='rev':
-                del n_spk_parts[1]
-            n_spk = '-'.join(n_spk_parts)
-            n_speakers[uid] = n_spk
-
-    print('Loading speaker info for head #2')
-    n_speakers2=dict()
-    with open(args.utt2spk_n2,'r') as f:
-        for line in f:
-            uid, n_sid = line.strip().split()
-            n_spk = n_sid.split('_')[0]
-            n_spk_parts = n_spk.split('-')[:-2]
-            if n_spk_parts[0][:3]=='rev':
-                del n_spk_parts[0]
-            if len(n_spk_parts)>1 and n_spk_parts[1][:3]=='rev':
-                del n_spk_parts[1]
-            n_spk = '-'.join(n_spk_parts)
-            n_speakers2[uid] = n_spk
-
-    print('Loading speaker info for head #3')
-    n_speakers3=dict()
-    with open(args.utt2spk_n3,'r') as f:
-        for line in f:
-            uid, n_sid = line.strip().split()
-            n_spk = n_sid.split('_')[0]
-            n_spk_parts = n_spk.split('-')[:-2]
-            if n_spk_parts[0][:3]=='rev':
-                del n_spk_parts[0]
-            if len(n_spk_parts)>1 and n_spk_parts[1][:3]=='rev':
-                del n_spk_parts[1]
-            n_spk = '-'.join(n_spk_parts)
-            n_speakers3[uid] = n_spk
-
-    print('Loading speaker info for head #4')
-    n_speakers4=dict()
-    with open(args.utt2spk_n4,'r') as f:
-        for line in f:
-            uid, n_sid = line.strip().split()
-            n_spk = n_sid.split('_')[0]
-            n_spk_parts = n_spk.split('-')[:-2]
-            if n_spk_parts[0][:3]=='rev':
-                del n_spk_parts[0]
-            if len(n_spk_parts)>1 and n_spk_parts[1][:3]=='rev':
-                del n_spk_parts[1]
-            n_spk = '-'.join(n_spk_parts)
-            n_speakers4[uid] = n_spk
+    head_speakers = list()
+    for head, utt2spk in enumerate(args.utt2spk_n):
+        print('Loading speaker info for head #{}'.format(head+1))
+        head_speakers.append(LoadHeadSpeakers(utt2spk))
 
     print('Loading segments boundaries')
     seg_by_uid = dict()
@@ -262,58 +160,41 @@ if __name__ == '__main__':
             seg_by_ali_uid[utt_id]=(int(float(start)*100),int(float(end)*100))
 
     print('Loading VAD alignment')
-    seg_by_sess = dict()
+    ali_by_sess = dict()
     with open(args.vad_ali) as f:
         for line in f:
             vad_info = line.strip().split()
             utt_id_ = vad_info[0]
-            vad_info = vad_info[1:]
+            speech = (np.array(vad_info[1:]) == '1')
 
             utt_id = utt_id_
             utt_id_parts=utt_id.split('-')
             utt_id = '-'.join(utt_id_parts[:-3])
             spk, sess, device = utt_id.split('_')[:3]
-            spk_parts = spk.split('-')
-            if spk_parts[0][:3]=='rev':
-                del spk_parts[0]
-            if len(spk_parts)>1 and spk_parts[1][:3]=='rev':
-                del spk_parts[1]
-            spk = '-'.join(spk_parts)
+            spk = StripRevPrefix(spk.split('-'))
 
+            scale = 1
             if device == 'NOLOCATION.L' or device == 'NOLOCATION.R':
-                device = 'W'
+                scale = args.worn_scale
 
-            if sess not in seg_by_sess:
-                seg_by_sess[sess] = list()
+            if sess not in ali_by_sess:
+                ali_by_sess[sess] = list()
             start, end = seg_by_ali_uid[utt_id_]
 
-            assert end-start >= len(vad_info), '{} {} {}'.format(start, end, len(vad_info))
-            assert end-start-len(vad_info)<=3, '{} {} {}'.format(start, end, len(vad_info))
-            end = start + len(vad_info)
-            seg_by_sess[sess].append((utt_id_, spk, '', '', '', '', start, end, vad_info, device))
+            assert end-start >= len(speech), '{} {} {}'.format(start, end, len(speech))
+            assert end-start-len(speech)<=3, '{} {} {}'.format(start, end, len(speech))
+            end = start + len(speech)
+            ali_by_sess[sess].append((spk, start, end, speech, scale))
 
     skip=0
-    for uid in n_speakers.keys():
-        n_spk = n_speakers[uid].split('_')[0]
-        if uid not in n_speakers2.keys():
-            skip+=1
-            continue
-        n_spk2 = n_speakers2[uid].split('_')[0]
-        if uid not in n_speakers3.keys():
-            skip+=1
-            continue
-        n_spk3 = n_speakers3[uid].split('_')[0]
-        if uid not in n_speakers4.keys():
+    utts_by_sess = dict()
+    for uid in head_speakers[0].keys():
+        if any(uid not in n_speakers for n_speakers in head_speakers[1:]):
             skip+=1
             continue
-        n_spk4 = n_speakers4[uid].split('_')[0]
+        head_spks = tuple(n_speakers[uid].split('_')[0] for n_speakers in head_speakers)
         spk, sess = uid.split('_')[:2]
-        spk_parts = spk.split('-')
-        if spk_parts[0][:3]=='rev':
-            del spk_parts[0]
-        if len(spk_parts)>1 and spk_parts[1][:3]=='rev':
-            del spk_parts[1]
-        spk = '-'.join(spk_parts)
+        spk = StripRevPrefix(spk.split('-'))
         if uid not in seg_by_uid.keys():
             skip+=1
             continue
@@ -321,16 +202,34 @@ if __name__ == '__main__':
         if uid not in len_by_uid.keys():
             skip+=1
             continue
-        vad_info = len_by_uid[uid]
-        assert end-start >= vad_info, '{} {} {}'.format(start, end, vad_info)
-        assert end-start-vad_info<=3, '{} {} {}'.format(start, end, vad_info)
-        end = start + vad_info
+        length = len_by_uid[uid]
+        assert end-start >= length, '{} {} {}'.format(start, end, length)
+        assert end-start-length<=3, '{} {} {}'.format(start, end, length)
+        end = start + length
 
-        seg_by_sess[sess].append((uid, spk, n_spk, n_spk2, n_spk3, n_spk4, start, end, [vad_info], 'kinect'))
+        if sess not in utts_by_sess:
+            utts_by_sess[sess] = list()
+        utts_by_sess[sess].append((uid, spk, head_spks, start, end))
 
     print('{} utts are skipped as missing in utt2spk'.format(skip))
     print('Processing segments session-by-session')
+    sessions = [sess for sess in ali_by_sess if sess in utts_by_sess]
+    sessions += [sess for sess in utts_by_sess if sess not in ali_by_sess]
+    tasks = ((SessionIndex(ali_by_sess.get(sess, [])), utts_by_sess[sess]) for sess in sessions)
+    pool = None
+    if args.num_jobs > 1 and len(sessions) > 1:
+        pool = Pool(min(args.num_jobs, len(sessions)))
+        results = pool.imap(ProcessSession, tasks)
+    else:
+        results = map(ProcessSession, tasks)
     with WriteHelper(args.wspec) as writer:
-        for sess in seg_by_sess:
+        for sess, sess_results in zip(sessions, results):
             print(sess)
-            ProcessSession(seg_by_sess[sess], writer, args.worn_scale)
\ No newline at end of file
+            for utt_id, vad_info_dense in sess_results:
+                if vad_info_dense is None:
+                    print("WARNING: utt {} does not have targets!".format(utt_id))
+                    continue
+                writer(utt_id, vad_info_dense)
+    if pool is not None:
+        pool.close()
+        pool.join()
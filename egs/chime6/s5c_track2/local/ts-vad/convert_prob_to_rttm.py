@@ -24,106 +24,127 @@ where:
 <name> = <speaker-id>
 <conf> = "<NA>"
 <slat> = "<NA>"
+
+The input probabilities are expected to be ordered by session and fragment
+index (e.g. "sort weights.ark |"), so sessions are read and converted one at
+a time (in parallel with --num_jobs > 1) and written to the RTTM as soon as
+they are ready.
 """
 
 
 import os
 import argparse
+from collections import deque
+from multiprocessing import Pool
 import regex as re
 import numpy as np
-from scipy import signal, ndimage
+from scipy import ndimage
 from kaldiio import ReadHelper
 
 
-class Segment:
-    def __init__(self, begin, end, label):
-        self.begin = begin
-        self.end = end
-        self.label = label
-
-    def length(self):
-        return self.end - self.begin
-
-
-class VadProbSet:
-    def __init__(self, vad_rspec, reg_exp):
-        data = dict()
-        prev = -1
-        with ReadHelper(vad_rspec) as reader:
-            for utid, prob in reader:
-                result = reg_exp.match(utid)
-                assert result is not None, 'Wrong utterance ID format: \"{}\"'.format(utid)
-                sess_indx = result.group(1)
-                spkr = result.group(2)
-
-                result = reg_exp.match(sess_indx)
-                assert result is not None, 'Wrong utterance ID format: \"{}\"'.format(sess_indx)
-                sess = result.group(1)
-                indx = int(result.group(2))
-
-                sess = sess + '-' + spkr
-
-                if sess not in data.keys():
-                    assert indx == 1
-                    prev = -1
-                    data[sess] = list()
-                assert indx >= prev
-                data[sess].append(prob)
-                prev = indx
-            reader.close()
-        print('  loaded {} sessions'.format(len(data)))
-        print('  combining fragments')
-        self.data = dict()
-        for sess, items in data.items():
-            self.data[sess] = np.hstack(items)
-
-    def apply_filter(self, window, threshold, threshold_first):
-        for sess in self.data.keys():
-            if threshold_first:
-                self.data[sess] = np.vectorize(lambda value: 1.0 if value > threshold else 0.0)(self.data[sess]).astype(dtype=np.int32)
-                if window > 1:
-                    self.data[sess] = signal.medfilt(self.data[sess], window).astype(dtype=np.int32)
-            else:
-                if window > 1:
-                    self.data[sess] = signal.medfilt(self.data[sess], window)
-                self.data[sess] = np.vectorize(lambda value: 1.0 if value > threshold else 0.0)(self.data[sess]).astype(dtype=np.int32)
-
-    def convert(self, frame_shift,  min_silence, min_speech, out_rttm):
-        min_silence = int(round(min_silence / frame_shift))
-        min_speech = int(round(min_speech / frame_shift))
-        with open(out_rttm, 'wt', encoding='utf-8') as wstream:
-            for sess, prob in self.data.items():
-                print('  session: {}  num_frames: {}  duration: {:.2f} hrs'.format(sess, len(prob), len(prob) * frame_shift / 60 / 60))
-                segments = list()
-                for i, label in enumerate(prob):
-                    if (len(segments) == 0) or (segments[-1].label != label):
-                        segments.append(Segment(i, i + 1, label))
-                    else:
-                        segments[-1].end += 1
-                if (min_silence > 0) or (min_speech > 0):
-                    items = segments
-                    segments = list()
-                    for segm in items:
-                        if len(segments) == 0:
-                            segments.append(segm)
-                        elif segm.label == segments[-1].label:
-                            segments[-1].end = segm.end
-                        else:
-                            min_length = min_silence if segm.label == 0 else min_speech
-                            if segm.length() < min_length:
-                                segments[-1].end = segm.end
-                            else:
-                                segments.append(segm)
-                for segm in segments:
-                    if segm.label == 1:
-                        begin = frame_shift * segm.begin
-                        length = frame_shift * segm.length()
-                        result = reg_exp.match(sess)
-                        assert result is not None, 'Wrong format: \"{}\"'.format(sess)
-                        utid = result.group(1)
-                        spk = result.group(2)
-                        wstream.write('SPEAKER {} 1 {:7.3f} {:7.3f} <NA> <NA> {} <NA> <NA>\n'.format(utid, begin, length, spk))
-        wstream.close()
+def ReadSessions(vad_rspec, reg_exp):
+    """Yields (sess, spkrs, probs, lengths) for every session of the rspecifier,
+       where probs[i, :lengths[i]] are the concatenated probabilities of
+       speaker spkrs[i] (the rest of the row is zero)."""
+    sess = None
+    chunks = dict()
+    done = set()
+
+    def Combine():
+        spkrs = list(chunks.keys())
+        lengths = np.array([sum(len(prob) for prob in chunks[spkr]) for spkr in spkrs], dtype=np.int64)
+        probs = np.zeros((len(spkrs), lengths.max()), dtype=np.float32)
+        for i, spkr in enumerate(spkrs):
+            np.concatenate(chunks[spkr], out=probs[i, :lengths[i]])
+        return sess, spkrs, probs, lengths
+
+    with ReadHelper(vad_rspec) as reader:
+        for utid, prob in reader:
+            result = reg_exp.match(utid)
+            assert result is not None, 'Wrong utterance ID format: \"{}\"'.format(utid)
+            sess_indx = result.group(1)
+            spkr = result.group(2)
+
+            result = reg_exp.match(sess_indx)
+            assert result is not None, 'Wrong utterance ID format: \"{}\"'.format(sess_indx)
+            utt_sess = result.group(1)
+            indx = int(result.group(2))
+
+            if utt_sess != sess:
+                if sess is not None:
+                    yield Combine()
+                    done.add(sess)
+                assert utt_sess not in done, 'Session {} is not contiguous in the input'.format(utt_sess)
+                sess = utt_sess
+                chunks = dict()
+                prev = dict()
+            if spkr not in chunks:
+                assert indx == 1
+                chunks[spkr] = list()
+                prev[spkr] = -1
+            assert indx >= prev[spkr]
+            chunks[spkr].append(prob)
+            prev[spkr] = indx
+        reader.close()
+    if sess is not None:
+        yield Combine()
+
+
+def ApplyFilter(probs, window, threshold, threshold_first):
+    """Thresholds and median-filters (with zero padding, as scipy.signal.medfilt)
+       every row of probs; returns 0/1 labels."""
+    if window > 1 and window % 2 == 0:
+        raise ValueError('Median filter window should be odd: {}'.format(window))
+    if threshold_first:
+        labels = (probs > threshold).astype(np.int32)
+        if window > 1:
+            labels = ndimage.median_filter(labels, size=(1, window), mode='constant')
+    else:
+        if window > 1:
+            probs = ndimage.median_filter(probs, size=(1, window), mode='constant')
+        labels = (probs > threshold).astype(np.int32)
+    return labels
+
+
+def GetSpeechSegments(labels, min_silence, min_speech):
+    """Returns begin and end frames of the speech segments of a 0/1 label
+       sequence. Silence (speech) runs shorter than min_silence (min_speech)
+       frames are merged into the preceding segment."""
+    if len(labels) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    begins = np.concatenate(([0], np.flatnonzero(np.diff(labels)) + 1))
+    ends = np.append(begins[1:], len(labels))
+    run_labels = labels[begins]
+    if (min_silence > 0) or (min_speech > 0):
+        min_length = np.where(run_labels == 0, min_silence, min_speech)
+        keep = (ends - begins) >= min_length
+        keep[0] = True
+        # a short run takes the label of the last kept run before it
+        last_kept = np.maximum.accumulate(np.where(keep, np.arange(len(keep)), 0))
+        run_labels = run_labels[last_kept]
+    speech = (run_labels == 1)
+    prev_speech = np.concatenate(([False], speech[:-1]))
+    next_speech = np.concatenate((speech[1:], [False]))
+    return begins[speech & ~prev_speech], ends[speech & ~next_speech]
+
+
+def ConvertSession(task):
+    """Returns log messages and RTTM lines of one session."""
+    (sess, spkrs, probs, lengths), opts = task
+    frame_shift, window, threshold, threshold_first, min_silence, min_speech = opts
+    min_silence = int(round(min_silence / frame_shift))
+    min_speech = int(round(min_speech / frame_shift))
+    labels = ApplyFilter(probs, window, threshold, threshold_first)
+    messages = list()
+    lines = list()
+    for i, spkr in enumerate(spkrs):
+        num_frames = int(lengths[i])
+        messages.append('  session: {}  num_frames: {}  duration: {:.2f} hrs'.format(sess + '-' + spkr, num_frames, num_frames * frame_shift / 60 / 60))
+        begins, ends = GetSpeechSegments(labels[i, :num_frames], min_silence, min_speech)
+        for begin, end in zip(begins.tolist(), ends.tolist()):
+            lines.append('SPEAKER {} 1 {:7.3f} {:7.3f} <NA> <NA> {} <NA> <NA>\n'.format(sess, frame_shift * begin, frame_shift * (end - begin), spkr))
+    return messages, lines
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Usage: convert_prob_to_wa.py <vad-rspec> <rttm>')
@@ -134,6 +155,7 @@ if __name__ == '__main__':
     parser.add_argument("--threshold_first", "-r", action="store_true")
     parser.add_argument("--min_silence", "-k", type=float, default=0.0)
     parser.add_argument("--min_speech", "-m", type=float, default=0.0)
+    parser.add_argument("--num_jobs", "-j", type=int, default=1)
     parser.add_argument('vad_rspec', type=str)
     parser.add_argument('out_rttm', type=str)
     args = parser.parse_args()
@@ -146,6 +168,7 @@ if __name__ == '__main__':
     print('  Apply thresh. first: {}'.format(args.threshold_first))
     print('  Min silence length:  {}'.format(args.min_silence))
     print('  Min speech length:   {}'.format(args.min_speech))
+    print('  Number of jobs:      {}'.format(args.num_jobs))
     print('  VAD rspec:           {}'.format(args.vad_rspec))
     print('  Output rttm file:    {}'.format(args.out_rttm))
 
@@ -155,11 +178,31 @@ if __name__ == '__main__':
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    print('Loading VAD probabilities')
-    vad_prob = VadProbSet(args.vad_rspec, reg_exp)
-
-    print('Applying filtering')
-    vad_prob.apply_filter(args.window, args.threshold, args.threshold_first)
-
-    print('Writing rttm')
-    vad_prob.convert(args.frame_shift, args.min_silence, args.min_speech, args.out_rttm)
+    opts = (args.frame_shift, args.window, args.threshold, args.threshold_first, args.min_silence, args.min_speech)
+    tasks = ((session, opts) for session in ReadSessions(args.vad_rspec, reg_exp))
+
+    print('Converting VAD probabilities to rttm')
+    num_sessions = 0
+    with open(args.out_rttm, 'wt', encoding='utf-8') as wstream:
+        def Write(result):
+            messages, lines = result
+            for message in messages:
+                print(message)
+            wstream.writelines(lines)
+
+        if args.num_jobs > 1:
+            # at most 2 * num_jobs sessions are kept in memory
+            with Pool(args.num_jobs) as pool:
+                pending = deque()
+                for task in tasks:
+                    pending.append(pool.apply_async(ConvertSession, (task,)))
+                    if len(pending) >= 2 * args.num_jobs:
+                        Write(pending.popleft().get())
+                    num_sessions += 1
+                while pending:
+                    Write(pending.popleft().get())
+        else:
+            for task in tasks:
+                Write(ConvertSession(task))
+                num_sessions += 1
+    print('  converted {} sessions'.format(num_sessions))
@@ -7,7 +7,9 @@
     The output is written to 'image2num_frames' in the given data dir. This
     file is later used by image/get_allowed_lengths.py to find a set of allowed lengths
     for the data dir. The output format is similar to utt2num_frames
-
+    If the data dir has image shards (listed in 'image_shards', see
+    image/images_to_shards.py), the image sizes are looked up in the index of
+    the shards instead of opening the images.
 """
 
 import argparse
@@ -15,6 +17,7 @@ import os
 import sys
 import numpy as np
 from PIL import Image
+from image_shard import read_shard_index, read_shard_list
 
 parser = argparse.ArgumentParser(description="""Computes the image lengths (i.e. width) in an image data dir
                                                 and writes them (by default) to image2num_frames.""")
@@ -31,9 +34,12 @@ parser.add_argument('--padding', type=int, default=5,
 args = parser.parse_args()
 
 
-def get_scaled_image_length(im):
+def get_scaled_image_length(size):
+    """ Given the size (width, height) of an image, returns its width after
+        scaling its height to feat_dim.
+    """
     scale_size = args.feat_dim
-    sx, sy = im.size
+    sx, sy = size
     scale = (1.0 * scale_size) / sy
     nx = int(scale * sx)
     return nx
@@ -48,14 +54,24 @@ if args.out_ark == '-':
 else:
     out_fh = open(args.out_ark, 'w', encoding='latin-1')
 
+image_sizes = {}
+shard_list_path = os.path.join(args.dir, 'image_shards')
+if os.path.isfile(shard_list_path):
+    for shard_path in read_shard_list(shard_list_path):
+        for entry in read_shard_index(shard_path)[1]:
+            image_sizes[entry.image_id] = (entry.width, entry.height)
+
 with open(data_list_path) as f:
     for line in f:
         line = line.strip()
         line_vect = line.split(' ')
         image_id = line_vect[0]
         image_path = line_vect[1]
-        im = Image.open(image_path)
-        im_len = get_scaled_image_length(im) + (args.padding * 2)
+        if image_id in image_sizes:
+            size = image_sizes[image_id]
+        else:
+            size = Image.open(image_path).size
+        im_len = get_scaled_image_length(size) + (args.padding * 2)
         print('{} {}'.format(image_id, im_len), file=out_fh)
 
 out_fh.close()
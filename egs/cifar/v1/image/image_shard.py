@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Apache 2.0
+
+""" This module reads and writes image shards: single files that contain a set
+    of images as packed uint8 pixels, with an index of the images at the top.
+    It is used by image/images_to_shards.py, image/shards_to_matrix.py and
+    image/get_image2num_frames.py.
+
+    The format of a shard is:
+      kaldi-image-shard <header-size>\n     (<header-size> is 12 digits wide)
+      <image-id> <offset> <height> <width> <num-channels> [<label>]\n
+      ...                                    (one line per image)
+      <pixels of the images>
+    The first two parts (the header) are <header-size> bytes long (utf-8), and
+    <offset> is the byte offset of the pixels of the image from the end of the
+    header. The pixels of an image are stored row by row (from the top of the
+    image), with the channel varying the fastest, i.e. as a numpy array of
+    shape (height, width, num-channels). The label (e.g. the class of the image
+    for CIFAR) is an optional string.
+
+    The pixels are memory-mapped when a shard is opened with ShardReader, so
+    an image is only read from disk when it is accessed, and the dimensions of
+    all the images can be obtained from the header without reading any pixels
+    (see read_shard_index()).
+"""
+
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = 'kaldi-image-shard'
+_FIRST_LINE_LEN = len(MAGIC) + 14  # magic, space, 12 digits and newline
+
+""" shard_entry is a named tuple that describes one image in a shard.
+    offset is the byte offset of its pixels from the end of the header,
+    and label is None if the image has no label.
+"""
+shard_entry = namedtuple('shard_entry', 'image_id offset height width '
+                                        'num_channels label')
+
+
+def read_shard_index(shard_path):
+    """ Reads the header of a shard.
+    Returns
+    -------
+    (int, [shard_entry]): the size of the header (i.e. where the pixels start)
+                          and the entries of the images in the shard, in order.
+    """
+    with open(shard_path, 'rb') as f:
+        first_line = f.read(_FIRST_LINE_LEN).decode('utf-8').split()
+        if len(first_line) != 2 or first_line[0] != MAGIC:
+            raise Exception("{} is not an image shard".format(shard_path))
+        header_size = int(first_line[1])
+        lines = f.read(header_size - _FIRST_LINE_LEN).decode('utf-8').split('\n')
+    entries = []
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) not in (5, 6):
+            raise Exception("Bad line in the header of shard {}: {}".format(
+                shard_path, line))
+        entries.append(shard_entry(parts[0], int(parts[1]), int(parts[2]),
+                                   int(parts[3]), int(parts[4]),
+                                   parts[5] if len(parts) == 6 else None))
+    return header_size, entries
+
+
+def read_shard_list(path):
+    """ Reads a file that lists shards (one path per line), e.g.
+        'data/train/image_shards' as written by image/images_to_shards.py.
+    Returns
+    -------
+    [string]: the shard paths.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class ShardWriter(object):
+    """ Writes images to a shard. The pixels are first written to a temporary
+        file next to the shard and are copied after the header when close()
+        is called, since the header has to be complete before it is written.
+        E.g.:
+          writer = ShardWriter('shards/shard.1.img')
+          writer.write('00001', pixels, label='6')
+          writer.close()
+    """
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.tmp_path = shard_path + '.tmp'
+        self.pixels_fh = open(self.tmp_path, 'wb')
+        self.entries = []
+        self.offset = 0
+
+    def write(self, image_id, pixels, label=None):
+        """ Adds an image. 'pixels' is an array of shape (height, width) or
+            (height, width, num_channels), with values in 0..255.
+        """
+        pixels = np.asarray(pixels)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, np.newaxis]
+        if pixels.ndim != 3 or pixels.size == 0:
+            raise Exception("Bad image {} with shape {}".format(image_id,
+                                                                pixels.shape))
+        if label is not None and len(str(label).split()) != 1:
+            raise Exception("Bad label for image {}: '{}'".format(image_id, label))
+        height, width, num_channels = pixels.shape
+        self.entries.append(shard_entry(image_id, self.offset, height, width,
+                                        num_channels, label))
+        data = np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+        self.pixels_fh.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        self.pixels_fh.close()
+        index = []
+        for entry in self.entries:
+            fields = [entry.image_id, entry.offset, entry.height, entry.width,
+                      entry.num_channels]
+            if entry.label is not None:
+                fields.append(entry.label)
+            index.append(' '.join(map(str, fields)) + '\n')
+        index = ''.join(index).encode('utf-8')
+        header_size = _FIRST_LINE_LEN + len(index)
+        with open(self.shard_path, 'wb') as f:
+            f.write('{} {:012d}\n'.format(MAGIC, header_size).encode('utf-8'))
+            f.write(index)
+            with open(self.tmp_path, 'rb') as pixels_fh:
+                shutil.copyfileobj(pixels_fh, f)
+        os.remove(self.tmp_path)
+
+
+class ShardReader(object):
+    """ Gives access to the images in a shard, with the pixels memory-mapped.
+        Iterating over it yields (shard_entry, pixels) in the order in which
+        the images were written; reader[image_id] returns the pixels of one
+        image as a read-only uint8 array of shape (height, width, num_channels).
+    """
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.header_size, self.entries = read_shard_index(shard_path)
+        self.index = {entry.image_id: entry for entry in self.entries}
+        if os.path.getsize(shard_path) > self.header_size:
+            self.data = np.memmap(shard_path, dtype=np.uint8, mode='r',
+                                  offset=self.header_size)
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, image_id):
+        return image_id in self.index
+
+    def get_pixels(self, entry):
+        size = entry.height * entry.width * entry.num_channels
+        return self.data[entry.offset:entry.offset + size].reshape(
+            entry.height, entry.width, entry.num_channels)
+
+    def __getitem__(self, image_id):
+        return self.get_pixels(self.index[image_id])
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield entry, self.get_pixels(entry)
+
+
+def pixels_to_matrix(pixels):
+    """ Converts the pixels of an image (as stored in a shard) to the feature
+        matrix of the image as used in this directory (see matrix_to_image.py):
+        the number of rows equals the width of the image, and the number of
+        columns equals the height of the image times the number of channels,
+        with the channel varying the fastest. The values are scaled to [0, 1].
+    """
+    height, width, num_channels = pixels.shape
+    return (np.transpose(pixels, (1, 0, 2)).reshape(width, height * num_channels)
+            .astype(np.float32) / 255.0)
+
+
+def matrix_to_pixels(matrix, num_channels):
+    """ The inverse of pixels_to_matrix(); the values are rounded to 0..255. """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    width, num_cols = matrix.shape
+    if num_cols % num_channels != 0:
+        raise Exception("Number of columns should be a multiple of {}".format(
+            num_channels))
+    pixels = np.clip(np.rint(matrix * 255.0), 0, 255).astype(np.uint8)
+    return np.transpose(pixels.reshape(width, num_cols // num_channels,
+                                       num_channels), (1, 0, 2))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Apache 2.0
+
+""" This script packs the images of an image data dir into image shards (see
+    image/image_shard.py for the format): files that contain the uint8 pixels
+    of many images, with an index of the image ids, dimensions and labels at
+    the top. The shards are written to <shard-dir>/shard.<n>.img and their
+    paths are listed in <dir>/image_shards, which is used by
+    image/get_image2num_frames.py and image/shards_to_matrix.py.
+
+    By default, the images listed in <dir>/images.scp are read. With
+    --from-ark, Kaldi-format text matrices in the format described in
+    image/matrix_to_image.py are read instead (e.g. the output of
+    local/process_data.py, or copy-feats with an ark,t: output), and the
+    values are scaled from [0, 1] to 0..255.
+    E.g.:
+      image/images_to_shards.py --num-channels 3 --labels data/train/labels.txt \
+          --from-ark <(copy-feats scp:data/train/feats.scp ark,t:-) \
+          data/train data/train/shards
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from image_shard import ShardWriter, matrix_to_pixels
+
+parser = argparse.ArgumentParser(description="""Packs the images of a data dir
+                                 into image shards and lists them in
+                                 'dir'/image_shards.""")
+parser.add_argument('dir', type=str,
+                    help='Source data directory (containing images.scp)')
+parser.add_argument('shard_dir', type=str,
+                    help='Where to write the shards')
+parser.add_argument('--images-per-shard', type=int, default=5000,
+                    help='Maximum number of images in each shard')
+parser.add_argument('--num-channels', type=int, choices=(1, 3), default=1,
+                    help='3 if the images are in RGB, 1 if they are in grayscale '
+                    '(the images in images.scp are converted if needed).')
+parser.add_argument('--labels', type=str, default=None,
+                    help='If supplied, a file with lines "<image-id> <label>" '
+                    '(e.g. labels.txt in CIFAR data dirs); the labels are '
+                    'stored in the shards.')
+parser.add_argument('--from-ark', type=str, default=None,
+                    help='If supplied, read the images as Kaldi-format text '
+                    'matrices from this file ("-" for stdin) instead of '
+                    'reading images.scp.')
+args = parser.parse_args()
+
+
+def read_images_scp():
+    """ Yields (image_id, pixels) for the images in images.scp. """
+    from PIL import Image
+    mode = 'L' if args.num_channels == 1 else 'RGB'
+    with open(os.path.join(args.dir, 'images.scp')) as f:
+        for line in f:
+            line_vect = line.strip().split(' ')
+            image_id = line_vect[0]
+            image_path = line_vect[1]
+            yield image_id, np.asarray(Image.open(image_path).convert(mode))
+
+
+def read_text_matrices(file_handle):
+    """ Yields (image_id, pixels) for the Kaldi-format text matrices in
+        file_handle.
+    """
+    key = None
+    rows = []
+    for line in file_handle:
+        line = line.split()
+        if not line:
+            continue
+        if key is None:
+            if len(line) < 2 or line[1] != '[':
+                raise Exception("Expected '<key> [' at the start of a "
+                                "matrix, got: {}".format(' '.join(line)))
+            key = line[0]
+            line = line[2:]
+        end = bool(line) and line[-1] == ']'
+        if end:
+            line = line[:-1]
+        if line:
+            rows.append(line)
+        if end:
+            if not rows:
+                raise Exception("Matrix {} is empty".format(key))
+            matrix = np.array(rows, dtype=np.float64)
+            yield key, matrix_to_pixels(matrix, args.num_channels)
+            key = None
+            rows = []
+
+
+### main ###
+labels = {}
+if args.labels is not None:
+    with open(args.labels) as f:
+        for line in f:
+            line_vect = line.strip().split()
+            if line_vect:
+                labels[line_vect[0]] = line_vect[1]
+
+if args.from_ark is None:
+    images = read_images_scp()
+elif args.from_ark == '-':
+    images = read_text_matrices(sys.stdin)
+else:
+    images = read_text_matrices(open(args.from_ark))
+
+if not os.path.isdir(args.shard_dir):
+    os.makedirs(args.shard_dir)
+
+shard_paths = []
+writer = None
+num_images = 0
+for image_id, pixels in images:
+    if num_images % args.images_per_shard == 0:
+        if writer is not None:
+            writer.close()
+        shard_path = os.path.join(args.shard_dir,
+                                  'shard.{}.img'.format(len(shard_paths) + 1))
+        shard_paths.append(shard_path)
+        writer = ShardWriter(shard_path)
+    writer.write(image_id, pixels, labels.get(image_id))
+    num_images += 1
+if writer is not None:
+    writer.close()
+
+with open(os.path.join(args.dir, 'image_shards'), 'w', encoding='utf-8') as f:
+    for shard_path in shard_paths:
+        print(shard_path, file=f)
+
+print("{}: wrote {} images to {} shards in {}".format(
+    sys.argv[0], num_images, len(shard_paths), args.shard_dir), file=sys.stderr)
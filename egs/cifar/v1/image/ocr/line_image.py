@@ -0,0 +1,259 @@
+# Copyright   2018 Ashish Arora
+#             2018 Chun Chieh Chang
+# Apache 2.0
+# minimum bounding box part in this script is originally from
+#https://github.com/BebeSparkelSparkel/MinimumBoundingBox
+#https://startupnextdoor.com/computing-convex-hull-in-python/
+""" This module contains the functions that are shared by the scripts which
+ extract line images from page images (local/create_line_image_from_page_image.py
+ in madcat_ar, madcat_zh, yomdle_fa, yomdle_zh and yomdle_tamil).
+ Given the word segmentation (bounding box around a word) for every word of a
+ line, the convex hull of the corner points is computed once and the minimum
+ area bounding box of the line is found from it. The bounding box will not
+ necessarily be vertically or horizontally aligned; the line image is cut out
+ of the page image and rotated to horizontal with a single affine warp.
+ The pages are processed in a process pool (see map_pages()).
+ The scripts import it with sys.path.insert(0, 'image/ocr').
+"""
+
+import xml.etree.ElementTree as ElementTree
+from math import atan2, cos, sin, pi, degrees, radians, sqrt
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.spatial import ConvexHull
+from PIL import Image
+
+
+def pad_image(image, padding, mode='RGB'):
+    """ Given an image, returns a padded image around the border.
+        This routine save the code from crashing if bounding boxes that are
+        slightly outside the page boundary. The page is padded by padding // 2
+        pixels on the left and top, and the word coordinates need to be
+        shifted by the same offset (see get_hull()).
+    Returns
+    -------
+    image: page image
+    """
+    offset = int(padding // 2)
+    padded_image = Image.new(mode, (image.size[0] + int(padding),
+                                    image.size[1] + int(padding)), "white")
+    padded_image.paste(im=image, box=(offset, offset))
+    return padded_image
+
+
+def get_hull(points, padding):
+    """ Given the list of 2D points (the corners of the word bounding boxes of a
+        line) in page coordinates, returns the vertices of their convex hull in
+        the coordinates of the padded page (see pad_image()), in counterclockwise
+        order, as an array of shape (num_vertices, 2).
+        Raises an exception if there are fewer than 3 points or all of them
+        are on a line.
+    """
+    if len(points) <= 2:
+        raise ValueError('More than two points required.')
+    points = np.asarray(points) + int(padding // 2)
+    return points[ConvexHull(points).vertices]
+
+
+def dilate_polygon(points, amount_increase):
+    """ Increases size of polygon given as an array of shape (num_points, 2).
+        Assumes points in polygon are given in CCW order.
+    Returns
+    -------
+    an array of shape (num_points, 2) of integer points.
+    """
+    points = np.asarray(points)
+    prev_edge = points - np.roll(points, 1, axis=0)
+    next_edge = np.roll(points, -1, axis=0) - points
+
+    prev_normal = np.stack((prev_edge[:, 1], -prev_edge[:, 0]), axis=1)
+    prev_normal = prev_normal / np.linalg.norm(prev_normal, axis=1, keepdims=True)
+    next_normal = np.stack((next_edge[:, 1], -next_edge[:, 0]), axis=1)
+    next_normal = next_normal / np.linalg.norm(next_normal, axis=1, keepdims=True)
+
+    bisect = prev_normal + next_normal
+    bisect = bisect / np.linalg.norm(bisect, axis=1, keepdims=True)
+
+    cos_theta = np.sum(next_normal * bisect, axis=1)
+    hyp = float(amount_increase) / cos_theta
+
+    return np.around(points + hyp[:, np.newaxis] * bisect).astype(int)
+
+
+def minimum_bounding_box(hull):
+    """ Given the vertices of a convex polygon in order (e.g. as returned by
+        get_hull()), it returns the minimum area rectangle bounding all the
+        points. One side of the rectangle is parallel to an edge of the hull;
+        all the edges are tried at once.
+    Returns
+    -------
+    (corner_points, unit_vector):
+    corner_points: array of shape (4, 2), the corners of the rectangle
+    unit_vector (float, float): direction of one of the sides of the rectangle
+    """
+    hull = np.asarray(hull, dtype=float)
+    edges = np.roll(hull, -1, axis=0) - hull
+    edge_length = np.sqrt(edges[:, 0] ** 2 + edges[:, 1] ** 2)
+    # unit vectors parallel and orthogonal to each edge, with shape
+    # (num_edges, 2).
+    unit_p = edges / edge_length[:, np.newaxis]
+    unit_o = np.stack((-unit_p[:, 1], unit_p[:, 0]), axis=1)
+
+    # projections of all the points on all the edge directions, with shape
+    # (num_edges, num_points).
+    dis_p = unit_p.dot(hull.T)
+    dis_o = unit_o.dot(hull.T)
+    min_p = dis_p.min(axis=1)
+    min_o = dis_o.min(axis=1)
+    len_p = dis_p.max(axis=1) - min_p
+    len_o = dis_o.max(axis=1) - min_o
+
+    # the first of the edges with the smallest area.
+    i = int(np.argmin(len_p * len_o))
+    unit_vector = (float(unit_p[i, 0]), float(unit_p[i, 1]))
+    len_p, len_o = float(len_p[i]), float(len_o[i])
+    center_p = float(min_p[i]) + len_p / 2
+    center_o = float(min_o[i]) + len_o / 2
+
+    # convert the center to x, y coordinates and rotate the corners around it.
+    # (this is done in the same way as in the original scripts, so that the
+    # corners that are at integer coordinates are rounded in the same way).
+    unit_vector_angle = atan2(unit_vector[1], unit_vector[0])
+    angle_orthogonal = unit_vector_angle + pi / 2
+    center = (center_p * cos(unit_vector_angle) + center_o * cos(angle_orthogonal),
+              center_p * sin(unit_vector_angle) + center_o * sin(angle_orthogonal))
+    corner_points = []
+    for i1 in (.5, -.5):
+        for i2 in (i1, -1 * i1):
+            corner = (center[0] + i1 * len_p, center[1] + i2 * len_o)
+            diff = (corner[0] - center[0], corner[1] - center[1])
+            diff_angle = atan2(diff[1], diff[0]) + unit_vector_angle
+            diff_length = sqrt(diff[0] ** 2 + diff[1] ** 2)
+            corner_points.append((center[0] + diff_length * cos(diff_angle),
+                                  center[1] + diff_length * sin(diff_angle)))
+    return np.array(corner_points), unit_vector
+
+
+def get_horizontal_angle(unit_vector_angle):
+    """ Given an angle in radians, returns angle of the unit vector in
+        first or fourth quadrant.
+    Returns
+    ------
+    (float): updated angle of the unit vector to be in radians.
+             It is only in first or fourth quadrant.
+    """
+    if unit_vector_angle > pi / 2 and unit_vector_angle <= pi:
+        unit_vector_angle = unit_vector_angle - pi
+    elif unit_vector_angle > -pi and unit_vector_angle < -pi / 2:
+        unit_vector_angle = unit_vector_angle + pi
+
+    return unit_vector_angle
+
+
+def get_smaller_angle(unit_vector):
+    """ Given the direction of one of the sides of a rectangle, returns the
+        smallest absolute angle of the rectangle from horizontal axis.
+    Returns
+    ------
+    (float): smallest angle of the rectangle to be in radians.
+    """
+    unit_vector_angle = atan2(unit_vector[1], unit_vector[0])
+    ortho_vector_angle = atan2(unit_vector[0], -1 * unit_vector[1])
+
+    unit_vector_angle_updated = get_horizontal_angle(unit_vector_angle)
+    ortho_vector_angle_updated = get_horizontal_angle(ortho_vector_angle)
+
+    if abs(unit_vector_angle_updated) < abs(ortho_vector_angle_updated):
+        return unit_vector_angle_updated
+    else:
+        return ortho_vector_angle_updated
+
+
+def extract_line_image(image, corner_points, unit_vector):
+    """ Given the (padded) page image and a rectangle in it, returns the part of
+        the page image inside the axis-aligned bounding box of the rectangle
+        after the rectangle has been rotated to horizontal.
+        This gives the same image as cropping the bounding box of the rectangle,
+        rotating the crop around its center (with PIL's Image.rotate()) and
+        cropping the bounding box of the rotated rectangle, but the three steps
+        are done with a single affine transform of the page image.
+    """
+    corner_points = np.asarray(corner_points)
+    min_x, min_y = corner_points.min(axis=0).astype(int)
+    max_x, max_y = corner_points.max(axis=0).astype(int)
+    # the center of the crop, as used by rotated_points() in the
+    # original scripts and by Image.rotate().
+    crop_w, crop_h = max_x - min_x, max_y - min_y
+    center_x, center_y = int(crop_w / 2), int(crop_h / 2)
+    rotate_center_x, rotate_center_y = crop_w / 2, crop_h / 2
+
+    angle = get_smaller_angle(unit_vector)
+    # the corners of the rectangle rotated to horizontal, in the coordinates
+    # of the crop.
+    rot = -angle
+    x = corner_points[:, 0] - min_x - center_x
+    y = corner_points[:, 1] - min_y - center_y
+    x_dash = x * cos(rot) - y * sin(rot) + center_x
+    y_dash = y * cos(rot) + x * sin(rot) + center_y
+    box_min_x, box_min_y = int(x_dash.min()), int(y_dash.min())
+    box_max_x, box_max_y = int(x_dash.max()), int(y_dash.max())
+
+    # this is the matrix that Image.rotate(degrees(angle)) uses, mapping from
+    # the rotated crop to the crop; it is composed with the two crops, which
+    # are translations.
+    angle = -radians(degrees(angle) % 360.0)
+    a, b = round(cos(angle), 15), round(sin(angle), 15)
+    d, e = round(-sin(angle), 15), round(cos(angle), 15)
+    c = a * -rotate_center_x + b * -rotate_center_y + rotate_center_x
+    f = d * -rotate_center_x + e * -rotate_center_y + rotate_center_y
+    matrix = (a, b, a * box_min_x + b * box_min_y + c + min_x,
+              d, e, d * box_min_x + e * box_min_y + f + min_y)
+    return image.transform((box_max_x - box_min_x, box_max_y - box_min_y),
+                           Image.AFFINE, matrix, resample=Image.BICUBIC)
+
+
+def read_madcat_zones(madcat_file_path):
+    """ Given a madcat xml file, yields the pairs (zone-id, points) for its
+        zones, in order, where points is the list of corner points (x, y) of the
+        token images of the zone.  The file is parsed incrementally.
+    """
+    zone_id = None
+    in_token_image = 0
+    points = []
+    for event, elem in ElementTree.iterparse(madcat_file_path,
+                                             events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if tag == 'zone' and zone_id is None:
+                zone_id = elem.get('id')
+                points = []
+            elif tag == 'token-image' and zone_id is not None:
+                in_token_image += 1
+            continue
+        if tag == 'point' and in_token_image > 0:
+            points.append((int(elem.get('x')), int(elem.get('y'))))
+        elif tag == 'token-image' and zone_id is not None:
+            in_token_image -= 1
+        elif tag == 'zone' and in_token_image == 0:
+            yield zone_id, points
+            zone_id = None
+            elem.clear()
+
+
+def map_pages(process_page, pages, num_jobs=1,
+              initializer=None, initargs=()):
+    """ Yields process_page(page) for each element of 'pages', in order.
+        If num_jobs > 1, the pages are processed in a pool of num_jobs
+        processes, which are set up by calling initializer(*initargs);
+        process_page must then be a module-level function.
+    """
+    if num_jobs > 1:
+        with Pool(num_jobs, initializer=initializer, initargs=initargs) as pool:
+            for result in pool.imap(process_page, pages):
+                yield result
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        for page in pages:
+            yield process_page(page)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Apache 2.0
+
+""" This script converts the images in the image shards of a data dir (listed
+    in <dir>/image_shards, see image/images_to_shards.py) to Kaldi-format
+    feature matrices in the format described in image/matrix_to_image.py,
+    so they can be used wherever the features of images are read (e.g. by
+    image/nnet3/get_egs.sh through feats.scp). The matrices are written to
+    standard output (by default) in binary form.
+    E.g.:
+      image/shards_to_matrix.py data/train --out-labels data/train/labels.txt | \
+          copy-feats ark:- ark,scp:data/train/data/images.ark,data/train/feats.scp
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from signal import signal, SIGPIPE, SIG_DFL
+from image_shard import ShardReader, read_shard_list, pixels_to_matrix
+signal(SIGPIPE, SIG_DFL)
+
+parser = argparse.ArgumentParser(description="""Converts the images in the
+                                 image shards of a data dir to Kaldi-format
+                                 feature matrices.""")
+parser.add_argument('dir', type=str,
+                    help='Data directory (containing image_shards)')
+parser.add_argument('--out-ark', type=str, default='-',
+                    help='Where to write the output feature file')
+parser.add_argument('--binary', type=lambda x: (str(x).lower() == 'true'),
+                    default=True,
+                    help='If false, write the matrices in text form')
+parser.add_argument('--out-labels', type=str, default=None,
+                    help='If supplied, write the labels of the images to this '
+                    'file, as lines "<image-id> <label>".')
+args = parser.parse_args()
+
+
+def write_kaldi_matrix(file_handle, matrix, key):
+    if args.binary:
+        file_handle.write(key.encode('utf-8') + b' \0BFM \4' +
+                          np.int32(matrix.shape[0]).tobytes() + b'\4' +
+                          np.int32(matrix.shape[1]).tobytes() +
+                          np.ascontiguousarray(matrix).tobytes())
+    else:
+        rows = [' '.join(map(str, row)) for row in matrix.tolist()]
+        file_handle.write((key + '  [ ' + '\n  '.join(rows) + ' ]\n').encode('utf-8'))
+
+
+### main ###
+if args.out_ark == '-':
+    out_fh = sys.stdout.buffer
+else:
+    out_fh = open(args.out_ark, 'wb')
+labels_fh = None
+if args.out_labels is not None:
+    labels_fh = open(args.out_labels, 'w', encoding='utf-8')
+
+num_images = 0
+for shard_path in read_shard_list(os.path.join(args.dir, 'image_shards')):
+    for entry, pixels in ShardReader(shard_path):
+        write_kaldi_matrix(out_fh, pixels_to_matrix(pixels), entry.image_id)
+        if labels_fh is not None and entry.label is not None:
+            print(entry.image_id, entry.label, file=labels_fh)
+        num_images += 1
+
+out_fh.close()
+if labels_fh is not None:
+    labels_fh.close()
+print("{}: wrote {} matrices".format(sys.argv[0], num_images), file=sys.stderr)
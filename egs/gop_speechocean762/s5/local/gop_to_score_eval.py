@@ -1,13 +1,15 @@
 # Copyright 2021  Xiaomi Corporation (Author: Junbo Zhang, Yongqing Wang)
 # Apache 2.0
 
-# This script does phone-level pronunciation scoring by GOP values.
+# This script does phone-level pronunciation scoring by GOP values, using the
+# per-phone quadratic coefficients trained by gop_to_score_train.py. All the
+# phones are scored at once.
 
 import sys
 import argparse
 import pickle
 import kaldi_io
-from utils import round_score
+import numpy as np
 
 
 def get_args():
@@ -26,16 +28,30 @@ def main():
     args = get_args()
 
     with open(args.model, 'rb') as f:
-        model_of = pickle.load(f)
+        coefs = pickle.load(f)
+
+    ph_keys, phones, gops_all = [], [], []
+    for key, gops in kaldi_io.read_post_scp(args.gop_scp):
+        for i, [(ph, gop)] in enumerate(gops):
+            ph_keys.append(f'{key}.{i}')
+            phones.append(ph)
+            gops_all.append(gop)
+    phones = np.array(phones, dtype=np.int64)
+    gops_all = np.array(gops_all, dtype=np.float64)
+
+    known = phones < len(coefs)
+    known[known] = ~np.isnan(coefs[phones[known], 0])
+    if not known.all():
+        raise KeyError(f'No model for phone {phones[~known][0]}')
+
+    c = coefs[phones]
+    scores = c[:, 0] + c[:, 1] * gops_all + c[:, 2] * gops_all * gops_all
+    # The same as utils.round_score(score, 1)
+    scores = np.round(np.clip(scores, 0, 2))
 
     with open(args.output, 'wt') as f:
-        for key, gops in kaldi_io.read_post_scp(args.gop_scp):
-            for i, [(ph, gop)] in enumerate(gops):
-                ph_key = f'{key}.{i}'
-                c, b = model_of[ph]
-                score = b + c[0] + c[1] * gop + c[2] * gop * gop
-                score = round_score(score, 1)
-                f.write(f'{ph_key}\t{score:.1f}\t{ph}\n')
+        for ph_key, score, ph in zip(ph_keys, scores.tolist(), phones.tolist()):
+            f.write(f'{ph_key}\t{score:.1f}\t{ph}\n')
 
 
 if __name__ == "__main__":
@@ -2,7 +2,10 @@
 # Apache 2.0
 
 # This script trains a simple polynomial regression model to convert GOP into
-# human expert scores.
+# human expert scores. The quadratic regressions of all the phones are solved
+# together from their normal equations, and the model is stored as an array of
+# shape (num_phones, 3) holding the coefficients of 1, gop and gop^2 for each
+# phone (NaN for phones without training data).
 
 
 import sys
@@ -10,10 +13,8 @@ import argparse
 import pickle
 import kaldi_io
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.linear_model import LinearRegression
-from utils import load_phone_symbol_table, load_human_scores, balanced_sampling
+from utils import (load_phone_symbol_table, load_human_scores,
+                   balanced_sample_weights)
 
 
 def get_args():
@@ -24,7 +25,9 @@ def get_args():
     parser.add_argument('--phone-symbol-table', type=str, default='',
                         help='Phone symbol table, used for detect unmatch '
                              'feature and labels.')
-    parser.add_argument('--nj', type=int, default=1, help='Job number')
+    parser.add_argument('--nj', type=int, default=1,
+                        help='Job number (not used any more, all the phones '
+                             'are trained at once)')
     parser.add_argument('gop_scp', help='Input gop file, in Kaldi scp')
     parser.add_argument('human_scoring_json',
                         help='Input human scores file, in JSON format')
@@ -34,15 +37,94 @@ def get_args():
     return args
 
 
-def train_model_for_phone(label_feat_pairs):
-    model = LinearRegression()
-    labels, gops = list(zip(*label_feat_pairs))
-    labels = np.array(labels).reshape(-1, 1)
-    gops = np.array(gops).reshape(-1, 1)
-    gops = PolynomialFeatures(2).fit_transform(gops)
-    gops, labels = balanced_sampling(gops, labels)
-    model.fit(gops, labels)
-    return model.coef_, model.intercept_
+def train_models(phones, gops, labels):
+    """ Fits score = c0 + c1 * gop + c2 * gop^2 for each phone by weighted least
+        squares, with the labels of each phone balanced as in
+        balanced_sampling() (see balanced_sample_weights()).
+        As in sklearn's LinearRegression, gop and gop^2 are centred on their
+        weighted means for each phone, the 2x2 normal equations of c1 and c2
+        are solved for all the phones at once (with the minimum-norm solution
+        if they are singular) and c0 is recovered from the means. So a phone
+        whose gop values are all the same gets c1 = c2 = 0 and c0 = the
+        weighted mean of its labels.
+    Returns
+    -------
+    an array of shape (num_phones, 3), where num_phones is the largest phone
+    id plus one; the rows of the phones without data are NaN.
+    """
+    num_phones = phones.max() + 1
+    weights = balanced_sample_weights(phones, labels)
+    features = np.stack([gops, gops ** 2], axis=1)
+    total_weights = np.bincount(phones, weights=weights, minlength=num_phones)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.stack([np.bincount(phones, weights=weights * features[:, k],
+                                      minlength=num_phones)
+                          for k in range(2)], axis=1) / total_weights[:, np.newaxis]
+        label_means = np.bincount(phones, weights=weights * labels,
+                                  minlength=num_phones) / total_weights
+    features = features - means[phones]
+    centred_labels = labels - label_means[phones]
+    normal_matrix = np.stack([np.stack([
+        np.bincount(phones, weights=weights * features[:, j] * features[:, k],
+                    minlength=num_phones) for k in range(2)], axis=1)
+        for j in range(2)], axis=1)
+    rhs = np.stack([np.bincount(phones, weights=weights * features[:, j] * centred_labels,
+                                minlength=num_phones)
+                    for j in range(2)], axis=1)
+    # Minimum-norm solution: the eigenvalues that are zero up to rounding
+    # errors, relative to the (uncentred) size of the features, are dropped.
+    eigvals, eigvecs = np.linalg.eigh(normal_matrix)
+    scale = np.bincount(phones, weights=weights * (gops ** 2 + gops ** 4),
+                        minlength=num_phones)
+    keep = eigvals > 1e-12 * scale[:, np.newaxis]
+    inv_eigvals = np.divide(1.0, eigvals, out=np.zeros_like(eigvals), where=keep)
+    projected = np.matmul(rhs[:, np.newaxis, :], eigvecs)[:, 0, :] * inv_eigvals
+    coefs = np.zeros((num_phones, 3))
+    coefs[:, 1:] = np.matmul(eigvecs, projected[:, :, np.newaxis])[:, :, 0]
+    coefs[:, 0] = label_means - (coefs[:, 1:] * means).sum(axis=1)
+    coefs[total_weights == 0] = np.nan
+    return coefs
+
+
+# Compares train_models() with the per-phone sklearn LinearRegression it
+# replaced (with the balanced weights as sample weights), on random data with
+# phones that have one example, a single gop value, two gop values or no data.
+# Run as: gop_to_score_train.py --test
+def test_library():
+    from sklearn.preprocessing import PolynomialFeatures
+    from sklearn.linear_model import LinearRegression
+    rng = np.random.RandomState(0)
+    phones, gops, labels = [], [], []
+    for phone, num_examples, values in [(1, 500, None), (2, 1, None), (3, 40, [-1.3]),
+                                        (5, 30, [-7.1, -0.2]), (6, 3, None),
+                                        (7, 200, None)]:
+        phones += [phone] * num_examples
+        gops += list(rng.choice(values, num_examples) if values is not None
+                     else -rng.gamma(1.0, 3.0, num_examples))
+        labels += list(rng.choice([0.0, 1.0, 2.0], num_examples))
+    phones, gops, labels = np.array(phones), np.array(gops), np.array(labels)
+    coefs = train_models(phones, gops, labels)
+    weights = balanced_sample_weights(phones, labels)
+    for phone in range(coefs.shape[0]):
+        mask = phones == phone
+        if not mask.any():
+            assert np.isnan(coefs[phone]).all()
+            continue
+        model = LinearRegression().fit(
+            PolynomialFeatures(2).fit_transform(gops[mask].reshape(-1, 1)),
+            labels[mask], sample_weight=weights[mask])
+        ref = np.array([model.intercept_ + model.coef_[0], model.coef_[1], model.coef_[2]])
+        if len(set(gops[mask])) > 1:
+            assert np.allclose(coefs[phone], ref, rtol=1e-8, atol=1e-8), (phone, coefs[phone], ref)
+        else:
+            # a single gop value: sklearn fits the mean label there, but its
+            # gop coefficients are rounding noise unless there is only one
+            # example; the model here is flat.
+            g = gops[mask][0]
+            assert np.allclose(coefs[phone], [np.dot(ref, [1, g, g * g]), 0, 0]), (phone, coefs[phone], ref)
+            if mask.sum() == 1:
+                assert np.allclose(coefs[phone], ref), (phone, coefs[phone], ref)
+    print('{}: self-check passed'.format(sys.argv[0]))
 
 
 def main():
@@ -55,7 +137,7 @@ def main():
     score_of, phone_of = load_human_scores(args.human_scoring_json, floor=1)
 
     # Prepare training data
-    train_data_of = {}
+    phones, gops_all, labels = [], [], []
     for key, gops in kaldi_io.read_post_scp(args.gop_scp):
         for i, [(ph, gop)] in enumerate(gops):
             ph_key = f'{key}.{i}'
@@ -65,19 +147,22 @@ def main():
             if phone_int2sym is not None and phone_int2sym[ph] != phone_of[ph_key]:
                 print(f'Unmatch: {phone_int2sym[ph]} <--> {phone_of[ph_key]} ')
                 continue
-            score = score_of[ph_key]
-            train_data_of.setdefault(ph, []).append((score, gop))
+            phones.append(ph)
+            gops_all.append(gop)
+            labels.append(score_of[ph_key])
 
     # Train polynomial regression
-    with ProcessPoolExecutor(args.nj) as ex:
-        future_to_model = [(ph, ex.submit(train_model_for_phone, pairs))
-                           for ph, pairs in train_data_of.items()]
-        model_of = {ph: future.result() for ph, future in future_to_model}
+    coefs = train_models(np.array(phones, dtype=np.int64),
+                         np.array(gops_all, dtype=np.float64),
+                         np.array(labels, dtype=np.float64))
 
     # Write to file
     with open(args.model, 'wb') as f:
-        pickle.dump(model_of, f)
+        pickle.dump(coefs, f)
 
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--test']:
+        test_library()
+        sys.exit(0)
     main()
@@ -5,6 +5,7 @@ import os
 import re
 import json
 import random
+import numpy as np
 from itertools import chain
 from collections import Counter
 from imblearn.over_sampling import RandomOverSampler
@@ -51,6 +52,21 @@ def balanced_sampling(x, y):
     return sampler.fit_resample(x, y)
 
 
+def balanced_sample_weights(groups, y):
+    """ Returns a weight for each example, such that within each group (e.g.
+        phone), every label has the same total weight as the most frequent
+        label of the group. This is what balanced_sampling() does by random
+        oversampling, but without the randomness and without copying the data.
+    """
+    groups = np.asarray(groups)
+    _, label_ids = np.unique(y, return_inverse=True)
+    num_labels = label_ids.max() + 1
+    counts = np.bincount(groups * num_labels + label_ids,
+                         minlength=(groups.max() + 1) * num_labels)
+    counts = counts.reshape(-1, num_labels)
+    return counts.max(axis=1)[groups] / counts[groups, label_ids]
+
+
 def add_more_negative_data(data):
     # Put all examples together
     whole_data = []
@@ -11,6 +11,7 @@ cmd=run.pl
 feat_dim=40
 augment=false
 fliplr=false
+num_threads=1  # number of processes used by each job of make_features.py
 echo "$0 $@"
 
 . ./cmd.sh
@@ -35,9 +36,11 @@ done
 # split images.scp
 utils/split_scp.pl $scp $split_scps || exit 1;
 
-$cmd JOB=1:$nj $logdir/extract_features.JOB.log \
+# The features are compressed by copy-feats, so make_features.py writes
+# them to its standard output rather than using --out-scp.
+$cmd --num-threads $num_threads JOB=1:$nj $logdir/extract_features.JOB.log \
   local/make_features.py $logdir/images.JOB.scp \
-    --allowed_len_file_path $data/allowed_lengths.txt \
+    --allowed_len_file_path $data/allowed_lengths.txt --num-jobs $num_threads \
     --feat-dim $feat_dim --fliplr $fliplr --augment $augment \| \
     copy-feats --compress=true --compression-method=7 \
     ark:- ark,scp:$featdir/images.JOB.ark,$featdir/images.JOB.scp
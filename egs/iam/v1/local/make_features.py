@@ -8,9 +8,12 @@
 """ This script converts images to Kaldi-format feature matrices. The input to
     this script is the path to a data directory, e.g. "data/train". This script
     reads the images listed in images.scp and writes them to standard output
-    (by default) as Kaldi-formatted matrices (in text form). It also scales the
+    (by default) as a Kaldi archive of binary matrices, and optionally an scp
+    file for the archive (via --out-scp). It also scales the
     images so they have the same height (via --feat-dim). It can optionally pad
     the images (on left/right sides) with white pixels.
+    The images are processed in --num-jobs processes; the output is in the
+    order of images.scp.
     If an 'image2num_frames' file is found in the data dir, it will be used
     to enforce the images to have the specified length in that file by padding
     white pixels (the --padding option will be ignored in this case). This relates
@@ -26,11 +29,12 @@ import numpy as np
 from scipy import misc
 from scipy.ndimage.interpolation import affine_transform
 import math
+from multiprocessing import Pool
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL)
 
 parser = argparse.ArgumentParser(description="""Converts images (in 'dir'/images.scp) to features and
-                                                writes them to standard output in text format.""")
+                                                writes them to standard output in binary format.""")
 parser.add_argument('images_scp_path', type=str,
                     help='Path of images.scp file')
 parser.add_argument('--allowed_len_file_path', type=str, default=None,
@@ -38,6 +42,9 @@ parser.add_argument('--allowed_len_file_path', type=str, default=None,
                     'target length (this overrides --padding).')
 parser.add_argument('--out-ark', type=str, default='-',
                     help='Where to write the output feature file')
+parser.add_argument('--out-scp', type=str, default=None,
+                    help='If supplied, an scp file for the output archive is '
+                    'written here (--out-ark must then be a file).')
 parser.add_argument('--feat-dim', type=int, default=40,
                     help='Size to scale the height of all images')
 parser.add_argument('--padding', type=int, default=5,
@@ -47,24 +54,21 @@ parser.add_argument('--fliplr', type=lambda x: (str(x).lower()=='true'), default
                    help="Flip the image left-right for right to left languages")
 parser.add_argument("--augment", type=lambda x: (str(x).lower()=='true'), default=False,
                    help="performs image augmentation")
-args = parser.parse_args()
+parser.add_argument('--num-jobs', type=int, default=1,
+                    help='Number of processes over which the images are '
+                    'distributed.')
 
 
-def write_kaldi_matrix(file_handle, matrix, key):
-    file_handle.write(key + " [ ")
-    num_rows = len(matrix)
-    if num_rows == 0:
+def get_kaldi_matrix_bytes(matrix):
+    """ Returns the matrix in Kaldi binary format (as float32), i.e. what
+        follows the key and the space in a binary archive.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] == 0:
         raise Exception("Matrix is empty")
-    num_cols = len(matrix[0])
-
-    for row_index in range(len(matrix)):
-        if num_cols != len(matrix[row_index]):
-            raise Exception("All the rows of a matrix are expected to "
-                            "have the same length")
-        file_handle.write(" ".join(map(lambda x: str(x), matrix[row_index])))
-        if row_index != num_rows - 1:
-            file_handle.write("\n")
-    file_handle.write(" ]\n")
+    return (b'\0BFM \4' + np.int32(matrix.shape[0]).tobytes() +
+            b'\4' + np.int32(matrix.shape[1]).tobytes() +
+            np.ascontiguousarray(matrix).tobytes())
 
 
 def horizontal_pad(im, allowed_lengths = None):
@@ -72,23 +76,17 @@ def horizontal_pad(im, allowed_lengths = None):
         left_padding = right_padding = args.padding
     else:  # Find an allowed length for the image
         imlen = im.shape[1] # width
-        allowed_len = 0
-        for l in allowed_lengths:
-            if l > imlen:
-                allowed_len = l
-                break
-        if allowed_len == 0:
+        # allowed_lengths is sorted, this finds the smallest allowed length
+        # that is greater than imlen.
+        index = np.searchsorted(allowed_lengths, imlen, side='right')
+        if index == len(allowed_lengths):
             #  No allowed length was found for the image (the image is too long)
             return None
-        padding = allowed_len - imlen
+        padding = allowed_lengths[index] - imlen
         left_padding = int(padding // 2)
         right_padding = padding - left_padding
-    dim_y = im.shape[0] # height
-    im_pad = np.concatenate((255 * np.ones((dim_y, left_padding),
-                                           dtype=int), im), axis=1)
-    im_pad1 = np.concatenate((im_pad, 255 * np.ones((dim_y, right_padding),
-                                                    dtype=int)), axis=1)
-    return im_pad1
+    return np.pad(im, ((0, 0), (left_padding, right_padding)), 'constant',
+                  constant_values=255)
 
 def get_scaled_image_aug(im, mode='normal'):
     scale_size = args.feat_dim
@@ -112,64 +110,49 @@ def get_scaled_image_aug(im, mode='normal'):
 
 def contrast_normalization(im, low_pct, high_pct):
     element_number = im.size
-    rows = im.shape[0]
-    cols = im.shape[1]
-    im_contrast = np.zeros(shape=im.shape)
     low_index = int(low_pct * element_number)
     high_index = int(high_pct * element_number)
-    sorted_im = np.sort(im, axis=None)
-    low_thred = sorted_im[low_index]
-    high_thred = sorted_im[high_index]
-    for i in range(rows):
-        for j in range(cols):
-            if im[i, j] > high_thred:
-                im_contrast[i, j] = 255  # lightest to white
-            elif im[i, j] < low_thred:
-                im_contrast[i, j] = 0  # darkest to black
-            else:
-                # linear normalization
-                im_contrast[i, j] = (im[i, j] - low_thred) * \
-                    255 / (high_thred - low_thred)
-    return im_contrast
+    # the pixel values of rank low_index and high_index.
+    sorted_im = np.partition(im, (low_index, high_index), axis=None)
+    low_thred = float(sorted_im[low_index])
+    high_thred = float(sorted_im[high_index])
+    if high_thred == low_thred:
+        return np.where(im > high_thred, 255.0, 0.0)
+    # linear normalization; the pixels lighter than high_thred become white
+    # and the ones darker than low_thred black.
+    return np.clip((im - low_thred) * 255 / (high_thred - low_thred), 0, 255)
 
 
 def geometric_moment(frame, p, q):
-    m = 0
-    for i in range(frame.shape[1]):
-        for j in range(frame.shape[0]):
-            m += (i ** p) * (j ** q) * frame[i][i]
-    return m
+    # x is the column index and y the row index of a pixel.
+    x = np.arange(frame.shape[1], dtype=float)
+    y = np.arange(frame.shape[0], dtype=float)
+    return (y ** q).dot(frame).dot(x ** p)
 
 
 def central_moment(frame, p, q):
-    u = 0
-    x_bar = geometric_moment(frame, 1, 0) / \
-        geometric_moment(frame, 0, 0)  # m10/m00
-    y_bar = geometric_moment(frame, 0, 1) / \
-        geometric_moment(frame, 0, 0)  # m01/m00
-    for i in range(frame.shape[1]):
-        for j in range(frame.shape[0]):
-            u += ((i - x_bar)**p) * ((j - y_bar)**q) * frame[i][j]
-    return u
+    m00 = geometric_moment(frame, 0, 0)
+    x_bar = geometric_moment(frame, 1, 0) / m00  # m10/m00
+    y_bar = geometric_moment(frame, 0, 1) / m00  # m01/m00
+    x = np.arange(frame.shape[1]) - x_bar
+    y = np.arange(frame.shape[0]) - y_bar
+    return (y ** q).dot(frame).dot(x ** p)
 
 
 def height_normalization(frame, w, h):
-    frame_normalized = np.zeros(shape=(h, w))
     alpha = 4
-    x_bar = geometric_moment(frame, 1, 0) / \
-        geometric_moment(frame, 0, 0)  # m10/m00
-    y_bar = geometric_moment(frame, 0, 1) / \
-        geometric_moment(frame, 0, 0)  # m01/m00
+    m00 = geometric_moment(frame, 0, 0)
+    x_bar = geometric_moment(frame, 1, 0) / m00  # m10/m00
+    y_bar = geometric_moment(frame, 0, 1) / m00  # m01/m00
     sigma_x = (alpha * ((central_moment(frame, 2, 0) /
-                         geometric_moment(frame, 0, 0)) ** .5))  # alpha * sqrt(u20/m00)
+                         m00) ** .5))  # alpha * sqrt(u20/m00)
     sigma_y = (alpha * ((central_moment(frame, 0, 2) /
-                         geometric_moment(frame, 0, 0)) ** .5))  # alpha * sqrt(u02/m00)
-    for x in range(w):
-        for y in range(h):
-            i = int((x / w - 0.5) * sigma_x + x_bar)
-            j = int((y / h - 0.5) * sigma_y + y_bar)
-            frame_normalized[x][y] = frame[i][j]
-    return frame_normalized
+                         m00) ** .5))  # alpha * sqrt(u02/m00)
+    i = ((np.arange(w) / w - 0.5) * sigma_x + x_bar).astype(int)
+    j = ((np.arange(h) / h - 0.5) * sigma_y + y_bar).astype(int)
+    i = np.clip(i, 0, frame.shape[1] - 1)
+    j = np.clip(j, 0, frame.shape[0] - 1)
+    return frame[np.ix_(j, i)]
 
 
 def find_slant_project(im):
@@ -177,22 +160,25 @@ def find_slant_project(im):
     cols = im.shape[1]
     std_max = 0
     alpha_max = 0
-    col_disp = np.zeros(90, int)
-    proj = np.zeros(shape=(90, cols + 2 * rows), dtype=int)
-    for r in range(rows):
-        for alpha in range(-45, 45, 1):
-            col_disp[alpha] = int(r * math.tan(alpha / 180.0 * math.pi))
-        for c in range(cols):
-            if im[r, c] < 100:
-                for alpha in range(-45, 45, 1):
-                    proj[alpha + 45, c + col_disp[alpha] + rows] += 1
-    for alpha in range(-45, 45, 1):
+    alphas = range(-45, 45, 1)
+    # col_disp[r, alpha + 45] is the displacement of row r when the image is
+    # projected at an angle alpha.
+    tan_alpha = np.array([math.tan(alpha / 180.0 * math.pi) for alpha in alphas])
+    col_disp = (np.arange(rows)[:, np.newaxis] * tan_alpha).astype(int)
+    # proj[alpha + 45, :] is the projection at an angle alpha of the dark
+    # pixels, computed for all angles at once.
+    proj_len = cols + 2 * rows
+    r, c = np.nonzero(im < 100)
+    proj_index = (c[:, np.newaxis] + col_disp[r] + rows +
+                  proj_len * np.arange(len(alphas)))
+    proj = np.bincount(proj_index.ravel(), minlength=len(alphas) * proj_len)
+    proj = proj.reshape(len(alphas), proj_len)
+    for alpha in alphas:
         proj_histogram, bin_array = np.histogram(proj[alpha + 45, :], bins=10)
         proj_std = np.std(proj_histogram)
         if proj_std > std_max:
             std_max = proj_std
             alpha_max = alpha
-    proj_std = np.std(proj, axis=1)
     return -alpha_max
 
 
@@ -214,53 +200,95 @@ def horizontal_shear(im, degree):
     return sheared_im
 
 
-### main ###
-random.seed(1)
-data_list_path = args.images_scp_path
-if args.out_ark == '-':
-    out_fh = sys.stdout
-else:
-    out_fh = open(args.out_ark,'w')
-
-allowed_lengths = None
-allowed_len_handle = args.allowed_len_file_path
-if os.path.isfile(allowed_len_handle):
-    print("Found 'allowed_lengths.txt' file...", file=sys.stderr)
-    allowed_lengths = []
-    with open(allowed_len_handle) as f:
-        for line in f:
-            allowed_lengths.append(int(line.strip()))
-    print("Read {} allowed lengths and will apply them to the "
-          "features.".format(len(allowed_lengths)), file=sys.stderr)
-
-num_fail = 0
-num_ok = 0
 aug_setting = ['normal', 'scaled']
-with open(data_list_path) as f:
-    for line in f:
-        line = line.strip()
-        line_vect = line.split(' ')
-        image_id = line_vect[0]
-        image_path = line_vect[1]
-        im = misc.imread(image_path)
-        if args.fliplr:
-            im = np.fliplr(im)
-        if args.augment:
-            im_aug = get_scaled_image_aug(im, aug_setting[0])
-            im_contrast = contrast_normalization(im_aug, 0.05, 0.2)
-            slant_degree = find_slant_project(im_contrast)
-            im_sheared = horizontal_shear(im_contrast, slant_degree)
-            im_aug = im_sheared
-        else:
-            im_aug = get_scaled_image_aug(im, aug_setting[0])
-        im_horizontal_padded = horizontal_pad(im_aug, allowed_lengths)
-        if im_horizontal_padded is None:
+allowed_lengths = None
+
+
+def init_worker(worker_args, worker_allowed_lengths):
+    """ Sets up the global variables in a worker process. """
+    global args, allowed_lengths
+    args = worker_args
+    allowed_lengths = worker_allowed_lengths
+    random.seed(1)
+
+
+def get_features(line):
+    """ Returns (image-id, features) for a line of images.scp, where the
+        features are in Kaldi binary format, or None if the image is too long.
+    """
+    line_vect = line.strip().split(' ')
+    image_id = line_vect[0]
+    image_path = line_vect[1]
+    im = misc.imread(image_path)
+    if args.fliplr:
+        im = np.fliplr(im)
+    if args.augment:
+        im_aug = get_scaled_image_aug(im, aug_setting[0])
+        im_contrast = contrast_normalization(im_aug, 0.05, 0.2)
+        slant_degree = find_slant_project(im_contrast)
+        im_sheared = horizontal_shear(im_contrast, slant_degree)
+        im_aug = im_sheared
+    else:
+        im_aug = get_scaled_image_aug(im, aug_setting[0])
+    im_horizontal_padded = horizontal_pad(im_aug, allowed_lengths)
+    if im_horizontal_padded is None:
+        return image_id, None
+    data = np.transpose(im_horizontal_padded, (1, 0))
+    data = np.divide(data, 255.0)
+    return image_id, get_kaldi_matrix_bytes(data)
+
+
+def main():
+    if args.out_ark == '-':
+        if args.out_scp is not None:
+            sys.exit("make_features.py: --out-scp requires --out-ark to be a file")
+        out_fh = sys.stdout.buffer
+    else:
+        out_fh = open(args.out_ark, 'wb')
+    scp_fh = open(args.out_scp, 'w') if args.out_scp is not None else None
+
+    allowed_lengths = None
+    allowed_len_handle = args.allowed_len_file_path
+    if allowed_len_handle is not None and os.path.isfile(allowed_len_handle):
+        print("Found 'allowed_lengths.txt' file...", file=sys.stderr)
+        with open(allowed_len_handle) as f:
+            allowed_lengths = np.sort([int(line.strip()) for line in f])
+        print("Read {} allowed lengths and will apply them to the "
+              "features.".format(len(allowed_lengths)), file=sys.stderr)
+
+    num_fail = 0
+    num_ok = 0
+    with open(args.images_scp_path) as f:
+        lines = [line for line in f if line.strip() != '']
+    if args.num_jobs > 1:
+        pool = Pool(args.num_jobs, initializer=init_worker,
+                    initargs=(args, allowed_lengths))
+        results = pool.imap(get_features, lines, chunksize=8)
+    else:
+        pool = None
+        init_worker(args, allowed_lengths)
+        results = map(get_features, lines)
+    for image_id, features in results:
+        if features is None:
             num_fail += 1
             continue
-        data = np.transpose(im_horizontal_padded, (1, 0))
-        data = np.divide(data, 255.0)
         num_ok += 1
-        write_kaldi_matrix(out_fh, data, image_id)
+        out_fh.write((image_id + ' ').encode())
+        if scp_fh is not None:
+            print('{} {}:{}'.format(image_id, args.out_ark, out_fh.tell()),
+                  file=scp_fh)
+        out_fh.write(features)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    out_fh.flush()
+    if scp_fh is not None:
+        scp_fh.close()
+
+    print('Generated features for {} images. Failed for {} (image too '
+          'long).'.format(num_ok, num_fail), file=sys.stderr)
+
 
-print('Generated features for {} images. Failed for {} (image too '
-      'long).'.format(num_ok, num_fail), file=sys.stderr)
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
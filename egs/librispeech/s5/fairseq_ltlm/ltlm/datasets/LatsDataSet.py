@@ -12,13 +12,19 @@ import tqdm
 import argparse
 import time
 import logging
+import itertools
 
 
 from ltlm.pyutils.data_utils import parse_lats_data_str
+from ltlm.pyutils.lats_parser import iter_lats
+from ltlm.pyutils.lats_store import (is_lats_store,
+                                     read_store_meta,
+                                     read_store_utts,
+                                     write_lats_store,
+                                     RaggedColumn)
 from ltlm.pyutils.lattice_utils import (topsort_lat,
                                         oracle_path,
                                         padding,
-                                        parse_lats,
                                         WORD_ID)
 logger = logging.getLogger(__name__)
 
@@ -30,8 +36,9 @@ class LatsDataSet(FairseqDataset):
         parser.add_argument(f'--{prefix}data', type=str, default=None,
                             help=f"{prefix} data archive(s). Comma separable list of glob patterns. for each dump can be added suffix after :. "
                             f"Example exp/model/decode/lt_egs/lat.*.dump,exp/model/decode/lt_egs_beam8/lat.*.dump:_beam8")
-        parser.add_argument(f'--{prefix}data_type', type=str, choices=['dump', 'lat_t'],  default='dump',
-                            help=f"lat_t - kaldi ark,t format. Dump - pickle data dump(s).")
+        parser.add_argument(f'--{prefix}data_type', type=str, choices=['dump', 'lat_t', 'memmap'],  default='dump',
+                            help=f"lat_t - kaldi ark,t format. Dump - pickle data dump(s). "
+                            f"memmap - columnar lattice store(s) (see pyscripts/lats_to_store.py).")
         if not add_scale_opts:
             return
         parser.add_argument(f'--{prefix}max_len', type=int, default=600,
@@ -90,7 +97,7 @@ class LatsDataSet(FairseqDataset):
         self.max_len = float('inf')
 
     def get_data_from_disc(self, data_dict_list, data_type='dump'):
-        assert data_type in ['lat_t', 'dump'], RuntimeError(f'Wrong data type {data_type}')
+        assert data_type in ['lat_t', 'dump', 'memmap'], RuntimeError(f'Wrong data type {data_type}')
         logger.info(f" data dict list is {data_dict_list}")
         self.data_pattern = data_dict_list
         # all_data = self.parse_lats_data_str(lats_data)
@@ -100,13 +107,21 @@ class LatsDataSet(FairseqDataset):
         for data_dict in data_dict_list:
             curr_data = data_dict['lats']
             suff = data_dict['utt_suff']
+            curr_type = data_dict.get('data_type', data_type)
             # epoch = data_dict['epoch']
-            logger.debug(f"Loading data from {curr_data}. Suffix={suff}.")
+            logger.debug(f"Loading data from {curr_data}. Suffix={suff}. Type = {curr_type}")
             # Read data from disk
-            if data_type == 'lat_t':
+            if curr_type == 'memmap':
+                stores = [curr_data] if is_lats_store(curr_data) else sorted(filter(is_lats_store, glob(curr_data)))
+                assert len(stores) > 0, RuntimeError(f"Lattice stores not found in {curr_data}")
+                for store_dir in stores:
+                    logger.debug(f"Mapping store {store_dir}.")
+                    self.add_data_from_store(store_dir, suff=suff)
+            elif curr_type == 'lat_t':
                 if curr_data == '-':
                     logger.info(f"Reading lattice arc from std input.")
-                    self.add_data_from_latt(sys.stdin.readlines(), recompute_utt2id=False, suff=suff)
+                    self.add_data_from_compact(iter_lats(sys.stdin, keep_ali=True),
+                                               recompute_utt2id=False, suff=suff)
                 else:
                     if os.path.isdir(curr_data):
                         logger.info(f"{curr_data} is directory. Loading {curr_data}/lat.*.t")
@@ -114,8 +129,9 @@ class LatsDataSet(FairseqDataset):
                     for fn in glob(curr_data):
                         logger.debug(f"Reading {fn}. Type = {data_type}")
                         with open(fn, 'r', encoding='utf-8') as f:
-                            self.add_data_from_latt(f.readlines(), recompute_utt2id=False, suff=suff)
-            elif data_type == 'dump':
+                            self.add_data_from_compact(iter_lats(f, keep_ali=True),
+                                                   recompute_utt2id=False, suff=suff)
+            elif curr_type == 'dump':
                 if os.path.isdir(curr_data):
                     logger.info(f"{curr_data} is directory. Loading {curr_data}/lat.*.dump")
                     curr_data = os.path.join(curr_data, 'lat.*.dump')
@@ -126,7 +142,7 @@ class LatsDataSet(FairseqDataset):
                     data_dicts.append(data_dict)
                     suffs.append(suff)
             else:
-                raise RuntimeError(f'Wrong data type {data_type}')
+                raise RuntimeError(f'Wrong data type {curr_type}')
         if len(data_dicts) > 0:
             logger.info(f"Combining dicts to dataset")
             self.add_data_from_dicts(data_dicts, recompute_utt2id=False, suffs=suffs)
@@ -134,28 +150,59 @@ class LatsDataSet(FairseqDataset):
         logger.info(f"Loaded {len(self.id2utt)} utterance from {data_dict_list}")
         self.utt2id = {utt: i for i, utt in enumerate(self.id2utt)}
 
-    def add_data_from_latt(self, lines, recompute_utt2id=True, suff=''):
-        utt2lat = parse_lats(lines)
-        if suff:
-            utt2lat = {k+suff:v for k,v in utt2lat.items()}
-        id2utt = utt2lat.keys()
-        self.id2utt.extend(id2utt)
-        converted_comp_lat = [self.compact_lat_to_lat(utt2lat[utt]) for utt in id2utt]
-        lats = [topsort_lat(l) for l, _, _ in converted_comp_lat]
-        weights = [np.array(w) for _, w, _ in converted_comp_lat]
-        phone_ali = [a for _, _, a in converted_comp_lat]
-        self.id2lat.extend(lats)
-        self.id2weights.extend(weights)
-        self.id2p_ali.extend(phone_ali)
+    def is_memmap(self):
+        return isinstance(self.id2lat, RaggedColumn)
+
+    def check_in_memory(self):
+        assert not self.is_memmap(), RuntimeError(f"Memory mapped lattice store cannot be combined with other data")
+
+    def add_data_from_store(self, store_dir, suff=''):
+        """ Map lattices from columnar store. Data is not loaded into memory.
+        :return: store meta """
+        meta = read_store_meta(store_dir)
+        if not self.is_memmap():
+            assert len(self.id2lat) == 0, RuntimeError(f"Memory mapped lattice store cannot be combined with other data")
+            self.id2lat = RaggedColumn('lat')
+            self.id2weights = RaggedColumn('weights')
+            self.id2p_ali = None
+        utts = read_store_utts(store_dir)
+        assert len(utts) == meta['num_utts'], RuntimeError(f"Broken store {store_dir}")
+        self.id2utt.extend(u + suff for u in utts)
+        self.id2lat.append_store(store_dir, len(utts))
+        self.id2weights.append_store(store_dir, len(utts))
+        return meta
+
+    def data_to_columns(self):
+        """ Per utterance arrays for write_lats_store. """
+        columns = {'lat': self.id2lat, 'weights': self.id2weights}
+        dtypes = {'lat': np.int32, 'weights': np.float32}
+        return columns, dtypes, {}
+
+    def save_to_store(self, out_dir):
+        """ Save dataset to columnar lattice store. Phone alignments are not saved. """
+        columns, dtypes, extra = self.data_to_columns()
+        write_lats_store(out_dir, self.id2utt, columns, dtypes=dtypes, extra=extra)
+
+    def add_data_from_compact(self, utt_lats, recompute_utt2id=True, suff=''):
+        """ Add lattices from lats_parser.
+        :param utt_lats: iterable of (utt_id, CompactLat) """
+        self.check_in_memory()
+        for utt, compact_lat in utt_lats:
+            lat, weights, phone_ali = self.compact_arrays_to_lat(compact_lat)
+            self.id2utt.append(utt + suff)
+            self.id2lat.append(topsort_lat(lat))
+            self.id2weights.append(weights)
+            self.id2p_ali.append(phone_ali)
         if recompute_utt2id:
             self.utt2id = {utt: i for i, utt in enumerate(self.id2utt)}
-    
+
     def add_data_from_dicts(self, data_dicts, recompute_utt2id=True, suffs=['']):
         for i, (d, s) in  enumerate(zip(data_dicts, suffs)):
             self.add_list_data_from_dict(d, recompute_utt2id=(recompute_utt2id and i == len(data_dicts) - 1), suff=s)
 
 
     def add_list_data_from_dict(self, data_dict, recompute_utt2id=True, suff=''):
+        self.check_in_memory()
         if suff:
             id2utt = [u+suff for u in data_dict['id2utt']]
         else:
@@ -186,11 +233,17 @@ class LatsDataSet(FairseqDataset):
         assert len(utt2ref) == len(self.id2utt), f'Utterance name {set(self.id2utt) - set(utt2ref.keys())} not found in file {ref_text_fname}'
         return utt2ref
 
+    def get_lat_lens(self):
+        if self.is_memmap():
+            return self.id2lat.lengths().tolist()
+        return [len(lat) for lat in self.id2lat]
+
     def cliped_data(self, max_len):
         # Clip max len
         self.max_len = max_len
-        self.clipid2len_id = sorted([(len(lat), i) for i, lat in enumerate(self.id2lat) if len(lat) < max_len])
-        self.too_big_lats = [i for i, lat in enumerate(self.id2lat) if len(lat) >= max_len]
+        lat_lens = self.get_lat_lens()
+        self.clipid2len_id = sorted([(l, i) for i, l in enumerate(lat_lens) if l < max_len])
+        self.too_big_lats = [i for i, l in enumerate(lat_lens) if l >= max_len]
         num_clipped = len(self.id2lat) - len(self.clipid2len_id)
         logger.info(f'LatsDataSet: Clipping with max_len={max_len} remove {num_clipped} utts '
                     f'({round(num_clipped / len(self.id2lat) * 100, 2)}%).')
@@ -211,7 +264,7 @@ class LatsDataSet(FairseqDataset):
             utt_id = self.id2utt[i]
 
             #raise RuntimeError(f'LatsDataSet:__getitem__ Bad item {item}')
-        weights = torch.Tensor(self.id2weights[i]) # L X 2
+        weights = torch.Tensor(np.array(self.id2weights[i])) # L X 2
         #logger.info(f'W shape: {weights.shape}')
         lat = topsort_lat(self.id2lat[i])
         return {'net_input': {'src_tokens': torch.LongTensor(lat), },
@@ -243,53 +296,40 @@ class LatsDataSet(FairseqDataset):
     def num_tokens(self, index):
         return self.size(index)
 
-    def compact_lat_to_lat(self, compact_lat):
-        """ Converting kaldi compact lattice in to my lat format"""
-        out_lat = []
-        out_weights = []
-        out_phone_ali = []
-
+    def compact_arrays_to_lat(self, compact_lat):
+        """ Converting lats_parser.CompactLat in to my lat format """
         new_id_shift = 2
-        eos_arcs = set()
-        max_state_id = -1
-
-        # Add BOS symbol
-        out_lat.append((self.tokenizer.get_bos_id(), 1, 2))
-        out_weights.append((0, 0))
-        out_phone_ali.append('')
-
-        # Add words
-        for arc in compact_lat:
-            if len(arc) == 4:
-                # EOS arc
-                eos_arcs.add(arc)
-            elif len(arc) == 6:
-                # arc with word
-                state_from, state_to, word_id, w_hcl, w_am, ali = arc
-                new_state_from, new_state_to = state_from + new_id_shift, state_to + new_id_shift
-                out_lat.append((word_id, new_state_from, new_state_to))
-                out_weights.append((w_hcl, w_am))
-                out_phone_ali.append(ali)
-                if new_state_to > max_state_id:
-                    max_state_id = new_state_to
-            else:
-                raise RuntimeError("unknown arc len in compact_lat_to_lat. Need to debug")
-        # Add EOS symbols
-        word_id = self.tokenizer.get_eos_id()
-        new_state_to = max_state_id + 1
-        for arc in eos_arcs:
-            state_from, w_hcl, w_am, ali = arc
-            new_state_from = state_from + new_id_shift
-            out_lat.append((word_id, new_state_from, new_state_to))
-            out_weights.append((w_hcl, w_am))
-            out_phone_ali.append(ali)
+        arcs, weights = compact_lat.arcs, compact_lat.weights
+        num_arcs, num_finals = arcs.shape[0], compact_lat.finals.shape[0]
+        out_lat = np.empty((1 + num_arcs + num_finals, 3), dtype=np.int64)
+        out_weights = np.zeros((1 + num_arcs + num_finals, 2), dtype=weights.dtype)
+        # BOS arc
+        out_lat[0] = (self.tokenizer.get_bos_id(), 1, 2)
+        # Word arcs
+        out_lat[1:num_arcs + 1, 0] = arcs[:, 2]
+        out_lat[1:num_arcs + 1, 1:] = arcs[:, :2] + new_id_shift
+        out_weights[1:num_arcs + 1] = weights
+        # EOS arcs
+        max_state_id = out_lat[1:num_arcs + 1, 2].max() if num_arcs > 0 else -1
+        out_lat[num_arcs + 1:, 0] = self.tokenizer.get_eos_id()
+        out_lat[num_arcs + 1:, 1] = compact_lat.finals + new_id_shift
+        out_lat[num_arcs + 1:, 2] = max_state_id + 1
+        out_weights[num_arcs + 1:] = compact_lat.final_weights
+        if compact_lat.ali is None:
+            out_phone_ali = None
+        else:
+            out_phone_ali = ['', *compact_lat.ali, *compact_lat.final_ali]
         return out_lat, out_weights, out_phone_ali
 
     def get_compact_lattices(self):
         comp_lats = {}
         new_id_shift = 2
-        for i, (utt_id, lat, weights, ali) in enumerate(zip(self.id2utt, self.id2lat, self.id2weights, self.id2p_ali)):
+        # Memory mapped stores don't keep phone alignments
+        id2p_ali = self.id2p_ali if self.id2p_ali is not None else itertools.repeat(None)
+        for i, (utt_id, lat, weights, ali) in enumerate(zip(self.id2utt, self.id2lat, self.id2weights, id2p_ali)):
             comp_lat = []
+            if ali is None:
+                ali = itertools.repeat('')
             for (word_id, state_from, state_to), (w_hcl, w_ac), p_ali in zip(lat, weights, ali):
                 state_from, state_to = state_from - new_id_shift, state_to - new_id_shift
                 if word_id == self.tokenizer.get_bos_id():
@@ -336,7 +376,7 @@ class LatsDataSet(FairseqDataset):
         stats = {}
         stats['num_lat'] = len(self.id2lat)
         stats['tokenizer_num_words'] = len(self.tokenizer)
-        stats['avg_lat_len'] = sum([len(l) for l in self.id2lat])/len(self.id2lat)
+        stats['avg_lat_len'] = sum(self.get_lat_lens())/len(self.id2lat)
         return stats
 
     def print_statistic(self, out=logger.info):
@@ -12,6 +12,7 @@ from ltlm.datasets import LatsDataSet
 from ltlm.pyutils.logging_utils import setup_logger
 from ltlm.pyutils.lattice_utils import padding
 from ltlm.pyutils.data_utils import parse_lats_data_str
+from ltlm.pyutils.lats_store import RaggedColumn, RaggedUttMap
 logger = logging.getLogger(__name__)
 
 
@@ -84,6 +85,37 @@ class LatsOracleAlignDataSet(LatsDataSet):
         self.ref_text_fname = ref_text_fname
         self.utt2ref = super().load_ref(ref_text_fname)
 
+    def get_data_from_disc(self, data_dict_list, data_type='dump'):
+        super().get_data_from_disc(data_dict_list, data_type)
+        if self.is_memmap():
+            self.utt2ref = RaggedUttMap(self.id2ref, self.utt2id)
+            self.utt2ali = RaggedUttMap(self.id2ali, self.utt2id)
+
+    def add_data_from_store(self, store_dir, suff=''):
+        if not self.is_memmap():
+            self.id2ref = RaggedColumn('ref')
+            self.id2ali = RaggedColumn('ali')
+        meta = super().add_data_from_store(store_dir, suff=suff)
+        assert 'ref' in meta['columns'] and 'ali' in meta['columns'], \
+            RuntimeError(f"{store_dir} has no oracle alignment. Columns are {meta['columns']}")
+        self.id2ref.append_store(store_dir, meta['num_utts'])
+        self.id2ali.append_store(store_dir, meta['num_utts'])
+        self.oracle_err_sum += meta['extra']['oracle_err_sum']
+        self.num_ref_words += meta['extra']['num_ref_words']
+        return meta
+
+    def data_to_columns(self):
+        """ Oracle hypothesis texts (utt2ohyp) are not saved. """
+        columns, dtypes, extra = super().data_to_columns()
+        columns['ref'] = [self.utt2ref[utt] for utt in self.id2utt]
+        columns['ali'] = [self.utt2ali[utt] for utt in self.id2utt]
+        dtypes['ref'] = np.int64
+        dtypes['ali'] = np.int64
+        extra['oracle_err_sum'] = self.oracle_err_sum
+        extra['num_ref_words'] = self.num_ref_words
+        extra['all_oracle_targets'] = self.all_oracle_targets
+        return columns, dtypes, extra
+
     def add_data_from_dicts(self, data_dicts, recompute_utt2id=True, suffs=['']):
         super().add_data_from_dicts(data_dicts, recompute_utt2id, suffs)
 
@@ -118,7 +150,7 @@ class LatsOracleAlignDataSet(LatsDataSet):
         lat = lat_item['net_input']['src_tokens']
         utt_id = lat_item['utt_id']
         lat_item['ref'] = self.utt2ref[utt_id]
-        lat_item['ali'] = self.utt2ali[utt_id]
+        lat_item['ali'] = np.array(self.utt2ali[utt_id])
 
         y = torch.zeros(lat.shape[0])
         y[lat_item['ali']] = 1
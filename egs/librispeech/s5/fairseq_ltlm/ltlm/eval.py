@@ -11,13 +11,26 @@ from fairseq import checkpoint_utils, data, options, tasks
 from ltlm.pyutils.logging_utils import setup_logger
 from ltlm.models import LTLM
 from ltlm.datasets import LatsDataSet
-from ltlm.pyutils.lattice_utils import collate_lats, best_path_nloglike
+from ltlm.pyutils.lattice_utils import collate_lats
+from ltlm.pyutils.lattice_kernels import batch_best_paths
 from ltlm.pyutils.kaldi_utils import compute_wer
 from ltlm.Tokenizer import WordTokenizer
 from ltlm.tasks import rescoring_task
 logger = logging.getLogger(__name__)
 
 RESCORE_STRATEGIES = frozenset(['base', 'bce'])
+BEST_PATH_BTZ = 256
+
+
+def decode_best_paths(tokenizer, utts, lats, nlls, utt2hyp, btz=BEST_PATH_BTZ):
+    """ Batched best path search. Writes hypotheses without <s> </s> into utt2hyp """
+    final_word_id = tokenizer.get_eos_id()
+    for b in range(0, len(utts), btz):
+        paths = batch_best_paths(lats[b:b + btz], nlls[b:b + btz], final_word_id=final_word_id)
+        for utt, (_, hyp) in zip(utts[b:b + btz], paths):
+            hyp_line = tokenizer.decode([[arc[0] for arc in hyp]])[0]
+            assert hyp_line[0] == '<s>' and hyp_line[-1] == '</s>', RuntimeError(f"{utt} {hyp_line}")
+            utt2hyp[utt] = hyp_line[1:-1]
 
 
 def compute_model_wer(model, dataset, ref_fname,
@@ -33,13 +46,8 @@ def compute_model_wer(model, dataset, ref_fname,
     removed_lats, removed_lats_ws, removed_lats_utts = dataset.get_removed_utts()
     tokenizer = dataset.tokenizer
     if len(removed_lats) > 0:
-        final_word_id = tokenizer.get_eos_id()
-        for lat, weights, utt in zip(removed_lats, removed_lats_ws, removed_lats_utts):
-            p = weights[:, 0] * lmwt + weights[:, 1] * acwt
-            _, hyp = best_path_nloglike(lat, p, final_word_id=final_word_id)
-            hyp_line = tokenizer.decode([[arc[0] for arc in hyp]])[0]
-            assert hyp_line[0] == '<s>' and hyp_line[-1] == '</s>', RuntimeError(f"{hyp_line}")
-            utt2hyp[utt] = hyp_line[1:-1]
+        nlls = [weights[:, 0] * lmwt + weights[:, 1] * acwt for weights in removed_lats_ws]
+        decode_best_paths(tokenizer, removed_lats_utts, removed_lats, nlls, utt2hyp)
     wer_str = compute_wer(ref_fname, utt2hyp, keep_tmp=keep_tmp, hyp_filter=hyp_filter)[0]  # 0 - wer, 1 - ser
     if model is not None and is_model_training:
         model.train()
@@ -90,7 +98,6 @@ def get_rescoring_hyps(model, dataset,  acwt=1, lmwt=1, model_weight=1.3, strate
     logger.info(f"Strategy in {strategy}")
 
     tokenizer = dataset.tokenizer
-    final_word_id = tokenizer.get_eos_id()
     utt2hyp = {}
 
     if model_weight == 0:
@@ -98,6 +105,7 @@ def get_rescoring_hyps(model, dataset,  acwt=1, lmwt=1, model_weight=1.3, strate
     else:
         utt2score = get_scores(model, dataset, **kwargs)
 
+    utts, lats, nlls = [], [], []
     for utt, lt_probs in utt2score.items():
         item = dataset[utt]
         # 'net_input': {'src_tokens': lat, },
@@ -109,11 +117,10 @@ def get_rescoring_hyps(model, dataset,  acwt=1, lmwt=1, model_weight=1.3, strate
         axl_weight = weights[:, 0] * lmwt + weights[:, 1] * acwt
         lt_nll = apply_strategy(lat, lt_probs, strategy)
         nll = axl_weight + lt_nll * model_weight
-        _, hyp = best_path_nloglike(lat, nll,
-                                   final_word_id=final_word_id)
-        hyp_line = tokenizer.decode([[arc[0] for arc in hyp]])[0]
-        assert hyp_line[0] == '<s>' and hyp_line[-1] == '</s>', RuntimeError(f"{i} {hyp_line}")
-        utt2hyp[utt] = hyp_line[1:-1]
+        utts.append(utt)
+        lats.append(lat)
+        nlls.append(nll)
+    decode_best_paths(tokenizer, utts, lats, nlls, utt2hyp)
     return utt2hyp
 
 
@@ -0,0 +1,83 @@
+# Copyright 2021 STC-Innovation LTD (Author: Anton Mitrofanov)
+# Parallel conversion of kaldi text lattices (lat.*.t) to lattice store shards.
+# Every file (or byte range of a file with --chunks_per_file) is parsed in a separate process
+# and written to <out_dir>/store.<n>. Train with --data <out_dir>/store.* --data_type memmap
+import argparse
+import logging
+import os
+import sys
+from glob import glob
+
+from ltlm.datasets import LatsOracleAlignDataSet
+from ltlm.Tokenizer import WordTokenizer
+from ltlm.pyutils.logging_utils import setup_logger
+from ltlm.pyutils.lats_parser import iter_lats_parallel
+from ltlm.tasks.rescoring_task import add_training_type_args, get_data_cls
+
+logger = logging.getLogger(__name__)
+
+
+class ShardWriter:
+    """ Converts parsed chunk to dataset and saves it as a store shard. Runs in worker processes. """
+    def __init__(self, data_cls, tokenizer, out_dir, ref_text_fname=None, all_oracle_targets=False):
+        self.data_cls = data_cls
+        self.tokenizer = tokenizer
+        self.out_dir = out_dir
+        self.ref_text_fname = ref_text_fname
+        self.all_oracle_targets = all_oracle_targets
+
+    def __call__(self, chunk_id, utt_lats):
+        setup_logger(stream=sys.stderr, logger_level=logging.WARNING)
+        if issubclass(self.data_cls, LatsOracleAlignDataSet):
+            ds = self.data_cls(self.tokenizer, ref_text_fname=self.ref_text_fname,
+                               all_oracle_targets=self.all_oracle_targets)
+        else:
+            ds = self.data_cls(self.tokenizer)
+        ds.add_data_from_compact(utt_lats)
+        if isinstance(ds, LatsOracleAlignDataSet):
+            ds.load_ref(self.ref_text_fname)
+            ds.compute_oracle_ali()
+        shard_dir = os.path.join(self.out_dir, f'store.{chunk_id + 1}')
+        ds.save_to_store(shard_dir)
+        return shard_dir, len(ds.id2utt)
+
+
+def main():
+    setup_logger(stream=sys.stderr, logger_level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    add_training_type_args(parser)
+    type_args, _ = parser.parse_known_args()
+    data_cls = get_data_cls(type_args)
+    WordTokenizer.add_args(parser)
+    parser.add_argument('--ref_text_fname', type=str, default=None,
+                        help="Reference kaldi text. Required for oracle_path training type.")
+    parser.add_argument("--all_oracle_targets", action='store_true',
+                        help='All oracle paths contains in training target')
+    parser.add_argument('--nj', type=int, default=4, help="Number of processes")
+    parser.add_argument('--chunks_per_file', type=int, default=1,
+                        help="Split every lattice file into byte ranges at utterance boundaries")
+    parser.add_argument('lats', type=str, help="Glob pattern of text lattices or directory with lat.*.t")
+    parser.add_argument('out_dir', type=str, help="Output directory for store shards.")
+    args = parser.parse_args()
+
+    lats = os.path.join(args.lats, 'lat.*.t') if os.path.isdir(args.lats) else args.lats
+    fnames = sorted(glob(lats))
+    assert len(fnames) > 0, RuntimeError(f"{lats} not found")
+    if issubclass(data_cls, LatsOracleAlignDataSet):
+        assert args.ref_text_fname is not None, RuntimeError("--ref_text_fname required")
+
+    tokenizer = WordTokenizer.build_from_args(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    writer = ShardWriter(data_cls, tokenizer, args.out_dir,
+                         ref_text_fname=args.ref_text_fname,
+                         all_oracle_targets=args.all_oracle_targets)
+    num_utts = 0
+    for shard_dir, shard_utts in iter_lats_parallel(fnames, nj=args.nj, chunks_per_file=args.chunks_per_file,
+                                                    process_chunk=writer):
+        logger.info(f"Shard {shard_dir} saved ({shard_utts} utterances).")
+        num_utts += shard_utts
+    logger.info(f"Converted {num_utts} utterances from {len(fnames)} files to {args.out_dir}/store.*")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# Copyright 2021 STC-Innovation LTD (Author: Anton Mitrofanov)
+# Converts lat.*.dump or kaldi lat.*.t lattices to a columnar memory mapped lattice store.
+# Usage example:
+# python ltlm/pyscripts/lats_to_store.py --tokenizer_fn data/lang/words.txt \
+#   --data exp/model/decode/lt_egs --data_type dump exp/model/decode/lt_egs/store
+# Then train/eval with --data_type memmap (or "data_type": "memmap" in data json).
+import argparse
+import logging
+import sys
+
+from ltlm.Tokenizer import WordTokenizer
+from ltlm.pyutils.logging_utils import setup_logger
+from ltlm.tasks.rescoring_task import add_training_type_args, get_data_cls
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    setup_logger(stream=sys.stderr, logger_level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    add_training_type_args(parser)
+    type_args, _ = parser.parse_known_args()
+    logger.info(f"Using  {vars(type_args)}")
+    data_cls = get_data_cls(type_args)
+    WordTokenizer.add_args(parser)
+    data_cls.add_args(parser, add_scale_opts=True)
+    parser.add_argument('store', type=str, help="Output lattice store directory.")
+    args = parser.parse_args()
+    assert args.data_type != 'memmap', RuntimeError("Input data is already lattice store")
+
+    tokenizer = WordTokenizer.build_from_args(args)
+    ds = data_cls.build_from_args(args, tokenizer, clip=False)
+    ds.save_to_store(args.store)
+    logger.info(f"Lattice store {args.store} saved.")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,8 @@ def parse_lats_json(fname):
     # {
     # "train" : [ { "epoch": 1, "lats": "exp/model/decode/lt_egs", "utt_suff": "", "use_once": True},
     #             { "epoch": 2, "lats": "exp/model2/decode/lt_egs", "utt_suff": "_2", "use_once": False},
-    #             { "epoch": 2, "lats": "exp/model/decode/lt_egs", "utt_suff": "", "use_once": False}
+    #             { "epoch": 2, "lats": "exp/model/decode/lt_egs", "utt_suff": "", "use_once": False},
+    #             { "epoch": 3, "lats": "exp/model/decode/lt_egs/store", "utt_suff": "", "data_type": "memmap"}
     #           ],
     # "valid" : [{"lats": "exp/model/decode_valid/lt_egs", "ref": "data/valid/text"}],
     # "test" : [ {"lats": "exp/model/decode_valid/lt_egs", "ref": "data/valid/text"},
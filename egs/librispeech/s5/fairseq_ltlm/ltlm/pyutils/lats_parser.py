@@ -0,0 +1,162 @@
+# Copyright 2021 STC-Innovation LTD (Author: Anton Mitrofanov)
+""" Streaming parser for kaldi text lattices (lattice-copy ark,t:-).
+
+Unlike lattice_utils.parse_lats it does not need the whole text in memory
+and returns NumPy arrays instead of tuples with string alignments.
+Files can be split into byte ranges at utterance boundaries and parsed in a process pool.
+"""
+import os
+import logging
+from collections import namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# arcs - int64 [num_arcs, 3] (state_from, state_to, word_id)
+# weights - float64 [num_arcs, 2] (hclg, am)
+# finals - int64 [num_finals] final states
+# final_weights - float64 [num_finals, 2]
+# ali, final_ali - list of alignment strings or None
+CompactLat = namedtuple('CompactLat', ['arcs', 'weights', 'finals', 'final_weights', 'ali', 'final_ali'])
+
+
+def _split_weight(field, keep_ali):
+    w_hclg, w_am, ali = field.split(',', 2)
+    return float(w_hclg), float(w_am), (ali if keep_ali else None)
+
+
+def _to_compact(arcs, weights, finals, final_weights, ali, final_ali, keep_ali):
+    return CompactLat(np.array(arcs, dtype=np.int64).reshape(-1, 3),
+                      np.array(weights, dtype=np.float64).reshape(-1, 2),
+                      np.array(finals, dtype=np.int64),
+                      np.array(final_weights, dtype=np.float64).reshape(-1, 2),
+                      ali if keep_ali else None,
+                      final_ali if keep_ali else None)
+
+
+def iter_lats(lines, keep_ali=False):
+    """ Streaming version of lattice_utils.parse_lats.
+    :param lines: iterable with kaldi text lattice lines (str or bytes)
+    :param keep_ali: keep alignment strings
+    :return: generator of (utt_id, CompactLat)
+    """
+    utt_id = None
+    arcs, weights, finals, final_weights, ali, final_ali = [], [], [], [], [], []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        fields = line.split()
+        if utt_id is None:
+            if len(fields) == 0:
+                continue
+            assert len(fields) == 1, RuntimeError(f"iter_lats: expected utterance id, got {line}")
+            utt_id = fields[0]
+            continue
+        num_fields = len(fields)
+        if num_fields == 4:
+            arcs.append((int(fields[0]), int(fields[1]), int(fields[2])))
+            w_hclg, w_am, a = _split_weight(fields[3], keep_ali)
+            weights.append((w_hclg, w_am))
+            ali.append(a)
+        elif num_fields == 3:
+            arcs.append((int(fields[0]), int(fields[1]), int(fields[2])))
+            weights.append((0.0, 0.0))
+            ali.append('')
+        elif num_fields == 2:
+            finals.append(int(fields[0]))
+            w_hclg, w_am, a = _split_weight(fields[1], keep_ali)
+            final_weights.append((w_hclg, w_am))
+            final_ali.append(a)
+        elif num_fields == 1:
+            finals.append(int(fields[0]))
+            final_weights.append((0.0, 0.0))
+            final_ali.append('')
+        elif num_fields == 0:
+            yield utt_id, _to_compact(arcs, weights, finals, final_weights, ali, final_ali, keep_ali)
+            utt_id = None
+            arcs, weights, finals, final_weights, ali, final_ali = [], [], [], [], [], []
+        else:
+            raise RuntimeError(f"iter_lats Wrong line in  {utt_id}: {line}")
+    if utt_id is not None:
+        yield utt_id, _to_compact(arcs, weights, finals, final_weights, ali, final_ali, keep_ali)
+
+
+def split_at_utterances(fname, num_chunks):
+    """ Split a text lattice file into byte ranges. Each range starts at an utterance id line.
+    :return: list of (fname, begin, end)
+    """
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, 'rb') as f:
+        for i in range(1, num_chunks):
+            pos = max(size * i // num_chunks, bounds[-1])
+            f.seek(pos)
+            if pos > 0:
+                # skip the rest of current line
+                f.readline()
+            # find an empty line - end of lattice
+            while True:
+                line = f.readline()
+                if not line or not line.strip():
+                    break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(fname, b, e) for b, e in zip(bounds[:-1], bounds[1:]) if e > b]
+
+
+def iter_byte_range(fname, begin, end):
+    with open(fname, 'rb', buffering=1 << 20) as f:
+        f.seek(begin)
+        pos = begin
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def parse_chunk(chunk, keep_ali=False):
+    """ :param chunk: (fname, begin, end)
+        :return: list of (utt_id, CompactLat) """
+    return list(iter_lats(iter_byte_range(*chunk), keep_ali=keep_ali))
+
+
+def make_chunks(fnames, chunks_per_file=1):
+    chunks = []
+    for fn in fnames:
+        if chunks_per_file > 1:
+            chunks.extend(split_at_utterances(fn, chunks_per_file))
+        else:
+            chunks.append((fn, 0, os.path.getsize(fn)))
+    return chunks
+
+
+def iter_lats_parallel(fnames, nj=1, chunks_per_file=1, keep_ali=False, process_chunk=None):
+    """ Parse text lattice files in a process pool. Results are yielded in file order.
+    :param fnames: list of lat.*.t files
+    :param nj: number of processes
+    :param chunks_per_file: split each file into byte ranges at utterance boundaries
+    :param keep_ali: keep alignment strings
+    :param process_chunk: picklable function (chunk_id, [(utt_id, CompactLat), ...]) -> result,
+                          called in workers. Default returns parsed lattices.
+    :return: generator of results per chunk
+    """
+    chunks = make_chunks(fnames, chunks_per_file)
+    logger.info(f"Parsing {len(fnames)} files in {len(chunks)} chunks with {nj} processes.")
+    tasks = [(chunk_id, chunk, keep_ali, process_chunk) for chunk_id, chunk in enumerate(chunks)]
+    if nj <= 1:
+        yield from map(_run_task, tasks)
+        return
+    with Pool(nj) as pool:
+        yield from pool.imap(_run_task, tasks)
+
+
+def _run_task(task):
+    chunk_id, chunk, keep_ali, process_chunk = task
+    lats = parse_chunk(chunk, keep_ali=keep_ali)
+    if process_chunk is None:
+        return lats
+    return process_chunk(chunk_id, lats)
@@ -0,0 +1,166 @@
+# Copyright 2021 STC-Innovation LTD (Author: Anton Mitrofanov)
+""" Columnar on-disk lattice store.
+
+Store is a directory:
+    meta.json            - format version, number of utterances, column names and extra values
+    utts.txt             - utterance ids, one per line. Line number is utterance index
+    <column>.npy         - concatenated per-utterance arrays of the column
+    <column>.offsets.npy - int64 [num_utts + 1]. Utterance i is <column>[offsets[i]:offsets[i+1]]
+
+Columns are opened with np.load(mmap_mode='r'), so dataloader workers share pages through the OS cache.
+"""
+import bisect
+import json
+import os
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT = 'ltlm_lats_store'
+STORE_VERSION = 1
+META_FNAME = 'meta.json'
+UTTS_FNAME = 'utts.txt'
+
+
+def is_lats_store(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, META_FNAME))
+
+
+def write_lats_store(out_dir, id2utt, columns, dtypes=None, extra=None):
+    """ Write utterances to store.
+
+    :param out_dir: store directory. Will be created.
+    :param id2utt: list of utterance ids.
+    :param columns: dict column_name -> list of per-utterance arrays. Same order as id2utt.
+    :param dtypes: dict column_name -> numpy dtype. Default - dtype of the first array.
+    :param extra: json serializable dict with additional dataset values.
+    """
+    dtypes = dtypes or {}
+    os.makedirs(out_dir, exist_ok=True)
+    for name, values in columns.items():
+        assert len(values) == len(id2utt), \
+            RuntimeError(f"Column {name} has {len(values)} items, but there are {len(id2utt)} utterances")
+        arrays = [np.asarray(v, dtype=dtypes.get(name, None)) for v in values]
+        lens = np.fromiter((a.shape[0] for a in arrays), dtype=np.int64, count=len(arrays))
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        if len(arrays) > 0:
+            dtype = dtypes.get(name, arrays[0].dtype)
+            inner_shape = max((a.shape[1:] for a in arrays), key=len)
+            data = np.concatenate([a.reshape((-1, *inner_shape)) for a in arrays]).astype(dtype, copy=False)
+        else:
+            data = np.zeros(0, dtype=dtypes.get(name, np.float32))
+        np.save(os.path.join(out_dir, f'{name}.npy'), data)
+        np.save(os.path.join(out_dir, f'{name}.offsets.npy'), offsets)
+    with open(os.path.join(out_dir, UTTS_FNAME), 'w', encoding='utf-8') as f:
+        for utt in id2utt:
+            f.write(f"{utt}\n")
+    meta = {'format': STORE_FORMAT,
+            'version': STORE_VERSION,
+            'num_utts': len(id2utt),
+            'columns': list(columns.keys()),
+            'extra': extra or {}}
+    with open(os.path.join(out_dir, META_FNAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"Lattice store {out_dir} saved. {len(id2utt)} utterances, columns {list(columns.keys())}.")
+
+
+def read_store_meta(store_dir):
+    with open(os.path.join(store_dir, META_FNAME), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    assert meta.get('format') == STORE_FORMAT and meta.get('version') == STORE_VERSION, \
+        RuntimeError(f"{store_dir} is not a lattice store (meta {meta})")
+    return meta
+
+
+def read_store_utts(store_dir):
+    with open(os.path.join(store_dir, UTTS_FNAME), 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+class RaggedColumn:
+    """ Read-only list-like view of one column from one or more stores.
+
+    Arrays are memory mapped lazily on the first access. Only paths are pickled,
+    so every worker process maps the same files instead of copying the data.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.store_dirs = []
+        self.cum_counts = [0]
+        self._values = None
+        self._offsets = None
+
+    def append_store(self, store_dir, num_utts):
+        self.store_dirs.append(store_dir)
+        self.cum_counts.append(self.cum_counts[-1] + num_utts)
+        self._values, self._offsets = None, None
+
+    def _open(self):
+        self._values = [np.load(os.path.join(d, f'{self.name}.npy'), mmap_mode='r') for d in self.store_dirs]
+        self._offsets = [np.load(os.path.join(d, f'{self.name}.offsets.npy'), mmap_mode='r') for d in self.store_dirs]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_values'], state['_offsets'] = None, None
+        return state
+
+    def __len__(self):
+        return self.cum_counts[-1]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"RaggedColumn {self.name}: index {i} out of range")
+        if self._values is None:
+            self._open()
+        part = bisect.bisect_right(self.cum_counts, i) - 1
+        local_i = i - self.cum_counts[part]
+        offsets = self._offsets[part]
+        return self._values[part][offsets[local_i]:offsets[local_i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """ Length of each utterance array. Computed from offsets only. """
+        if self._offsets is None:
+            self._open()
+        if len(self._offsets) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.diff(o) for o in self._offsets])
+
+
+class RaggedUttMap:
+    """ Read-only dict-like view utt_id -> array over RaggedColumn """
+    def __init__(self, column, utt2id):
+        self.column = column
+        self.utt2id = utt2id
+
+    def __getitem__(self, utt):
+        return self.column[self.utt2id[utt]]
+
+    def __contains__(self, utt):
+        return utt in self.utt2id
+
+    def __len__(self):
+        return len(self.utt2id)
+
+    def __iter__(self):
+        return iter(self.utt2id)
+
+    def keys(self):
+        return self.utt2id.keys()
+
+    def values(self):
+        return (self.column[i] for i in self.utt2id.values())
+
+    def items(self):
+        return ((utt, self.column[i]) for utt, i in self.utt2id.items())
+
+    def get(self, utt, default=None):
+        return self[utt] if utt in self.utt2id else default
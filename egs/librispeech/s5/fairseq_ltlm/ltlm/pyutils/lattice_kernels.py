@@ -0,0 +1,293 @@
+# Copyright 2021 STC-Innovation LTD (Author: Anton Mitrofanov)
+""" Level-synchronous lattice algorithms.
+
+States are grouped by topological level (longest distance from a state without incoming arcs).
+All arcs entering states of one level are processed with a single array operation,
+so the python loop runs over levels instead of states and arcs.
+Many lattices can be packed into one disjoint graph (see pack_lats) and processed together.
+"""
+import itertools
+import numpy as np
+import torch
+
+from ltlm.pyutils.lattice_utils import WORD_ID, STATE_FROM, STATE_TO
+
+START_STATE = 1
+
+
+def csr_gather(starts, ends):
+    """ Concatenated ranges [starts[0]:ends[0]] + [starts[1]:ends[1]] + ... """
+    counts = ends - starts
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+def state_levels(state_from, state_to, num_states=None):
+    """ Topological levels of states. Level-synchronous Kahn's algorithm.
+    :param state_from: int array [num_arcs]
+    :param state_to: int array [num_arcs]
+    :param num_states: size of output. Default max state id + 1
+    :return: int64 array [num_states]. -1 for states without arcs.
+    """
+    state_from = np.asarray(state_from, dtype=np.int64)
+    state_to = np.asarray(state_to, dtype=np.int64)
+    if num_states is None:
+        num_states = int(max(state_from.max(), state_to.max())) + 1
+    present = np.zeros(num_states, dtype=bool)
+    present[state_from] = True
+    present[state_to] = True
+    indegree = np.bincount(state_to, minlength=num_states)
+
+    # CSR: arcs leaving state s are out_arcs[out_starts[s]:out_starts[s+1]]
+    out_arcs = np.argsort(state_from, kind='stable')
+    out_starts = np.searchsorted(state_from[out_arcs], np.arange(num_states + 1))
+
+    levels = np.full(num_states, -1, dtype=np.int64)
+    frontier = np.flatnonzero(present & (indegree == 0))
+    level = 0
+    num_done = 0
+    while frontier.size > 0:
+        levels[frontier] = level
+        num_done += frontier.size
+        arc_ids = out_arcs[csr_gather(out_starts[frontier], out_starts[frontier + 1])]
+        dests = state_to[arc_ids]
+        indegree -= np.bincount(dests, minlength=num_states)
+        dests = np.unique(dests)
+        frontier = dests[indegree[dests] == 0]
+        level += 1
+    if num_done != present.sum():
+        raise RuntimeError(f"Topsort error. Lattice has a cycle.")
+    return levels
+
+
+def topsort_order(state_from, state_to, num_states=None):
+    """ Random topological order of states. Kahn's algorithm that takes a random state among all states
+    without unprocessed incoming arcs at each step, as the original lattice_utils.topsort_lat did,
+    so every topological order can be produced (not only those that keep the levels of state_levels).
+    Runs in O(num_states + num_arcs).
+    :param state_from: int array [num_arcs]
+    :param state_to: int array [num_arcs]
+    :param num_states: Default max state id + 1
+    :return: old state ids in new order. """
+    state_from = np.asarray(state_from, dtype=np.int64)
+    state_to = np.asarray(state_to, dtype=np.int64)
+    if num_states is None:
+        num_states = int(max(state_from.max(), state_to.max())) + 1
+    present = np.zeros(num_states, dtype=bool)
+    present[state_from] = True
+    present[state_to] = True
+    num_present = int(present.sum())
+    indegree = np.bincount(state_to, minlength=num_states)
+    ready = np.flatnonzero(present & (indegree == 0)).tolist()
+
+    out_arcs = np.argsort(state_from, kind='stable')
+    out_starts = np.searchsorted(state_from[out_arcs], np.arange(num_states + 1)).tolist()
+    dests = state_to[out_arcs].tolist()
+    indegree = indegree.tolist()
+    picks = np.random.random(num_present).tolist()
+
+    order = []
+    while ready:
+        i = int(picks[len(order)] * len(ready))
+        state = ready[i]
+        ready[i] = ready[-1]
+        ready.pop()
+        order.append(state)
+        for dest in dests[out_starts[state]:out_starts[state + 1]]:
+            indegree[dest] -= 1
+            if indegree[dest] == 0:
+                ready.append(dest)
+    if len(order) != num_present:
+        raise RuntimeError(f"Topsort error. Lattice has a cycle.")
+    return np.array(order, dtype=np.int64)
+
+
+def group_arcs_by_level(levels, state_to):
+    """ :return: arcs sorted by level of their destination state and level boundaries in this order """
+    dest_levels = levels[state_to]
+    order = np.argsort(dest_levels, kind='stable')
+    bounds = np.searchsorted(dest_levels[order], np.arange(levels.max() + 2))
+    return order, bounds
+
+
+def pack_lats(lats):
+    """ Pack lattices into one disjoint graph.
+    :param lats: list of lattices [(word_id, state_from, state_to), ...]
+    :return: packed lattice [num_arcs, 3], arc offsets [num_lats + 1], state offsets [num_lats + 1]
+    """
+    lats = [np.asarray(lat, dtype=np.int64).reshape(-1, 3) for lat in lats]
+    num_arcs = np.array([lat.shape[0] for lat in lats], dtype=np.int64)
+    num_states = np.array([lat[:, [STATE_FROM, STATE_TO]].max() + 1 if lat.shape[0] else 0 for lat in lats],
+                          dtype=np.int64)
+    arc_offsets = np.concatenate([[0], np.cumsum(num_arcs)])
+    state_offsets = np.concatenate([[0], np.cumsum(num_states)])
+    packed = np.concatenate(lats) if lats else np.zeros((0, 3), dtype=np.int64)
+    shifts = np.repeat(state_offsets[:-1], num_arcs)
+    packed[:, STATE_FROM] += shifts
+    packed[:, STATE_TO] += shifts
+    return packed, arc_offsets, state_offsets
+
+
+def logsumexp_scatter(values, index, size):
+    """ out[i] = log(sum(exp(values[index == i]))). Differentiable by values. """
+    with torch.no_grad():
+        shift = np.full(size, -np.inf)
+        np.maximum.at(shift, index.numpy(), values.detach().cpu().numpy())
+        shift[np.isinf(shift)] = 0
+        shift = torch.from_numpy(shift).to(values)
+    sums = values.new_zeros(size).index_add(0, index, (values - shift[index]).exp())
+    return sums.log() + shift
+
+
+def batch_forward(lats, nloglikes):
+    """ Forward algorithm for many lattices at once. Same semantic as lattice_utils.forward.
+    :param lats: list of topsorted lattices
+    :param nloglikes: list of arc scores (torch tensors or arrays)
+    :return: torch tensor [num_lats] with forward score of the last state of each lattice.
+    """
+    packed, arc_offsets, state_offsets = pack_lats(lats)
+    nloglike = torch.cat([torch.as_tensor(n).reshape(-1) for n in nloglikes])
+    num_states = int(state_offsets[-1])
+    levels = state_levels(packed[:, STATE_FROM], packed[:, STATE_TO], num_states)
+    order, bounds = group_arcs_by_level(levels, packed[:, STATE_TO])
+
+    logalpha = nloglike.new_zeros(num_states)
+    for level in range(1, len(bounds) - 1):
+        arc_ids = order[bounds[level]:bounds[level + 1]]
+        if arc_ids.size == 0:
+            continue
+        dests, dest_index = np.unique(packed[arc_ids, STATE_TO], return_inverse=True)
+        arc_ids_t = torch.from_numpy(arc_ids)
+        values = logalpha[torch.from_numpy(packed[arc_ids, STATE_FROM])] + nloglike[arc_ids_t]
+        level_alpha = logsumexp_scatter(values, torch.from_numpy(dest_index), dests.size)
+        logalpha = logalpha.index_copy(0, torch.from_numpy(dests), level_alpha)
+    return logalpha[torch.from_numpy(state_offsets[1:] - 1)]
+
+
+def forward(lat_tensor, nloglike):
+    """ Level-synchronous version of lattice_utils.forward """
+    return batch_forward([lat_tensor], [nloglike])[0]
+
+
+def batch_best_paths(lats, nloglikes, final_word_id):
+    """ Best path (minimum negative log likelihood) for many lattices at once.
+    Same semantic (and tie breaking) as lattice_utils.best_path_nloglike.
+
+    :param lats: list of topsorted lattices [(word_id, state_from, state_to), ...]
+    :param nloglikes: list of arc negative log likelihoods
+    :param final_word_id: ==tokenizer.get_eos_id()
+    :return: list of (best path score, best path arcs tuple)
+    """
+    packed, arc_offsets, state_offsets = pack_lats(lats)
+    nloglike = np.concatenate([np.asarray(n).reshape(-1) for n in nloglikes])
+    num_arcs, num_states = packed.shape[0], int(state_offsets[-1])
+    levels = state_levels(packed[:, STATE_FROM], packed[:, STATE_TO], num_states)
+    order, bounds = group_arcs_by_level(levels, packed[:, STATE_TO])
+
+    alpha = np.full(num_states, np.inf, dtype=nloglike.dtype)
+    alpha[state_offsets[:-1] + START_STATE] = 0
+    back_arc = np.full(num_states, -1, dtype=np.int64)
+    for level in range(1, len(bounds) - 1):
+        arc_ids = order[bounds[level]:bounds[level + 1]]
+        if arc_ids.size == 0:
+            continue
+        froms, dests = packed[arc_ids, STATE_FROM], packed[arc_ids, STATE_TO]
+        values = alpha[froms] + nloglike[arc_ids]
+        level_alpha = np.full(num_states, np.inf, dtype=alpha.dtype)
+        np.minimum.at(level_alpha, dests, values)
+        winners = np.isfinite(values) & (values == level_alpha[dests])
+        # first arc in (state_from, arc_id) order wins. Same as sequential strict '<'.
+        keys = froms[winners] * num_arcs + arc_ids[winners]
+        best_keys = np.full(num_states, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(best_keys, dests[winners], keys)
+        updated = np.unique(dests[winners])
+        alpha[updated] = level_alpha[updated]
+        back_arc[updated] = best_keys[updated] % num_arcs
+
+    is_final = np.zeros(num_states, dtype=bool)
+    is_final[packed[packed[:, WORD_ID] == final_word_id, STATE_TO]] = True
+    out = []
+    for i, lat in enumerate(lats):
+        s_begin, s_end = state_offsets[i], state_offsets[i + 1]
+        finals = np.flatnonzero(is_final[s_begin:s_end]) + s_begin
+        assert finals.size > 0, RuntimeError(f"Lattice without final states {lat}")
+        final_state = finals[np.argmin(alpha[finals])]
+        assert np.isfinite(alpha[final_state]), RuntimeError(f"Final state is unreachable in {lat}")
+        arcs = []
+        state = final_state
+        while state != s_begin + START_STATE:
+            arc_id = back_arc[state]
+            arcs.append(arc_id - arc_offsets[i])
+            state = packed[arc_id, STATE_FROM]
+        lat = np.asarray(lat)
+        out.append((alpha[final_state], tuple(lat[a] for a in reversed(arcs))))
+    return out
+
+
+def best_path_nloglike(lat_tensor, nloglike, final_word_id):
+    """ Level-synchronous version of lattice_utils.best_path_nloglike """
+    return batch_best_paths([lat_tensor], [nloglike], final_word_id)[0]
+
+
+def random_lattice(num_states, num_arcs, final_word_id, num_words=10):
+    """ Random topsorted lattice for test_library(). States 1..num_states, every state is
+    reachable from state 1 and reaches state num_states, which is the only final state. """
+    arcs = [(np.random.randint(num_words), s - 1, s) for s in range(2, num_states + 1)]
+    for _ in range(num_arcs - len(arcs)):
+        s_from = np.random.randint(1, num_states)
+        arcs.append((np.random.randint(num_words), s_from, np.random.randint(s_from + 1, num_states + 1)))
+    arcs = [(final_word_id if s_to == num_states else w, s_from, s_to) for w, s_from, s_to in arcs]
+    return np.array([arcs[i] for i in np.random.permutation(len(arcs))], dtype=np.int64)
+
+
+def test_library():
+    """ Compares the kernels with the per-arc implementations in lattice_utils on random lattices. """
+    from ltlm.pyutils import lattice_utils
+    final_word_id = 100
+    for _ in range(200):
+        lats = [random_lattice(num_states, np.random.randint(num_states - 1, 4 * num_states), final_word_id)
+                for num_states in np.random.randint(2, 30, size=np.random.randint(1, 6))]
+
+        # levels: longest distance from the start state
+        lat = lats[0]
+        levels = state_levels(lat[:, STATE_FROM], lat[:, STATE_TO])
+        ref_levels = np.full(levels.shape[0], -1, dtype=np.int64)
+        ref_levels[START_STATE] = 0
+        for s in range(START_STATE + 1, levels.shape[0]):
+            ref_levels[s] = max(ref_levels[a[STATE_FROM]] + 1 for a in lat if a[STATE_TO] == s)
+        assert (levels == ref_levels).all(), f"{levels} != {ref_levels}"
+        sorted_lat = lattice_utils.topsort_lat(lat)
+        assert (sorted_lat[:, STATE_FROM] < sorted_lat[:, STATE_TO]).all()
+        assert sorted(sorted_lat[:, WORD_ID]) == sorted(lat[:, WORD_ID])
+
+        # topsort_order: on small lattices, every topological order is produced
+        small_lat = random_lattice(np.random.randint(2, 7), np.random.randint(5, 9), final_word_id)
+        arcs = set(map(tuple, small_lat[:, [STATE_FROM, STATE_TO]].tolist()))
+        ref_orders = {order for order in itertools.permutations(range(1, small_lat[:, STATE_TO].max() + 1))
+                      if all(order.index(a) < order.index(b) for a, b in arcs)}
+        orders = {tuple(topsort_order(small_lat[:, STATE_FROM], small_lat[:, STATE_TO]).tolist())
+                  for _ in range(50 * len(ref_orders))}
+        assert orders == ref_orders, f"{orders} != {ref_orders}"
+
+        # forward
+        nloglikes = [torch.randn(lat.shape[0], dtype=torch.float64) for lat in lats]
+        batch_alphas = batch_forward(lats, nloglikes)
+        for lat, nloglike, alpha in zip(lats, nloglikes, batch_alphas):
+            ref_alpha = lattice_utils.forward(torch.from_numpy(lat), nloglike)
+            assert torch.allclose(alpha, ref_alpha), f"{alpha} != {ref_alpha}"
+
+        # best path, with ties
+        nloglikes = [np.random.randint(0, 3, size=lat.shape[0]).astype(np.float64) for lat in lats]
+        for lat, nloglike, (score, path) in zip(lats, nloglikes,
+                                                batch_best_paths(lats, nloglikes, final_word_id)):
+            ref_score, ref_path = lattice_utils.best_path_nloglike(lat, nloglike, final_word_id)
+            assert score == ref_score, f"{score} != {ref_score}"
+            assert np.array_equal(np.array(path), np.array(ref_path)), f"{path} != {ref_path}"
+    print("lattice_kernels: all tests passed")
+
+
+if __name__ == "__main__":
+    test_library()
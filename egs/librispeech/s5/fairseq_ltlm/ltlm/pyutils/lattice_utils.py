@@ -33,45 +33,33 @@ def padding(*sequences):
 
 
 def topsort_lat(lat, random_shift=False, max_state=None):
-    """ Topsorting a lattice. Kahn's algorithm
+    """ Topsorting a lattice. Kahn's algorithm with a random pick among the ready states
+    (see lattice_kernels.topsort_order)
     This function contains random, so topsort_lat(lat) can be != topsort_lat(lat)
     :param lat: - [(word_id, state_from, state_to), ...]
     :param random_shift: - randomly increases the distance between consecutive states. False
     :param max_state: - maximum state id. Default None
     :raturn: new topsorted lattice"""
+    from ltlm.pyutils.lattice_kernels import topsort_order
 
-    V = {arc[STATE_FROM] for arc in lat} | {arc[STATE_TO] for arc in lat}
-    A = {i: set() for i in V}
-    for arc in lat:
-        A[arc[STATE_TO]].add(arc[STATE_FROM])
-    newid2oldid = [0]
-    while len(newid2oldid) <= len(V):
-        vs = [i for i, v in A.items() if len(v) == 0]
-        if len(vs) == 0:
-            print(f"Lat: {lat}")
-            print(f"V: {V}")
-            print(f"A: {A}")
-            print(f"newid2oldid: {newid2oldid}")
-            raise RuntimeError(f"Topsort error.")
-        i = np.random.choice(vs)
-        A.pop(i)
-        newid2oldid.append(i)
-        for a in A.values():
-            a.discard(i)
-    old2new = {i_old: i_new for i_new, i_old in enumerate(newid2oldid)}
+    lat = np.asarray(lat, dtype=np.int64).reshape(-1, 3)
+    newid2oldid = topsort_order(lat[:, STATE_FROM], lat[:, STATE_TO])
+    old2new = np.zeros(int(lat[:, [STATE_FROM, STATE_TO]].max()) + 1, dtype=np.int64)
+    old2new[newid2oldid] = np.arange(1, newid2oldid.shape[0] + 1)
     if random_shift:
-        shift=0
-        max_shift = max_state - len(old2new)
-        max_step = max_state // len(old2new)
-        for k,v in old2new.items():
-            if v == 0 or v == 1:
-                continue
+        shift = 0
+        num_states = newid2oldid.shape[0] + 1
+        max_shift = max_state - num_states
+        max_step = max_state // num_states
+        shifts = np.zeros(num_states, dtype=np.int64)
+        for new_id in range(2, num_states):
             new_shift = random.randint(0, min(max_step, max_shift))
             shift += new_shift
             max_shift -= new_shift
-            old2new[k] += shift
+            shifts[new_id] = shift
+        old2new += shifts[old2new]
 
-    sorted_lat = np.array([(arc[0], old2new[arc[1]], old2new[arc[2]]) for arc in lat])
+    sorted_lat = np.stack([lat[:, WORD_ID], old2new[lat[:, STATE_FROM]], old2new[lat[:, STATE_TO]]], axis=1)
     return sorted_lat
 
 
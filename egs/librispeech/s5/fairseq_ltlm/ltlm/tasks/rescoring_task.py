@@ -96,7 +96,7 @@ class RescoringTask(FairseqTask):
                                                  tokenizer=self.tokenizer,
                                                  max_len=self.cfg.max_len,
                                                  ref_text_fname=ref_text,
-                                                 data_type='dump',
+                                                 data_type=set_data.get('data_type', 'dump'),
                                                  clip=True)
             logger.info(f"For split {split}:({lats_data}) ORACLE WER is {round(ds.oracle_wer()[0], 2)}")
             wer = compute_model_wer(None,
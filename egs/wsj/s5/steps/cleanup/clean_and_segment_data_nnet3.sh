@@ -43,6 +43,9 @@ extractor=    # i-Vector extractor. If provided, will extract i-vectors.
 use_vad=false # Use energy-based VAD for i-vector extraction
 
 segmentation_opts=
+fused=false  # If true, modify, taint and segment the ctm-edits in a single
+             # pass with steps/cleanup/internal/process_ctm_edits.py.
+num_jobs=1   # Number of processes used by process_ctm_edits.py if --fused true.
 
 . ./path.sh
 . utils/parse_options.sh
@@ -73,6 +76,9 @@ if [ $# -ne 5 ]; then
                                 # Please run steps/cleanup/internal/segment_ctm_edits.py
                                 # without arguments to see allowed options.
     --cleanup        <true|false>  # Clean up intermediate files afterward.  Default true.
+    --fused <true|false>        # If true, do the modification, tainting and segmentation
+                                # of the ctm-edits in a single pass.  Default false.
+    --num-jobs <n>              # Number of processes to use if --fused true.  Default 1.
     --extractor <extractor>     # i-vector extractor directory if i-vector is
                                 # to be used during decoding. Must match
                                 # the extractor used for training neural-network.
@@ -198,7 +204,7 @@ if [ $stage -le 4 ]; then
   steps/cleanup/internal/get_non_scored_words.py $lang > $dir/non_scored_words.txt
 fi
 
-if [ $stage -le 5 ]; then
+if ! $fused && [ $stage -le 5 ]; then
   echo "$0: modifying ctm-edits file to allow repetitions [for dysfluencies] and "
   echo "   ... to fix reference mismatches involving non-scored words. "
 
@@ -210,7 +216,7 @@ if [ $stage -le 5 ]; then
   echo " a list of commonly-repeated words."
 fi
 
-if [ $stage -le 6 ]; then
+if ! $fused && [ $stage -le 6 ]; then
   echo "$0: applying 'taint' markers to ctm-edits file to mark silences and"
   echo "  ... non-scored words that are next to errors."
   $cmd $dir/log/taint_ctm_edits.log \
@@ -219,7 +225,7 @@ if [ $stage -le 6 ]; then
 fi
 
 
-if [ $stage -le 7 ]; then
+if ! $fused && [ $stage -le 7 ]; then
   echo "$0: creating segmentation from ctm-edits file."
 
   $cmd $dir/log/segment_ctm_edits.log \
@@ -238,6 +244,26 @@ if [ $stage -le 7 ]; then
   echo "For detailed utterance-level debugging information, see $dir/ctm_edits.segmented"
 fi
 
+if $fused && [ $stage -le 7 ]; then
+  echo "$0: modifying, tainting and creating segmentation from ctm-edits file."
+
+  $cmd --num-threads $num_jobs $dir/log/process_ctm_edits.log \
+    steps/cleanup/internal/process_ctm_edits.py \
+      --verbose=3 --num-jobs=$num_jobs \
+      $segmentation_opts \
+      --oov-symbol-file=$lang/oov.txt \
+      --ctm-edits-out=$dir/ctm_edits.segmented \
+      --word-stats-out=$dir/word_stats.txt \
+      $dir/non_scored_words.txt \
+      $dir/lattice_oracle/ctm_edits $dir/text $dir/segments
+
+  echo "$0: contents of $dir/log/process_ctm_edits.log are:"
+  cat $dir/log/process_ctm_edits.log
+  echo "For word-level statistics on p(not-being-in-a-segment), with 'worst' words at the top,"
+  echo "see $dir/word_stats.txt"
+  echo "For detailed utterance-level debugging information, see $dir/ctm_edits.segmented"
+fi
+
 if [ $stage -le 8 ]; then
   echo "$0: working out required segment padding to account for feature-generation edge effects."
   # make sure $data/utt2dur exists.
@@ -0,0 +1,477 @@
+# Copyright 2016   Vimal Manohar
+#           2016   Johns Hopkins University (author: Daniel Povey)
+# Apache 2.0
+
+"""This module contains the per-utterance processing of the 'ctm-edits'
+format that is shared by modify_ctm_edits.py, taint_ctm_edits.py,
+segment_ctm_edits.py and process_ctm_edits.py.
+
+The ctm-edits file format is as follows [note: file-id is really
+utterance-id in this context]:
+<file-id> <channel> <start-time> <duration> <conf> <hyp-word> <ref-word> <edit> ['tainted']
+e.g.:
+AJJacobs_2007P-0001605-0003029 1 0 0.09 <eps> 1.0 <eps> sil
+AJJacobs_2007P-0001605-0003029 1 0.09 0.15 i 1.0 i cor
+
+An utterance is represented as the list of its split lines (a list of lists of
+fields, one per line), which is what ReadUtterances() yields and what the
+functions below operate on in place.  The statistics are accumulated in
+objects that can be summed with Add(), so that utterances may be processed
+in separate processes.
+"""
+
+from __future__ import print_function
+import logging
+import sys
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s [%(filename)s:%(lineno)s - '
+                              '%(funcName)s - %(levelname)s ] %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def ReadUtterances(f, program_name):
+    """Reads a ctm-edits file from the file handle 'f' and yields pairs
+    (utterance-id, split-lines-of-utterance), one per utterance.  The lines of
+    an utterance must be contiguous.  'program_name' is used in the error
+    messages."""
+    first_line = f.readline()
+    if first_line == '':
+        sys.exit(program_name + ": empty input")
+    split_pending_line = first_line.split()
+    if len(split_pending_line) == 0:
+        sys.exit(program_name + ": bad input line " + first_line)
+    cur_utterance = split_pending_line[0]
+    split_lines_of_cur_utterance = []
+
+    while True:
+        if len(split_pending_line) == 0 or split_pending_line[0] != cur_utterance:
+            yield cur_utterance, split_lines_of_cur_utterance
+            split_lines_of_cur_utterance = []
+            if len(split_pending_line) == 0:
+                break
+            else:
+                cur_utterance = split_pending_line[0]
+
+        split_lines_of_cur_utterance.append(split_pending_line)
+        next_line = f.readline()
+        split_pending_line = next_line.split()
+        if len(split_pending_line) == 0:
+            if next_line != '':
+                sys.exit(program_name + ": got an empty or whitespace input line")
+
+
+def ReadNonScoredWords(non_scored_words_file, program_name):
+    """Returns the set of words in the file 'non_scored_words_file', which
+    contains one word per line."""
+    non_scored_words = set()
+    try:
+        f = open(non_scored_words_file, encoding='utf-8')
+    except:
+        sys.exit(program_name + ": error opening file: "
+                 "--non-scored-words=" + non_scored_words_file)
+    for line in f.readlines():
+        a = line.split()
+        if not len(line.split()) == 1:
+            sys.exit(program_name + ": bad line in non-scored-words "
+                     "file {0}: {1}".format(non_scored_words_file, line))
+        non_scored_words.add(a[0])
+    f.close()
+    return non_scored_words
+
+
+class ModifyStats(object):
+    """Statistics of the changes made to the reference by ModifyUtterance()."""
+    def __init__(self):
+        self.num_lines = 0
+        self.num_correct_lines = 0
+        # ref_change_stats will be a map from a string like
+        # 'foo -> bar' to an integer count; it keeps track of how much we changed
+        # the reference.
+        self.ref_change_stats = defaultdict(int)
+        # repetition_stats will be a map from strings like
+        # 'a', or 'a b' (the repeated strings), to an integer count; like
+        # ref_change_stats, it keeps track of how many changes we made
+        # in allowing repetitions.
+        self.repetition_stats = defaultdict(int)
+
+    def Add(self, other):
+        self.num_lines += other.num_lines
+        self.num_correct_lines += other.num_correct_lines
+        for k, v in other.ref_change_stats.items():
+            self.ref_change_stats[k] += v
+        for k, v in other.repetition_stats.items():
+            self.repetition_stats[k] += v
+
+
+# This function processes a single line of ctm-edits input for fixing
+# "non-scored" words.  The input 'a' is the split line as an array of fields.
+# It modifies the object 'a'.   This function returns the modified array,
+# and please note that it is destructive of its input 'a'.
+# If it returns the empty array then the line is to be deleted.
+def ProcessLineForNonScoredWords(a, non_scored_words, stats):
+    try:
+        assert len(a) == 8
+        stats.num_lines += 1
+        # we could do:
+        # [ file, channel, start, duration, hyp_word, confidence, ref_word, edit_type ] = a
+        duration = a[3]
+        hyp_word = a[4]
+        ref_word = a[6]
+        edit_type = a[7]
+        if edit_type == 'ins':
+            assert ref_word == '<eps>'
+            if hyp_word in non_scored_words:
+                # insert this non-scored word into the reference.
+                stats.ref_change_stats[ref_word + ' -> ' + hyp_word] += 1
+                ref_word = hyp_word
+                edit_type = 'fix'
+        elif edit_type == 'del':
+            assert hyp_word == '<eps>' and float(duration) == 0.0
+            if ref_word in non_scored_words:
+                stats.ref_change_stats[ref_word + ' -> ' + hyp_word] += 1
+                return []
+        elif edit_type == 'sub':
+            assert hyp_word != '<eps>'
+            if hyp_word in non_scored_words and ref_word in non_scored_words:
+                # we also allow replacing one non-scored word with another.
+                stats.ref_change_stats[ref_word + ' -> ' + hyp_word] += 1
+                ref_word = hyp_word
+                edit_type = 'fix'
+        else:
+            assert edit_type == 'cor' or edit_type == 'sil'
+            stats.num_correct_lines += 1
+
+        a[4] = hyp_word
+        a[6] = ref_word
+        a[7] = edit_type
+        return a
+
+    except Exception:
+        logger.error("bad line in ctm-edits input: "
+                     "{0}".format(a))
+        raise RuntimeError
+
+# This function processes the split lines of one utterance (as a
+# list of lists of fields), to allow repetitions of words, so if the
+# reference says 'i' but the hyp says 'i i', or the ref says
+# 'you know' and the hyp says 'you know you know', we change the
+# ref to match.
+# It returns the modified list-of-lists [but note that the input
+# is actually modified].
+def ProcessUtteranceForRepetitions(split_lines_of_utt, non_scored_words, stats):
+    repetition_stats = stats.repetition_stats
+    # The array 'selected_lines' will contain the indexes of of selected
+    # elements of 'split_lines_of_utt'.  Consider split_line =
+    # split_lines_of_utt[i].  If the hyp and ref words in split_line are both
+    # either '<eps>' or non-scoreable words, we discard the index.
+    # Otherwise we put it into selected_lines.
+    selected_line_indexes = []
+    # selected_edits will contain, for each element of selected_line_indexes, the
+    # corresponding edit_type from the original utterance previous to
+    # this function call ('cor', 'ins', etc.).
+    #
+    # As a special case, if there was a substitution ('sub') where the
+    # reference word was a non-scored word and the hyp word was a real word,
+    # we mark it in this array as 'ins', because for purposes of this algorithm
+    # it behaves the same as an insertion.
+    #
+    # Whenever we do any operation that will change the reference, we change
+    # all the selected_edits in the array to None so that they won't match
+    # any further operations.
+    selected_edits = []
+    # selected_hyp_words will contain, for each element of selected_line_indexes, the
+    # corresponding hyp_word.
+    selected_hyp_words = []
+
+    for i in range(len(split_lines_of_utt)):
+        split_line = split_lines_of_utt[i]
+        hyp_word = split_line[4]
+        ref_word = split_line[6]
+        # keep_this_line will be True if we are going to keep this line in the
+        # 'selected lines' for further processing of repetitions.  We only
+        # eliminate lines involving non-scored words or epsilon in both hyp
+        # and reference position
+        # [note: epsilon in hyp position for non-empty segments indicates
+        #  optional-silence, and it does make sense to make this 'invisible',
+        #  just like non-scored words, for the purposes of this code.]
+        keep_this_line = True
+        if (hyp_word == '<eps>' or hyp_word in non_scored_words) and \
+           (ref_word == '<eps>' or ref_word in non_scored_words):
+            keep_this_line = False
+        if keep_this_line:
+            selected_line_indexes.append(i)
+            edit_type = split_line[7]
+            if edit_type == 'sub' and ref_word in non_scored_words:
+                assert not hyp_word in non_scored_words
+                # For purposes of this algorithm, substitution of, say,
+                # '[COUGH]' by 'hello' behaves like an insertion of 'hello',
+                # since we're willing to remove the '[COUGH]' from the
+                # transript.
+                edit_type = 'ins'
+            selected_edits.append(edit_type)
+            selected_hyp_words.append(hyp_word)
+
+    # indexes_to_fix will be a list of indexes into 'selected_indexes' where we
+    # plan to fix the ref to match the hyp.
+    indexes_to_fix = []
+
+    # This loop scans for, and fixes, two-word insertions that follow,
+    # or precede, the corresponding correct words.
+    for i in range(0, len(selected_line_indexes) - 3):
+        this_indexes = selected_line_indexes[i:i+4]
+        this_hyp_words = selected_hyp_words[i:i+4]
+
+        if this_hyp_words[0] == this_hyp_words[2] and \
+           this_hyp_words[1] == this_hyp_words[3] and \
+           this_hyp_words[0] != this_hyp_words[1]:
+            # if the hyp words were of the form [ 'a', 'b', 'a', 'b' ]...
+            this_edits = selected_edits[i:i+4]
+            if this_edits == [ 'cor', 'cor', 'ins', 'ins' ] or \
+                    this_edits == [ 'ins', 'ins', 'cor', 'cor' ]:
+                if this_edits[0] == 'cor':
+                    indexes_to_fix += [ i+2, i+3 ]
+                else:
+                    indexes_to_fix += [ i, i+1 ]
+
+                # the next line prevents this region of the text being used
+                # in any further edits.
+                selected_edits[i:i+4] = [ None, None, None, None ]
+                word_pair = this_hyp_words[0] + ' '  + this_hyp_words[1]
+                # e.g. word_pair = 'hi there'
+                # add 2 because these stats are of words.
+                repetition_stats[word_pair] += 2
+                # the next line prevents this region of the text being used
+                # in any further edits.
+                selected_edits[i:i+4] = [ None, None, None, None ]
+
+    # This loop scans for, and fixes, one-word insertions that follow,
+    # or precede, the corresponding correct words.
+    for i in range(0, len(selected_line_indexes) - 1):
+        this_indexes = selected_line_indexes[i:i+2]
+        this_hyp_words = selected_hyp_words[i:i+2]
+
+        if this_hyp_words[0] == this_hyp_words[1]:
+            # if the hyp words were of the form [ 'a', 'a' ]...
+            this_edits = selected_edits[i:i+2]
+            if this_edits == [ 'cor', 'ins' ] or this_edits == [ 'ins', 'cor' ]:
+                if this_edits[0] == 'cor':
+                    indexes_to_fix.append(i+1)
+                else:
+                    indexes_to_fix.append(i)
+                repetition_stats[this_hyp_words[0]] += 1
+                # the next line prevents this region of the text being used
+                # in any further edits.
+                selected_edits[i:i+2] = [ None, None ]
+
+    for i in indexes_to_fix:
+        j = selected_line_indexes[i]
+        split_line = split_lines_of_utt[j]
+        ref_word = split_line[6]
+        hyp_word = split_line[4]
+        assert ref_word == '<eps>' or ref_word in non_scored_words
+        # we replace reference with the decoded word, which will be a
+        # repetition.
+        split_line[6] = hyp_word
+        split_line[7] = 'cor'
+
+    return split_lines_of_utt
+
+
+# This is the processing done by modify_ctm_edits.py: it fixes the reference
+# for non-scored words and, if allow_repetitions is True, for repetitions.
+# note: split_lines_of_utt is a list of lists, one per line, each containing the
+# sequence of fields.
+# Returns the same format of data after processing.
+def ModifyUtterance(split_lines_of_utt, non_scored_words, allow_repetitions,
+                    stats):
+    new_split_lines_of_utt = []
+    for split_line in split_lines_of_utt:
+        new_split_line = ProcessLineForNonScoredWords(split_line, non_scored_words,
+                                                      stats)
+        if new_split_line != []:
+            new_split_lines_of_utt.append(new_split_line)
+    if allow_repetitions:
+        new_split_lines_of_utt = ProcessUtteranceForRepetitions(
+            new_split_lines_of_utt, non_scored_words, stats)
+    return new_split_lines_of_utt
+
+
+def PrintNonScoredStats(stats, verbose):
+    if verbose < 1:
+        return
+    num_lines = stats.num_lines
+    num_correct_lines = stats.num_correct_lines
+    ref_change_stats = stats.ref_change_stats
+    if num_lines == 0:
+        print("modify_ctm_edits.py: processed no input.", file = sys.stderr)
+    num_lines_modified = sum(ref_change_stats.values())
+    num_incorrect_lines = num_lines - num_correct_lines
+    percent_lines_incorrect= '%.2f' % (num_incorrect_lines * 100.0 / num_lines)
+    percent_modified = '%.2f' % (num_lines_modified * 100.0 / num_lines);
+    if num_incorrect_lines > 0:
+        percent_of_incorrect_modified = '%.2f' % (num_lines_modified * 100.0 /
+                                                  num_incorrect_lines)
+    else:
+        percent_of_incorrect_modified = float('nan')
+    print("modify_ctm_edits.py: processed {0} lines of ctm ({1}% of which incorrect), "
+          "of which {2} were changed fixing the reference for non-scored words "
+          "({3}% of lines, or {4}% of incorrect lines)".format(
+            num_lines, percent_lines_incorrect, num_lines_modified,
+            percent_modified, percent_of_incorrect_modified),
+          file = sys.stderr)
+
+    keys = sorted(ref_change_stats.keys(), reverse=True,
+                  key = lambda x: ref_change_stats[x])
+    num_keys_to_print = 40 if verbose >= 2 else 10
+
+    print("modify_ctm_edits.py: most common edits (as percentages "
+          "of all such edits) are:\n" +
+          ('\n'.join([ '%s [%.2f%%]' % (k, ref_change_stats[k]*100.0/num_lines_modified)
+                     for k in keys[0:num_keys_to_print]]))
+          + '\n...'if num_keys_to_print < len(keys) else '',
+          file = sys.stderr)
+
+
+def PrintRepetitionStats(stats, verbose):
+    repetition_stats = stats.repetition_stats
+    if verbose < 1 or sum(repetition_stats.values()) == 0:
+        return
+    num_lines = stats.num_lines
+    num_correct_lines = stats.num_correct_lines
+    num_lines_modified = sum(repetition_stats.values())
+    num_incorrect_lines = num_lines - num_correct_lines
+    percent_lines_incorrect= '%.2f' % (num_incorrect_lines * 100.0 / num_lines)
+    percent_modified = '%.2f' % (num_lines_modified * 100.0 / num_lines);
+    if num_incorrect_lines > 0:
+        percent_of_incorrect_modified = '%.2f' % (num_lines_modified * 100.0 /
+                                                  num_incorrect_lines)
+    else:
+        percent_of_incorrect_modified = float('nan')
+    print("modify_ctm_edits.py: processed {0} lines of ctm ({1}% of which incorrect), "
+          "of which {2} were changed fixing the reference for repetitions ({3}% of "
+          "lines, or {4}% of incorrect lines)".format(
+            num_lines, percent_lines_incorrect, num_lines_modified,
+            percent_modified, percent_of_incorrect_modified),
+          file = sys.stderr)
+
+    keys = sorted(repetition_stats.keys(), reverse=True,
+                  key = lambda x: repetition_stats[x])
+    num_keys_to_print = 40 if verbose >= 2 else 10
+
+    print("modify_ctm_edits.py: most common repetitions inserted into reference (as percentages "
+          "of all words fixed in this way) are:\n" +
+          ('\n'.join([ '%s [%.2f%%]' % (k, repetition_stats[k]*100.0/num_lines_modified)
+                     for k in keys[0:num_keys_to_print]]))
+          + '\n...' if num_keys_to_print < len(keys) else '',
+          file = sys.stderr)
+
+
+class TaintStats(object):
+    """Statistics of the tainting done by TaintUtterance()."""
+    def __init__(self):
+        # num_lines_of_type will map from line-type ('cor', 'sub', etc.) to count.
+        self.num_lines_of_type = defaultdict(int)
+        self.num_tainted_lines = 0
+        self.num_del_lines_giving_taint = 0
+        self.num_sub_lines_giving_taint = 0
+        self.num_ins_lines_giving_taint = 0
+
+    def Add(self, other):
+        for k, v in other.num_lines_of_type.items():
+            self.num_lines_of_type[k] += v
+        self.num_tainted_lines += other.num_tainted_lines
+        self.num_del_lines_giving_taint += other.num_del_lines_giving_taint
+        self.num_sub_lines_giving_taint += other.num_sub_lines_giving_taint
+        self.num_ins_lines_giving_taint += other.num_ins_lines_giving_taint
+
+
+# This function is the core of taint_ctm_edits.py, that does the tainting and
+# removes some lines representing deletions.
+# split_lines_of_utt is a list of lists, one per line, each containing the
+# sequence of fields.  Returns the same format of data after processing to add
+# the 'tainted' field.  Note: this function is destructive of its input; the
+# input will not have the same value afterwards.
+def TaintUtterance(split_lines_of_utt, remove_deletions, stats):
+    # work out whether each line is taintable [i.e. silence or fix or unk replacing
+    # real-word].
+    taintable = [ False ] * len(split_lines_of_utt)
+    for i in range(len(split_lines_of_utt)):
+        edit_type = split_lines_of_utt[i][7]
+        if edit_type == 'sil' or edit_type == 'fix':
+            taintable[i] = True
+        elif edit_type == 'cor' and split_lines_of_utt[i][4] != split_lines_of_utt[i][6]:
+            # this is the case when <unk> replaces a real word that was out of
+            # the vocabulary; we mark it as correct because such words do
+            # translate to <unk> if we don't have a pronunciations.  However we
+            # don't have good confidence that the alignments of such words are
+            # accurate if they are adjacent to errors.
+            taintable[i] = True
+
+
+    for i in range(len(split_lines_of_utt)):
+        edit_type = split_lines_of_utt[i][7]
+        stats.num_lines_of_type[edit_type] += 1
+        if edit_type == 'del' or edit_type == 'sub' or edit_type == 'ins':
+            tainted_an_adjacent_line = False
+            # First go backwards tainting lines
+            j = i - 1
+            while j >= 0 and taintable[j]:
+                tainted_an_adjacent_line = True
+                if len(split_lines_of_utt[j]) == 8:
+                    stats.num_tainted_lines += 1
+                    split_lines_of_utt[j].append('tainted')
+                j -= 1
+            # Next go forwards tainting lines
+            j = i + 1
+            while j < len(split_lines_of_utt) and taintable[j]:
+                tainted_an_adjacent_line = True
+                if len(split_lines_of_utt[j]) == 8:
+                    stats.num_tainted_lines += 1
+                    split_lines_of_utt[j].append('tainted')
+                j += 1
+            if tainted_an_adjacent_line:
+                if edit_type == 'del':
+                    if remove_deletions:
+                        split_lines_of_utt[i][7] = 'remove-this-line'
+                    stats.num_del_lines_giving_taint += 1
+                elif edit_type == 'sub':
+                    stats.num_sub_lines_giving_taint += 1
+                else:
+                    stats.num_ins_lines_giving_taint += 1
+
+    new_split_lines_of_utt = []
+    for i in range(len(split_lines_of_utt)):
+        if (not remove_deletions
+                or split_lines_of_utt[i][7] != 'remove-this-line'):
+            new_split_lines_of_utt.append(split_lines_of_utt[i])
+    return new_split_lines_of_utt
+
+
+def PrintTaintStats(stats, verbose):
+    num_lines_of_type = stats.num_lines_of_type
+    tot_lines = sum(num_lines_of_type.values())
+    if verbose < 1 or tot_lines == 0:
+        return
+    print("taint_ctm_edits.py: processed {0} input lines, whose edit-types were: ".format(tot_lines) +
+          ', '.join([ '%s = %.2f%%' % (k, num_lines_of_type[k] * 100.0 / tot_lines)
+                      for k in sorted(list(num_lines_of_type.keys()), reverse = True,
+                                      key = lambda k: num_lines_of_type[k])  ]),
+          file = sys.stderr)
+
+
+    del_giving_taint_percent = stats.num_del_lines_giving_taint * 100.0 / tot_lines
+    sub_giving_taint_percent = stats.num_sub_lines_giving_taint * 100.0 / tot_lines
+    ins_giving_taint_percent = stats.num_ins_lines_giving_taint * 100.0 / tot_lines
+    tainted_lines_percent = stats.num_tainted_lines * 100.0 / tot_lines
+
+    print("taint_ctm_edits.py: as a percentage of all lines, (%.2f%%, %.2f%%, %.2f%%) were "
+          "(deletions, substitutions, insertions) that tainted adjacent lines.  %.2f%% of all "
+          "lines were tainted." % (del_giving_taint_percent, sub_giving_taint_percent,
+                                   ins_giving_taint_percent, tainted_lines_percent),
+          file = sys.stderr)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Copyright 2016   Vimal Manohar
+#           2016   Johns Hopkins University (author: Daniel Povey)
+# Apache 2.0
+
+from __future__ import print_function
+import sys, argparse, io, itertools
+from collections import deque
+from multiprocessing import Pool
+
+import ctm_edits
+import segment_ctm_edits
+
+sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding="utf8")
+
+# This script does in a single pass what modify_ctm_edits.py, taint_ctm_edits.py
+# and segment_ctm_edits.py do when they are run one after the other: it reads
+# the 'ctm-edits' file that is produced by get_ctm_edits.py and, for each
+# utterance in memory, fixes the reference for non-scored words and repetitions,
+# adds the 'tainted' markers and then works out the segmentation.  Only the
+# text and segments (and, optionally, the --ctm-edits-out debug output and the
+# --word-stats-out statistics) are written, and the output is the same as that
+# of the three scripts; the statistics that they print are printed at the end.
+#
+# The utterances are processed in chunks of --utterances-per-chunk
+# utterances, which are distributed over --num-jobs processes; the output is
+# written in the order of the input.
+
+parser = argparse.ArgumentParser(
+    description = "This program does the same as steps/cleanup/internal/modify_ctm_edits.py, "
+    "steps/cleanup/internal/taint_ctm_edits.py and steps/cleanup/internal/segment_ctm_edits.py "
+    "applied one after the other, but in a single pass over the ctm-edits input "
+    "which is output by steps/cleanup/internal/get_ctm_edits.py.  See those scripts "
+    "for more information.",
+    parents = [segment_ctm_edits.parser], conflict_handler = 'resolve',
+    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument("--verbose", type = int, default = 1,
+                    choices=[0,1,2,3],
+                    help = "Verbose level of the statistics of modify_ctm_edits.py "
+                    "and taint_ctm_edits.py, higher = more verbose output")
+parser.add_argument("--allow-repetitions", type = str, default = 'true',
+                    choices=['true','false'],
+                    help = "If true, allow repetitions in the transcript of one or "
+                    "two-word sequences; see modify_ctm_edits.py.")
+parser.add_argument("--remove-deletions", type=str, default="true",
+                    choices=["true", "false"],
+                    help = "Remove deletions next to taintable lines; see "
+                    "taint_ctm_edits.py.")
+parser.add_argument("--num-jobs", type = int, default = 1,
+                    help = "Number of processes over which the utterances "
+                    "are distributed.")
+parser.add_argument("--utterances-per-chunk", type = int, default = 200,
+                    help = "Number of utterances that are given to a process "
+                    "at a time.")
+
+
+# This sets up the global variables of segment_ctm_edits.py in the worker
+# processes.
+def InitWorker(args, non_scored_words, oov_symbol):
+    segment_ctm_edits.args = args
+    segment_ctm_edits.non_scored_words = non_scored_words
+    segment_ctm_edits.oov_symbol = oov_symbol
+
+
+# This processes a list of pairs (utterance-id, split-lines-of-utterance), as
+# yielded by ctm_edits.ReadUtterances().  It returns a tuple (text, segments,
+# ctm-edits-out, modify-stats, taint-stats, segmentation-stats) where the
+# first three are the strings to be written to the corresponding outputs
+# (ctm-edits-out is None if --ctm-edits-out was not specified).
+def ProcessChunk(utterances):
+    args = segment_ctm_edits.args
+    non_scored_words = segment_ctm_edits.non_scored_words
+    modify_stats = ctm_edits.ModifyStats()
+    taint_stats = ctm_edits.TaintStats()
+    segment_ctm_edits.stats = segment_ctm_edits.SegmentationStats(keep_lengths = True)
+
+    text_output_handle = io.StringIO()
+    segments_output_handle = io.StringIO()
+    ctm_edits_output_handle = io.StringIO()
+    for utterance, split_lines_of_utt in utterances:
+        split_lines_of_utt = ctm_edits.ModifyUtterance(
+            split_lines_of_utt, non_scored_words,
+            args.allow_repetitions == 'true', modify_stats)
+        split_lines_of_utt = ctm_edits.TaintUtterance(
+            split_lines_of_utt, args.remove_deletions == 'true', taint_stats)
+        if len(split_lines_of_utt) == 0:
+            # all lines of the utterance were non-scored words that were
+            # deleted; there is nothing left to segment.
+            continue
+        (segments_for_utterance,
+         deleted_segments_for_utterance) = segment_ctm_edits.GetSegmentsForUtterance(
+             split_lines_of_utt)
+        segment_ctm_edits.AccWordStatsForUtterance(split_lines_of_utt,
+                                                   segments_for_utterance)
+        segment_ctm_edits.WriteSegmentsForUtterance(
+            text_output_handle, segments_output_handle, utterance,
+            segments_for_utterance)
+        if args.ctm_edits_out != None:
+            segment_ctm_edits.PrintDebugInfoForUtterance(
+                ctm_edits_output_handle, split_lines_of_utt,
+                segments_for_utterance, deleted_segments_for_utterance)
+
+    return (text_output_handle.getvalue(), segments_output_handle.getvalue(),
+            ctm_edits_output_handle.getvalue() if args.ctm_edits_out != None else None,
+            modify_stats, taint_stats, segment_ctm_edits.stats)
+
+
+def ProcessData(args):
+    try:
+        f_in = open(args.ctm_edits_in, encoding='utf-8')
+    except:
+        sys.exit("process_ctm_edits.py: error opening ctm-edits input "
+                 "file {0}".format(args.ctm_edits_in))
+    try:
+        text_output_handle = open(args.text_out, 'w', encoding='utf-8')
+    except:
+        sys.exit("process_ctm_edits.py: error opening text output "
+                 "file {0}".format(args.text_out))
+    try:
+        segments_output_handle = open(args.segments_out, 'w', encoding='utf-8')
+    except:
+        sys.exit("process_ctm_edits.py: error opening segments output "
+                 "file {0}".format(args.segments_out))
+    if args.ctm_edits_out != None:
+        try:
+            ctm_edits_output_handle = open(args.ctm_edits_out, 'w', encoding='utf-8')
+        except:
+            sys.exit("process_ctm_edits.py: error opening ctm-edits output "
+                     "file {0}".format(args.ctm_edits_out))
+
+    modify_stats = ctm_edits.ModifyStats()
+    taint_stats = ctm_edits.TaintStats()
+    segmentation_stats = segment_ctm_edits.SegmentationStats()
+
+    def Write(result):
+        (text, segments, ctm_edits_out,
+         this_modify_stats, this_taint_stats, this_segmentation_stats) = result
+        text_output_handle.write(text)
+        segments_output_handle.write(segments)
+        if ctm_edits_out != None:
+            ctm_edits_output_handle.write(ctm_edits_out)
+        modify_stats.Add(this_modify_stats)
+        taint_stats.Add(this_taint_stats)
+        segmentation_stats.Add(this_segmentation_stats)
+
+    utterances = ctm_edits.ReadUtterances(f_in, "process_ctm_edits.py")
+    chunks = iter(lambda: list(itertools.islice(utterances, args.utterances_per_chunk)), [])
+    if args.num_jobs > 1:
+        # at most 2 * num_jobs chunks are kept in memory
+        with Pool(args.num_jobs, initializer = InitWorker,
+                  initargs = (segment_ctm_edits.args,
+                              segment_ctm_edits.non_scored_words,
+                              segment_ctm_edits.oov_symbol)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(ProcessChunk, (chunk,)))
+                if len(pending) >= 2 * args.num_jobs:
+                    Write(pending.popleft().get())
+            while pending:
+                Write(pending.popleft().get())
+    else:
+        for chunk in chunks:
+            Write(ProcessChunk(chunk))
+    try:
+        text_output_handle.close()
+        segments_output_handle.close()
+        if args.ctm_edits_out != None:
+            ctm_edits_output_handle.close()
+    except:
+        sys.exit("process_ctm_edits.py: error closing one or more outputs "
+                 "(broken pipe or full disk?)")
+    return modify_stats, taint_stats, segmentation_stats
+
+
+def Main():
+    args = parser.parse_args()
+    if args.num_jobs < 1 or args.utterances_per_chunk < 1:
+        sys.exit("process_ctm_edits.py: --num-jobs and --utterances-per-chunk "
+                 "must be positive")
+    segment_ctm_edits.Init(args)
+
+    (modify_stats, taint_stats,
+     segmentation_stats) = ProcessData(args)
+
+    ctm_edits.PrintNonScoredStats(modify_stats, args.verbose)
+    ctm_edits.PrintRepetitionStats(modify_stats, args.verbose)
+    ctm_edits.PrintTaintStats(taint_stats, args.verbose)
+    if segmentation_stats.num_utterances == 0:
+        sys.exit("process_ctm_edits.py: no utterances were left after fixing "
+                 "the reference for non-scored words")
+    segment_ctm_edits.stats = segmentation_stats
+    segment_ctm_edits.PrintSegmentStats()
+    if args.word_stats_out != None:
+        segment_ctm_edits.PrintWordStats(args.word_stats_out)
+    if args.ctm_edits_out != None:
+        print("process_ctm_edits.py: detailed utterance-level debug information "
+              "is in " + args.ctm_edits_out, file = sys.stderr)
+
+
+if __name__ == '__main__':
+    Main()
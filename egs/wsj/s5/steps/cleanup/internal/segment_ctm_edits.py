@@ -10,6 +10,8 @@ from __future__ import division
 import sys, operator, argparse, os
 from collections import defaultdict
 
+import ctm_edits
+
 # This script reads 'ctm-edits' file format that is produced by get_ctm_edits.py
 # and modified by modify_ctm_edits.py and taint_ctm_edits.py Its function is to
 # produce a segmentation and text from the ctm-edits input.
@@ -111,9 +113,6 @@ parser.add_argument("segments_out", metavar = "<segments-out>",
                     "but instead of <recording-id>, the second field is the old utterance-id, i.e "
                     "<new-utterance-id> <old-utterance-id> <start-time> <end-time>")
 
-args = parser.parse_args()
-
-
 
 
 def IsTainted(split_line_of_utt):
@@ -637,19 +636,78 @@ class Segment(object):
         return ' '.join(text_array)
 
 
+# This returns the new list [0, 0]; it is the default of word_count_pair
+# (a lambda expression would not allow us to pickle the stats).
+def NewCountPair():
+    return [0, 0]
+
+# The global statistics of the segmentation.  They are kept in an object (the
+# global variable 'stats') so that the stats of utterances that were segmented
+# in separate processes can be summed with Add(); see process_ctm_edits.py.
+# If keep_lengths is True, the lengths of the segments and utterances are also
+# kept in lists, so that Add() can sum them in the same order as a single
+# process would have done (floating-point addition is not associative, and we
+# want the printed stats not to depend on how the utterances were split up).
+class SegmentationStats(object):
+    def __init__(self, keep_lengths = False):
+        # segment_total_length and num_segments are maps from
+        # 'stage' strings; see AccumulateSegmentStats for details.
+        self.segment_total_length = defaultdict(int)
+        self.num_segments = defaultdict(int)
+        # word_count_pair is a map from a string (the word) to
+        # a list [total-count, count-not-within-segments]
+        self.word_count_pair = defaultdict(NewCountPair)
+        self.num_utterances = 0
+        self.num_utterances_without_segments = 0
+        self.total_length_of_utterances = 0
+        self.segment_lengths = defaultdict(list) if keep_lengths else None
+        self.utterance_lengths = [] if keep_lengths else None
+
+    def AccumulateSegment(self, text, length):
+        self.num_segments[text] += 1
+        self.segment_total_length[text] += length
+        if self.segment_lengths is not None:
+            self.segment_lengths[text].append(length)
+
+    def AccumulateUtterance(self, length):
+        self.num_utterances += 1
+        self.total_length_of_utterances += length
+        if self.utterance_lengths is not None:
+            self.utterance_lengths.append(length)
+
+    def Add(self, other):
+        for key in other.segment_total_length:
+            self.num_segments[key] += other.num_segments[key]
+            if other.segment_lengths is not None:
+                for length in other.segment_lengths[key]:
+                    self.segment_total_length[key] += length
+            else:
+                self.segment_total_length[key] += other.segment_total_length[key]
+        for word, pair in other.word_count_pair.items():
+            this_pair = self.word_count_pair[word]
+            this_pair[0] += pair[0]
+            this_pair[1] += pair[1]
+        self.num_utterances += other.num_utterances
+        self.num_utterances_without_segments += other.num_utterances_without_segments
+        if other.utterance_lengths is not None:
+            for length in other.utterance_lengths:
+                self.total_length_of_utterances += length
+        else:
+            self.total_length_of_utterances += other.total_length_of_utterances
+
 # Here, 'text' will be something that indicates the stage of processing,
 # e.g. 'Stage 0: segment cores', 'Stage 1: add tainted lines',
 #, etc.
 def AccumulateSegmentStats(segment_list, text):
-    global segment_total_length, num_segments
     for segment in segment_list:
-        num_segments[text] += 1
-        segment_total_length[text] += segment.Length()
+        stats.AccumulateSegment(text, segment.Length())
 
 def PrintSegmentStats():
-    global segment_total_length, num_segments, \
-       num_utterances, num_utterances_without_segments, \
-       total_length_of_utterances
+    segment_total_length = stats.segment_total_length
+    num_segments = stats.num_segments
+    num_utterances = stats.num_utterances
+    num_utterances_without_segments = stats.num_utterances_without_segments
+    total_length_of_utterances = stats.total_length_of_utterances
 
     print('Number of utterances is %d, of which %.2f%% had no segments after '
           'all processing; total length of data in original utterances (in seconds) '
@@ -678,14 +736,11 @@ def PrintSegmentStats():
 # Note: split_lines_of_utt is a list of lists, one per line, each containing the
 # sequence of fields.
 def GetSegmentsForUtterance(split_lines_of_utt):
-    global num_utterances, num_utterances_without_segments, total_length_of_utterances
-
-    num_utterances += 1
 
     segment_ranges = ComputeSegmentCores(split_lines_of_utt)
 
     utterance_end_time = float(split_lines_of_utt[-1][2]) + float(split_lines_of_utt[-1][3])
-    total_length_of_utterances += utterance_end_time
+    stats.AccumulateUtterance(utterance_end_time)
 
     segments = [ Segment(split_lines_of_utt, x[0], x[1])
                  for x in segment_ranges ]
@@ -780,7 +835,7 @@ def GetSegmentsForUtterance(split_lines_of_utt):
             segments[i+1].debug_str += ",overlaps-previous-segment"
 
     if len(segments) == 0:
-        num_utterances_without_segments += 1
+        stats.num_utterances_without_segments += 1
 
     return (segments, deleted_segments)
 
@@ -879,9 +934,7 @@ def PrintDebugInfoForUtterance(ctm_edits_out_handle,
 # of error (there is a higher probability of having a wrong lexicon entry).
 def AccWordStatsForUtterance(split_lines_of_utt,
                              segments_for_utterance):
-    # word_count_pair is a map from a string (the word) to
-    # a list [total-count, count-not-within-segments]
-    global word_count_pair
+    word_count_pair = stats.word_count_pair
     line_is_in_segment = [ False ] * len(split_lines_of_utt)
     for segment in segments_for_utterance:
         for i in range(segment.start_index, segment.end_index):
@@ -899,7 +952,7 @@ def PrintWordStats(word_stats_out):
     except:
         sys.exit("segment_ctm_edits.py: error opening word-stats file --word-stats-out={0} "
                  "for writing".format(word_stats_out))
-    global word_count_pair
+    word_count_pair = stats.word_count_pair
     # Sort from most to least problematic.  We want to give more prominence to
     # words that are most frequently not in segments, but also to high-count
     # words.  Define badness = pair[1] / pair[0], and total_count = pair[0],
@@ -946,42 +999,18 @@ def ProcessData():
             sys.exit("segment_ctm_edits.py: error opening ctm-edits output "
                      "file {0}".format(args.ctm_edits_out))
 
-    # Most of what we're doing in the lines below is splitting the input lines
-    # and grouping them per utterance, before giving them to ProcessUtterance()
-    # and then printing the modified lines.
-    first_line = f_in.readline()
-    if first_line == '':
-        sys.exit("segment_ctm_edits.py: empty input")
-    split_pending_line = first_line.split()
-    if len(split_pending_line) == 0:
-        sys.exit("segment_ctm_edits.py: bad input line " + first_line)
-    cur_utterance = split_pending_line[0]
-    split_lines_of_cur_utterance = []
-
-    while True:
-        if len(split_pending_line) == 0 or split_pending_line[0] != cur_utterance:
-            (segments_for_utterance,
-             deleted_segments_for_utterance) = GetSegmentsForUtterance(split_lines_of_cur_utterance)
-            AccWordStatsForUtterance(split_lines_of_cur_utterance, segments_for_utterance)
-            WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
-                                      cur_utterance, segments_for_utterance)
-            if args.ctm_edits_out != None:
-                PrintDebugInfoForUtterance(ctm_edits_output_handle,
-                                           split_lines_of_cur_utterance,
-                                           segments_for_utterance,
-                                           deleted_segments_for_utterance)
-            split_lines_of_cur_utterance = []
-            if len(split_pending_line) == 0:
-                break
-            else:
-                cur_utterance = split_pending_line[0]
-
-        split_lines_of_cur_utterance.append(split_pending_line)
-        next_line = f_in.readline()
-        split_pending_line = next_line.split()
-        if len(split_pending_line) == 0:
-            if next_line != '':
-                sys.exit("segment_ctm_edits.py: got an empty or whitespace input line")
+    for cur_utterance, split_lines_of_cur_utterance in ctm_edits.ReadUtterances(
+            f_in, "segment_ctm_edits.py"):
+        (segments_for_utterance,
+         deleted_segments_for_utterance) = GetSegmentsForUtterance(split_lines_of_cur_utterance)
+        AccWordStatsForUtterance(split_lines_of_cur_utterance, segments_for_utterance)
+        WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
+                                  cur_utterance, segments_for_utterance)
+        if args.ctm_edits_out != None:
+            PrintDebugInfoForUtterance(ctm_edits_output_handle,
+                                       split_lines_of_cur_utterance,
+                                       segments_for_utterance,
+                                       deleted_segments_for_utterance)
     try:
         text_output_handle.close()
         segments_output_handle.close()
@@ -992,59 +1021,53 @@ def ProcessData():
                  "(broken pipe or full disk?)")
 
 
-def ReadNonScoredWords(non_scored_words_file):
-    global non_scored_words
+def ReadOovSymbol(oov_symbol_file):
     try:
-        f = open(non_scored_words_file, encoding='utf-8')
-    except:
-        sys.exit("segment_ctm_edits.py: error opening file: "
-                 "--non-scored-words=" + non_scored_words_file)
-    for line in f.readlines():
-        a = line.split()
-        if not len(line.split()) == 1:
-            sys.exit("segment_ctm_edits.py: bad line in non-scored-words "
-                     "file {0}: {1}".format(non_scored_words_file, line))
-        non_scored_words.add(a[0])
-    f.close()
-
-
-
-
-non_scored_words = set()
-ReadNonScoredWords(args.non_scored_words_in)
-
-oov_symbol = None
-if args.oov_symbol_file != None:
-    try:
-        with open(args.oov_symbol_file, encoding='utf-8') as f:
+        with open(oov_symbol_file, encoding='utf-8') as f:
             line = f.readline()
             assert len(line.split()) == 1
             oov_symbol = line.split()[0]
             assert f.readline() == ''
     except Exception as e:
         sys.exit("segment_ctm_edits.py: error reading file --oov-symbol-file=" +
-                 args.oov_symbol_file + ", error is: " + str(e))
-elif args.unk_padding != 0.0:
-    sys.exit("segment_ctm_edits.py: if the --unk-padding option is nonzero (which "
-             "it is by default, the --oov-symbol-file option must be supplied.")
-
-# segment_total_length and num_segments are maps from
-# 'stage' strings; see AccumulateSegmentStats for details.
-segment_total_length = defaultdict(int)
-num_segments = defaultdict(int)
-# the lambda expression below is an anonymous function that takes no arguments
-# and returns the new list [0, 0].
-word_count_pair = defaultdict(lambda: [0, 0])
-num_utterances = 0
-num_utterances_without_segments = 0
-total_length_of_utterances = 0
-
-
-ProcessData()
-PrintSegmentStats()
-if args.word_stats_out != None:
-    PrintWordStats(args.word_stats_out)
-if args.ctm_edits_out != None:
-    print("segment_ctm_edits.py: detailed utterance-level debug information "
-          "is in " + args.ctm_edits_out, file = sys.stderr)
+                 oov_symbol_file + ", error is: " + str(e))
+    return oov_symbol
+
+
+# This sets up the global variables 'args', 'non_scored_words' and
+# 'oov_symbol' that the segmentation depends on, from the parsed
+# command-line options.
+def Init(parsed_args):
+    global args, non_scored_words, oov_symbol
+    args = parsed_args
+    non_scored_words = ctm_edits.ReadNonScoredWords(args.non_scored_words_in,
+                                                    "segment_ctm_edits.py")
+    oov_symbol = None
+    if args.oov_symbol_file != None:
+        oov_symbol = ReadOovSymbol(args.oov_symbol_file)
+    elif args.unk_padding != 0.0:
+        sys.exit("segment_ctm_edits.py: if the --unk-padding option is nonzero (which "
+                 "it is by default, the --oov-symbol-file option must be supplied.")
+
+
+def Main():
+    global stats
+    Init(parser.parse_args())
+    stats = SegmentationStats()
+
+    ProcessData()
+    PrintSegmentStats()
+    if args.word_stats_out != None:
+        PrintWordStats(args.word_stats_out)
+    if args.ctm_edits_out != None:
+        print("segment_ctm_edits.py: detailed utterance-level debug information "
+              "is in " + args.ctm_edits_out, file = sys.stderr)
+
+
+args = None
+non_scored_words = set()
+oov_symbol = None
+stats = SegmentationStats()
 
+if __name__ == '__main__':
+    Main()
@@ -9,6 +9,11 @@ from collections import defaultdict
 import argparse
 import sys
 import math
+from multiprocessing import Pool
+import numpy as np
+
+# Number of words per task of SelectPronsBayesian().
+WORDS_PER_TASK = 20000
 
 def GetArgs():
     parser = argparse.ArgumentParser(description = "Use a Bayesian framework to select"
@@ -44,6 +49,8 @@ def GetArgs():
     parser.add_argument("--variants-counts", type = int, default = 1,
                         help = "Generate upto this many variants of prons for each word out"
                         "of the ref. lexicon.")
+    parser.add_argument("--num-jobs", type = int, default = 1,
+                        help = "Number of processes used to select the prons.")
     parser.add_argument("silence_file", metavar = "<silphonetic-file>", type = str,
                         help = "File containing a list of silence phones.")
     parser.add_argument("pron_stats_file", metavar = "<stats-file>", type = str,
@@ -112,9 +119,77 @@ def CheckArgs(args):
 
     return args
 
-def ReadPronStats(pron_stats_file_handle):
-    stats = {}
-    for line in pron_stats_file_handle.readlines():
+# Encodes (word-id, pron-id) pairs as single integers.
+def PairKeys(word_ids, pron_ids):
+    return (np.asarray(word_ids, dtype=np.int64) << 32) | np.asarray(pron_ids, dtype=np.int64)
+
+class PronLexicon(object):
+    """A lexicon stored as arrays of interned word and pron ids. The i'th row
+    holds the prons of word word_ids[i], which are
+    pron_ids[indptr[i]:indptr[i+1]] (CSR format), in the order they first
+    appear in the lexicon file; the rows are in the order the words first
+    appear in the file. A row is kept, with no prons, if all prons of the
+    word are removed."""
+    def __init__(self, word_ids, pron_ids, indptr, num_words):
+        self.word_ids = word_ids
+        self.pron_ids = pron_ids
+        self.indptr = indptr
+        self.entry_word_ids = np.repeat(word_ids, np.diff(indptr))
+        self.keys = np.sort(PairKeys(self.entry_word_ids, pron_ids))
+        self.has_word = np.zeros(num_words, dtype=bool)
+        self.has_word[word_ids] = True
+        self.num_prons = np.bincount(self.entry_word_ids, minlength=num_words)
+
+    def Contains(self, word_ids, pron_ids):
+        return np.isin(PairKeys(word_ids, pron_ids), self.keys)
+
+    def RemoveEntries(self, mask):
+        # Returns a lexicon without the entries (indexes into pron_ids) in mask.
+        kept = ~mask
+        rows = np.repeat(np.arange(len(self.word_ids)), np.diff(self.indptr))
+        indptr = np.zeros_like(self.indptr)
+        np.cumsum(np.bincount(rows[kept], minlength=len(self.word_ids)), out=indptr[1:])
+        return PronLexicon(self.word_ids, self.pron_ids[kept], indptr, len(self.has_word))
+
+    def ToDict(self, words, prons, word_mask=None):
+        # Returns a dict: word -> list of prons, optionally only for the words
+        # whose ids are set in word_mask.
+        rows = np.arange(len(self.word_ids))
+        if word_mask is not None:
+            rows = rows[word_mask[self.word_ids]]
+        pron_ids = self.pron_ids.tolist()
+        return dict((words[w], [prons[p] for p in pron_ids[b:e]]) for w, b, e in zip(
+            self.word_ids[rows].tolist(), self.indptr[rows].tolist(), self.indptr[rows + 1].tolist()))
+
+class PronStats(object):
+    """Soft counts of (word-id, pron-id) pairs, sorted by PairKeys()."""
+    def __init__(self, keys, counts):
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.counts = counts[order]
+
+    def Lookup(self, word_ids, pron_ids):
+        # Returns the counts of the given pairs (0 for pairs without stats),
+        # and whether they have stats.
+        keys = PairKeys(word_ids, pron_ids)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys)), np.zeros(len(keys), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        return np.where(found, self.counts[pos], 0.0), found
+
+    def Remove(self, word_ids, pron_ids):
+        keep = ~np.isin(self.keys, PairKeys(word_ids, pron_ids))
+        self.keys = self.keys[keep]
+        self.counts = self.counts[keep]
+
+def ReadPronStats(pron_stats_file_handle, word_to_id, pron_to_id):
+    # Stats of words or prons which do not appear in any lexicon are never used
+    # and are skipped. As before, the last count of a repeated pair is used.
+    word_ids = []
+    pron_ids = []
+    counts = []
+    for line in pron_stats_file_handle:
         splits = line.strip().split()
         if len(splits) == 0:
             continue
@@ -122,10 +197,16 @@ def ReadPronStats(pron_stats_file_handle):
             raise Exception('Invalid format of line ' + line
                                 + ' in stats file.')
         count = float(splits[0])
-        word = splits[1]
-        phones = ' '.join(splits[2:])
-        stats[(word, phones)] = count
-    return stats
+        word_id = word_to_id.get(splits[1])
+        pron_id = pron_to_id.get(' '.join(splits[2:]))
+        if word_id is None or pron_id is None:
+            continue
+        word_ids.append(word_id)
+        pron_ids.append(pron_id)
+        counts.append(count)
+    keys = PairKeys(word_ids, pron_ids)[::-1]
+    _, last = np.unique(keys, return_index=True)
+    return PronStats(keys[last], np.array(counts, dtype=np.float64)[::-1][last])
 
 def ReadWordCounts(word_counts_file_handle):
     counts = {}
@@ -139,172 +220,251 @@ def ReadWordCounts(word_counts_file_handle):
         counts[word] = count
     return counts
 
-def ReadLexicon(args, lexicon_file_handle, counts):
+def ReadLexicon(args, lexicon_file_handle, word_to_id, pron_to_id):
     # we're skipping any word not in counts (not seen in training data),
     # cause we're only learning prons for words who have acoustic examples.
-    lexicon = defaultdict(set)
-    for line in lexicon_file_handle.readlines():
+    # New prons are added to pron_to_id.
+    word_ids = []
+    pron_ids = []
+    for line in lexicon_file_handle:
         splits = line.strip().split()
         if len(splits) == 0:
             continue
         if len(splits) < 2:
             raise Exception('Invalid format of line ' + line
                                 + ' in lexicon file.')
-        word = splits[0]
-        if word not in counts:
+        word_id = word_to_id.get(splits[0])
+        if word_id is None:
             continue
         phones = ' '.join(splits[1:])
-        lexicon[word].add(phones)
-    return lexicon
-
-def FilterPhoneticDecodingLexicon(args, phonetic_decoding_lexicon, stats):
+        word_ids.append(word_id)
+        pron_ids.append(pron_to_id.setdefault(phones, len(pron_to_id)))
+    word_ids = np.array(word_ids, dtype=np.int64)
+    pron_ids = np.array(pron_ids, dtype=np.int64)
+    # remove repeated entries, and group the entries by word (in the order
+    # of the first appearance of the words), keeping the file order otherwise.
+    _, first = np.unique(PairKeys(word_ids, pron_ids), return_index=True)
+    first = np.sort(first)
+    word_ids, pron_ids = word_ids[first], pron_ids[first]
+    rows, first, inverse = np.unique(word_ids, return_index=True, return_inverse=True)
+    row_rank = np.argsort(np.argsort(first))
+    order = np.argsort(row_rank[inverse], kind='stable')
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_rank[inverse], minlength=len(rows)), out=indptr[1:])
+    return PronLexicon(rows[np.argsort(row_rank)], pron_ids[order], indptr, len(word_to_id))
+
+def FilterPhoneticDecodingLexicon(args, phonetic_decoding_lexicon, stats, words, prons):
     # We want to remove all candidates which contains silence phones
     silphones = set()
     for line in args.silence_file_handle:
         silphones.add(line.strip())
-    rejected_candidates = set()
-    for word, prons in phonetic_decoding_lexicon.items():
-        for pron in prons:
-            for phone in pron.split():
-                if phone in silphones:
-                   if (word, pron) in stats:
-                       count = stats[(word, pron)]
-                       del stats[(word, pron)]
-                   else:
-                       count = 0
-                   rejected_candidates.add((word, pron))
-                   print('WARNING: removing the candidate pronunciation from phonetic-decoding: {0}: '
-                         '"{1}" whose soft-count from lattice-alignment is {2}, cause it contains at'
-                         ' least one silence phone.'.format(word, pron, count), file=sys.stderr)
-                   break
-    for word, pron in rejected_candidates:
-        phonetic_decoding_lexicon[word].remove(pron)
-    return phonetic_decoding_lexicon, stats
-
-def ComputePriorCounts(args, counts, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon):
-    prior_counts = defaultdict(list)
+    lexicon = phonetic_decoding_lexicon
+    has_silence = np.array([any(phone in silphones for phone in pron.split()) for pron in prons],
+                           dtype=bool)
+    rejected = has_silence[lexicon.pron_ids] if len(prons) > 0 else np.zeros(0, dtype=bool)
+    word_ids = lexicon.entry_word_ids[rejected]
+    pron_ids = lexicon.pron_ids[rejected]
+    soft_counts, found = stats.Lookup(word_ids, pron_ids)
+    for word_id, pron_id, count, has_count in zip(word_ids.tolist(), pron_ids.tolist(),
+                                                  soft_counts.tolist(), found.tolist()):
+        print('WARNING: removing the candidate pronunciation from phonetic-decoding: {0}: '
+              '"{1}" whose soft-count from lattice-alignment is {2}, cause it contains at'
+              ' least one silence phone.'.format(words[word_id], prons[pron_id],
+                                                 count if has_count else 0), file=sys.stderr)
+    stats.Remove(word_ids, pron_ids)
+    return lexicon.RemoveEntries(rejected), stats
+
+def ComputePriorCounts(args, words, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon):
+    # Returns a (num-words x 3) array of prior counts of the three sources.
     # In case one source is absent for a word, we set zero prior to this source, 
     # and then re-normalize the prior mean parameters s.t. they sum up to one.
-    for word in counts:
-        prior_mean = [args.prior_mean[0], args.prior_mean[1], args.prior_mean[2]]
-        if word not in ref_lexicon:
-            prior_mean[0] = 0
-        if word not in g2p_lexicon:
-            prior_mean[1] = 0
-        if word not in phonetic_decoding_lexicon:
-            prior_mean[2] = 0
-        prior_mean_sum = sum(prior_mean)
-        try:
-            prior_mean = [float(t) / prior_mean_sum for t in prior_mean] 
-        except ZeroDivisionError:
-            print('WARNING: word {} appears in train_counts but not in any lexicon.'.format(word), file=sys.stderr)
-        prior_counts[word] = [t * args.prior_counts_tot for t in prior_mean] 
-    return prior_counts
-
-def ComputePosteriors(args, stats, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon, prior_counts):
-    posteriors = defaultdict(list) # This dict stores a list of (pronunciation, posterior)
-    # pairs for each word, where the posteriors are normalized soft counts. Before normalization,
-    # The soft-counts were augmented by a user-specified prior count, according the source 
+    has_source = np.stack([ref_lexicon.has_word, g2p_lexicon.has_word,
+                           phonetic_decoding_lexicon.has_word], axis=1)
+    prior_mean = np.where(has_source, np.array(args.prior_mean), 0.0)
+    prior_mean_sum = prior_mean[:, 0] + prior_mean[:, 1] + prior_mean[:, 2]
+    for word_id in np.flatnonzero(prior_mean_sum == 0):
+        print('WARNING: word {} appears in train_counts but not in any lexicon.'.format(
+            words[word_id]), file=sys.stderr)
+    valid = prior_mean_sum != 0
+    prior_mean[valid] /= prior_mean_sum[valid, np.newaxis]
+    return prior_mean * args.prior_counts_tot
+
+class PronPosteriors(object):
+    """The candidate prons of all words with their posteriors. Group i has
+    the candidates of word word_ids[i], which are entries
+    indptr[i]:indptr[i+1] of the arrays pron_ids, posts (posteriors) and
+    sources (0/1/2 if the pron is in the ref./G2P/phonetic-decoding lexicon,
+    checked in that order). Within a group, the entries are sorted by
+    increasing posterior."""
+    def __init__(self, word_ids, indptr, pron_ids, posts, sources):
+        self.word_ids = word_ids
+        self.indptr = indptr
+        self.pron_ids = pron_ids
+        self.posts = posts
+        self.sources = sources
+
+def ComputePosteriors(args, stats, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon, prior_counts,
+                      words, prons):
+    # The posteriors are normalized soft counts. Before normalization,
+    # The soft-counts were augmented by a user-specified prior count, according the source
     # (ref/G2P/phonetic-decoding) of this pronunciation.
-
-    for word, prons in ref_lexicon.items():
-        for pron in prons:
-            # c is the augmented soft count (observed count + prior count)
-            c = float(prior_counts[word][0]) / len(ref_lexicon[word]) + stats.get((word, pron), 0)
-            posteriors[word].append((pron, c))
-
-    for word, prons in g2p_lexicon.items():
-        for pron in prons:
-            c = float(prior_counts[word][1]) / len(g2p_lexicon[word]) + stats.get((word, pron), 0)
-            posteriors[word].append((pron, c))
-
-    for word, prons in phonetic_decoding_lexicon.items():
-        for pron in prons:
-            c = float(prior_counts[word][2]) / len(phonetic_decoding_lexicon[word]) + stats.get((word, pron), 0)
-            posteriors[word].append((pron, c))
-
-    num_prons_from_ref = sum(len(ref_lexicon[i]) for i in ref_lexicon)
-    num_prons_from_g2p = sum(len(g2p_lexicon[i]) for i in g2p_lexicon)
-    num_prons_from_phonetic_decoding = sum(len(phonetic_decoding_lexicon[i]) for i in phonetic_decoding_lexicon)
+    # Each word's candidates are the ref. prons, then the G2P prons and then
+    # the phonetic-decoding prons (a pron may appear more than once).
+    cand_word_ids = []
+    cand_pron_ids = []
+    cand_counts = []
+    for source, lexicon in enumerate([ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon]):
+        word_ids = lexicon.entry_word_ids
+        # c is the augmented soft count (observed count + prior count)
+        c = (prior_counts[word_ids, source] / lexicon.num_prons[word_ids]
+             + stats.Lookup(word_ids, lexicon.pron_ids)[0])
+        cand_word_ids.append(word_ids)
+        cand_pron_ids.append(lexicon.pron_ids)
+        cand_counts.append(c)
+    cand_word_ids = np.concatenate(cand_word_ids)
+    cand_pron_ids = np.concatenate(cand_pron_ids)
+    cand_counts = np.concatenate(cand_counts)
+
+    # Group the candidates by word, in the order the words first appear.
+    group_word_ids, first, inverse = np.unique(cand_word_ids, return_index=True,
+                                               return_inverse=True)
+    group_rank = np.argsort(np.argsort(first))
+    group_word_ids = group_word_ids[np.argsort(group_rank)]
+    groups = group_rank[inverse]
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    cand_word_ids = cand_word_ids[order]
+    cand_pron_ids = cand_pron_ids[order]
+    cand_counts = cand_counts[order]
+    num_groups = len(group_word_ids)
+    group_sizes = np.bincount(groups, minlength=num_groups)
+    indptr = np.zeros(num_groups + 1, dtype=np.int64)
+    np.cumsum(group_sizes, out=indptr[1:])
+
+    num_prons_from_ref = len(ref_lexicon.pron_ids)
+    num_prons_from_g2p = len(g2p_lexicon.pron_ids)
+    num_prons_from_phonetic_decoding = len(phonetic_decoding_lexicon.pron_ids)
     print ("---------------------------------------------------------------------------------------------------", file=sys.stderr)
-    print ('Total num. words is {}:'.format(len(posteriors)), file=sys.stderr)
+    print ('Total num. words is {}:'.format(num_groups), file=sys.stderr)
     print ('{0} candidate prons came from the reference lexicon; {1} came from G2P;{2} came from'
            'phonetic_decoding'.format(num_prons_from_ref, num_prons_from_g2p, num_prons_from_phonetic_decoding), file=sys.stderr)
     print ("---------------------------------------------------------------------------------------------------", file=sys.stderr)
 
-    # Normalize the augmented soft counts to get posteriors.
-    count_sum = defaultdict(float) # This dict stores the pronunciation which has 
-    # the sum of augmented soft counts for each word.
-    
-    for word in posteriors:
-        # each entry is a pair: (prounciation, count)
-        count_sum[word] = sum([entry[1] for entry in posteriors[word]])
-    
-    for word, entry in posteriors.items():
-        new_entry = []
-        for pron, count in entry:      
-            post = float(count) / count_sum[word]
-            new_entry.append((pron, post))
-            source = 'R'
-            if word in g2p_lexicon and pron in g2p_lexicon[word]:
-                source = 'G'
-            elif word in phonetic_decoding_lexicon and pron in phonetic_decoding_lexicon[word]:
-                source = 'P'
-            print(word, source, "%3.2f" % post, pron, file=args.pron_posteriors_handle)
-        del entry[:]
-        entry.extend(sorted(new_entry, key=lambda new_entry: new_entry[1]))
-    return posteriors
-
-def SelectPronsBayesian(args, counts, posteriors, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon):
-    reference_selected = 0
-    g2p_selected = 0
-    phonetic_decoding_selected = 0
-    learned_lexicon = defaultdict(set)
-
-    for word, entry in posteriors.items():
+    # Normalize the augmented soft counts to get posteriors. The sum of the
+    # augmented soft counts of each word is accumulated in candidate order.
+    count_sum = np.zeros(num_groups)
+    for k in range(group_sizes.max() if num_groups > 0 else 0):
+        has_k = group_sizes > k
+        count_sum[has_k] += cand_counts[indptr[:-1][has_k] + k]
+    posts = cand_counts / count_sum[groups]
+
+    in_ref = ref_lexicon.Contains(cand_word_ids, cand_pron_ids)
+    in_g2p = g2p_lexicon.Contains(cand_word_ids, cand_pron_ids)
+    in_phonetic_decoding = phonetic_decoding_lexicon.Contains(cand_word_ids, cand_pron_ids)
+    labels = np.where(in_g2p, 'G', np.where(in_phonetic_decoding, 'P', 'R'))
+    args.pron_posteriors_handle.writelines(
+        "{0} {1} {2:3.2f} {3}\n".format(words[w], label, post, prons[p])
+        for w, label, post, p in zip(cand_word_ids.tolist(), labels.tolist(), posts.tolist(),
+                                     cand_pron_ids.tolist()))
+
+    sources = np.where(in_ref, 0, np.where(in_g2p, 1, 2))
+    # Sort the candidates of each word by posterior (stable, like sorted()).
+    order = np.argsort(posts, kind='stable')
+    order = order[np.argsort(groups[order], kind='stable')]
+    return PronPosteriors(group_word_ids, indptr, cand_pron_ids[order], posts[order],
+                          sources[order])
+
+# Selects the prons of a list of words. 'task' is a tuple (options, words),
+# where options is (variants_counts, variants_prob_mass, variants_prob_mass_ref)
+# and words is a list of tuples (word_id, pron_ids, posts, sources, in_ref,
+# num_ref_prons, count) with the candidates of the word sorted by increasing
+# posterior (see PronPosteriors). Returns a list of (word_id, selected
+# pron_ids) for the words with selected prons, and the number of selected
+# prons from each source.
+def SelectPronsForWords(task):
+    (default_variants_counts, default_variants_prob_mass, variants_prob_mass_ref), words = task
+    selected = []
+    num_selected = [0, 0, 0]
+    for word_id, pron_ids, posts, sources, in_ref, num_ref_prons, count in words:
+        entry = list(zip(pron_ids, posts, sources))
+        learned_prons = []
         num_variants = 0
         post_tot = 0.0
-        variants_counts = args.variants_counts
-        variants_prob_mass = args.variants_prob_mass
-        if word in ref_lexicon:
-            # the variants count of the current word's prons in the ref lexicon.
-            variants_counts_ref = len(ref_lexicon[word])
+        variants_counts = default_variants_counts
+        variants_prob_mass = default_variants_prob_mass
+        if in_ref:
             # For words who don't appear in acoustic training data at all, we simply accept all ref prons.
             # For words in ref. vocab, we set the max num. variants 
-            if counts.get(word, 0) > 0:
-                variants_counts = math.ceil(1.5 * variants_counts_ref)
+            if count > 0:
+                variants_counts = math.ceil(1.5 * num_ref_prons)
             else:
-                variants_counts = variants_counts_ref
+                variants_counts = num_ref_prons
                 variants_prob_mass = 1.0
         last_post = 0.0
         while ((num_variants < variants_counts and post_tot < variants_prob_mass)
                or (len(entry) > 0 and entry[-1][1] == last_post)): # this conditions 
                # means the posterior of the current pron is the same as the one we just included.
             try:
-                pron, post = entry.pop()
+                pron_id, post, source = entry.pop()
                 last_post = post
             except IndexError:
                 break
             post_tot += post
-            learned_lexicon[word].add(pron)
+            if pron_id not in learned_prons:
+                learned_prons.append(pron_id)
             num_variants += 1
-            if word in ref_lexicon and pron in ref_lexicon[word]:
-                reference_selected += 1
-            elif word in g2p_lexicon and pron in g2p_lexicon[word]:
-                g2p_selected += 1
-            else:
-                phonetic_decoding_selected += 1
+            num_selected[source] += 1
 
-        while (num_variants < variants_counts and post_tot < args.variants_prob_mass_ref):
+        while (num_variants < variants_counts and post_tot < variants_prob_mass_ref):
             try:
-                pron, post = entry.pop()
+                pron_id, post, source = entry.pop()
             except IndexError:
                 break
-            if word in ref_lexicon and pron in ref_lexicon[word]:
+            if source == 0:
                 post_tot += post
-                learned_lexicon[word].add(pron)
+                if pron_id not in learned_prons:
+                    learned_prons.append(pron_id)
                 num_variants += 1
-                reference_selected += 1
+                num_selected[source] += 1
+        if len(learned_prons) > 0:
+            selected.append((word_id, learned_prons))
+    return selected, num_selected
+
+def SelectPronsBayesian(args, counts, posteriors, ref_lexicon, words, prons):
+    # Returns the learned lexicon as a dict: word -> list of prons.
+    options = (args.variants_counts, args.variants_prob_mass, args.variants_prob_mass_ref)
+    indptr = posteriors.indptr.tolist()
+    pron_ids = posteriors.pron_ids.tolist()
+    posts = posteriors.posts.tolist()
+    sources = posteriors.sources.tolist()
+    word_ids = posteriors.word_ids.tolist()
+    in_ref = ref_lexicon.has_word[posteriors.word_ids].tolist()
+    num_ref_prons = ref_lexicon.num_prons[posteriors.word_ids].tolist()
+    tasks = []
+    for begin in range(0, len(word_ids), WORDS_PER_TASK):
+        end = min(begin + WORDS_PER_TASK, len(word_ids))
+        tasks.append((options, [(word_ids[i], pron_ids[indptr[i]:indptr[i+1]],
+                                 posts[indptr[i]:indptr[i+1]], sources[indptr[i]:indptr[i+1]],
+                                 in_ref[i], num_ref_prons[i], counts.get(words[word_ids[i]], 0))
+                                for i in range(begin, end)]))
+    pool = None
+    if args.num_jobs > 1 and len(tasks) > 1:
+        pool = Pool(min(args.num_jobs, len(tasks)))
+        results = pool.imap(SelectPronsForWords, tasks)
+    else:
+        results = map(SelectPronsForWords, tasks)
+
+    learned_lexicon = {}
+    num_selected = [0, 0, 0]
+    for selected, task_num_selected in results:
+        for word_id, learned_prons in selected:
+            learned_lexicon[words[word_id]] = [prons[p] for p in learned_prons]
+        for source in range(3):
+            num_selected[source] += task_num_selected[source]
+    if pool is not None:
+        pool.close()
+        pool.join()
+    reference_selected, g2p_selected, phonetic_decoding_selected = num_selected
 
     num_prons_tot = reference_selected + g2p_selected + phonetic_decoding_selected
     print('---------------------------------------------------------------------------------------------------', file=sys.stderr)
@@ -314,7 +474,7 @@ def SelectPronsBayesian(args, counts, posteriors, ref_lexicon, g2p_lexicon, phon
     return learned_lexicon
 
 def WriteEditsAndSummary(args, learned_lexicon, ref_lexicon, phonetic_decoding_lexicon, g2p_lexicon, counts, stats):
-    # Note that learned_lexicon and ref_lexicon are dicts of sets of prons, while the other two lexicons are sets of (word, pron) pairs.
+    # Note that all the lexicons are dicts: word -> list of prons, and stats is a dict: (word, pron) -> soft count.
     threshold = 3
     words = [defaultdict(set) for i in range(4)] # "words" contains four bins, where we
     # classify each word into, according to whether it's count > threshold,
@@ -421,26 +581,248 @@ def WriteLearnedLexiconOov(learned_lexicon, ref_lexicon, file_handle):
 def Main():
     args = GetArgs()
 
-    # Read in three lexicon sources, word counts, and pron stats.
+    # Read in three lexicon sources, word counts, and pron stats. The words
+    # and prons are interned to integer ids.
     counts = ReadWordCounts(args.word_counts_file_handle)
-    ref_lexicon = ReadLexicon(args, args.ref_lexicon_handle, counts)
-    g2p_lexicon = ReadLexicon(args, args.g2p_lexicon_handle, counts)
-    phonetic_decoding_lexicon =  ReadLexicon(args, args.phonetic_decoding_lexicon_handle, counts)
-    stats = ReadPronStats(args.pron_stats_file_handle)
-    phonetic_decoding_lexicon, stats = FilterPhoneticDecodingLexicon(args, phonetic_decoding_lexicon, stats)
+    words = list(counts)
+    word_to_id = dict((word, i) for i, word in enumerate(words))
+    pron_to_id = {}
+    ref_lexicon = ReadLexicon(args, args.ref_lexicon_handle, word_to_id, pron_to_id)
+    g2p_lexicon = ReadLexicon(args, args.g2p_lexicon_handle, word_to_id, pron_to_id)
+    phonetic_decoding_lexicon =  ReadLexicon(args, args.phonetic_decoding_lexicon_handle, word_to_id, pron_to_id)
+    prons = [None] * len(pron_to_id)
+    for pron, i in pron_to_id.items():
+        prons[i] = pron
+    stats = ReadPronStats(args.pron_stats_file_handle, word_to_id, pron_to_id)
+    phonetic_decoding_lexicon, stats = FilterPhoneticDecodingLexicon(args, phonetic_decoding_lexicon, stats,
+                                                                     words, prons)
    
     # Compute prior counts
-    prior_counts = ComputePriorCounts(args, counts, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon)
+    prior_counts = ComputePriorCounts(args, words, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon)
     # Compute posteriors, and then select prons to construct the learned lexicon.
-    posteriors = ComputePosteriors(args, stats, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon, prior_counts)
+    posteriors = ComputePosteriors(args, stats, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon, prior_counts,
+                                   words, prons)
 
     # Select prons to construct the learned lexicon.
-    learned_lexicon = SelectPronsBayesian(args, counts, posteriors, ref_lexicon, g2p_lexicon, phonetic_decoding_lexicon)
-    
+    learned_lexicon = SelectPronsBayesian(args, counts, posteriors, ref_lexicon, words, prons)
+
+    # The edits and the summary only need the lexicons of the learned words,
+    # and the soft counts of their candidates.
+    learned_word_mask = np.zeros(len(words), dtype=bool)
+    learned_word_mask[[word_to_id[word] for word in learned_lexicon]] = True
+    ref_lexicon_dict = ref_lexicon.ToDict(words, prons)
+    g2p_lexicon_dict = g2p_lexicon.ToDict(words, prons, learned_word_mask)
+    phonetic_decoding_lexicon_dict = phonetic_decoding_lexicon.ToDict(words, prons, learned_word_mask)
+    is_learned = learned_word_mask[posteriors.word_ids]
+    cand_word_ids = np.repeat(posteriors.word_ids, np.diff(posteriors.indptr))
+    cand_mask = np.repeat(is_learned, np.diff(posteriors.indptr))
+    soft_counts, found = stats.Lookup(cand_word_ids[cand_mask], posteriors.pron_ids[cand_mask])
+    stats_dict = dict(((words[w], prons[p]), c) for w, p, c in zip(
+        cand_word_ids[cand_mask][found].tolist(), posteriors.pron_ids[cand_mask][found].tolist(),
+        soft_counts[found].tolist()))
+
     # Write the learned prons for words out of the ref. vocab into learned_lexicon_oov.
-    WriteLearnedLexiconOov(learned_lexicon, ref_lexicon, args.learned_lexicon_oov_handle)
+    WriteLearnedLexiconOov(learned_lexicon, ref_lexicon_dict, args.learned_lexicon_oov_handle)
     # Edits will be printed into ref_lexicon_edits, and the summary will be printed into stderr.
-    WriteEditsAndSummary(args, learned_lexicon, ref_lexicon, phonetic_decoding_lexicon, g2p_lexicon, counts, stats)
+    WriteEditsAndSummary(args, learned_lexicon, ref_lexicon_dict, phonetic_decoding_lexicon_dict,
+                         g2p_lexicon_dict, counts, stats_dict)
+
+# Compares the outputs with those of the original dict-based implementation
+# (with insertion-ordered sets in place of sets) on small random lexicons with
+# repeated entries, prons shared between sources, candidates with silence
+# phones and tied posteriors. Run as: select_prons_bayesian.py --test
+def test_library():
+    import io
+    import random
+    from contextlib import redirect_stderr
+
+    def ReadPronStatsRef(handle):
+        stats = {}
+        for line in handle.readlines():
+            splits = line.strip().split()
+            if len(splits) == 0:
+                continue
+            stats[(splits[1], ' '.join(splits[2:]))] = float(splits[0])
+        return stats
+
+    def ReadLexiconRef(handle, counts):
+        lexicon = defaultdict(dict)  # word -> insertion-ordered set of prons
+        for line in handle.readlines():
+            splits = line.strip().split()
+            if len(splits) == 0 or splits[0] not in counts:
+                continue
+            lexicon[splits[0]][' '.join(splits[1:])] = None
+        return lexicon
+
+    def FilterPhoneticDecodingLexiconRef(args, phonetic_decoding_lexicon, stats):
+        silphones = set(line.strip() for line in args.silence_file_handle)
+        rejected_candidates = {}
+        for word, prons in phonetic_decoding_lexicon.items():
+            for pron in prons:
+                if any(phone in silphones for phone in pron.split()):
+                    count = stats.pop((word, pron), 0)
+                    rejected_candidates[(word, pron)] = None
+                    print('WARNING: removing the candidate pronunciation from phonetic-decoding: {0}: '
+                          '"{1}" whose soft-count from lattice-alignment is {2}, cause it contains at'
+                          ' least one silence phone.'.format(word, pron, count), file=sys.stderr)
+        for word, pron in rejected_candidates:
+            del phonetic_decoding_lexicon[word][pron]
+        return phonetic_decoding_lexicon, stats
+
+    def ComputePriorCountsRef(args, counts, lexicons):
+        prior_counts = {}
+        for word in counts:
+            prior_mean = [args.prior_mean[i] if word in lexicons[i] else 0 for i in range(3)]
+            prior_mean_sum = sum(prior_mean)
+            try:
+                prior_mean = [float(t) / prior_mean_sum for t in prior_mean]
+            except ZeroDivisionError:
+                print('WARNING: word {} appears in train_counts but not in any lexicon.'.format(word), file=sys.stderr)
+            prior_counts[word] = [t * args.prior_counts_tot for t in prior_mean]
+        return prior_counts
+
+    def ComputePosteriorsRef(args, stats, lexicons, prior_counts):
+        posteriors = defaultdict(list)
+        for source, lexicon in enumerate(lexicons):
+            for word, prons in lexicon.items():
+                for pron in prons:
+                    c = float(prior_counts[word][source]) / len(lexicon[word]) + stats.get((word, pron), 0)
+                    posteriors[word].append((pron, c))
+        print ("---------------------------------------------------------------------------------------------------", file=sys.stderr)
+        print ('Total num. words is {}:'.format(len(posteriors)), file=sys.stderr)
+        print ('{0} candidate prons came from the reference lexicon; {1} came from G2P;{2} came from'
+               'phonetic_decoding'.format(*[sum(len(lexicon[w]) for w in lexicon) for lexicon in lexicons]),
+               file=sys.stderr)
+        print ("---------------------------------------------------------------------------------------------------", file=sys.stderr)
+        for word, entry in posteriors.items():
+            count_sum = sum([e[1] for e in entry])
+            new_entry = []
+            for pron, count in entry:
+                post = float(count) / count_sum
+                new_entry.append((pron, post))
+                source = 'R'
+                if word in lexicons[1] and pron in lexicons[1][word]:
+                    source = 'G'
+                elif word in lexicons[2] and pron in lexicons[2][word]:
+                    source = 'P'
+                print(word, source, "%3.2f" % post, pron, file=args.pron_posteriors_handle)
+            entry[:] = sorted(new_entry, key=lambda e: e[1])
+        return posteriors
+
+    def SelectPronsBayesianRef(args, counts, posteriors, lexicons):
+        ref_lexicon = lexicons[0]
+        num_selected = [0, 0, 0]
+        learned_lexicon = defaultdict(dict)
+        for word, entry in posteriors.items():
+            entry = list(entry)
+            num_variants = 0
+            post_tot = 0.0
+            variants_counts = args.variants_counts
+            variants_prob_mass = args.variants_prob_mass
+            if word in ref_lexicon:
+                if counts.get(word, 0) > 0:
+                    variants_counts = math.ceil(1.5 * len(ref_lexicon[word]))
+                else:
+                    variants_counts = len(ref_lexicon[word])
+                    variants_prob_mass = 1.0
+            last_post = 0.0
+            while ((num_variants < variants_counts and post_tot < variants_prob_mass)
+                   or (len(entry) > 0 and entry[-1][1] == last_post)):
+                try:
+                    pron, post = entry.pop()
+                    last_post = post
+                except IndexError:
+                    break
+                post_tot += post
+                learned_lexicon[word][pron] = None
+                num_variants += 1
+                num_selected[[i for i in range(3) if word in lexicons[i] and pron in lexicons[i][word]][0]] += 1
+            while (num_variants < variants_counts and post_tot < args.variants_prob_mass_ref):
+                try:
+                    pron, post = entry.pop()
+                except IndexError:
+                    break
+                if word in ref_lexicon and pron in ref_lexicon[word]:
+                    post_tot += post
+                    learned_lexicon[word][pron] = None
+                    num_variants += 1
+                    num_selected[0] += 1
+        print('---------------------------------------------------------------------------------------------------', file=sys.stderr)
+        print ('Num. words in the learned lexicon: {0} num. selected prons: {1}'.format(len(learned_lexicon), sum(num_selected)), file=sys.stderr)
+        print ('{0} selected prons came from reference candidate prons; {1} came from G2P candidate prons;'
+               '{2} came from phonetic-decoding candidate prons.'.format(*num_selected), file=sys.stderr)
+        return dict((word, list(prons)) for word, prons in learned_lexicon.items())
+
+    rng = random.Random(0)
+    phones = ['a', 'b', 'c', 'd', 'e', 'sil']
+    for trial in range(50):
+        vocab = ['w{}'.format(i) for i in range(30)]
+        files = {'counts': [], 'stats': [], 'ref': [], 'g2p': [], 'pd': []}
+        for word in vocab + ['oov1', 'oov2']:
+            if word in vocab and rng.random() < 0.9:
+                files['counts'].append('{} {}\n'.format(word, rng.choice([0, 1, 3, 10, 100])))
+            prons = [' '.join(rng.choice(phones[:-1]) for _ in range(rng.randint(1, 3)))
+                     for _ in range(rng.randint(1, 4))]
+            for lexicon in ('ref', 'g2p', 'pd'):
+                for _ in range(rng.randint(0, 3)):
+                    pron = rng.choice(prons)
+                    if lexicon == 'pd' and rng.random() < 0.2:
+                        pron += ' sil'
+                    files[lexicon].append('{} {}\n'.format(word, pron))
+                    if rng.random() < 0.7:
+                        # the soft counts are rounded so that some posteriors are equal.
+                        files['stats'].append('{} {} {}\n'.format(rng.choice([0.5, 1.0, 2.0, rng.random() * 5]),
+                                                                  word, pron))
+        args = argparse.Namespace(prior_mean=[0.6, 0.2, 0.2], prior_counts_tot=15.0,
+                                  variants_prob_mass=rng.choice([0.5, 0.7]), variants_prob_mass_ref=0.9,
+                                  variants_counts=rng.choice([1, 2]), num_jobs=1)
+        Open = lambda name: io.StringIO(''.join(files[name]))
+
+        args.silence_file_handle = io.StringIO('sil\n')
+        args.pron_posteriors_handle = io.StringIO()
+        with redirect_stderr(io.StringIO()) as stderr_ref:
+            counts = ReadWordCounts(Open('counts'))
+            lexicons = [ReadLexiconRef(Open(name), counts) for name in ('ref', 'g2p', 'pd')]
+            stats = ReadPronStatsRef(Open('stats'))
+            lexicons[2], stats = FilterPhoneticDecodingLexiconRef(args, lexicons[2], stats)
+            prior_counts = ComputePriorCountsRef(args, counts, lexicons)
+            posteriors_ref = ComputePosteriorsRef(args, stats, lexicons, prior_counts)
+            learned_lexicon_ref = SelectPronsBayesianRef(args, counts, posteriors_ref, lexicons)
+        pron_posteriors_ref = args.pron_posteriors_handle.getvalue()
+
+        args.silence_file_handle = io.StringIO('sil\n')
+        args.pron_posteriors_handle = io.StringIO()
+        with redirect_stderr(io.StringIO()) as stderr_new:
+            counts = ReadWordCounts(Open('counts'))
+            words = list(counts)
+            word_to_id = dict((word, i) for i, word in enumerate(words))
+            pron_to_id = {}
+            lexicons = [ReadLexicon(args, Open(name), word_to_id, pron_to_id) for name in ('ref', 'g2p', 'pd')]
+            prons = [None] * len(pron_to_id)
+            for pron, i in pron_to_id.items():
+                prons[i] = pron
+            stats = ReadPronStats(Open('stats'), word_to_id, pron_to_id)
+            lexicons[2], stats = FilterPhoneticDecodingLexicon(args, lexicons[2], stats, words, prons)
+            prior_counts = ComputePriorCounts(args, words, *lexicons)
+            posteriors = ComputePosteriors(args, stats, lexicons[0], lexicons[1], lexicons[2], prior_counts,
+                                           words, prons)
+            learned_lexicon = SelectPronsBayesian(args, counts, posteriors, lexicons[0], words, prons)
+
+        assert args.pron_posteriors_handle.getvalue() == pron_posteriors_ref
+        assert stderr_new.getvalue() == stderr_ref.getvalue()
+        posteriors_new = {}
+        for i, word_id in enumerate(posteriors.word_ids.tolist()):
+            begin, end = posteriors.indptr[i], posteriors.indptr[i + 1]
+            posteriors_new[words[word_id]] = list(zip([prons[p] for p in posteriors.pron_ids[begin:end]],
+                                                      posteriors.posts[begin:end].tolist()))
+        assert posteriors_new == dict(posteriors_ref)
+        assert list(posteriors_new) == list(posteriors_ref)
+        assert learned_lexicon == learned_lexicon_ref
+        assert list(learned_lexicon) == list(learned_lexicon_ref)
+    print('{}: self-check passed'.format(sys.argv[0]))
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--test']:
+        test_library()
+        sys.exit(0)
     Main()
@@ -4,10 +4,17 @@
 # Apache 2.0.
 
 from __future__ import print_function
-from collections import defaultdict
+from collections import defaultdict, deque
 import argparse
+import itertools
 import sys
 import math
+from multiprocessing import Pool
+import numpy as np
+
+# Max. number of elements of the (candidates x examples x prons) arrays
+# processed at once by RunEM().
+MAX_BATCH_ELEMENTS = 1 << 22
 
 def GetArgs():
     parser = argparse.ArgumentParser(
@@ -38,6 +45,8 @@ def GetArgs():
                         help = "Floor value of the pronunciation posterior statistics."
                         "The valid range is (0, 0.01),"
                         "See Section 3 in the paper for details.")
+    parser.add_argument("--num-jobs", type = int, default = 1,
+                        help = "Number of words processed in parallel.")
     parser.add_argument("silence_phones_file", metavar = "<silphone-file>", type = str,
                         help = "File containing a list of silence phones.")
     parser.add_argument("arc_stats_file", metavar = "<arc-stats-file>", type = str,
@@ -173,7 +182,7 @@ def FilterPhoneticDecodingLexicon(args, pd_lexicon):
     for line in args.silence_phones_file_handle:
         silphones.add(line.strip())
     rejected_candidates = set()
-    for word, prons in pd_lexicon.iteritems():
+    for word, prons in pd_lexicon.items():
         for pron in prons:
             for phone in pron.split():
                 if phone in silphones:
@@ -184,31 +193,146 @@ def FilterPhoneticDecodingLexicon(args, pd_lexicon):
     return pd_lexicon
 
 # One iteration of Expectation-Maximization computation (Eq. 3-4 in the paper).
-def OneEMIter(args, word, stats, prons, pron_probs, debug=False):
-    prob_acc = [0.0 for i in range(len(prons[word]))]
-    s = sum(pron_probs)
-    for i in range(len(pron_probs)):
-        pron_probs[i] = pron_probs[i] / s
-    log_like = 0.0
-    for (utt, start_frame) in stats[word]:
-        prob = []
-        soft_counts = []
-        for i in range(len(prons[word])):
-            phones = prons[word][i]
-            soft_count = stats[word][(utt, start_frame)].get(phones, 0)
-            if soft_count < args.delta: 
-                soft_count = args.delta
-            soft_counts.append(soft_count)
-        prob = [i[0] * i[1] for i in zip(soft_counts, pron_probs)]
-        for i in range(len(prons[word])):
-            prob_acc[i] += prob[i] / sum(prob)
-        log_like += math.log(sum(prob))
-    pron_probs = [1.0 / float(len(stats[word])) * p for p in prob_acc]
-    log_like = 1.0 / float(len(stats[word])) * log_like
-    if debug:
-        print("Log_like of the word: ", log_like, "pron probs: ", pron_probs)
+# soft_counts is the (examples x prons) matrix of the soft counts of a word,
+# floored at delta, and pron_probs a (..., prons) array of pron probs; leading
+# dimensions are computed independently (e.g. one row per deletion candidate).
+# Returns the re-estimated pron probs and the avg. log-likelihood per example.
+def OneEMIter(soft_counts, pron_probs):
+    num_examples = soft_counts.shape[0]
+    pron_probs = pron_probs / pron_probs.sum(axis=-1, keepdims=True)
+    prob = soft_counts * pron_probs[..., np.newaxis, :]
+    prob_sum = prob.sum(axis=-1)
+    pron_probs = 1.0 / float(num_examples) * (prob / prob_sum[..., np.newaxis]).sum(axis=-2)
+    log_like = 1.0 / float(num_examples) * np.log(prob_sum).sum(axis=-1)
     return pron_probs, log_like
 
+# Runs EM for every row of pron_probs (a (candidates x prons) array) until the
+# change in the avg. log-likelihood of that row is not larger than 'tolerance'.
+# The rows are processed in batches of at most MAX_BATCH_ELEMENTS elements.
+# Returns the pron probs, the log-likelihoods and the numbers of iterations.
+def RunEM(soft_counts, pron_probs, tolerance):
+    pron_probs = pron_probs.copy()
+    num_rows = pron_probs.shape[0]
+    log_like = np.ones(num_rows)
+    log_like_last = -np.ones(num_rows)
+    num_iters = np.zeros(num_rows, dtype=int)
+    batch_size = max(1, MAX_BATCH_ELEMENTS // soft_counts.size)
+    for batch_start in range(0, num_rows, batch_size):
+        rows = np.arange(batch_start, min(batch_start + batch_size, num_rows))
+        while len(rows) > 0:
+            num_iters[rows] += 1
+            log_like_last[rows] = log_like[rows]
+            pron_probs[rows], log_like[rows] = OneEMIter(soft_counts, pron_probs[rows])
+            rows = rows[np.abs(log_like[rows] - log_like_last[rows]) > tolerance]
+    return pron_probs, log_like, num_iters
+
+# Builds the (examples x prons) soft count matrix of a word from its arc stats
+# (a dict: (utt, start_frame) -> dict: phones -> count), floored at delta.
+def GetSoftCounts(word_stats, word_prons, delta):
+    cols = defaultdict(list)
+    for j, pron in enumerate(word_prons):
+        cols[pron].append(j)
+    soft_counts = np.zeros((len(word_stats), len(word_prons)))
+    for e, example in enumerate(word_stats.values()):
+        for phones, count in example.items():
+            for j in cols.get(phones, []):
+                soft_counts[e, j] = count
+    return np.maximum(soft_counts, delta)
+
+# Greedy pron selection for a single word (Alg. 1 in the paper). 'task' is a tuple
+# (word, prons, sources, soft_counts, alpha, beta, delta, dianostic_info), where
+# sources[i] is the source of prons[i] ('P', 'G' or 'R').
+# Returns (word, list of selected prons).
+def SelectPronsForWord(task):
+    word, prons, sources, soft_counts, alpha, beta, delta, dianostic_info = task
+    num_examples, n = soft_counts.shape
+    source_index = np.array(['PGR'.index(source) for source in sources])
+    log_delta = math.log(delta)
+    # Quality score q_b = loss_abs * M_w / (M_w + beta_s(b)) + alpha_s(b) * log_delta
+    # See Sec. 4.3 and Alg. 1 in the paper.
+    loss_scales = float(num_examples) / (float(num_examples) + np.array(beta)[source_index])
+    thresholds = -log_delta * np.array(alpha)[source_index]
+
+    pron_probs = np.full(n, 1 / float(n))
+    if dianostic_info:
+        print("pronunciations of word '{}': {}".format(word, prons))
+    # Avg.(over all egs) soft counts, i.e. the pron probs after the first EM iteration.
+    soft_counts_normalized = OneEMIter(soft_counts, pron_probs)[0]
+    if dianostic_info:
+        print("Avg.(over all egs) soft counts: {}".format(soft_counts_normalized.tolist()))
+    active = np.ones(n, dtype=bool)
+    while active.sum() > 1:
+        pron_probs, log_like, num_iters = RunEM(soft_counts, pron_probs[np.newaxis, :], 1e-7)
+        pron_probs, log_like = pron_probs[0], log_like[0]
+        if dianostic_info:
+            print("\n Log_like after {} iters of EM: {}, estimated pron_probs: {} \n".format(
+                    num_iters[0], log_like, pron_probs.tolist()))
+
+        # Set the prob of each active pron to zero in turn and re-run EM from there,
+        # all candidates at once.
+        candidates = np.flatnonzero(active)
+        pron_probs_mod = np.tile(pron_probs + 0.01 * active, (len(candidates), 1))
+        pron_probs_mod[np.arange(len(candidates)), candidates] = 0.0
+        pron_probs_mod /= pron_probs_mod.sum(axis=1, keepdims=True)
+        _, log_like2, num_iters2 = RunEM(soft_counts, pron_probs_mod, 0.001)
+
+        loss_abs = log_like - log_like2 # absolute likelihood loss before normalization
+        # (supposed to be positive, but could be negative near zero because of numerical precision limit).
+        losses = loss_abs * loss_scales[candidates]
+        quality_scores = losses - thresholds[candidates]
+        if dianostic_info:
+            for k, i in enumerate(candidates):
+                print("\n set the pron_prob of '{}' whose source is {}, to zero results in {}"
+                      " loss in avg. log-likelihood; Num. iters until converging:{}. ".format(
+                        prons[i], sources[i], loss_abs[k], num_iters2[k]))
+                if quality_scores[k] < 0:
+                    print("Smoothed log-like loss {} is smaller than threshold {} so that the quality"
+                          "score {} is negative, adding the pron to the list of candidates to delete"
+                          ". ".format(losses[k], thresholds[i], quality_scores[k]))
+        if not (quality_scores < 0).any():
+            break
+        # delete the candidate with the lowest (negative) quality score.
+        k = np.argmin(quality_scores)
+        deleted = candidates[k]
+        active[deleted] = False
+        pron_probs[deleted] = 0.0
+        pron_probs[active] += 0.01
+        pron_probs /= pron_probs.sum()
+        source = sources[deleted]
+        pron = prons[deleted]
+        soft_count = soft_counts_normalized[deleted]
+        loss, thr = losses[k], thresholds[deleted]
+        # This part of diagnostic info provides hints to the user on how to adjust the parameters.
+        if dianostic_info:
+            print("removed pron {}, from source {} with quality score {:.5f}".format(
+                    pron, source, quality_scores[k]))
+            if (source == 'P' and soft_count > 0.7 and num_examples > 5):
+                print("WARNING: alpha_{pd} or beta_{pd} may be too large!"
+                      "    For the word '{}' whose count is {}, the candidate "
+                      "    pronunciation from phonetic decoding '{}' with normalized "
+                      "    soft count {} (out of 1) is rejected. It shouldn't have been"
+                      "    rejected if alpha_{pd} is smaller than {}".format(
+                        word, num_examples, pron, soft_count, -loss / log_delta),
+                        file=sys.stderr)
+                if loss_abs[k] > thr:
+                    print("    or beta_{pd} is smaller than {}".format(
+                            (loss_abs[k] / thr - 1) * num_examples), file=sys.stderr)
+            if (source == 'G' and soft_count > 0.7 and num_examples > 5):
+                print("WARNING: alpha_{g2p} or beta_{g2p} may be too large!"
+                      "    For the word '{}' whose count is {}, the candidate "
+                      "    pronunciation from G2P '{}' with normalized "
+                      "    soft count {} (out of 1) is rejected. It shouldn't have been"
+                      "    rejected if alpha_{g2p} is smaller than {} ".format(
+                        word, num_examples, pron, soft_count, -loss / log_delta),
+                      file=sys.stderr)
+                if loss_abs[k] > thr:
+                    print("    or beta_{g2p} is smaller than {}.".format((
+                            loss_abs[k] / thr - 1) * num_examples), file=sys.stderr)
+    return word, [prons[i] for i in np.flatnonzero(active)]
+
+def SelectPronsForWords(tasks):
+    return [SelectPronsForWord(task) for task in tasks]
+
 def SelectPronsGreedy(args, stats, counts, ref_lexicon, g2p_lexicon, pd_lexicon, dianostic_info=False):
     prons = defaultdict(list) # Put all possible prons from three source lexicons into this dictionary
     src = {} # Source of each (word, pron) pair: 'P' = phonetic-decoding, 'G' = G2P, 'R' = reference
@@ -225,132 +349,35 @@ def SelectPronsGreedy(args, stats, counts, ref_lexicon, g2p_lexicon, pd_lexicon,
                 src[(word, pron)] = 'G'
             if word in ref_lexicon and pron in ref_lexicon[word]:
                 src[(word, pron)] = 'R'
-   
-    for word in prons:
-        if word not in stats:
-            continue
-        n = len(prons[word])
-        pron_probs = [1/float(n) for i in range(n)]
-        if dianostic_info:
-            print("pronunciations of word '{}': {}".format(word, prons[word]))
-        active_indexes = set(range(len(prons[word])))
-       
-        deleted_prons = [] # indexes of prons to be deleted
-        soft_counts_normalized = []
-        while len(active_indexes) > 1:
-            log_like = 1.0
-            log_like_last = -1.0
-            num_iters = 0
-            while abs(log_like - log_like_last) > 1e-7:
-                num_iters += 1
-                log_like_last = log_like
-                pron_probs, log_like = OneEMIter(args, word, stats, prons, pron_probs, False)
-                if log_like_last == 1.0 and len(soft_counts_normalized) == 0: # the first iteration
-                    soft_counts_normalized = pron_probs
-                    if dianostic_info: 
-                        print("Avg.(over all egs) soft counts: {}".format(soft_counts_normalized))
-            if dianostic_info:
-                print("\n Log_like after {} iters of EM: {}, estimated pron_probs: {} \n".format(
-                        num_iters, log_like, pron_probs))
-            candidates_to_delete = []
-            
-            for i in active_indexes:
-                pron_probs_mod = [p for p in pron_probs]
-                pron_probs_mod[i] = 0.0
-                for j in range(len(pron_probs_mod)):
-                    if j in active_indexes and j != i:
-                        pron_probs_mod[j] += 0.01
-                pron_probs_mod = [s / sum(pron_probs_mod) for s in pron_probs_mod]
-                log_like2 = 1.0
-                log_like2_last = -1.0
-                num_iters2 = 0
-                # Running EM until convengence
-                while abs(log_like2 - log_like2_last) > 0.001 :
-                    num_iters2 += 1
-                    log_like2_last = log_like2
-                    pron_probs_mod, log_like2 = OneEMIter(args, word, stats,
-                                                          prons, pron_probs_mod, False)
-                
-                loss_abs = log_like - log_like2 # absolute likelihood loss before normalization
-                # (supposed to be positive, but could be negative near zero because of numerical precision limit).
-                log_delta = math.log(args.delta)
-                thr = -log_delta
-                loss = loss_abs
-                source = src[(word, prons[word][i])]
-                if dianostic_info:
-                    print("\n set the pron_prob of '{}' whose source is {}, to zero results in {}"
-                    " loss in avg. log-likelihood; Num. iters until converging:{}. ".format(
-                      prons[word][i], source, loss, num_iters2))
-                # Compute quality score q_b = loss_abs * / (M_w + beta_s(b)) + alpha_s(b) * log_delta
-                # See Sec. 4.3 and Alg. 1 in the paper.
-                if source == 'P':
-                   thr *= args.alpha[0]
-                   loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[0])
-                if source == 'G':
-                   thr *= args.alpha[1]
-                   loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[1])
-                if source == 'R':
-                   thr *= args.alpha[2]
-                   loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[2])
-                if loss - thr < 0: # loss - thr here is just q_b
-                   if dianostic_info:
-                       print("Smoothed log-like loss {} is smaller than threshold {} so that the quality"
-                             "score {} is negative, adding the pron to the list of candidates to delete"
-                             ". ".format(loss, thr, loss-thr))
-                   candidates_to_delete.append((loss-thr, i))
-            if len(candidates_to_delete) == 0:
-                break
-            candidates_to_delete_sorted = sorted(candidates_to_delete, 
-                                                 key=lambda candidates_to_delete: candidates_to_delete[0])
-
-            deleted_candidate = candidates_to_delete_sorted[0]
-            active_indexes.remove(deleted_candidate[1])
-            pron_probs[deleted_candidate[1]] = 0.0
-            for i in range(len(pron_probs)):
-                if i in active_indexes:
-                    pron_probs[i] += 0.01
-            pron_probs = [s / sum(pron_probs) for s in pron_probs]
-            source = src[(word, prons[word][deleted_candidate[1]])]
-            pron = prons[word][deleted_candidate[1]]
-            soft_count = soft_counts_normalized[deleted_candidate[1]]
-            quality_score = deleted_candidate[0]
-            # This part of diagnostic info provides hints to the user on how to adjust the parameters.
-            if dianostic_info:
-                print("removed pron {}, from source {} with quality score {:.5f}".format(
-                        pron, source, quality_score)) 
-                if (source == 'P' and soft_count > 0.7 and len(stats[word]) > 5):
-                    print("WARNING: alpha_{pd} or beta_{pd} may be too large!"
-                          "    For the word '{}' whose count is {}, the candidate "
-                          "    pronunciation from phonetic decoding '{}' with normalized "
-                          "    soft count {} (out of 1) is rejected. It shouldn't have been"
-                          "    rejected if alpha_{pd} is smaller than {}".format(
-                            word, len(stats[word]), pron, soft_count, -loss / log_delta, 
-                            -args.alpha[0] * len(stats[word]) + (objf_change + args.beta[0])),
-                            file=sys.stderr)
-                    if loss_abs > thr:
-                        print("    or beta_{pd} is smaller than {}".format(
-                                (loss_abs / thr - 1) * len(stats[word])), file=sys.stderr)
-                if (source == 'G' and soft_count > 0.7 and len(stats[word]) > 5):
-                    print("WARNING: alpha_{g2p} or beta_{g2p} may be too large!"
-                          "    For the word '{}' whose count is {}, the candidate "
-                          "    pronunciation from G2P '{}' with normalized "
-                          "    soft count {} (out of 1) is rejected. It shouldn't have been"
-                          "    rejected if alpha_{g2p} is smaller than {} ".format(
-                            word, len(stats[word]), pron, soft_count, -loss / log_delta, 
-                            -args.alpha[1] * len(stats[word]) + (objf_change + args.beta[1])),
-                          file=sys.stderr)
-                    if loss_abs > thr:
-                        print("    or beta_{g2p} is smaller than {}.".format((
-                                loss_abs / thr - 1) * len(stats[word])), file=sys.stderr)
-            deleted_prons.append(deleted_candidate[1])
-        for i in range(len(prons[word])):
-            if i not in deleted_prons:
-                learned_lexicon[word].add(prons[word][i])
+
+    # The soft count matrices are built as the words are handed out, in chunks
+    # of 16 words; at most 2 * num_jobs chunks are waiting for or being
+    # processed by a worker at any time, so they are not all held in memory.
+    tasks = ((word, prons[word], [src[(word, pron)] for pron in prons[word]],
+              GetSoftCounts(stats[word], prons[word], args.delta),
+              args.alpha, args.beta, args.delta, dianostic_info)
+             for word in prons if word in stats)
+    def AddResults(results):
+        for word, selected_prons in results:
+            for pron in selected_prons:
+                learned_lexicon[word].add(pron)
+    if args.num_jobs > 1:
+        chunks = iter(lambda: list(itertools.islice(tasks, 16)), [])
+        with Pool(args.num_jobs) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(SelectPronsForWords, (chunk,)))
+                if len(pending) >= 2 * args.num_jobs:
+                    AddResults(pending.popleft().get())
+            while pending:
+                AddResults(pending.popleft().get())
+    else:
+        AddResults(map(SelectPronsForWord, tasks))
 
     return learned_lexicon
 
 def WriteLearnedLexicon(learned_lexicon, file_handle):
-    for word, prons in learned_lexicon.iteritems():
+    for word, prons in learned_lexicon.items():
         for pron in prons:
             print('{0} {1}'.format(word, pron), file=file_handle)
     file_handle.close()
@@ -33,7 +33,11 @@ It generates three different configs:
  'final.config' : which has the actual config used to initialize the model used
                  in training i.e, it has file paths for LDA transform and
                  other initialization files
+
+The left and right context of the network (which nnet3-info would print for
+the model created from 'ref.config') can be computed without the C++ tools;
+see context.py.
 """
 
 
-__all__ = ["utils", "layers", "parser"]
+__all__ = ["utils", "layers", "parser", "context"]
@@ -0,0 +1,591 @@
+# Copyright 2016    Johns Hopkins University (Dan Povey)
+# Apache 2.0.
+
+""" This module works out the left-context, right-context and modulus of a
+neural network directly from the config lines that the xconfig layers produce
+(see XconfigLayerBase.get_full_config()), so that xconfig_to_configs.py does
+not need to run nnet3-init and nnet3-info for this.  It follows the C++ code
+very closely: see ComputeSimpleNnetContext() in nnet3/nnet-utils.cc, the
+IsComputable() functions of the Descriptor classes in
+nnet3/nnet-descriptor.cc, and the IsComputable() functions of the components
+that are not "simple" (TdnnComponent, TimeHeightConvolutionComponent,
+RestrictedAttentionComponent, StatisticsExtractionComponent and
+StatisticsPoolingComponent).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import re
+from collections import defaultdict
+
+import libs.nnet3.xconfig.utils as xutils
+
+
+def _gcd(a, b):
+    while b != 0:
+        a, b = b, a % b
+    return a
+
+
+def _lcm(a, b):
+    return a * b // _gcd(a, b)
+
+
+def split_config_line(config_line):
+    """Splits a line of a nnet3 config file, like
+    'component-node name=lstm1.c component=lstm1.c input=Sum(lstm1.c1, lstm1.c2)'
+    into its first token and a dict from keys to (string) values, e.g.
+    ('component-node', {'name': 'lstm1.c', 'component': 'lstm1.c',
+                        'input': 'Sum(lstm1.c1, lstm1.c2)'}).
+    Unlike xutils.parse_config_line(), this is for the lines that we write
+    out, not for xconfig lines; it returns None for empty lines.
+    """
+    config_line = config_line.split('#')[0]
+    fields = []
+    depth = 0
+    start = None
+    for i, c in enumerate(config_line):
+        if c.isspace() and depth == 0:
+            if start is not None:
+                fields.append(config_line[start:i])
+                start = None
+            continue
+        if start is None:
+            start = i
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+    if start is not None:
+        fields.append(config_line[start:])
+    if len(fields) == 0:
+        return None
+    key_to_value = dict()
+    for field in fields[1:]:
+        parts = field.split('=', 1)
+        if len(parts) != 2:
+            raise RuntimeError("Could not parse field '{0}' in config "
+                               "line: {1}".format(field, config_line))
+        key_to_value[parts[0]] = parts[1]
+    return (fields[0], key_to_value)
+
+
+def _descriptor_modulus(desc):
+    """Returns the modulus of the Descriptor 'desc' (an xutils.Descriptor
+    object), as Descriptor::Modulus() does in the C++ code."""
+    if desc.operator is None or desc.operator in ['Const', 'ReplaceIndex']:
+        return 1
+    elif desc.operator == 'Round':
+        return desc.items[1]
+    elif desc.operator == 'Scale':
+        return _descriptor_modulus(desc.items[1])
+    ans = len(desc.items) if desc.operator == 'Switch' else 1
+    for item in desc.items:
+        if isinstance(item, xutils.Descriptor):
+            ans = _lcm(ans, _descriptor_modulus(item))
+    return ans
+
+
+def _descriptor_dependencies(desc, ans):
+    """Adds to the set 'ans' the names of the nodes that the Descriptor 'desc'
+    depends on, not counting those inside IfDefined() expressions (which
+    would give cycles for recurrent networks)."""
+    if desc.operator is None:
+        ans.add(desc.items[0])
+    elif desc.operator not in ['IfDefined', 'Const']:
+        for item in desc.items:
+            if isinstance(item, xutils.Descriptor):
+                _descriptor_dependencies(item, ans)
+
+
+def _descriptor_inputs(desc, t, x, ans):
+    """Appends to the list 'ans' the (node-name, t, x) triples whose
+    computability may be needed to work out whether the Descriptor 'desc'
+    is computable at time t and x index x.  The inputs inside IfDefined() are
+    not needed, as IfDefined() expressions are always computable."""
+    op = desc.operator
+    if op is None:
+        ans.append((desc.items[0], t, x))
+    elif op == 'Offset':
+        _descriptor_inputs(desc.items[0], t + desc.items[1],
+                           x + (desc.items[2] if len(desc.items) > 2 else 0),
+                           ans)
+    elif op == 'Switch':
+        # python's % is the "mathematical" modulus, as in the C++ code.
+        _descriptor_inputs(desc.items[t % len(desc.items)], t, x, ans)
+    elif op == 'Round':
+        _descriptor_inputs(desc.items[0], t - t % desc.items[1], x, ans)
+    elif op == 'ReplaceIndex':
+        if desc.items[1] == 't':
+            _descriptor_inputs(desc.items[0], desc.items[2], x, ans)
+        else:
+            _descriptor_inputs(desc.items[0], t, desc.items[2], ans)
+    elif op in ['Append', 'Sum', 'Failover']:
+        for item in desc.items:
+            _descriptor_inputs(item, t, x, ans)
+    elif op == 'Scale':
+        _descriptor_inputs(desc.items[1], t, x, ans)
+    else:
+        assert op in ['IfDefined', 'Const']
+
+
+def _descriptor_is_computable(desc, t, x, computable):
+    """Returns true if the Descriptor 'desc' is computable at time t and x
+    index x, given 'computable', the set of (node-name, t, x) triples that are
+    computable."""
+    op = desc.operator
+    if op is None:
+        return (desc.items[0], t, x) in computable
+    elif op == 'Offset':
+        return _descriptor_is_computable(
+            desc.items[0], t + desc.items[1],
+            x + (desc.items[2] if len(desc.items) > 2 else 0), computable)
+    elif op == 'Switch':
+        return _descriptor_is_computable(desc.items[t % len(desc.items)],
+                                         t, x, computable)
+    elif op == 'Round':
+        return _descriptor_is_computable(desc.items[0],
+                                         t - t % desc.items[1], x, computable)
+    elif op == 'ReplaceIndex':
+        if desc.items[1] == 't':
+            return _descriptor_is_computable(desc.items[0], desc.items[2], x,
+                                             computable)
+        else:
+            return _descriptor_is_computable(desc.items[0], t, desc.items[2],
+                                             computable)
+    elif op in ['Append', 'Sum']:
+        return all(_descriptor_is_computable(item, t, x, computable)
+                   for item in desc.items)
+    elif op == 'Failover':
+        return any(_descriptor_is_computable(item, t, x, computable)
+                   for item in desc.items)
+    elif op == 'Scale':
+        return _descriptor_is_computable(desc.items[1], t, x, computable)
+    else:
+        assert op in ['IfDefined', 'Const']
+        return True
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+class ComponentTimes(object):
+    """This class describes which input times a component needs in order to
+    compute its output at a time t, as the IsComputable() function of the
+    corresponding C++ component does.  Components that are not listed in
+    __init__ are "simple" components, which need their input at time t.
+    """
+    def __init__(self, component_type, key_to_value):
+        self.type = component_type
+        if component_type == 'TdnnComponent':
+            self.offsets = _int_list(key_to_value['time-offsets'])
+        elif component_type == 'TimeHeightConvolutionComponent':
+            if 'offsets' in key_to_value:
+                time_offsets = set(int(pair.split(',')[0]) for pair in
+                                   key_to_value['offsets'].split(';'))
+            else:
+                time_offsets = set(_int_list(key_to_value['time-offsets']))
+            if 'required-time-offsets' in key_to_value:
+                required = set(_int_list(key_to_value['required-time-offsets']))
+                # required time offsets that are not used have no effect.
+                time_offsets &= required
+            self.offsets = sorted(time_offsets)
+        elif component_type == 'RestrictedAttentionComponent':
+            # the inputs that are required default to all the inputs.
+            num_left = int(key_to_value.get('num-left-inputs-required', -1))
+            if num_left < 0:
+                num_left = int(key_to_value['num-left-inputs'])
+            num_right = int(key_to_value.get('num-right-inputs-required', -1))
+            if num_right < 0:
+                num_right = int(key_to_value['num-right-inputs'])
+            time_stride = int(key_to_value.get('time-stride', 1))
+            self.offsets = [time_stride * i
+                            for i in range(-num_left, num_right + 1)]
+        elif component_type == 'StatisticsExtractionComponent':
+            self.input_period = int(key_to_value.get('input-period', 1))
+            self.output_period = int(key_to_value.get('output-period', 1))
+        elif component_type == 'StatisticsPoolingComponent':
+            self.input_period = int(key_to_value.get('input-period', 1))
+            self.left_context = int(key_to_value.get('left-context', 0))
+            self.right_context = int(key_to_value.get('right-context', 0))
+        elif component_type == 'DistributeComponent':
+            raise NotImplementedError(
+                "Computing the context is not supported for DistributeComponent")
+        else:
+            self.offsets = [0]
+
+    def input_times(self, t):
+        """Returns a pair (times, need_all): if need_all is true, the output
+        at time t is computable if the input is computable at all of 'times';
+        otherwise if it is computable at any of them."""
+        if self.type == 'StatisticsExtractionComponent':
+            t_start = (t // self.output_period) * self.output_period
+            return (range(t_start, t_start + self.output_period,
+                          self.input_period), False)
+        elif self.type == 'StatisticsPoolingComponent':
+            if t % self.input_period != 0:
+                return ([], False)
+            return (range(t - self.left_context, t + self.right_context + 1,
+                          self.input_period), False)
+        else:
+            return ([t + o for o in self.offsets], True)
+
+
+def _parse_nnet_edits(nnet_edits):
+    """Parses the --nnet-edits option of xconfig_to_configs.py and returns a
+    dict from old to new node names.  Only the 'rename-node' edit, which is
+    the one the recipes use (to make some node the 'output' node), is
+    supported; we raise NotImplementedError for anything else."""
+    renames = dict()
+    if nnet_edits is None:
+        return renames
+    for edit in nnet_edits.split(';'):
+        parsed = split_config_line(edit)
+        if parsed is None:
+            continue
+        (command, key_to_value) = parsed
+        if (command != 'rename-node' or
+                set(key_to_value.keys()) != set(['old-name', 'new-name'])):
+            raise NotImplementedError(
+                "Unsupported nnet edit '{0}'".format(edit.strip()))
+        renames[key_to_value['old-name']] = key_to_value['new-name']
+    return renames
+
+
+class NnetContextComputer(object):
+    """This class holds the structure of a neural network, as read from the
+    lines of a config file like ref.config, in the form needed to work out
+    which outputs are computable.
+
+    e.g.:
+      computer = NnetContextComputer(config_lines)
+      (left_context, right_context) = computer.compute_context()
+    """
+    def __init__(self, config_lines, nnet_edits=None):
+        # the following are dicts indexed by node name.
+        self.input_nodes = set()
+        self.descriptors = dict()      # component-nodes and output-nodes.
+        self.node_components = dict()  # component-node -> component name.
+        self.dim_range_inputs = dict()
+        self.component_times = dict()  # indexed by component name.
+        component_lines = dict()
+
+        for line in config_lines:
+            parsed = split_config_line(line)
+            if parsed is None:
+                continue
+            (first_token, key_to_value) = parsed
+            name = key_to_value.get('name')
+            if first_token == 'input-node':
+                self.input_nodes.add(name)
+            elif first_token == 'component':
+                component_lines[name] = key_to_value
+            elif first_token == 'component-node':
+                self.descriptors[name] = xutils.Descriptor(key_to_value['input'])
+                self.node_components[name] = key_to_value['component']
+            elif first_token == 'output-node':
+                self.descriptors[name] = xutils.Descriptor(key_to_value['input'])
+            elif first_token == 'dim-range-node':
+                self.dim_range_inputs[name] = key_to_value['input-node']
+            else:
+                raise RuntimeError("Unexpected config line: {0}".format(line))
+
+        for node, component in self.node_components.items():
+            if component not in self.component_times:
+                if component not in component_lines:
+                    raise RuntimeError("Component-node {0} uses undefined "
+                                       "component {1}".format(node, component))
+                key_to_value = component_lines[component]
+                self.component_times[component] = ComponentTimes(
+                    key_to_value['type'], key_to_value)
+
+        self.modulus = 1
+        for desc in self.descriptors.values():
+            self.modulus = _lcm(self.modulus, _descriptor_modulus(desc))
+
+        # work out which (original) node names play the role of 'input',
+        # 'ivector' and 'output', after applying the nnet edits.
+        renames = _parse_nnet_edits(nnet_edits)
+        all_nodes = (list(self.input_nodes) + list(self.descriptors.keys()) +
+                     list(self.dim_range_inputs.keys()))
+        new_to_old = dict()
+        for node in all_nodes:
+            new_name = renames.get(node, node)
+            if new_name in new_to_old:
+                raise RuntimeError("Renaming nodes would give two nodes "
+                                   "named {0}".format(new_name))
+            new_to_old[new_name] = node
+        self.input_name = new_to_old.get('input')
+        self.ivector_name = new_to_old.get('ivector')
+        self.output_name = new_to_old.get('output')
+        if (self.input_name not in self.input_nodes or
+                self.output_name is None or
+                self.output_name in self.node_components):
+            raise RuntimeError("Network does not have an input-node named "
+                               "'input' and an output-node named 'output'")
+        if self.ivector_name not in self.input_nodes:
+            self.ivector_name = None
+        self.order = self._topological_order()
+
+    def _node_dependencies(self, node):
+        ans = set()
+        if node in self.descriptors:
+            _descriptor_dependencies(self.descriptors[node], ans)
+        elif node in self.dim_range_inputs:
+            ans.add(self.dim_range_inputs[node])
+        elif node not in self.input_nodes:
+            # This can happen for nodes of an existing model
+            # (see xparser.get_model_component_info()) which are not
+            # in the config lines.
+            raise NotImplementedError("Node {0} is not defined".format(node))
+        return ans
+
+    def _topological_order(self):
+        """Returns the nodes that the output depends on, with each node
+        after the nodes it depends on."""
+        order = []
+        state = {self.output_name: 1}  # 1 = being visited, 2 = done.
+        stack = [(self.output_name, iter(self._node_dependencies(self.output_name)))]
+        while len(stack) > 0:
+            (node, deps) = stack[-1]
+            dep = next(deps, None)
+            if dep is None:
+                stack.pop()
+                state[node] = 2
+                order.append(node)
+            elif dep not in state:
+                state[dep] = 1
+                stack.append((dep, iter(self._node_dependencies(dep))))
+            elif state[dep] == 1:
+                raise RuntimeError("Network has a cycle (through node {0}) "
+                                   "not broken by IfDefined()".format(dep))
+        return order
+
+    def _node_inputs(self, node, t, x, ans):
+        """Appends to 'ans' the (node, t, x) triples that might be needed to
+        work out whether 'node' is computable at (t, x)."""
+        if node in self.descriptors:
+            desc = self.descriptors[node]
+            if node in self.node_components:
+                times = self.component_times[
+                    self.node_components[node]].input_times(t)[0]
+            else:
+                times = [t]
+            for input_t in times:
+                _descriptor_inputs(desc, input_t, x, ans)
+        elif node in self.dim_range_inputs:
+            ans.append((self.dim_range_inputs[node], t, x))
+
+    def _is_computable(self, node, t, x, computable, input_start, input_end):
+        if node in self.input_nodes:
+            if node == self.input_name:
+                return x == 0 and input_start <= t < input_end
+            elif node == self.ivector_name:
+                return (x == 0 and
+                        input_start - self.modulus <= t < input_end)
+            return False
+        elif node in self.dim_range_inputs:
+            return (self.dim_range_inputs[node], t, x) in computable
+        desc = self.descriptors[node]
+        if node not in self.node_components:
+            return _descriptor_is_computable(desc, t, x, computable)
+        (times, need_all) = self.component_times[
+            self.node_components[node]].input_times(t)
+        if need_all:
+            return all(_descriptor_is_computable(desc, input_t, x, computable)
+                       for input_t in times)
+        else:
+            return any(_descriptor_is_computable(desc, input_t, x, computable)
+                       for input_t in times)
+
+    def output_is_computable(self, input_start, window_size):
+        """Returns a list of bools, saying for each t in
+        [input_start, input_start + window_size) whether the output is
+        computable at time t if the input is provided for those times
+        (and the ivector, if present, for times starting modulus frames
+        earlier).  This is like EvaluateComputationRequest() in
+        nnet3/nnet-utils.cc."""
+        input_end = input_start + window_size
+        # First work out, going backwards from the output, which (t, x) pairs
+        # of which nodes we need to know about...
+        needed = defaultdict(set)
+        needed[self.output_name] = set((t, 0)
+                                       for t in range(input_start, input_end))
+        for node in reversed(self.order):
+            inputs = []
+            for (t, x) in needed[node]:
+                self._node_inputs(node, t, x, inputs)
+            for (input_node, t, x) in inputs:
+                needed[input_node].add((t, x))
+        # ... then go forward, working out which of them are computable.
+        computable = set()
+        for node in self.order:
+            for (t, x) in needed[node]:
+                if self._is_computable(node, t, x, computable,
+                                       input_start, input_end):
+                    computable.add((node, t, x))
+        return [(self.output_name, t, 0) in computable
+                for t in range(input_start, input_end)]
+
+    def _compute_context_for_shift(self, input_start, window_size):
+        output_ok = self.output_is_computable(input_start, window_size)
+        if True not in output_ok:
+            return None
+        first_ok = output_ok.index(True)
+        first_not_ok = (output_ok.index(False, first_ok)
+                        if False in output_ok[first_ok:] else window_size)
+        return (first_ok, window_size - first_not_ok)
+
+    def compute_context(self):
+        """Returns the pair (left_context, right_context) of the network, as
+        ComputeSimpleNnetContext() in nnet3/nnet-utils.cc does."""
+        window_size = 40
+        max_window_size = 800
+        while window_size < max_window_size:
+            contexts = []
+            # by going "<= modulus" instead of "< modulus" we do one more
+            # computation than we really need; it becomes a sanity check.
+            for input_start in range(self.modulus + 1):
+                context = self._compute_context_for_shift(input_start,
+                                                          window_size)
+                if context is None:
+                    break
+                contexts.append(context)
+            if len(contexts) <= self.modulus:
+                # we assume the window was too small.
+                window_size *= 2
+                continue
+            if contexts[0] != contexts[self.modulus]:
+                raise RuntimeError("nnet does not have the properties we expect.")
+            return (max([c[0] for c in contexts]),
+                    max([c[1] for c in contexts]))
+        raise RuntimeError("Failure computing the context of the network "
+                           "(perhaps not a simple nnet?)")
+
+
+def get_config_lines(all_layers, config_basename='ref'):
+    """Returns the lines that would be written to config_dir/{config_basename}.config
+    for the layers in 'all_layers'."""
+    return [line for layer in all_layers
+            for (basename, line) in layer.get_full_config()
+            if basename == config_basename]
+
+
+def compute_model_context(config_lines, nnet_edits=None):
+    """Returns a tuple (left_context, right_context, modulus) for the network
+    described by 'config_lines' (e.g. the lines of ref.config, see
+    get_config_lines()), after applying 'nnet_edits' (as in the --nnet-edits
+    option of xconfig_to_configs.py).  These are the same as what nnet3-info
+    would print for the model created from them by nnet3-init.  Raises
+    NotImplementedError if the network refers to nodes that are not defined
+    in 'config_lines' (e.g. nodes of an existing model), or if it needs nnet
+    edits other than 'rename-node'; in those cases the caller should fall back
+    to nnet3-info."""
+    computer = NnetContextComputer(config_lines, nnet_edits)
+    (left_context, right_context) = computer.compute_context()
+    return (left_context, right_context, computer.modulus)
+
+
+def test_library():
+    # Each xconfig below is converted to ref.config; if nnet3-init and
+    # nnet3-info are on the path, the context is compared with theirs,
+    # otherwise with the context given here.
+    import os
+    import shutil
+    import subprocess
+    import tempfile
+    import libs.nnet3.xconfig.parser as xparser
+
+    xconfigs = [
+        ("input dim=40 name=input\n"
+         "output name=output input=Append(-1,0,1)", (1, 1, 1)),
+        ("input dim=100 name=ivector\n"
+         "input dim=40 name=input\n"
+         "fixed-affine-layer name=lda input=Append(-2,-1,0,1,2,ReplaceIndex(ivector, t, 0)) affine-transform-file=foo/lda.mat\n"
+         "relu-batchnorm-layer name=tdnn1 dim=512\n"
+         "relu-batchnorm-layer name=tdnn2 dim=512 input=Append(-1,0,1)\n"
+         "relu-batchnorm-layer name=tdnn3 dim=512 input=Append(-3,0,3)\n"
+         "output-layer name=output dim=300 max-change=1.5", (6, 6, 1)),
+        ("input dim=40 name=input\n"
+         "relu-batchnorm-dropout-layer name=tdnn1 dim=768 input=Append(-1,0,1)\n"
+         "tdnnf-layer name=tdnnf2 dim=768 bottleneck-dim=96 time-stride=1\n"
+         "tdnnf-layer name=tdnnf3 dim=768 bottleneck-dim=96 time-stride=3\n"
+         "tdnnf-layer name=tdnnf4 dim=768 bottleneck-dim=96 time-stride=0\n"
+         "linear-component name=prefinal-l dim=192 l2-regularize=0.0\n"
+         "prefinal-layer name=prefinal input=prefinal-l small-dim=192 big-dim=768\n"
+         "output-layer name=output include-log-softmax=false dim=300", (5, 5, 1)),
+        ("input dim=40 name=input\n"
+         "fixed-affine-layer name=lda input=Append(-2,-1,0,1,2) affine-transform-file=foo/lda.mat\n"
+         "relu-renorm-layer name=tdnn1 dim=512\n"
+         "fast-lstmp-layer name=lstm1 cell-dim=512 recurrent-projection-dim=128 non-recurrent-projection-dim=128 delay=-3\n"
+         "relu-renorm-layer name=tdnn2 dim=512 input=Append(-3,0,3)\n"
+         "lstmp-layer name=lstm2 cell-dim=512 recurrent-projection-dim=128 non-recurrent-projection-dim=128 delay=-3\n"
+         "output-layer name=output output-delay=5 dim=300", (0, 10, 1)),
+        ("input dim=40 name=input\n"
+         "relu-batchnorm-layer name=tdnn1 dim=512 input=Append(-2,-1,0,1,2)\n"
+         "gru-layer name=gru1 cell-dim=256 delay=-3\n"
+         "norm-pgru-layer name=pgru2 cell-dim=256 recurrent-projection-dim=64 non-recurrent-projection-dim=64 delay=3\n"
+         "output-layer name=output dim=300", (2, 2, 1)),
+        ("input dim=40 name=input\n"
+         "conv-relu-batchnorm-layer name=cnn1 height-in=40 height-out=40 time-offsets=-1,0,1 height-offsets=-1,0,1 num-filters-out=32\n"
+         "conv-relu-batchnorm-layer name=cnn2 height-in=40 height-out=20 height-subsample-out=2 time-offsets=-1,0,1 height-offsets=-1,0,1 num-filters-out=32 required-time-offsets=0\n"
+         "res-block name=res3 num-filters=32 height=20 time-period=1\n"
+         "relu-batchnorm-layer name=tdnn4 dim=512 input=Append(-3,0,3)\n"
+         "output-layer name=output dim=300", (4, 4, 1)),
+        ("input dim=40 name=input\n"
+         "relu-batchnorm-layer name=tdnn1 dim=512 input=Append(-1,0,1)\n"
+         "attention-relu-renorm-layer name=attention1 num-heads=4 value-dim=32 key-dim=16 num-left-inputs=5 num-right-inputs=2 time-stride=3\n"
+         "output-layer name=output dim=300", (16, 7, 1)),
+        ("input dim=40 name=input\n"
+         "relu-batchnorm-layer name=tdnn1 dim=512 input=Append(-2,-1,0,1,2)\n"
+         "relu-batchnorm-layer name=tdnn2 dim=512 input=Append(-2,0,2)\n"
+         "relu-batchnorm-layer name=tdnn3 dim=512\n"
+         "stats-layer name=stats config=mean+stddev(-99:3:9:99)\n"
+         "relu-batchnorm-layer name=tdnn4 dim=512 input=Append(tdnn3, stats)\n"
+         "output-layer name=output dim=300", (4, 4, 9)),
+        ("input dim=40 name=input\n"
+         "relu-batchnorm-layer name=tdnn1 dim=512 input=Append(Offset(input, -2), Switch(input, Offset(input, 1)))\n"
+         "relu-batchnorm-layer name=tdnn2 dim=512 input=Round(tdnn1, 3)\n"
+         "output-layer name=output dim=300", (4, 1, 6)) ]
+
+    have_binaries = all(
+        any(os.access(os.path.join(path, binary), os.X_OK)
+            for path in os.environ.get('PATH', '').split(os.pathsep))
+        for binary in ['nnet3-init', 'nnet3-info'])
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for (xconfig, expected) in xconfigs:
+            xconfig_file = os.path.join(temp_dir, 'xconfig')
+            with open(xconfig_file, 'w') as f:
+                print(xconfig, file=f)
+            all_layers = xparser.read_xconfig_file(xconfig_file)
+            config_lines = get_config_lines(all_layers)
+            ans = compute_model_context(config_lines)
+            if have_binaries:
+                with open(os.path.join(temp_dir, 'ref.config'), 'w') as f:
+                    print('\n'.join(config_lines), file=f)
+                out = subprocess.check_output(
+                    'nnet3-init {0}/ref.config - | nnet3-info - '
+                    '2>/dev/null'.format(temp_dir), shell=True)
+                info = dict(re.findall(r'^(\S+): (-?\d+)$',
+                                       out.decode(), re.MULTILINE))
+                expected = (int(info['left-context']),
+                            int(info['right-context']),
+                            int(info['modulus']))
+            if ans != expected:
+                print("Error: context of network from xconfig:\n{0}\nis "
+                      "{1}, expected {2}".format(xconfig, ans, expected))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    assert (compute_model_context(
+        ["input-node name=input dim=40",
+         "output-node name=output-0 input=Offset(input, 2)"],
+        nnet_edits="rename-node old-name=output-0 new-name=output") ==
+            (0, 2, 1))
+
+
+if __name__ == "__main__":
+    test_library()
@@ -17,6 +17,7 @@ sys.path.insert(0, 'steps/')
 sys.path.insert(0, os.path.realpath(os.path.dirname(sys.argv[0])) + '/')
 
 import libs.nnet3.xconfig.parser as xparser
+import libs.nnet3.xconfig.context as xcontext
 import libs.common as common_lib
 
 
@@ -50,6 +51,15 @@ def get_args():
                         new-name=output' if node xxx plays the role of the
                         output node in this network.  This is only used for
                         computing the left/right context.""")
+    parser.add_argument('--write-raw-models', type=str, default=True,
+                        action=common_lib.StrToBoolAction,
+                        choices=["true", "false"],
+                        help="""If true, create config-dir/init.raw and
+                        config-dir/ref.raw with nnet3-init (some scripts
+                        expect them to exist).  The left/right context is
+                        worked out without them, unless --existing-model is
+                        given, so this can be set to false to avoid running
+                        any of the nnet3 binaries.""")
 
     print(' '.join(sys.argv), file=sys.stderr)
 
@@ -173,6 +183,8 @@ def get_config_headers():
 
 
 # This is where most of the work of this program happens.
+# It returns a dict from config basename to the lines of the
+# config files that were written.
 def write_config_files(config_dir, all_layers):
     # config_basename_to_lines is map from the basename of the
     # config, as a string (i.e. 'ref', 'all', 'init') to a list of
@@ -201,6 +213,7 @@ def write_config_files(config_dir, all_layers):
     except OSError:
         pass
 
+    written_lines = dict()
     for basename, lines in config_basename_to_lines.items():
         # check the lines num start with 'output-node':
         num_output_node_lines = sum( [ 1 if line.startswith('output-node' ) else 0
@@ -228,18 +241,47 @@ def write_config_files(config_dir, all_layers):
             # we use raise rather than raise(e) as using a blank raise
             # preserves the backtrace
             raise
-
-
-def add_nnet_context_info(config_dir, nnet_edits=None,
-                          existing_model=None):
-    """Create the 'vars' file that specifies model_left_context, etc."""
-
-    common_lib.execute_command("nnet3-init {0} {1}/ref.config "
-                               "{1}/ref.raw"
-                               "".format(existing_model if
-                                         existing_model is not None else "",
-                                         config_dir))
-    model = "{0}/ref.raw".format(config_dir)
+        written_lines[basename] = lines
+    return written_lines
+
+
+def get_model_context(config_dir, config_basename, config_lines,
+                      nnet_edits=None, existing_model=None,
+                      write_raw_model=True):
+    """Returns a dict with the keys 'left-context' and 'right-context' for
+    the model specified in config_dir/{config_basename}.config, whose lines
+    are 'config_lines'.  The context is computed by
+    libs.nnet3.xconfig.context; only if that is not possible (e.g. if the
+    model uses nodes of an existing model) do we create
+    config_dir/{config_basename}.raw with nnet3-init and run nnet3-info on it.
+    If 'write_raw_model' is true, config_dir/{config_basename}.raw is
+    created in any case."""
+    model = "{0}/{1}.raw".format(config_dir, config_basename)
+
+    def init_model():
+        common_lib.execute_command("nnet3-init {0} {1}/{2}.config {3}"
+                                   "".format(existing_model if
+                                             existing_model is not
+                                             None else '',
+                                             config_dir, config_basename,
+                                             model))
+    if write_raw_model:
+        init_model()
+
+    if existing_model is None:
+        try:
+            (left_context, right_context,
+             modulus) = xcontext.compute_model_context(config_lines,
+                                                       nnet_edits)
+            return {'left-context': left_context,
+                    'right-context': right_context}
+        except NotImplementedError as e:
+            print("{0}: {1}; using nnet3-info to get the context of "
+                  "{2}/{3}.config".format(sys.argv[0], str(e), config_dir,
+                                          config_basename), file=sys.stderr)
+
+    if not write_raw_model:
+        init_model()
     if nnet_edits is not None:
         model = "nnet3-copy --edits='{0}' {1} - |".format(nnet_edits,
                                                           model)
@@ -250,51 +292,41 @@ def add_nnet_context_info(config_dir, nnet_edits=None,
     # num-parameters: 90543902
     # modulus: 1
     # ...
-    info = {}
+    context = {}
     for line in out.split("\n")[:4]: # take 4 initial lines,
         parts = line.split(":")
         if len(parts) != 2:
             continue
-        info[parts[0].strip()] = int(parts[1].strip())
+        key = parts[0].strip()
+        value = int(parts[1].strip())
+        if key in ['left-context', 'right-context']:
+            context[key] = value
+    return context
+
+
+def add_nnet_context_info(config_dir, context):
+    """Create the 'vars' file that specifies model_left_context, etc."""
 
     # Writing the 'vars' file:
     #   model_left_context=0
     #   model_right_context=7
     vf = open('{0}/vars'.format(config_dir), 'w')
-    vf.write('model_left_context={0}\n'.format(info['left-context']))
-    vf.write('model_right_context={0}\n'.format(info['right-context']))
+    vf.write('model_left_context={0}\n'.format(context['left-context']))
+    vf.write('model_right_context={0}\n'.format(context['right-context']))
     vf.close()
 
-def check_model_contexts(config_dir, nnet_edits=None, existing_model=None):
+def check_model_contexts(config_dir, config_lines, nnet_edits=None,
+                         existing_model=None, write_raw_models=True):
+    """Returns a dict from 'init' and 'ref' to the context of the models in
+    init.config (if it exists) and ref.config; see get_model_context()."""
     contexts = {}
     for file_name in ['init', 'ref']:
         if os.path.exists('{0}/{1}.config'.format(config_dir, file_name)):
-            contexts[file_name] = {}
-            common_lib.execute_command("nnet3-init {0} {1}/{2}.config "
-                                       "{1}/{2}.raw"
-                                       "".format(existing_model if
-                                                 existing_model is not
-                                                 None else '',
-                                                 config_dir, file_name))
-            model = "{0}/{1}.raw".format(config_dir, file_name)
-            if nnet_edits is not None and file_name != 'init':
-                model = "nnet3-copy --edits='{0}' {1} - |".format(nnet_edits,
-                                                                  model)
-            out = common_lib.get_command_stdout('nnet3-info "{0}"'.format(model))
-            # out looks like this
-            # left-context: 7
-            # right-context: 0
-            # num-parameters: 90543902
-            # modulus: 1
-            # ...
-            for line in out.split("\n")[:4]: # take 4 initial lines,
-                parts = line.split(":")
-                if len(parts) != 2:
-                    continue
-                key = parts[0].strip()
-                value = int(parts[1].strip())
-                if key in ['left-context', 'right-context']:
-                    contexts[file_name][key] = value
+            contexts[file_name] = get_model_context(
+                config_dir, file_name, config_lines[file_name],
+                nnet_edits=(nnet_edits if file_name != 'init' else None),
+                existing_model=existing_model,
+                write_raw_model=write_raw_models)
 
     if 'init' in contexts:
         assert('ref' in contexts)
@@ -311,6 +343,7 @@ def check_model_contexts(config_dir, nnet_edits=None, existing_model=None):
                     " in ref.config. Please use delay=$label_delay in the"
                     " initial fixed-affine-layer of the network, to avoid"
                     " this issue.")
+    return contexts
 
 
 
@@ -322,11 +355,12 @@ def main():
         existing_layers = xparser.get_model_component_info(args.existing_model)
     all_layers = xparser.read_xconfig_file(args.xconfig_file, existing_layers)
     write_expanded_xconfig_files(args.config_dir, all_layers)
-    write_config_files(args.config_dir, all_layers)
-    check_model_contexts(args.config_dir, args.nnet_edits,
-                         existing_model=args.existing_model)
-    add_nnet_context_info(args.config_dir, args.nnet_edits,
-                          existing_model=args.existing_model)
+    config_lines = write_config_files(args.config_dir, all_layers)
+    contexts = check_model_contexts(args.config_dir, config_lines,
+                                    args.nnet_edits,
+                                    existing_model=args.existing_model,
+                                    write_raw_models=args.write_raw_models)
+    add_nnet_context_info(args.config_dir, contexts['ref'])
 
 
 if __name__ == '__main__':
@@ -219,38 +219,38 @@ fi
 cat $dir/phones/align_lexicon.txt | utils/sym2int.pl -f 3- $dir/phones.txt | \
   utils/sym2int.pl -f 1-2 $dir/words.txt > $dir/phones/align_lexicon.int
 
+# The lexicon FSTs are written with integer labels, so that fstcompile does not
+# have to look up the symbols.
+symbol_table_opts="--phone-symbol-table=$dir/phones.txt --word-symbol-table=$dir/words.txt"
+
 # Create the basic L.fst without disambiguation symbols, for use
 # in training.
 if "$silprob"; then
-  utils/lang/make_lexicon_fst_silprob.py $grammar_opts --sil-phone=$silphone \
+  utils/lang/make_lexicon_fst_silprob.py $grammar_opts $symbol_table_opts --sil-phone=$silphone \
          $tmpdir/lexiconp_silprob.txt $silprob_file | \
-      fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-        --keep_isymbols=false --keep_osymbols=false |   \
+      fstcompile |   \
       fstarcsort --sort_type=olabel > $dir/L.fst || exit 1;
 else
-  utils/lang/make_lexicon_fst.py $grammar_opts --sil-prob=$sil_prob --sil-phone=$silphone \
+  utils/lang/make_lexicon_fst.py $grammar_opts $symbol_table_opts --sil-prob=$sil_prob --sil-phone=$silphone \
            $tmpdir/lexiconp.txt | \
-      fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-        --keep_isymbols=false --keep_osymbols=false | \
+      fstcompile | \
       fstarcsort --sort_type=olabel > $dir/L.fst || exit 1;
 fi
 
 
 # and create the version that has disambiguation symbols.
 if "$silprob"; then
-  utils/lang/make_lexicon_fst_silprob.py $grammar_opts \
+  utils/lang/make_lexicon_fst_silprob.py $grammar_opts $symbol_table_opts \
     --sil-phone=$silphone --sil-disambig='#'$ndisambig \
     $tmpdir/lexiconp_silprob_disambig.txt $silprob_file | \
-    fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-      --keep_isymbols=false --keep_osymbols=false |   \
+    fstcompile |   \
     fstaddselfloops  $dir/phones/wdisambig_phones.int $dir/phones/wdisambig_words.int | \
     fstarcsort --sort_type=olabel > $dir/L_disambig.fst || exit 1;
 else
-  utils/lang/make_lexicon_fst.py $grammar_opts \
+  utils/lang/make_lexicon_fst.py $grammar_opts $symbol_table_opts \
     --sil-prob=$sil_prob --sil-phone=$silphone --sil-disambig='#'$ndisambig \
        $tmpdir/lexiconp_disambig.txt | \
-     fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-                --keep_isymbols=false --keep_osymbols=false | \
+     fstcompile | \
      fstaddselfloops $dir/phones/wdisambig_phones.int $dir/phones/wdisambig_words.int | \
      fstarcsort --sort_type=olabel > $dir/L_disambig.fst || exit 1;
 fi
@@ -8,6 +8,8 @@ from __future__ import division
 import sys
 import argparse
 import math
+import bisect
+from array import array
 from collections import defaultdict
 
 # note, this was originally based
@@ -45,31 +47,62 @@ if args.verbose >= 1:
     print(' '.join(sys.argv), file = sys.stderr)
 
 
-class HistoryState(object):
-    def __init__(self):
-        # note: neither backoff_prob nor the floats
-        # in word_to_prob are in log space.
-        self.backoff_prob = 1.0
-        # will be a dict from string to float.  the prob is
-        # the actual probability of the word, including any probability
-        # mass from backoff (they get added together while writing out
-        # the arpa, and these probs are read in from the arpa).
-        self.word_to_prob = dict()
-
-
 class ArpaModel(object):
     def __init__(self):
-        # self.orders is indexed by history-length [i.e. 0 for unigram,
-        # 1 for bigram and so on], and is then a dict indexed
-        # by tuples of history-words.  E.g. for trigrams, we'd index
-        # it as self.orders[2][('a', 'b')].
-        # The value-type of the dict is HistoryState.  E.g. to set the
-        # probability of the trigram a b -> c to 0.2, we'd do
-        # self.orders[2][('a', 'b')].word_to_prob['c'] = 0.2
-        self.orders = []
+        # The words are interned as integer ids: self.words maps from id to
+        # word and self.word_to_id from word to id.
+        self.words = []
+        self.word_to_id = dict()
+        # The following are indexed by history-length [i.e. 0 for unigram,
+        # 1 for bigram and so on].
+        # self.hist_to_index[n] is a dict from the history (as a tuple of word
+        # ids) to a history index, in the order in which the histories were
+        # first seen.  E.g. for trigrams, we'd index it as
+        # self.hist_to_index[2][(a, b)], where a and b are word ids.
+        self.hist_to_index = []
+        # self.backoff_probs[n] is an array, indexed by history index, of the
+        # backoff probs of the histories (1.0 if not given in the ARPA).
+        self.backoff_probs = []
+        # self.ngram_keys[n] is a sorted array of the n-grams with
+        # history-length n, each encoded as (history-index * vocab-size +
+        # word-id), and self.ngram_probs[n] is the array of their
+        # probabilities.  The n-grams of a history are thus contiguous and
+        # sorted by word id.
+        # note: neither the backoff probs nor the n-gram probs are in log
+        # space.  the n-gram prob is the actual probability of the word,
+        # including any probability mass from backoff (they get added together
+        # while writing out the arpa, and these probs are read in from the
+        # arpa).
+        self.ngram_keys = []
+        self.ngram_probs = []
+        # the number of words in the ARPA file; the n-gram keys are computed
+        # with it.
+        self.vocab_size = 0
+        # the word ids in the order in which they appear in the unigram
+        # section.
+        self.unigram_words = []
+
+    def GetWordId(self, word):
+        word_id = self.word_to_id.get(word)
+        if word_id is None:
+            word_id = len(self.words)
+            self.word_to_id[word] = word_id
+            self.words.append(word)
+        return word_id
+
+    # Returns the index of history 'hist' (a tuple of word ids) in
+    # self.hist_to_index[len(hist)], creating it if it does not exist.
+    def GetHistIndex(self, hist):
+        hist_to_index = self.hist_to_index[len(hist)]
+        index = hist_to_index.get(hist)
+        if index is None:
+            index = len(hist_to_index)
+            hist_to_index[hist] = index
+            self.backoff_probs[len(hist)].append(1.0)
+        return index
 
     def Read(self, arpa_in):
-        assert len(self.orders) == 0
+        assert len(self.hist_to_index) == 0
         log10 = math.log(10.0)
         if arpa_in == "" or arpa_in == "-":
             arpa_in = "/dev/stdin"
@@ -101,12 +134,18 @@ class ArpaModel(object):
                     sys.argv[0], arpa_in, line[:-1]))
             max_order = int(a[0])
 
-
+        # the n-grams of each history-length, in the order they were read, as
+        # arrays of history index, word id and probability.
+        ngram_hists = []
+        ngram_words = []
+        ngram_probs = []
         for n in range(max_order):
-            # self.orders[n], indexed by history-length (length of the
-            # history-vector, == order-1), is a map from history as a tuple
-            # of strings, to class HistoryState.
-            self.orders.append(defaultdict(lambda: HistoryState()))
+            self.hist_to_index.append(dict())
+            self.backoff_probs.append(array('d'))
+            ngram_hists.append(array('l'))
+            ngram_words.append(array('l'))
+            ngram_probs.append(array('d'))
+        self.GetHistIndex(())
 
         cur_order = 0
         while True:
@@ -115,7 +154,7 @@ class ArpaModel(object):
                 sys.exit("{0}: reading {1}, found EOF while looking for \\end\\ marker.".format(
                     sys.argv[0], arpa_in))
             elif line[0:5] == '\\end\\':
-                if len(self.orders) == 0:
+                if len(self.hist_to_index) == 0:
                     sys.exit("{0}: reading {1}, read no n-grams.".format(sys.argv[0], arpa_in))
                 break
             else:
@@ -140,17 +179,20 @@ class ArpaModel(object):
                             sys.argv[0], arpa_in, cur_order, line[:-1]))
                     try:
                         prob = math.exp(float(a[0]) * log10)
-                        hist = tuple(a[1:cur_order])  # tuple of strings
-                        word = a[cur_order]  # a string
+                        hist = tuple([ self.GetWordId(x) for x in a[1:cur_order] ])
+                        word = self.GetWordId(a[cur_order])
                         backoff_prob = math.exp(float(a[cur_order+1]) * log10) if l == cur_order + 2 else None
                     except Exception as e:
                         sys.exit("{0}: reading {1}: in {2}-grams section, got bad "
                                  "line (exception is: {3}): {4}".format(
                                      sys.argv[0], arpa_in, cur_order,
                                      str(type(e)) + ',' + str(e), line[:-1]))
-                    self.orders[cur_order-1][hist].word_to_prob[word] = prob
+                    ngram_hists[cur_order-1].append(self.GetHistIndex(hist))
+                    ngram_words[cur_order-1].append(word)
+                    ngram_probs[cur_order-1].append(prob)
                     if backoff_prob != None:
-                        self.orders[cur_order][hist + (word,)].backoff_prob = backoff_prob
+                        index = self.GetHistIndex(hist + (word,))
+                        self.backoff_probs[cur_order][index] = backoff_prob
 
         if args.verbose >= 2:
             print("{0}: read {1}-gram model from {2}".format(
@@ -161,26 +203,108 @@ class ArpaModel(object):
             sys.exit("{0}: this script does not work when the ARPA language model "
                      "is unigram.".format(sys.argv[0]))
 
-    # Returns the probability of word 'word' in history-state 'hist'.
-    # Dies with error if this word is not predicted at all by the LM (not in vocab).
-    # history-state does not exist.
-    def GetProb(self, hist, word):
-        assert len(hist) < len(self.orders)
+        # sort the n-grams of each history-length by (history, word); if an
+        # n-gram appears more than once, the last one read is kept.
+        self.vocab_size = len(self.words)
+        self.unigram_words = list(dict.fromkeys(ngram_words[0]))
+        for n in range(max_order):
+            keys = [ h * self.vocab_size + w
+                     for h, w in zip(ngram_hists[n], ngram_words[n]) ]
+            probs = ngram_probs[n]
+            sorted_keys = array('q')
+            sorted_probs = array('d')
+            for i in sorted(range(len(keys)), key = keys.__getitem__):
+                if len(sorted_keys) > 0 and sorted_keys[-1] == keys[i]:
+                    sorted_probs[-1] = probs[i]
+                else:
+                    sorted_keys.append(keys[i])
+                    sorted_probs.append(probs[i])
+            self.ngram_keys.append(sorted_keys)
+            self.ngram_probs.append(sorted_probs)
+            ngram_hists[n] = ngram_words[n] = ngram_probs[n] = None
+
+    # Returns the range [begin, end) of the positions in self.ngram_keys[n]
+    # of the n-grams of the history with index 'index' in
+    # self.hist_to_index[n].
+    def GetNgramRange(self, n, index):
+        keys = self.ngram_keys[n]
+        begin = bisect.bisect_left(keys, index * self.vocab_size)
+        end = bisect.bisect_left(keys, (index + 1) * self.vocab_size, begin)
+        return (begin, end)
+
+    # Returns the probability of the n-gram with word-id 'word' in the
+    # history with index 'index' in self.hist_to_index[n], or None if there is
+    # no such n-gram.
+    def GetNgramProb(self, n, index, word):
+        if word >= self.vocab_size:
+            return None
+        keys = self.ngram_keys[n]
+        key = index * self.vocab_size + word
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return self.ngram_probs[n][i]
+        return None
+
+    # Returns the list of probabilities of the words in 'words' (a list of word
+    # ids) in history-state 'hist' (a tuple of word ids).  The back-off is
+    # done for all words not predicted in a history-state together.
+    # Dies with error if one of the words is not predicted at all by the LM
+    # (not in vocab).
+    def GetProbs(self, hist, words):
+        assert len(hist) < len(self.hist_to_index)
         if len(hist) == 0:
-            word_to_prob = self.orders[0][()].word_to_prob
-            if not word in word_to_prob:
-                sys.exit("{0}: no probability in unigram for word {1}".format(
-                    sys.argv[0], word))
-            return word_to_prob[word]
+            ans = []
+            for word in words:
+                prob = self.GetNgramProb(0, 0, word)
+                if prob is None:
+                    sys.exit("{0}: no probability in unigram for word {1}".format(
+                        sys.argv[0], self.words[word]))
+                ans.append(prob)
+            return ans
+        index = self.hist_to_index[len(hist)].get(hist)
+        if index is None:
+            return self.GetProbs(hist[1:], words)
+        ans = [ self.GetNgramProb(len(hist), index, word) for word in words ]
+        backoff_positions = [ i for i in range(len(ans)) if ans[i] is None ]
+        if len(backoff_positions) > 0:
+            backoff_prob = self.backoff_probs[len(hist)][index]
+            lower_order_probs = self.GetProbs(
+                hist[1:], [ words[i] for i in backoff_positions ])
+            for i, prob in zip(backoff_positions, lower_order_probs):
+                ans[i] = backoff_prob * prob
+        return ans
+
+    # Returns the sum of the probabilities in history-state 'hist' (a tuple of
+    # word ids) of the words allowed by the bigram constraints to follow
+    # hist[-1].  This is just for diagnostics.  For a history-state of
+    # higher order than bigram, it is computed from the sum for the backed-off
+    # history-state, so that only the probabilities of the n-grams
+    # explicitly present in the ARPA need to be looked up.
+    def GetAllowedProbSum(self, hist, allowed_words, prob_sums):
+        if hist in prob_sums:
+            return prob_sums[hist]
+        if len(hist) == 1:
+            ans = sum(self.GetProbs(hist, allowed_words[hist[0]][0]))
+        elif not hist in self.hist_to_index[len(hist)]:
+            ans = self.GetAllowedProbSum(hist[1:], allowed_words, prob_sums)
         else:
-            if hist in self.orders[len(hist)]:
-                hist_state = self.orders[len(hist)][hist]
-                if word in hist_state.word_to_prob:
-                    return hist_state.word_to_prob[word]
-                else:
-                    return hist_state.backoff_prob * self.GetProb(hist[1:], word)
-            else:
-                return self.GetProb(hist[1:], word)
+            n = len(hist)
+            index = self.hist_to_index[n][hist]
+            allowed_set = allowed_words[hist[-1]][1]
+            (begin, end) = self.GetNgramRange(n, index)
+            base = index * self.vocab_size
+            words = []
+            probs = []
+            for i in range(begin, end):
+                word = self.ngram_keys[n][i] - base
+                if word in allowed_set:
+                    words.append(word)
+                    probs.append(self.ngram_probs[n][i])
+            ans = sum(probs) + self.backoff_probs[n][index] * (
+                self.GetAllowedProbSum(hist[1:], allowed_words, prob_sums) -
+                sum(self.GetProbs(hist[1:], words)))
+        prob_sums[hist] = ans
+        return ans
 
     # This gets the state corresponding to 'hist' in 'hist_to_state', but backs
     # off for us if there is no such state.
@@ -192,13 +316,14 @@ class ArpaModel(object):
                 # this would likely be a code error, but possibly an error
                 # in the ARPA file
                 sys.exit("{0}: error processing histories: history-state {1} "
-                         "does not exist.".format(sys.argv[0], hist))
+                         "does not exist.".format(sys.argv[0],
+                             tuple([ self.words[w] for w in hist ])))
             return self.GetStateForHist(hist_to_state, hist[1:])
 
 
     def GetHistToStateMap(self):
         # This function, called from PrintAsFst, returns (hist_to_state,
-        # state_to_hist), which map from history (as a tuple of strings) to
+        # state_to_hist), which map from history (as a tuple of word ids) to
         # integer FST-state and vice versa.
 
         hist_to_state = dict()
@@ -207,16 +332,16 @@ class ArpaModel(object):
         # Make sure the initial bigram state comes first (and that
         # we have such a state even if it was completely pruned
         # away in the bigram LM.. which is unlikely of course)
-        hist = ('<s>',)
+        hist = (self.GetWordId('<s>'),)
         hist_to_state[hist] = len(state_to_hist)
         state_to_hist.append(hist)
 
         # create a bigram state for each of the 'real' words...  even if the LM
         # didn't naturally have such bigram states, we'll create them so that we
         # can enforce the bigram constraints supplied in 'bigrams_file' by the
-        # user.
-        for word in self.orders[0][()].word_to_prob:
-            if word != '<s>' and word != '</s>':
+        # user.  The words are listed in the order of the unigram section.
+        for word in self.unigram_words:
+            if self.words[word] != '<s>' and self.words[word] != '</s>':
                 hist = (word,)
                 hist_to_state[hist] = len(state_to_hist)
                 state_to_hist.append(hist)
@@ -225,9 +350,9 @@ class ArpaModel(object):
         # we don't have a unigram state in the output FST, only bigram states; and
         # we don't iterate over bigram histories because we covered them all above;
         # that's why we start 'n' from 2 below instead of from 0.
-        for n in range(2, len(self.orders)):
-            for hist in self.orders[n].keys():
-                # note: hist is a tuple of strings.
+        for n in range(2, len(self.hist_to_index)):
+            for hist in self.hist_to_index[n].keys():
+                # note: hist is a tuple of word ids.
                 assert not hist in hist_to_state
                 hist_to_state[hist] = len(state_to_hist)
                 state_to_hist.append(hist)
@@ -243,72 +368,89 @@ class ArpaModel(object):
         # History will map from history (as a tuple) to integer FST-state.
         (hist_to_state, state_to_hist) = self.GetHistToStateMap()
 
+        # allowed_words maps from left-word id to a pair (list, set) of the ids
+        # of the right-words; the list is sorted so that the arcs are printed
+        # in a deterministic order.
+        allowed_words = defaultdict(lambda: ([], set()))
+        for left_word, right_words in bigram_map.items():
+            word_ids = sorted([ self.GetWordId(x) for x in right_words ])
+            allowed_words[self.GetWordId(left_word)] = (word_ids, set(word_ids))
 
         # The following 3 things are just for diagnostics.
-        normalization_stats = [ [0, 0.0] for x in range(len(self.orders)) ]
+        normalization_stats = [ [0, 0.0] for x in range(len(self.hist_to_index)) ]
         num_ngrams_allowed = 0
         num_ngrams_disallowed = 0
+        prob_sums = dict()
 
+        # the lines of the FST are buffered and written out in blocks.
+        output = []
         for state in range(len(state_to_hist)):
             hist = state_to_hist[state]
             hist_len = len(hist)
             assert hist_len > 0
             if hist_len == 1:  # it's a bigram state...
                 context_word = hist[0]
-                if not context_word in bigram_map:
+                if not context_word in allowed_words:
                     print("{0}: warning: word {1} appears in ARPA but is not listed "
                           "as a left context in the bigram map".format(
-                              sys.argv[0], context_word), file = sys.stderr)
+                              sys.argv[0], self.words[context_word]), file = sys.stderr)
                     continue
                 # word list is a list of words that can follow this word.  It must be nonempty.
-                word_list = list(bigram_map[context_word])
+                word_list = allowed_words[context_word][0]
+
+                # the probabilities of all the words are looked up together.
+                prob_list = self.GetProbs(hist, word_list)
+                prob_sums[hist] = sum(prob_list)
 
                 normalization_stats[hist_len][0] += 1
+                normalization_stats[hist_len][1] += prob_sums[hist]
 
-                for word in word_list:
-                    prob = self.GetProb((context_word,), word)
+                for word, prob in zip(word_list, prob_list):
                     assert prob != 0
-                    normalization_stats[hist_len][1] += prob
                     cost = -math.log(prob)
+                    word_str = self.words[word]
                     if abs(cost) < 0.01 and args.verbose >= 3:
                         print("{0}: warning: very small cost {1} for {2}->{3}".format(
-                            sys.argv[0], cost, context_word, word), file=sys.stderr)
-                    if word == '</s>':
+                            sys.argv[0], cost, self.words[context_word], word_str),
+                              file=sys.stderr)
+                    if word_str == '</s>':
                         # print the final-prob of this state.
-                        print("%d %.3f" % (state, cost))
+                        output.append("%d %.3f\n" % (state, cost))
                     else:
                         next_state = self.GetStateForHist(hist_to_state,
                                                           (context_word, word))
-                        print("%d %d %s %s %.3f" %
-                              (state, next_state, word, word, cost))
+                        output.append("%d %d %s %s %.3f\n" %
+                                      (state, next_state, word_str, word_str, cost))
             else:  # it's a higher-order than bigram state.
-                assert hist in self.orders[hist_len]
-                hist_state = self.orders[hist_len][hist]
-                most_recent_word = hist[-1]
+                index = self.hist_to_index[hist_len][hist]
+                allowed_set = allowed_words[hist[-1]][1]
 
                 normalization_stats[hist_len][0] += 1
                 normalization_stats[hist_len][1] += \
-                  sum([ self.GetProb(hist, word) for word in bigram_map[most_recent_word]])
+                  self.GetAllowedProbSum(hist, allowed_words, prob_sums)
 
-                for word, prob in hist_state.word_to_prob.items():
-                    cost = -math.log(prob)
-                    if word in bigram_map[most_recent_word]:
+                (begin, end) = self.GetNgramRange(hist_len, index)
+                base = index * self.vocab_size
+                for i in range(begin, end):
+                    word = self.ngram_keys[hist_len][i] - base
+                    if word in allowed_set:
                         num_ngrams_allowed += 1
                     else:
                         num_ngrams_disallowed += 1
                         continue
-                    if word == '</s>':
+                    cost = -math.log(self.ngram_probs[hist_len][i])
+                    word_str = self.words[word]
+                    if word_str == '</s>':
                         # print the final-prob of this state.
-                        print("%d %.3f" % (state, cost))
+                        output.append("%d %.3f\n" % (state, cost))
                     else:
                         next_state = self.GetStateForHist(hist_to_state,
-                                                          (hist) + (word,))
-                        print("%d %d %s %s %.3f" %
-                              (state, next_state, word, word, cost))
+                                                          hist + (word,))
+                        output.append("%d %d %s %s %.3f\n" %
+                                      (state, next_state, word_str, word_str, cost))
                 # Now deal with the backoff probability of this state (back off
                 # to the lower-order state).
-                assert hist in self.orders[hist_len]
-                backoff_prob = self.orders[hist_len][hist].backoff_prob
+                backoff_prob = self.backoff_probs[hist_len][index]
                 assert backoff_prob != 0.0
                 cost = -math.log(backoff_prob)
                 backoff_hist = hist[1:]
@@ -316,15 +458,21 @@ class ArpaModel(object):
                 # note: we only print the disambig symbol on the input side.
                 if args.verbose >= 3 and abs(cost) < 0.001:
                     print("{0}: very low backoff cost {1} for history {2}, state = {3}".format(
-                        sys.argv[0], cost, str(hist), state), file = sys.stderr)
+                        sys.argv[0], cost, str(tuple([ self.words[w] for w in hist ])),
+                        state), file = sys.stderr)
 
                 # For hist-states that completely back off (they have no words coming out of them),
                 # there is no need to disambiguate, we can print an epsilon that will later be removed.
-                this_disambig_symbol = disambig_symbol if len(hist_state.word_to_prob) != 0 else '<eps>'
-                print("%d %d %s <eps> %.3f" %
-                      (state, backoff_state, this_disambig_symbol, cost))
+                this_disambig_symbol = disambig_symbol if end != begin else '<eps>'
+                output.append("%d %d %s <eps> %.3f\n" %
+                              (state, backoff_state, this_disambig_symbol, cost))
+            if len(output) >= 10000:
+                sys.stdout.write(''.join(output))
+                output = []
+        sys.stdout.write(''.join(output))
+
         if args.verbose >= 1:
-            for hist_len in range(1, len(self.orders)):
+            for hist_len in range(1, len(self.hist_to_index)):
                 num_states = normalization_stats[hist_len][0]
                 avg_prob_sum = normalization_stats[hist_len][1] / num_states if num_states > 0 else 0.0
                 print("{0}: for {1}-gram states, over {2} states the average sum of "
@@ -365,7 +513,7 @@ def ReadBigramMap(bigrams_file):
         [word1, word2] = a
         if word1 in ans and word2 in ans[word1]:
             sys.exit("{0}: bigrams file contained duplicate entry: {1} {2}".format(
-                sys.argv[0], word1, word2), file = sys.stderr)
+                sys.argv[0], word1, word2))
         if word2 == '<s>' or word1 == '</s>':
             sys.exit("{0}: bad sequence of BOS/EOS symbols: {1} {2}".format(
                 sys.argv[0], word1, word2))
@@ -9,6 +9,8 @@ import os
 import sys
 import math
 import re
+from collections import deque
+from multiprocessing import Pool
 
 # The use of latin-1 encoding does not preclude reading utf-8.  latin-1
 # encoding means "treat words as sequences of bytes", and it is compatible
@@ -23,7 +25,9 @@ def get_args():
        text form of a lexicon FST, to be compiled by fstcompile using the
        appropriate symbol tables (phones.txt and words.txt) .  It will mostly
        be invoked indirectly via utils/prepare_lang.sh.  The output goes to
-       the stdout.""")
+       the stdout.  If --phone-symbol-table and --word-symbol-table are
+       supplied, the labels are written as integers, so the output can be
+       compiled by fstcompile without the symbol tables.""")
 
     parser.add_argument('--sil-phone', dest='sil_phone', type=str,
                         help="""Text form of optional-silence phone, e.g. 'SIL'.  See also
@@ -49,6 +53,18 @@ def get_args():
                         help="""If supplied, --left-context-phones must also be supplied.
                         List of user-defined nonterminal symbols such as #nonterm:contact_list,
                         one per line.  E.g. data/local/dict/nonterminals.txt.""")
+    parser.add_argument('--phone-symbol-table', dest='phone_symbol_table', type=str,
+                        help="""If supplied, the phone symbol table (e.g. data/lang/phones.txt),
+                        which is used to write the phones as integers.  Must be supplied
+                        together with --word-symbol-table.""")
+    parser.add_argument('--word-symbol-table', dest='word_symbol_table', type=str,
+                        help="""If supplied, the word symbol table (e.g. data/lang/words.txt),
+                        which is used to write the words as integers.  Must be supplied
+                        together with --phone-symbol-table.""")
+    parser.add_argument('--num-jobs', dest='num_jobs', type=int, default=1,
+                        help="""Number of processes over which the formatting of the
+                        arcs for the pronunciations is split.  The output does not
+                        depend on this.""")
     parser.add_argument('lexiconp', type=str,
                         help="""Filename of lexicon with pronunciation probabilities
                         (normally lexiconp.txt), with lines of the form 'word prob p1 p2...',
@@ -57,6 +73,69 @@ def get_args():
     return args
 
 
+# The symbol tables for phones and words, as dicts from symbol to integer label
+# (as a string), or None if the labels are written in text form.  See
+# set_symbol_tables().
+phone_symbols = None
+word_symbols = None
+
+# The number of pronunciations whose arcs are formatted at a time (by a single
+# process, if --num-jobs > 1) and written to the output in one go.
+prons_per_chunk = 10000
+
+
+def read_symbol_table(filename):
+    """Reads a symbol table such as phones.txt or words.txt, with lines of the
+    form 'symbol integer-id', and returns it as a dict from symbol to the
+    integer id as a string, e.g. {'<eps>': '0', 'a': '1', ... }."""
+    ans = {}
+    with open(filename, 'r', encoding='latin-1') as f:
+        for line in f:
+            a = line.split()
+            if len(a) != 2 or not a[1].isdigit():
+                raise RuntimeError("Bad line '{0}' in symbol table {1}".format(
+                    line.strip(" \t\r\n"), filename))
+            ans[a[0]] = a[1]
+    return ans
+
+
+def set_symbol_tables(phone_table, word_table):
+    """Sets the symbol tables used by phone_label() and word_label(); they
+    are either both None, or dicts as returned by read_symbol_table()."""
+    global phone_symbols, word_symbols
+    phone_symbols = phone_table
+    word_symbols = word_table
+
+
+def phone_label(phone):
+    """Returns the label written in the output for the phone (or disambiguation
+    symbol, or '<eps>') 'phone'."""
+    if phone_symbols is None:
+        return phone
+    try:
+        return phone_symbols[phone]
+    except KeyError:
+        raise RuntimeError("The phone '{0}' is not in the phone symbol "
+                           "table".format(phone))
+
+
+def word_label(word):
+    """Returns the label written in the output for the word 'word'."""
+    if word_symbols is None:
+        return word
+    try:
+        return word_symbols[word]
+    except KeyError:
+        raise RuntimeError("The word '{0}' is not in the word symbol "
+                           "table".format(word))
+
+
+def format_arc(src, dest, phone, word, cost):
+    """Returns the text form of an arc of L.fst, without the newline."""
+    return "{0}\t{1}\t{2}\t{3}\t{4}".format(
+        src, dest, phone_label(phone), word_label(word), cost)
+
+
 def read_lexiconp(filename):
     """Reads the lexiconp.txt file in 'filename', with lines like 'word pron p1 p2 ...'.
     Returns a list of tuples (word, pron_prob, pron), where 'word' is a string,
@@ -139,13 +218,13 @@ def write_nonterminal_arcs(start_state, loop_state, next_state,
     final_state = next_state
     next_state += 1
 
-    print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+    print(format_arc(
         src=start_state, dest=shared_state,
         phone='#nonterm_begin', word='#nonterm_begin',
         cost=0.0))
 
     for nonterminal in nonterminals:
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+        print(format_arc(
             src=loop_state, dest=shared_state,
             phone=nonterminal, word=nonterminal,
             cost=0.0))
@@ -157,11 +236,11 @@ def write_nonterminal_arcs(start_state, loop_state, next_state,
     this_cost = -math.log(1.0 / len(left_context_phones))
 
     for left_context_phone in left_context_phones:
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+        print(format_arc(
             src=shared_state, dest=loop_state,
             phone=left_context_phone, word='<eps>', cost=this_cost))
     # arc from loop-state to a final-state with #nonterm_end as ilabel and olabel
-    print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+    print(format_arc(
         src=loop_state, dest=final_state,
         phone='#nonterm_end', word='#nonterm_end', cost=0.0))
     print("{state}\t{final_cost}".format(
@@ -169,8 +248,94 @@ def write_nonterminal_arcs(start_state, loop_state, next_state,
     return next_state
 
 
+def format_lexicon_arcs(lexicon, next_state, loop_state, sil_state=None,
+                        no_sil_cost=None, sil_cost=None):
+    """Returns, as a string, the text form of the arcs of L.fst for the
+    pronunciations in 'lexicon' (a list of 3-tuples (word, pron-prob, prons) as
+    returned by read_lexiconp()).  The states for the phones in the
+    pronunciations are allocated starting from 'next_state'; a pronunciation
+    with n phones uses max(n - 1, 0) of them.
+    If 'sil_state' is None there is no optional silence and the pronunciations
+    start and end at 'loop_state' (see write_fst_no_silence()); otherwise they
+    end with an arc to 'loop_state' with cost 'no_sil_cost' and an arc to
+    'sil_state' with cost 'sil_cost' (see write_fst_with_silence()).
+    """
+    eps_phone = phone_label('<eps>')
+    eps_word = word_label('<eps>')
+    loop_state = str(loop_state)
+    sil_state = (str(sil_state) if sil_state is not None else None)
+    # the end of the arcs for the phones after the first one.
+    no_word_suffix = '\t' + eps_word + '\t0.0\n'
+    lines = []
+    for (word, pronprob, pron) in lexicon:
+        cost = -math.log(pronprob)
+        word = word_label(word)
+        if len(pron) > 1:
+            cur_state = str(next_state)
+            next_state += 1
+            lines.append(loop_state + '\t' + cur_state + '\t' + phone_label(pron[0]) +
+                         '\t' + word + '\t' + str(cost) + '\n')
+            for phone in pron[1:-1]:
+                new_state = str(next_state)
+                next_state += 1
+                lines.append(cur_state + '\t' + new_state + '\t' + phone_label(phone) +
+                             no_word_suffix)
+                cur_state = new_state
+            word = eps_word
+            cost = 0.0
+        else:
+            cur_state = loop_state
+        # note: the pron may be empty.
+        phone = (phone_label(pron[-1]) if len(pron) > 0 else eps_phone)
+        if sil_state is None:
+            lines.append(cur_state + '\t' + loop_state + '\t' + phone + '\t' +
+                         word + '\t' + str(cost) + '\n')
+        else:
+            lines.append(cur_state + '\t' + loop_state + '\t' + phone + '\t' +
+                         word + '\t' + str(no_sil_cost + cost) + '\n')
+            lines.append(cur_state + '\t' + sil_state + '\t' + phone + '\t' +
+                         word + '\t' + str(sil_cost + cost) + '\n')
+    return ''.join(lines)
+
+
+def format_lexicon_arcs_for_chunk(args):
+    """Wrapper of format_lexicon_arcs() for use with Pool.apply_async()."""
+    return format_lexicon_arcs(*args)
+
+
+def write_lexicon_arcs(lexicon, next_state, num_jobs, *args):
+    """Writes to the standard output the arcs for the pronunciations in
+    'lexicon', as formatted by format_lexicon_arcs(lexicon, next_state, *args).
+    The lexicon is formatted in chunks of prons_per_chunk pronunciations,
+    which are distributed over 'num_jobs' processes if num_jobs > 1; the
+    state numbers of each chunk follow from the lengths of the pronunciations
+    in the chunks before it.  Returns the updated next_state."""
+    chunks = []
+    for start in range(0, len(lexicon), prons_per_chunk):
+        chunk = lexicon[start:start + prons_per_chunk]
+        chunks.append((chunk, next_state) + args)
+        next_state += sum([max(len(pron) - 1, 0)
+                           for (word, pronprob, pron) in chunk])
+    if num_jobs > 1:
+        # at most 2 * num_jobs chunks are kept in memory.
+        with Pool(num_jobs, initializer=set_symbol_tables,
+                  initargs=(phone_symbols, word_symbols)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(format_lexicon_arcs_for_chunk,
+                                                 (chunk,)))
+                if len(pending) >= 2 * num_jobs:
+                    sys.stdout.write(pending.popleft().get())
+            while pending:
+                sys.stdout.write(pending.popleft().get())
+    else:
+        for chunk in chunks:
+            sys.stdout.write(format_lexicon_arcs_for_chunk(chunk))
+    return next_state
+
 
-def write_fst_no_silence(lexicon, nonterminals=None, left_context_phones=None):
+def write_fst_no_silence(lexicon, nonterminals=None, left_context_phones=None,
+                         num_jobs=1):
     """Writes the text format of L.fst to the standard output.  This version is for
     when --sil-prob=0.0, meaning there is no optional silence allowed.
 
@@ -182,30 +347,13 @@ def write_fst_no_silence(lexicon, nonterminals=None, left_context_phones=None):
      'left_context_phones', which also relates to grammar decoding, and must be
         supplied if 'nonterminals' is supplied is either None or a list of
         phones that may appear as left-context, e.g. ['a', 'ah', ... '#nonterm_bos'].
+     'num_jobs' is the number of processes used to format the arcs for the
+        lexicon; see write_lexicon_arcs().
     """
 
     loop_state = 0
     next_state = 1  # the next un-allocated state, will be incremented as we go.
-    for (word, pronprob, pron) in lexicon:
-        cost = -math.log(pronprob)
-        cur_state = loop_state
-        for i in range(len(pron) - 1):
-            print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-                src=cur_state,
-                dest=next_state,
-                phone=pron[i],
-                word=(word if i == 0 else '<eps>'),
-                cost=(cost if i == 0 else 0.0)))
-            cur_state = next_state
-            next_state += 1
-
-        i = len(pron) - 1  # note: i == -1 if pron is empty.
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=cur_state,
-            dest=loop_state,
-            phone=(pron[i] if i >= 0 else '<eps>'),
-            word=(word if i <= 0 else '<eps>'),
-            cost=(cost if i <= 0 else 0.0)))
+    next_state = write_lexicon_arcs(lexicon, next_state, num_jobs, loop_state)
 
     if nonterminals is not None:
         next_state = write_nonterminal_arcs(
@@ -218,7 +366,8 @@ def write_fst_no_silence(lexicon, nonterminals=None, left_context_phones=None):
 
 
 def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
-                           nonterminals=None, left_context_phones=None):
+                           nonterminals=None, left_context_phones=None,
+                           num_jobs=1):
     """Writes the text format of L.fst to the standard output.  This version is for
        when --sil-prob != 0.0, meaning there is optional silence
      'lexicon' is a list of 3-tuples (word, pron-prob, prons)
@@ -233,6 +382,8 @@ def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
      'left_context_phones', which also relates to grammar decoding, and must be
         supplied if 'nonterminals' is supplied is either None or a list of
         phones that may appear as left-context, e.g. ['a', 'ah', ... '#nonterm_bos'].
+     'num_jobs' is the number of processes used to format the arcs for the
+        lexicon; see write_lexicon_arcs().
     """
 
     assert sil_prob > 0.0 and sil_prob < 1.0
@@ -246,52 +397,29 @@ def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
     next_state = 3  # the next un-allocated state, will be incremented as we go.
 
 
-    print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+    print(format_arc(
         src=start_state, dest=loop_state,
         phone='<eps>', word='<eps>', cost=no_sil_cost))
-    print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+    print(format_arc(
         src=start_state, dest=sil_state,
         phone='<eps>', word='<eps>', cost=sil_cost))
     if sil_disambig is None:
-        print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+        print(format_arc(
             src=sil_state, dest=loop_state,
             phone=sil_phone, word='<eps>', cost=0.0))
     else:
         sil_disambig_state = next_state
         next_state += 1
-        print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+        print(format_arc(
             src=sil_state, dest=sil_disambig_state,
             phone=sil_phone, word='<eps>', cost=0.0))
-        print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+        print(format_arc(
             src=sil_disambig_state, dest=loop_state,
             phone=sil_disambig, word='<eps>', cost=0.0))
 
 
-    for (word, pronprob, pron) in lexicon:
-        pron_cost = -math.log(pronprob)
-        cur_state = loop_state
-        for i in range(len(pron) - 1):
-            print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-                src=cur_state, dest=next_state,
-                phone=pron[i],
-                word=(word if i == 0 else '<eps>'),
-                cost=(pron_cost if i == 0 else 0.0)))
-            cur_state = next_state
-            next_state += 1
-
-        i = len(pron) - 1  # note: i == -1 if pron is empty.
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=cur_state,
-            dest=loop_state,
-            phone=(pron[i] if i >= 0 else '<eps>'),
-            word=(word if i <= 0 else '<eps>'),
-            cost=no_sil_cost + (pron_cost if i <= 0 else 0.0)))
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=cur_state,
-            dest=sil_state,
-            phone=(pron[i] if i >= 0 else '<eps>'),
-            word=(word if i <= 0 else '<eps>'),
-            cost=sil_cost + (pron_cost if i <= 0 else 0.0)))
+    next_state = write_lexicon_arcs(lexicon, next_state, num_jobs, loop_state,
+                                    sil_state, no_sil_cost, sil_cost)
 
     if nonterminals is not None:
         next_state = write_nonterminal_arcs(
@@ -375,10 +503,23 @@ def main():
         nonterminals = read_nonterminals(args.nonterminals)
         left_context_phones = read_left_context_phones(args.left_context_phones)
 
+    if (args.phone_symbol_table is None) != (args.word_symbol_table is None):
+        print("{0}: --phone-symbol-table and --word-symbol-table must be "
+              "specified together".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+    if args.phone_symbol_table is not None:
+        set_symbol_tables(read_symbol_table(args.phone_symbol_table),
+                          read_symbol_table(args.word_symbol_table))
+    if args.num_jobs < 1:
+        print("{0}: invalid value specified --num-jobs={1}".format(
+            sys.argv[0], args.num_jobs), file=sys.stderr)
+        sys.exit(1)
+
     if args.sil_prob == 0.0:
           write_fst_no_silence(lexicon,
                                nonterminals=nonterminals,
-                               left_context_phones=left_context_phones)
+                               left_context_phones=left_context_phones,
+                               num_jobs=args.num_jobs)
     else:
         # Do some checking that the options make sense.
         if args.sil_prob < 0.0 or args.sil_prob >= 1.0:
@@ -398,7 +539,8 @@ def main():
         write_fst_with_silence(lexicon, args.sil_prob, args.sil_phone,
                                args.sil_disambig,
                                nonterminals=nonterminals,
-                               left_context_phones=left_context_phones)
+                               left_context_phones=left_context_phones,
+                               num_jobs=args.num_jobs)
 
 
 
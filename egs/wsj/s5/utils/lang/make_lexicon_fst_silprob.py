@@ -9,6 +9,8 @@ import os
 import sys
 import math
 import re
+from collections import deque
+from multiprocessing import Pool
 
 # The use of latin-1 encoding does not preclude reading utf-8.  latin-1
 # encoding means "treat words as sequences of bytes", and it is compatible
@@ -29,7 +31,9 @@ def get_args():
 
        This version is for a lexicon with word-specific silence probabilities,
        see http://www.danielpovey.com/files/2015_interspeech_silprob.pdf
-       for an explanation""")
+       for an explanation.  If --phone-symbol-table and --word-symbol-table
+       are supplied, the labels are written as integers, so the output can be
+       compiled by fstcompile without the symbol tables.""")
 
     parser.add_argument('--sil-phone', dest='sil_phone', type=str,
                         help="Text form of optional-silence phone, e.g. 'SIL'.")
@@ -62,11 +66,86 @@ def get_args():
                         help="""If supplied, --left-context-phones must also be supplied.
                         List of user-defined nonterminal symbols such as #nonterm:contact_list,
                         one per line.  E.g. data/local/dict/nonterminals.txt.""")
+    parser.add_argument('--phone-symbol-table', dest='phone_symbol_table', type=str,
+                        help="""If supplied, the phone symbol table (e.g. data/lang/phones.txt),
+                        which is used to write the phones as integers.  Must be supplied
+                        together with --word-symbol-table.""")
+    parser.add_argument('--word-symbol-table', dest='word_symbol_table', type=str,
+                        help="""If supplied, the word symbol table (e.g. data/lang/words.txt),
+                        which is used to write the words as integers.  Must be supplied
+                        together with --phone-symbol-table.""")
+    parser.add_argument('--num-jobs', dest='num_jobs', type=int, default=1,
+                        help="""Number of processes over which the formatting of the
+                        arcs for the pronunciations is split.  The output does not
+                        depend on this.""")
 
     args = parser.parse_args()
     return args
 
 
+# The symbol tables for phones and words, as dicts from symbol to integer label
+# (as a string), or None if the labels are written in text form.  See
+# set_symbol_tables().
+phone_symbols = None
+word_symbols = None
+
+# The number of pronunciations whose arcs are formatted at a time (by a single
+# process, if --num-jobs > 1) and written to the output in one go.
+prons_per_chunk = 10000
+
+
+def read_symbol_table(filename):
+    """Reads a symbol table such as phones.txt or words.txt, with lines of the
+    form 'symbol integer-id', and returns it as a dict from symbol to the
+    integer id as a string, e.g. {'<eps>': '0', 'a': '1', ... }."""
+    ans = {}
+    with open(filename, 'r', encoding='latin-1') as f:
+        for line in f:
+            a = line.split()
+            if len(a) != 2 or not a[1].isdigit():
+                raise RuntimeError("Bad line '{0}' in symbol table {1}".format(
+                    line.strip(" \t\r\n"), filename))
+            ans[a[0]] = a[1]
+    return ans
+
+
+def set_symbol_tables(phone_table, word_table):
+    """Sets the symbol tables used by phone_label() and word_label(); they
+    are either both None, or dicts as returned by read_symbol_table()."""
+    global phone_symbols, word_symbols
+    phone_symbols = phone_table
+    word_symbols = word_table
+
+
+def phone_label(phone):
+    """Returns the label written in the output for the phone (or disambiguation
+    symbol, or '<eps>') 'phone'."""
+    if phone_symbols is None:
+        return phone
+    try:
+        return phone_symbols[phone]
+    except KeyError:
+        raise RuntimeError("The phone '{0}' is not in the phone symbol "
+                           "table".format(phone))
+
+
+def word_label(word):
+    """Returns the label written in the output for the word 'word'."""
+    if word_symbols is None:
+        return word
+    try:
+        return word_symbols[word]
+    except KeyError:
+        raise RuntimeError("The word '{0}' is not in the word symbol "
+                           "table".format(word))
+
+
+def format_arc(src, dest, phone, word, cost):
+    """Returns the text form of an arc of L.fst, without the newline."""
+    return "{0}\t{1}\t{2}\t{3}\t{4}".format(
+        src, dest, phone_label(phone), word_label(word), cost)
+
+
 def read_silprobs(filename):
     """ Reads the silprobs file (e.g. silprobs.txt) which will have a format like this:
      <s> 0.99
@@ -209,7 +288,7 @@ def write_nonterminal_arcs(start_state, sil_state, non_sil_state,
     final_state = next_state
     next_state += 1
 
-    print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+    print(format_arc(
         src=start_state, dest=shared_state,
         phone='#nonterm_begin', word='#nonterm_begin',
         cost=0.0))
@@ -223,7 +302,7 @@ def write_nonterminal_arcs(start_state, sil_state, non_sil_state,
         # word-position-dependent phones are not used and some words end
         # in the optional-silence phone.
         for src in [sil_state, non_sil_state]:
-            print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+            print(format_arc(
                 src=src, dest=shared_state,
                 phone=nonterminal, word=nonterminal,
                 cost=0.0))
@@ -244,7 +323,7 @@ def write_nonterminal_arcs(start_state, sil_state, non_sil_state,
         # you have words that end in the optional-silence phone.
         dest = (sil_state if left_context_phone == sil_phone else non_sil_state)
 
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+        print(format_arc(
             src=shared_state, dest=dest,
             phone=left_context_phone, word='<eps>', cost=this_cost))
 
@@ -256,15 +335,106 @@ def write_nonterminal_arcs(start_state, sil_state, non_sil_state,
     # lines above this, after reaching 'shared_state' because it saw the
     # user-defined nonterminal.
     for src in [sil_state, non_sil_state]:
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
+        print(format_arc(
             src=src, dest=final_state,
             phone='#nonterm_end', word='#nonterm_end', cost=0.0))
     print("{state}\t{final_cost}".format(
         state=final_state, final_cost=0.0))
     return next_state
 
+def format_lexicon_arcs(lexicon, next_state, non_sil_state, sil_state,
+                        sil_phone, sil_disambig):
+    """Returns, as a string, the text form of the arcs of L.fst for the
+    pronunciations in 'lexicon' (a list of 6-tuples as returned by
+    read_lexiconp()); see write_fst() for the meaning of the other arguments.
+    The states for the phones in the pronunciations are allocated starting
+    from 'next_state'; a pronunciation with n phones uses max(n, 1) of them.
+    """
+    eps_word = word_label('<eps>')
+    non_sil_state = str(non_sil_state)
+    sil_state = str(sil_state)
+    # the ends of the arcs for the phones after the first one, and of the
+    # arcs that leave the word to the nonsilence and silence states.
+    no_word_suffix = '\t' + eps_word + '\n'
+    non_sil_suffix = ('\t' + non_sil_state + '\t' + phone_label(sil_disambig) +
+                      '\t' + eps_word + '\t')
+    sil_suffix = ('\t' + sil_state + '\t' + phone_label(sil_phone) +
+                  '\t' + eps_word + '\t')
+    lines = []
+    for (word, pronprob, wordsilprob, silwordcorrection, nonsilwordcorrection, pron) in lexicon:
+        pron_cost = -math.log(pronprob)
+        word_to_sil_cost = -math.log(wordsilprob)
+        word_to_non_sil_cost = -math.log(1.0 - wordsilprob)
+        sil_to_word_cost = -math.log(silwordcorrection)
+        non_sil_to_word_cost = -math.log(nonsilwordcorrection)
+
+        if len(pron) == 0:
+            # this is not really expected but we try to handle it gracefully.
+            pron = ['<eps>']
+
+        # Create transitions from both non_sil_state and sil_state to a new
+        # state, with the word label and the word's first phone on them
+        cur_state = str(next_state)
+        next_state += 1
+        first_arc_suffix = ('\t' + cur_state + '\t' + phone_label(pron[0]) +
+                            '\t' + word_label(word) + '\t')
+        lines.append(non_sil_state + first_arc_suffix +
+                     str(pron_cost + non_sil_to_word_cost) + '\n')
+        lines.append(sil_state + first_arc_suffix +
+                     str(pron_cost + sil_to_word_cost) + '\n')
+
+        # add states and arcs for all but the first phone.
+        for phone in pron[1:]:
+            new_state = str(next_state)
+            next_state += 1
+            lines.append(cur_state + '\t' + new_state + '\t' + phone_label(phone) +
+                         no_word_suffix)
+            cur_state = new_state
+
+        # ... and from there we return via two arcs to the silence and
+        # nonsilence state.
+        lines.append(cur_state + non_sil_suffix + str(word_to_non_sil_cost) + '\n')
+        lines.append(cur_state + sil_suffix + str(word_to_sil_cost) + '\n')
+    return ''.join(lines)
+
+
+def format_lexicon_arcs_for_chunk(args):
+    """Wrapper of format_lexicon_arcs() for use with Pool.apply_async()."""
+    return format_lexicon_arcs(*args)
+
+
+def write_lexicon_arcs(lexicon, next_state, num_jobs, *args):
+    """Writes to the standard output the arcs for the pronunciations in
+    'lexicon', as formatted by format_lexicon_arcs(lexicon, next_state, *args).
+    The lexicon is formatted in chunks of prons_per_chunk pronunciations,
+    which are distributed over 'num_jobs' processes if num_jobs > 1; the
+    state numbers of each chunk follow from the lengths of the pronunciations
+    in the chunks before it.  Returns the updated next_state."""
+    chunks = []
+    for start in range(0, len(lexicon), prons_per_chunk):
+        chunk = lexicon[start:start + prons_per_chunk]
+        chunks.append((chunk, next_state) + args)
+        next_state += sum([max(len(entry[-1]), 1) for entry in chunk])
+    if num_jobs > 1:
+        # at most 2 * num_jobs chunks are kept in memory.
+        with Pool(num_jobs, initializer=set_symbol_tables,
+                  initargs=(phone_symbols, word_symbols)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(format_lexicon_arcs_for_chunk,
+                                                 (chunk,)))
+                if len(pending) >= 2 * num_jobs:
+                    sys.stdout.write(pending.popleft().get())
+            while pending:
+                sys.stdout.write(pending.popleft().get())
+    else:
+        for chunk in chunks:
+            sys.stdout.write(format_lexicon_arcs_for_chunk(chunk))
+    return next_state
+
+
 def write_fst(lexicon, silprobs, sil_phone, sil_disambig,
-              nonterminals = None, left_context_phones = None):
+              nonterminals = None, left_context_phones = None, num_jobs = 1):
     """Writes the text format of L.fst (or L_disambig.fst)  to the standard output.
      'lexicon' is a list of 5-tuples
      (word, pronprob, wordsilprob, silwordcorrection, nonsilwordcorrection, pron)
@@ -278,6 +448,8 @@ def write_fst(lexicon, silprobs, sil_phone, sil_disambig,
      'left_context_phones', which also relates to grammar decoding, and must be
         supplied if 'nonterminals' is supplied is either None or a list of
         phones that may appear as left-context, e.g. ['a', 'ah', ... '#nonterm_bos'].
+     'num_jobs' is the number of processes used to format the arcs for the
+        lexicon; see write_lexicon_arcs().
     """
     silbeginprob, silendcorrection, nonsilendcorrection, siloverallprob = silprobs
     initial_sil_cost = -math.log(silbeginprob)
@@ -294,55 +466,16 @@ def write_fst(lexicon, silprobs, sil_phone, sil_disambig,
     # The one to the nonsilence state has the silence disambiguation symbol
     # (We always use that symbol on the *non*-silence-containing arcs, which
     # avoids having to introduce extra arcs).
-    print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+    print(format_arc(
         src=start_state, dest=non_sil_state,
         phone=sil_disambig, word='<eps>', cost=initial_non_sil_cost))
-    print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
+    print(format_arc(
         src=start_state, dest=sil_state,
         phone=sil_phone, word='<eps>', cost=initial_sil_cost))
 
-    for (word, pronprob, wordsilprob, silwordcorrection, nonsilwordcorrection, pron) in lexicon:
-        pron_cost = -math.log(pronprob)
-        word_to_sil_cost = -math.log(wordsilprob)
-        word_to_non_sil_cost = -math.log(1.0 - wordsilprob)
-        sil_to_word_cost = -math.log(silwordcorrection)
-        non_sil_to_word_cost = -math.log(nonsilwordcorrection)
-
-        if len(pron) == 0:
-            # this is not really expected but we try to handle it gracefully.
-            pron = ['<eps>']
-
-        new_state = next_state  # allocate a new state
-        next_state += 1
-        # Create transitions from both non_sil_state and sil_state to 'new_state',
-        # with the word label and the word's first phone on them
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=non_sil_state, dest=new_state,
-            phone=pron[0], word=word, cost=(pron_cost + non_sil_to_word_cost)))
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=sil_state, dest=new_state,
-            phone=pron[0], word=word, cost=(pron_cost + sil_to_word_cost)))
-        cur_state = new_state
-
-        # add states and arcs for all but the first phone.
-        for i in range(1, len(pron)):
-            new_state = next_state
-            next_state += 1
-            print("{src}\t{dest}\t{phone}\t<eps>".format(
-                src=cur_state, dest=new_state, phone=pron[i]))
-            cur_state = new_state
-
-        # ... and from there we return via two arcs to the silence and
-        # nonsilence state.  the silence-disambig symbol, if used,q
-        # goes on the nonsilence arc; this saves us having to insert an epsilon.
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=cur_state,  dest=non_sil_state,
-            phone=sil_disambig, word='<eps>',
-            cost=word_to_non_sil_cost))
-        print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
-            src=cur_state, dest=sil_state,
-            phone=sil_phone, word='<eps>',
-            cost=word_to_sil_cost))
+    next_state = write_lexicon_arcs(lexicon, next_state, num_jobs,
+                                    non_sil_state, sil_state,
+                                    sil_phone, sil_disambig)
 
     if nonterminals is not None:
         next_state = write_nonterminal_arcs(
@@ -400,8 +533,20 @@ def main():
         nonterminals = read_nonterminals(args.nonterminals)
         left_context_phones = read_left_context_phones(args.left_context_phones)
 
+    if (args.phone_symbol_table is None) != (args.word_symbol_table is None):
+        print("{0}: --phone-symbol-table and --word-symbol-table must be "
+              "specified together".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+    if args.phone_symbol_table is not None:
+        set_symbol_tables(read_symbol_table(args.phone_symbol_table),
+                          read_symbol_table(args.word_symbol_table))
+    if args.num_jobs < 1:
+        print("{0}: invalid value specified --num-jobs={1}".format(
+            sys.argv[0], args.num_jobs), file=sys.stderr)
+        sys.exit(1)
+
     write_fst(lexicon, silprobs, args.sil_phone, args.sil_disambig,
-              nonterminals, left_context_phones)
+              nonterminals, left_context_phones, args.num_jobs)
 
 
 if __name__ == '__main__':
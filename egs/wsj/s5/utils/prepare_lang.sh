@@ -448,6 +448,10 @@ fi
 cat $dir/phones/align_lexicon.txt | utils/sym2int.pl -f 3- $dir/phones.txt | \
   utils/sym2int.pl -f 1-2 $dir/words.txt > $dir/phones/align_lexicon.int
 
+# The lexicon FSTs are written with integer labels, so that fstcompile does not
+# have to look up the symbols.
+symbol_table_opts="--phone-symbol-table=$dir/phones.txt --word-symbol-table=$dir/words.txt"
+
 # Create the basic L.fst without disambiguation symbols, for use
 # in training.
 
@@ -455,16 +459,14 @@ if $silprob; then
   # Add silence probabilities (models the prob. of silence before and after each
   # word).  On some setups this helps a bit.  See utils/dict_dir_add_pronprobs.sh
   # and where it's called in the example scripts (run.sh).
-  utils/lang/make_lexicon_fst_silprob.py $grammar_opts --sil-phone=$silphone \
+  utils/lang/make_lexicon_fst_silprob.py $grammar_opts $symbol_table_opts --sil-phone=$silphone \
          $tmpdir/lexiconp_silprob.txt $srcdir/silprob.txt | \
-     fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-       --keep_isymbols=false --keep_osymbols=false |   \
+     fstcompile |   \
      fstarcsort --sort_type=olabel > $dir/L.fst || exit 1;
 else
-  utils/lang/make_lexicon_fst.py $grammar_opts --sil-prob=$sil_prob --sil-phone=$silphone \
+  utils/lang/make_lexicon_fst.py $grammar_opts $symbol_table_opts --sil-prob=$sil_prob --sil-phone=$silphone \
             $tmpdir/lexiconp.txt | \
-    fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-      --keep_isymbols=false --keep_osymbols=false | \
+    fstcompile | \
     fstarcsort --sort_type=olabel > $dir/L.fst || exit 1;
 fi
 
@@ -531,19 +533,17 @@ utils/gen_topo.pl $num_nonsil_states $num_sil_states $nonsilphonelist $silphonel
 # disambiguation symbols from G.fst.
 
 if $silprob; then
-  utils/lang/make_lexicon_fst_silprob.py $grammar_opts \
+  utils/lang/make_lexicon_fst_silprob.py $grammar_opts $symbol_table_opts \
      --sil-phone=$silphone --sil-disambig='#'$ndisambig \
      $tmpdir/lexiconp_silprob_disambig.txt $srcdir/silprob.txt | \
-     fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-       --keep_isymbols=false --keep_osymbols=false |   \
+     fstcompile |   \
      fstaddselfloops  $dir/phones/wdisambig_phones.int $dir/phones/wdisambig_words.int | \
      fstarcsort --sort_type=olabel > $dir/L_disambig.fst || exit 1;
 else
-  utils/lang/make_lexicon_fst.py $grammar_opts \
+  utils/lang/make_lexicon_fst.py $grammar_opts $symbol_table_opts \
        --sil-prob=$sil_prob --sil-phone=$silphone --sil-disambig='#'$ndisambig \
          $tmpdir/lexiconp_disambig.txt | \
-     fstcompile --isymbols=$dir/phones.txt --osymbols=$dir/words.txt \
-       --keep_isymbols=false --keep_osymbols=false |   \
+     fstcompile |   \
      fstaddselfloops  $dir/phones/wdisambig_phones.int $dir/phones/wdisambig_words.int | \
      fstarcsort --sort_type=olabel > $dir/L_disambig.fst || exit 1;
 fi
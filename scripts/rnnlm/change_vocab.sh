@@ -68,9 +68,15 @@ awk -v s=$rnnlm_in_dir/unigram_probs.txt -v t=$rnnlm_in_dir/config/words.txt  -v
 
 rnnlm/get_special_symbol_opts.py < $rnnlm_out_dir/config/words.txt > $rnnlm_out_dir/special_symbol_opts.txt
 
-# Re-compute words_feats.txt and word embeddings.
+# Re-compute words_feats.txt and word embeddings.  If the old word features are
+# present, only the features of the added words are computed.
+reuse_opts=
+if [ -f $rnnlm_in_dir/word_feats.txt ]; then
+  reuse_opts="--old-vocab=$rnnlm_in_dir/config/words.txt --old-word-feats=$rnnlm_in_dir/word_feats.txt"
+  reuse_opts="$reuse_opts --old-unigram-probs=$rnnlm_in_dir/unigram_probs.txt"
+fi
 rnnlm/get_word_features.py --unigram-probs=$rnnlm_out_dir/unigram_probs.txt --treat-as-bos='#0' \
-  $rnnlm_out_dir/config/words.txt $rnnlm_out_dir/config/features.txt > $rnnlm_out_dir/word_feats.txt
+  $reuse_opts $rnnlm_out_dir/config/words.txt $rnnlm_out_dir/config/features.txt > $rnnlm_out_dir/word_feats.txt
 
 rnnlm-get-word-embedding $rnnlm_out_dir/word_feats.txt $rnnlm_out_dir/feat_embedding.final.mat \
   $rnnlm_out_dir/word_embedding.final.mat
@@ -7,11 +7,14 @@ import os
 import argparse
 import sys
 import math
-from collections import defaultdict
 sys.stdout = open(1, 'w', encoding='utf-8', closefd=False)
 
 import re
 
+import numpy as np
+
+import word_features
+
 
 parser = argparse.ArgumentParser(description="This script chooses the sparse feature representation of words. "
                                              "To be more specific, it chooses the set of features-- you compute "
@@ -57,6 +60,8 @@ parser.add_argument("--use-constant-feature", type=str, default="false",
                     "the --max-feature-rms option.");
 parser.add_argument("--max-feature-rms", type=float, default=0.01,
                     help="maximum allowed root-mean-square value for any feature.")
+parser.add_argument("--num-jobs", type=int, default=1,
+                    help="Number of processes used to enumerate the character n-grams.")
 
 # dir=exp/rnnlm_tdnn_d
 # paste <(awk '{print $2}' $dir/config/unigram_probs.txt) <(awk '{$1="";print;}' $dir/word_feats.txt ) | awk '{freq=$1; num_feats=(NF-1)/2; for (n=1;n<=num_feats;n++) { a=n*2; b=n*2+1; rms[$a] += freq * $b*$b; }} END{for(k in rms) { print k, rms[k];}}' | sort -k2 -nr | head
@@ -290,8 +295,8 @@ if args.top_word_features > 0:
 # For a given word, the feature value if there is a match will be the number of
 # matches times the feature scale.
 
-#  'ngram_feats' is a dict mapping a pair (match_type, match)
-#  to a pair (feat_freq, expected_feat_sumsq), where:
+#  'ngram_keys' is a list of pairs (match_type, match), indexed by n-gram id,
+#  and 'feat_freq' and 'expected_feat_sumsq' are arrays indexed by n-gram id, where:
 #
 #   match_type (a string) is one of: 'match', 'final', 'initial', 'word',
 #           describing the match type, as explained above.
@@ -301,58 +306,30 @@ if args.top_word_features > 0:
 #   expected_feat_sumsq (a float) is the sum over all words of the probability
 #    of that word, times the square of the number of times the feature
 #    appears there.
-
-# if you index ngram_feats with a key that wasn't present, you'll get the
-# tuple (0.0, 0.0).
-ngram_feats = defaultdict(lambda: (0.0, 0.0))
-
-for (word_index, unigram_prob) in enumerate(unigram_probs):
-    if word_index in word_indexes_to_exclude:
-        continue
-    word = wordlist[word_index]
-
-    for pos in range(len(word) + 1):  # +1 for EOW 'this_word_feats' is a dict
-        # from pairs (match_type, match) as defined above, to the count of the
-        # number of times the feature was matched in this word (this count can
-        # only be >1 if match_type == 'match').
-        this_word_feats = defaultdict(int)
-
-        for order in range(args.min_ngram_order, args.max_ngram_order + 1):
-            start = pos - order + 1
-            end = pos + 1
-
-            if start < -1:
-                continue
-
-            if start < 0 and end > len(word):
-                match_type = 'word'
-                start = 0
-                end = len(word)
-            elif start < 0:
-                match_type = 'initial'
-                start = 0
-            elif end > len(word):
-                match_type = 'final'
-                end = len(word)
-            else:
-                match_type = 'match'
-            if start >= end:
-                continue
-
-            match = word[start:end]
-            this_word_feats[(match_type, match)] += 1
-        for (match_type, match), count in this_word_feats.items():
-            (feat_freq, expected_feat_sumsq) = ngram_feats[(match_type, match)]
-            ngram_feats[(match_type, match)] = (feat_freq + unigram_prob,
-                                                expected_feat_sumsq + unigram_prob * count * count)
-
-
-for (match_type, match), (expected_feat_sum, expected_feat_sumsq) in sorted(ngram_feats.items()):
+#  Both are accumulated per position in the word, and a given (match_type,
+#  match) can occur only once per position, so both of them equal the
+#  sum over words of the probability of the word times the number of
+#  occurrences of the n-gram in the word.
+
+ngram_word_indexes = [word_index for word_index in range(len(wordlist))
+                      if word_index not in word_indexes_to_exclude]
+(ngram_keys, indptr, indices, counts) = word_features.build_ngram_matrix(
+    [wordlist[word_index] for word_index in ngram_word_indexes],
+    args.min_ngram_order, args.max_ngram_order, num_jobs=args.num_jobs)
+rows = word_features.get_csr_rows(indptr)
+word_probs = np.array(unigram_probs, dtype=np.float64)[ngram_word_indexes]
+feat_freq = np.bincount(indices, weights=word_probs[rows] * counts,
+                        minlength=len(ngram_keys))
+expected_feat_sumsq = feat_freq
+
+for ngram_id in sorted(range(len(ngram_keys)), key=lambda i: ngram_keys[i]):
+    (match_type, match) = ngram_keys[ngram_id]
+    expected_feat_sum = feat_freq[ngram_id]
     if match_type == 'word' and match in top_words:
         continue  # avoid duplicate
     if expected_feat_sum < args.min_frequency:
         continue  # very infrequent features are excluded via this mechanism.
-    rms = math.sqrt(expected_feat_sumsq)
+    rms = math.sqrt(expected_feat_sumsq[ngram_id])
     print("{0}\t{1}\t{2}\t{3}".format(
         num_features, match_type, match, get_feature_scale(rms)))
     num_features += 1
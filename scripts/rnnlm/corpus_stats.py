@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# Copyright  2017  Jian Wang
+# License: Apache 2.0.
+
+# This module computes the unigram counts of the data sources needed for
+# RNNLM data preparation, in a single pass over each data source.  Sources are
+# processed in parallel, one process per source.  It also has the function
+# used by prepare_split_data.py to convert text to integer form in worker
+# processes (integerize_lines()).
+#
+# The unigram counts of each source are cached in <text-dir>/.counts_cache,
+# keyed by the size and modification time of the source .txt file, and
+# are also written to <text-dir>/<name>.counts in the format produced by
+# rnnlm/ensure_counts_present.sh.  So when only data_weights.txt changes,
+# nothing needs to be re-read to get the weighted unigram counts.
+#
+# When run as a script it makes sure the .counts files are present, like
+# rnnlm/ensure_counts_present.sh does, e.g.:
+#   rnnlm/corpus_stats.py --num-jobs=8 data/rnnlm/text
+
+import os
+import argparse
+import sys
+import shutil
+from collections import Counter
+from multiprocessing import Pool
+
+EOS_SYMBOL = '</s>'
+CACHE_DIR_NAME = '.counts_cache'
+IO_BUFFER_SIZE = 1 << 24
+
+
+# split a line of text into words, on any whitespace as utils/sym2int.pl
+# does.  It is used for both the counts and the integerized text so that they
+# agree.
+def get_tokens(line):
+    return line.split()
+
+
+# return a string identifying the current contents of a file, used
+# as the key of the counts cache.
+def get_source_key(path):
+    st = os.stat(path)
+    return "{0} {1}".format(st.st_size, st.st_mtime_ns)
+
+
+def get_cache_paths(text_dir, name):
+    cache_dir = os.path.join(text_dir, CACHE_DIR_NAME)
+    return (os.path.join(cache_dir, name + ".counts"),
+            os.path.join(cache_dir, name + ".key"))
+
+
+# read the cached counts for data source 'name'.  If the cache is missing,
+# <text-dir>/<name>.counts is used if it is not older than the source (as in
+# rnnlm/ensure_counts_present.sh).  Returns None if neither is up to date.
+def read_cached_counts(text_dir, name):
+    counts_file, key_file = get_cache_paths(text_dir, name)
+    txt_file = os.path.join(text_dir, name + ".txt")
+    try:
+        with open(key_file, 'r', encoding="utf-8") as f:
+            if f.read().strip() != get_source_key(txt_file):
+                return None
+        return read_counts_file(counts_file)
+    except (IOError, OSError):
+        pass
+    counts_file = os.path.join(text_dir, name + ".counts")
+    try:
+        if os.path.getmtime(counts_file) >= os.path.getmtime(txt_file):
+            return read_counts_file(counts_file)
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def read_counts_file(counts_file):
+    counts = {}
+    with open(counts_file, 'r', encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            assert len(fields) == 2
+            counts[fields[0]] = counts.get(fields[0], 0) + int(fields[1])
+    return counts
+
+
+def write_counts_file(counts, counts_file):
+    with open(counts_file, 'w', encoding="utf-8") as f:
+        f.writelines("{0} {1}\n".format(word, count)
+                     for word, count in sorted(counts.items()))
+
+
+# write the counts to the cache and to <text-dir>/<name>.counts.
+def write_cached_counts(text_dir, name, counts, key):
+    counts_file, key_file = get_cache_paths(text_dir, name)
+    os.makedirs(os.path.dirname(counts_file), exist_ok=True)
+    write_counts_file(counts, counts_file)
+    with open(key_file, 'w', encoding="utf-8") as f:
+        print(key, file=f)
+    shutil.copyfile(counts_file, os.path.join(text_dir, name + ".counts"))
+
+
+# Globals of the worker processes, set by init_worker() so that the
+# vocabulary is not pickled for every task.
+_word_to_int_str = None
+_unk_int_str = None
+
+
+def init_worker(word_to_int_str, unk_int_str):
+    global _word_to_int_str, _unk_int_str
+    _word_to_int_str = word_to_int_str
+    _unk_int_str = unk_int_str
+
+
+# convert lines of text to integer form, like utils/sym2int.pl, after
+# init_worker() has been called with the vocabulary (as a dict word -> id
+# string) and the id string of the unknown word (None if OOVs are an error).
+# returns a tuple (list of the lines in integer form, without newlines,
+# num_oovs).
+def integerize_lines(lines):
+    int_lines = []
+    num_oovs = 0
+    for line in lines:
+        tokens = get_tokens(line)
+        if _unk_int_str is None:
+            try:
+                ids = [_word_to_int_str[w] for w in tokens]
+            except KeyError as e:
+                raise Exception("undefined symbol {0} and no --unk-word "
+                                "specified".format(str(e)))
+        else:
+            ids = [_word_to_int_str.get(w, _unk_int_str) for w in tokens]
+            num_oovs += sum(1 for w in tokens if w not in _word_to_int_str)
+        int_lines.append(' '.join(ids))
+    return int_lines, num_oovs
+
+
+# Count the words of one data source.
+# returns the counts as a dict, including the end-of-sentence count.
+def process_source(source_file):
+    counts = Counter()
+    num_lines = 0
+    with open(source_file, 'r', encoding="utf-8", buffering=IO_BUFFER_SIZE) as f:
+        for line in f:
+            counts.update(get_tokens(line))
+            num_lines += 1
+    counts[EOS_SYMBOL] += num_lines
+    return dict(counts)
+
+
+# Get the unigram counts of all data sources.  Only the sources whose cached
+# counts are not up to date are read.
+#  text_dir: directory with <name>.txt files.
+#  names: list of data source names.
+#  num_jobs: number of processes.
+# return a dict: name -> counts dict, and the number of sources that were read.
+def get_source_stats(text_dir, names, num_jobs=1):
+    source_counts = {}
+    tasks = []
+    for name in names:
+        counts = read_cached_counts(text_dir, name)
+        if counts is not None:
+            source_counts[name] = counts
+        else:
+            tasks.append(os.path.join(text_dir, name + ".txt"))
+
+    keys = dict((task, get_source_key(task)) for task in tasks)
+    if num_jobs > 1 and len(tasks) > 1:
+        pool = Pool(min(num_jobs, len(tasks)))
+        results = pool.imap(process_source, tasks)
+    else:
+        pool = None
+        results = map(process_source, tasks)
+    try:
+        for task, counts in zip(tasks, results):
+            name = os.path.basename(task)[:-4]
+            source_counts[name] = counts
+            write_cached_counts(text_dir, name, counts, keys[task])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return source_counts, len(tasks)
+
+
+# Get total (weighted) count for words from all data sources.
+#  data_weights: dict name -> (repeated_times_per_epoch, weight)
+#  vocab: dict word -> id
+#  unk_word: OOV words are mapped to this word; if '' OOV words are an error.
+# return a list of counts indexed by word id.
+def get_weighted_counts(source_counts, data_weights, vocab, unk_word=''):
+    counts = [0.0] * len(vocab)
+    for name, word_counts in source_counts.items():
+        weight = data_weights[name][0] * data_weights[name][1]
+        if weight == 0.0:
+            continue
+        for word, count in word_counts.items():
+            if word not in vocab:
+                if unk_word == '':
+                    sys.exit(sys.argv[0] + ": error: an OOV word {0} is present in the "
+                             "data source {1} but you have not specified an unknown word to "
+                             "map it to (--unk-word option).".format(word, name))
+                word = unk_word
+            counts[vocab[word]] += weight * count
+    return counts
+
+
+# get the names of all data sources in text_dir except dev.
+def get_source_names(text_dir):
+    return sorted(f[0:-4] for f in os.listdir(text_dir)
+                  if f.endswith(".txt") and f != 'dev.txt'
+                  and not os.path.isdir(os.path.join(text_dir, f)))
+
+
+# read the vocab, like utils/sym2int.pl does, and work out the id of the
+# unknown word (None if unk_word is None or '').
+# return a dict mapping the word to an integer id, and the id of the unknown word.
+def read_vocab(vocab_file, unk_word=None):
+    vocab = {}
+    with open(vocab_file, 'r', encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 2 or not fields[1].isdigit():
+                sys.exit(sys.argv[0] + ": bad line in symbol table file {0}: {1}".format(
+                    vocab_file, line.rstrip("\n")))
+            vocab[fields[0]] = int(fields[1])
+    if unk_word is None or unk_word == '':
+        return vocab, None
+    if unk_word not in vocab:
+        sys.exit(sys.argv[0] + ": OOV symbol {0} not defined in {1}".format(
+            unk_word, vocab_file))
+    return vocab, vocab[unk_word]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Makes sure unigram counts (*.counts) are "
+                                     "present and up to date in <text-dir>, computing them "
+                                     "in parallel if not.",
+                                     epilog="E.g. " + sys.argv[0] + " --num-jobs=8 data/rnnlm/text",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num-jobs", type=int, default=4,
+                        help="Number of data sources to process in parallel.")
+    parser.add_argument("text_dir",
+                        help="Directory in which to look for data")
+    args = parser.parse_args()
+
+    names = get_source_names(args.text_dir) + ['dev']
+    try:
+        source_counts, num_read = get_source_stats(args.text_dir, names, args.num_jobs)
+    except Exception as e:
+        sys.exit(sys.argv[0] + ": failed to process data sources: " + str(e))
+    print(sys.argv[0] + ": counted {0} data sources, {1} of them were read.".format(
+        len(source_counts), num_read), file=sys.stderr)
@@ -14,24 +14,13 @@ fi
 
 dir=$1
 
+# the counts are computed by rnnlm/corpus_stats.py (in parallel over the data
+# sources), which also caches them for rnnlm/get_unigram_probs.py.
 for f in `ls $dir/*.txt`; do
   counts_file=$(echo $f | sed s/.txt$/.counts/)
   if [ ! -f $counts_file -o $counts_file -ot $f ]; then
-    echo "$0: generating counts file for $f" 1>&2
-    cat $f | sed 's/ \+/ /g' | python -c '
-import sys
-counts = dict()
-eos = "</s>"
-counts[eos] = 0
-for line in sys.stdin:
-    tokens = line.strip("\n").strip(" ").split(" ")
-    for token in tokens:
-        if token not in counts:
-            counts[token] = 0
-        counts[token] += 1
-    counts[eos] += 1
-for word, count in counts.items():
-    print(f"{word} {count}")
-' | sort > $counts_file
+    echo "$0: generating counts files in $dir" 1>&2
+    rnnlm/corpus_stats.py $dir 1>&2
+    break
   fi
 done
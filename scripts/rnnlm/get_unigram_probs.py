@@ -9,6 +9,8 @@ import sys
 
 import re
 
+import corpus_stats
+
 
 parser = argparse.ArgumentParser(description="This script gets the unigram probabilities of words.",
                                  epilog="E.g. " + sys.argv[0] + " --vocab-file=data/rnnlm/vocab/words.txt "
@@ -32,6 +34,9 @@ parser.add_argument("--smooth-unigram-counts", type=float, default=1.0,
                     help="Specify the constant for smoothing. We will add "
                          "(smooth_unigram_counts * num_words_with_non_zero_counts / vocab_size) "
                          "to every unigram counts.")
+parser.add_argument("--num-jobs", type=int, default=4,
+                    help="Number of data sources to count in parallel, if their counts "
+                    "are not cached yet.")
 parser.add_argument("text_dir",
                     help="Directory in which to look for data")
 
@@ -123,31 +128,11 @@ def read_vocab(vocab_file):
 
 # Get total (weighted) count for words from all data_sources
 # return a list of counts indexed by word id.
-def get_counts(data_sources, data_weights, vocab):
-    counts = [0.0] * len(vocab)
-
-    for name, (_, counts_file) in data_sources.items():
-        weight = data_weights[name][0] * data_weights[name][1]
-        if weight == 0.0:
-            continue
-
-        with open(counts_file, 'r', encoding="utf-8") as f:
-            for line in f:
-                fields = line.split()
-                if len(fields) != 2: print("Warning, should be 2 cols:", fields, line, file=sys.stderr);
-                assert(len(fields) == 2)
-                word = fields[0]
-                count = fields[1]
-                if word not in vocab:
-                    if args.unk_word == '':
-                        sys.exit(sys.argv[0] + ": error: an OOV word {0} is present in the "
-                                 "counts file {1} but you have not specified an unknown word to "
-                                 "map it to (--unk-word option).".format(word, counts_file))
-                    else:
-                        word = args.unk_word
-                counts[vocab[word]] += weight * int(fields[1])
-
-    return counts
+def get_counts(source_counts, data_weights, vocab):
+    return corpus_stats.get_weighted_counts(
+        dict((name, source_counts[name]) for name in data_weights.keys()
+             if name in source_counts),
+        data_weights, vocab, args.unk_word)
 
 
 # Smooth counts and get unigram probs for words
@@ -181,15 +166,17 @@ def get_unigram_probs(vocab, counts, smooth_constant):
 
     return probs
 
-if os.system("rnnlm/ensure_counts_present.sh {0}".format(args.text_dir)) != 0:
-    print(sys.argv[0] + ": command 'rnnlm/ensure_counts_present.sh {0}' failed.".format(
-        args.text_dir))
+# Make sure the counts of all data sources are present and up to date, like
+# rnnlm/ensure_counts_present.sh.  Counts are cached by corpus_stats.py, so
+# only the data sources that changed since they were last counted are read.
+source_counts, _ = corpus_stats.get_source_stats(
+    args.text_dir, corpus_stats.get_source_names(args.text_dir), num_jobs=args.num_jobs)
 
 data_sources = get_all_data_sources_except_dev(args.text_dir)
 data_weights = read_data_weights(args.data_weights_file, data_sources)
 vocab = read_vocab(args.vocab_file)
 
-counts = get_counts(data_sources, data_weights, vocab)
+counts = get_counts(source_counts, data_weights, vocab)
 probs = get_unigram_probs(vocab, counts, args.smooth_unigram_counts)
 
 for idx, p in enumerate(probs):
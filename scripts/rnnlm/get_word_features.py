@@ -7,10 +7,13 @@ import os
 import argparse
 import sys
 import math
-from collections import defaultdict
 
 import re
 
+import numpy as np
+
+import word_features
+
 
 parser = argparse.ArgumentParser(description="This script turns the words into the sparse feature representation, "
                                              "using features from rnnlm/choose_features.py.",
@@ -33,6 +36,19 @@ parser.add_argument("--treat-as-bos", type=str, default='',
                     are never expected to be predicted.  (Note: it's not necessary
                     to do this for symbol zero, <eps>, because we exclude it from
                     the normalization sum).  Example: --treat-as-bos='#0'""")
+parser.add_argument("--num-jobs", type=int, default=1,
+                    help="Number of processes used to enumerate the character n-grams.")
+parser.add_argument("--old-vocab", type=str, default='',
+                    help="Vocab file of existing word features (--old-word-feats).  "
+                    "If supplied, the features of words that are in both vocabularies "
+                    "(and have the same unigram prob, see --old-unigram-probs) are copied "
+                    "from --old-word-feats, and only the added words are computed.  "
+                    "Used by rnnlm/change_vocab.sh.")
+parser.add_argument("--old-word-feats", type=str, default='',
+                    help="Word features file that corresponds to --old-vocab.")
+parser.add_argument("--old-unigram-probs", type=str, default='',
+                    help="Unigram probs that correspond to --old-vocab; required with "
+                    "--old-vocab if the features include the unigram feature.")
 
 args = parser.parse_args()
 
@@ -150,75 +166,126 @@ treat_as_bos_word_set = args.treat_as_bos.split(',')
 def treat_as_bos(word):
   return word in treat_as_bos_word_set
 
-def get_feature_list(word, idx):
-    """Return a dict from feat_id to value (as int or float), e.g.
-      { 0 -> 1.0, 100 -> 1 }
-    """
-    ans = defaultdict(int)  # the default is only used for character-ngram features.
-    if idx == 0:
-        return ans
-
-    if feats['constant'] is not None:
-        (feat_id, value) = feats['constant']
-        ans[feat_id] = value
-
-    if word in feats['special']:
-        (feat_id, scale) = feats['special'][word]
-        ans[feat_id] = 1 * scale
-        return ans   # return because words with the 'special' feature do
-                     # not get any other features (except the constant
-                     # feature).
-
+# Return the features of all words as a sparse matrix in COO form, as arrays
+# (rows, feat_ids, values).  'words' is a list of the string-valued words
+# and 'word_ids' a list of their integer ids (used to look up the unigram probs).
+def get_feature_matrix(words, word_ids):
+    rows = []
+    feat_ids = []
+    values = []
+
+    def add_feature(row, feat_id, value):
+        rows.append(row)
+        feat_ids.append(feat_id)
+        values.append(value)
+
+    # 'ngram_rows' are the rows of the words that get letter-based features.
+    ngram_rows = []
+    for row, (word, idx) in enumerate(zip(words, word_ids)):
+        if idx == 0:
+            continue
+
+        if feats['constant'] is not None:
+            (feat_id, value) = feats['constant']
+            add_feature(row, feat_id, value)
+
+        if word in feats['special']:
+            (feat_id, scale) = feats['special'][word]
+            add_feature(row, feat_id, 1 * scale)
+            continue   # words with the 'special' feature do not get any
+                       # other features (except the constant feature).
+
+        if 'unigram' in feats:
+            if unigram_probs is None:
+                sys.exit(sys.argv[0] + ": if unigram feature is present, you must specify the "
+                         "--unigram-probs option.");
+            (feat_id, offset, scale) = feats['unigram']
+            logp = math.log(unigram_probs[idx])
+            add_feature(row, feat_id, offset + logp * scale)
+
+        if 'length' in feats:
+            (feat_id, scale) = feats['length']
+            add_feature(row, feat_id, len(word) * scale)
+
+        if word in feats['word']:
+            (feat_id, scale) = feats['word'][word]
+            add_feature(row, feat_id, 1 * scale)
+        ngram_rows.append(row)
+
+    rows = np.array(rows, dtype=np.int64)
+    feat_ids = np.array(feat_ids, dtype=np.int64)
+    values = np.array(values, dtype=np.float64)
+    if len(ngram_rows) == 0 or feats['max_ngram_order'] < 0:
+        return (rows, feat_ids, values)
+
+    # the character n-gram features.  'word' matches were handled above.
+    (ngram_keys, indptr, indices, counts) = word_features.build_ngram_matrix(
+        [words[row] for row in ngram_rows], feats['min_ngram_order'],
+        feats['max_ngram_order'], include_word_type=False, num_jobs=args.num_jobs)
+    # map n-gram ids to feature ids and scales; -1 if the n-gram is not a feature.
+    ngram_feat_ids = np.full(len(ngram_keys), -1, dtype=np.int64)
+    ngram_scales = np.zeros(len(ngram_keys), dtype=np.float64)
+    for ngram_id, (match_type, match) in enumerate(ngram_keys):
+        if match in feats[match_type]:
+            (ngram_feat_ids[ngram_id], ngram_scales[ngram_id]) = feats[match_type][match]
+    ngram_feat_rows = np.array(ngram_rows, dtype=np.int64)[word_features.get_csr_rows(indptr)]
+    is_feature = ngram_feat_ids[indices] >= 0
+    return (np.concatenate([rows, ngram_feat_rows[is_feature]]),
+            np.concatenate([feat_ids, ngram_feat_ids[indices[is_feature]]]),
+            np.concatenate([values, counts[is_feature] * ngram_scales[indices[is_feature]]]))
+
+
+# Return a list with the formatted features of each word, e.g. '0 1 100 0.5'.
+def format_features(num_words, rows, feat_ids, values):
+    order = np.lexsort((feat_ids, rows))
+    rows = rows[order]
+    feat_ids = feat_ids[order]
+    values = values[order]
+    row_starts = np.searchsorted(rows, np.arange(num_words + 1))
+    feat_strs = ["%s %.3g" % (f, v) for f, v in zip(feat_ids.tolist(), values.tolist())]
+    return [" ".join(feat_strs[row_starts[row]:row_starts[row + 1]])
+            for row in range(num_words)]
+
+
+# Read the lines of --old-word-feats that can be reused for the new vocab;
+# return a dict from word to the formatted features.
+def read_reusable_features():
+    old_vocab = read_vocab(args.old_vocab)
+    old_id_to_word = dict((idx, word) for word, idx in old_vocab.items())
     if 'unigram' in feats:
-        if unigram_probs is None:
-            sys.exit(sys.argv[0] + ": if unigram feature is present, you must specify the "
-                     "--unigram-probs option.");
-        (feat_id, offset, scale) = feats['unigram']
-        logp = math.log(unigram_probs[idx])
-        ans[feat_id] = offset + logp * scale
-
-    if 'length' in feats:
-        (feat_id, scale) = feats['length']
-        ans[feat_id] = len(word) * scale
-
-    if word in feats['word']:
-        (feat_id, scale) = feats['word'][word]
-        ans[feat_id] = 1 * scale
-
-    for pos in range(len(word) + 1):  # +1 for EOW
-        for order in range(feats['min_ngram_order'], feats['max_ngram_order'] + 1):
-            start = pos - order + 1
-            end = pos + 1
-
-            if start < -1:
-                continue
-
-            if start < 0 and end > len(word):
-                # 'word' feature, which we already match before
+        if args.old_unigram_probs == '' or unigram_probs is None:
+            sys.exit(sys.argv[0] + ": --old-unigram-probs and --unigram-probs are required "
+                     "with --old-vocab if unigram feature is present.")
+        old_unigram_probs = read_unigram_probs(args.old_unigram_probs)
+    reusable = {}
+    with open(args.old_word_feats, 'r', encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            old_idx = int(fields[0])
+            word = old_id_to_word[old_idx]
+            if word not in vocab or treat_as_bos(word) or vocab[word] == 0:
                 continue
-            elif start < 0:
-                ngram_feats = feats['initial']
-                start = 0
-            elif end > len(word):
-                ngram_feats = feats['final']
-                end = len(word)
-            else:
-                ngram_feats = feats['match']
-            if start >= end:
+            if 'unigram' in feats and unigram_probs[vocab[word]] != old_unigram_probs[old_idx]:
                 continue
-
-            feat = word[start:end]
-            if feat in ngram_feats:
-                (feat_id, scale) = ngram_feats[feat]
-                ans[feat_id] += 1 * scale
-    return ans
-
-for word, idx in sorted(vocab.items(), key=lambda x: x[1]):
-    if treat_as_bos(word):
-      feature_list = get_feature_list("<s>", idx)
-    else:
-      feature_list = get_feature_list(word, idx)
-    print("{0}\t{1}".format(idx,
-                            " ".join(["%s %.3g" % (f, v) for f, v in sorted(feature_list.items())])))
-
+            reusable[word] = fields[1] if len(fields) > 1 else ''
+    return reusable
+
+
+sorted_words = sorted(vocab.items(), key=lambda x: x[1])
+reusable = read_reusable_features() if args.old_vocab != '' else {}
+new_words = [(word, idx) for word, idx in sorted_words if word not in reusable]
+(rows, feat_ids, values) = get_feature_matrix(
+    ["<s>" if treat_as_bos(word) else word for word, _ in new_words],
+    [idx for _, idx in new_words])
+new_features = format_features(len(new_words), rows, feat_ids, values)
+new_word_features = dict((word, features) for (word, _), features
+                         in zip(new_words, new_features))
+
+for word, idx in sorted_words:
+    features = reusable[word] if word in reusable else new_word_features[word]
+    print("{0}\t{1}".format(idx, features))
+
+if args.old_vocab != '':
+    print(sys.argv[0] + ": reused features of {0} words from {1}.".format(
+        len(reusable), args.old_word_feats), file=sys.stderr)
 print(sys.argv[0] + ": made features for {0} words.".format(len(vocab)), file=sys.stderr)
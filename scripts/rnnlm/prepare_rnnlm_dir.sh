@@ -16,6 +16,8 @@ unigram_factor=100.0     # Option used when pruning the LM used for sampling.
                          # You can increase this, e.g. to 200 or 400, if the LM used
                          # for sampling is too big, causing rnnlm-get-egs to
                          # take up too many CPUs worth of compute.
+num_jobs=4               # Number of processes used to count the data sources
+                         # and to convert them to integer form.
 
 . utils/parse_options.sh
 
@@ -70,10 +72,10 @@ if [ $stage -le 1 ]; then
 fi
 
 if [ $stage -le 2 ]; then
-  if [ ! -f $text_dir/dev.counts ] || [ $text_dir/dev.counts -ot $text_dir/dev.txt ]; then
-    echo "$0: preparing unigram counts in $text_dir"
-    rnnlm/ensure_counts_present.sh $text_dir
-  fi
+  echo "$0: preparing unigram counts in $text_dir"
+  # this reads the data sources whose counts are missing or out of date, in
+  # parallel, and caches the counts for rnnlm/get_unigram_probs.py.
+  rnnlm/corpus_stats.py --num-jobs=$num_jobs $text_dir
 fi
 
 
@@ -83,10 +85,8 @@ if [ $stage -le 3 ]; then
     # first we need the appropriately weighted unigram counts.
 
     if awk '{if($2 == "unigram"){saw_unigram=1;}} END{exit(saw_unigram ? 0 : 1)}' $dir/config/features.txt; then
-      # we need the unigram probabilities
-      rnnlm/ensure_counts_present.sh $text_dir
-
-      rnnlm/get_unigram_probs.py --vocab-file=$dir/config/words.txt \
+      # we need the unigram probabilities; the counts were prepared in stage 2.
+      rnnlm/get_unigram_probs.py --num-jobs=$num_jobs --vocab-file=$dir/config/words.txt \
         --unk-word=$(cat $dir/config/oov.txt) \
         --data-weights-file=$dir/config/data_weights.txt $text_dir \
         >$dir/unigram_probs.txt
@@ -114,7 +114,7 @@ if [ $stage -le 4 ]; then
 
   # note: the python script treats the empty unknown word as a special case,
   # so if oov.txt is empty we don't have to take any special action.
-  rnnlm/prepare_split_data.py --unk-word="$(cat $dir/config/oov.txt)" \
+  rnnlm/prepare_split_data.py --num-jobs=$num_jobs --unk-word="$(cat $dir/config/oov.txt)" \
      --vocab-file=$dir/config/words.txt --data-weights-file=$dir/config/data_weights.txt \
      --num-splits=$num_splits $text_dir $dir/text
   echo $num_repeats >$dir/text/info/num_repeats
@@ -7,9 +7,14 @@
 import os
 import argparse
 import sys
+import itertools
+from collections import deque
+from multiprocessing import Pool
 
 import re
 
+import corpus_stats
+
 
 parser = argparse.ArgumentParser(description="This script prepares files containing integerized text, "
                                  "for consumption by nnet3-get-egs.",
@@ -32,6 +37,8 @@ parser.add_argument("--data-weights-file", type=str, default='', required=True,
                     "like 'foo 1 0.5' and 'bar 2 1.5'.  These don't have to sum to one.")
 parser.add_argument("--num-splits", type=int, required=True,
                     help="The number of pieces to split up the data into.")
+parser.add_argument("--num-jobs", type=int, default=4,
+                    help="The number of processes that convert the text to integer form.")
 parser.add_argument("text_dir",
                     help="Directory in which to look for source data, as validated by validate_text_dir.py")
 parser.add_argument("split_dir",
@@ -88,35 +95,6 @@ def read_data_weights(weights_file, data_sources):
 
 
 
-# This function opens the file with filename 'source_filename',
-# reads from it line by line, and writes the lines round-robin
-# to the filehandles in the array 'output_filehandles',
-# each prepended by the weights in 'weight'.
-def distribute_to_outputs(source_filename, weight, output_filehandles):
-    weight_str = str(weight) + ' '
-    num_outputs = len(output_filehandles)
-    n = 0
-    try:
-        f = open(source_filename, 'r', encoding="utf-8")
-    except Exception as e:
-        sys.exit(sys.argv[0] + ": failed to open file {0} for reading: {1} ".format(
-            source_filename, str(e)))
-    for line in f:
-        output_filehandle = output_filehandles[n % num_outputs]
-        # the line 'line' will already have a terminating newline, so we
-        # suppress the extra newline by specifying end=''.
-        try:
-            print(weight_str + line, end='', file=output_filehandle)
-        except:
-            sys.exit(sys.argv[0] + ": failed to write to temporary file (disk full?)")
-        n += 1
-        print
-    f.close()
-
-
-
-
-
 data_sources = get_all_data_sources_except_dev(args.text_dir)
 data_weights = read_data_weights(args.data_weights_file, data_sources)
 
@@ -127,94 +105,116 @@ if not os.path.exists(args.split_dir + "/info"):
 with open("{0}/info/num_splits".format(args.split_dir), 'w', encoding="utf-8") as f:
     print(args.num_splits, file=f)
 
-# e.g. set temp_files = [ 'foo/1.tmp', 'foo/2.tmp', ..., 'foo/5.tmp' ]
-# we write the text data to here, later we convert to integer
-# while writing to the *.txt files.
-temp_files = [ "{0}/{1}.tmp".format(args.split_dir, n) for n in range(1, args.num_splits + 1) ]
-
-# create filehandles for writing to each of these '.tmp' output files.
-temp_filehandles = []
-for fname in temp_files:
-    try:
-        temp_filehandles.append(open(fname, 'w', encoding="utf-8"))
-    except Exception as e:
-        sys.exit(sys.argv[0] + ": failed to open file: " + str(e) +
-                 ".. if this is a max-open-filehandles limitation, you may "
-                 "need to rewrite parts of this script, but a workaround "
-                 "is to use fewer splits of the data (or change your OS "
-                 "ulimits)")
-
-
-print(sys.argv[0] + ": distributing data to temporary files")
-
-# this loop appends text data (prepended by data-weights), from each of
-# the source .txt files, to the filehandles in 'temp_filehandles'.
-for name in data_sources.keys():
-    source_file = data_sources[name]
-    multiplicity = data_weights[name][0]
-    weight = data_weights[name][1]
-    assert multiplicity >= 0
-
-    for n in range(multiplicity):
-        # 'offset' will be zero for the first copy of any data, and
-        # from there it will increase up to some value less than
-        # args.num_splits.  The point of this offset, which you can
-        # think of as a rotation modulo args.num_splits, is so that
-        # when we write the same data multiple times, we don't end
-        # up writing the same lines to the same file.
-        offset = (n * args.num_splits) // multiplicity
-        assert offset < args.num_splits
-        rotated_filehandles = temp_filehandles[offset:] + temp_filehandles[:offset]
-
-        # The following line is the core of what we're doing; see the
-        # documentation for this function for more details.
-        distribute_to_outputs(source_file, weight, rotated_filehandles)
-
-
-for f in temp_filehandles:
-    try:
-        f.close()
-    except:
-        sys.exit(sys.argv[0] + ": error closing temporary file (disk full?)");
+vocab, unk_id = corpus_stats.read_vocab(args.vocab_file, args.unk_word)
+word_to_int_str = dict((w, str(i)) for w, i in vocab.items())
+unk_int_str = None if unk_id is None else str(unk_id)
+
+names = sorted(data_sources.keys())
+weights = dict((name, str(data_weights[name][1])) for name in names
+               if data_weights[name][0] > 0)
 
+# number of lines of text that are given to a process at a time.
+LINES_PER_CHUNK = 10000
 
-print(sys.argv[0] + ": converting from text to integer form.")
 
-if args.unk_word != None and args.unk_word != '':
-    unk_opt = "--map-oov '{0}'".format(args.unk_word)
+# Convert the lines of text in 'source_file' to integer form and write line i,
+# prepended by 'weight_str', to output_files[i % len(output_files)].  The text
+# goes straight from the source to the outputs (no integerized copy of the data
+# is kept on disk); chunks of lines are converted by the processes of 'pool'
+# (or here, if it is None), with at most 2 * num_jobs chunks in flight.
+# returns the number of OOV words that were replaced with the unknown word.
+def write_integerized(source_file, weight_str, output_files, pool):
+    num_outputs = len(output_files)
+    num_oovs = 0
+    n = 0
+
+    def write(result):
+        nonlocal num_oovs, n
+        int_lines, chunk_oovs = result
+        num_oovs += chunk_oovs
+        for int_line in int_lines:
+            # an empty line is just the weight, as written by utils/sym2int.pl.
+            output_files[n % num_outputs].write(
+                weight_str + ' ' + int_line + '\n' if int_line != '' else weight_str + '\n')
+            n += 1
+
+    pending = deque()
+    with open(source_file, 'r', encoding="utf-8",
+              buffering=corpus_stats.IO_BUFFER_SIZE) as f:
+        for lines in iter(lambda: list(itertools.islice(f, LINES_PER_CHUNK)), []):
+            if pool is None:
+                write(corpus_stats.integerize_lines(lines))
+                continue
+            pending.append(pool.apply_async(corpus_stats.integerize_lines, (lines,)))
+            if len(pending) >= 2 * args.num_jobs:
+                write(pending.popleft().get())
+    while pending:
+        write(pending.popleft().get())
+    return num_oovs
+
+
+if args.num_jobs > 1:
+    pool = Pool(args.num_jobs, initializer=corpus_stats.init_worker,
+                initargs=(word_to_int_str, unk_int_str))
 else:
-    unk_opt = ""
-
-# Convert from text to integer form using the vocabulary file,
-# moving data from *.tmp to *.txt.
-for n in range(1, args.num_splits + 1):
-    command = "utils/sym2int.pl {unk_opt} -f 2- {vocab_file} <{input_file} >{output_file}".format(
-        vocab_file=args.vocab_file,
-        unk_opt=unk_opt,
-        input_file="{0}/{1}.tmp".format(args.split_dir, n),
-        output_file="{0}/{1}.txt".format(args.split_dir, n))
-    ret = os.system(command)
-    if ret != 0:
-        sys.exit(sys.argv[0] + ": command '{0}' returned with status {1}".format(
-            command, ret))
-    os.remove("{0}/{1}.tmp".format(args.split_dir, n))
+    pool = None
+    corpus_stats.init_worker(word_to_int_str, unk_int_str)
+
+
+print(sys.argv[0] + ": distributing data to split files in integer form")
+
+# Line n of the k'th copy of a data source goes to split (offset_k + n) % num_splits,
+# prepended by the data weight.  The order of lines within each split file is:
+# data sources in order, copies in order, lines in order.
+try:
+    split_files = [open("{0}/{1}.txt".format(args.split_dir, j + 1), 'w', encoding="utf-8")
+                   for j in range(args.num_splits)]
+except Exception as e:
+    sys.exit(sys.argv[0] + ": failed to open file: " + str(e) +
+             ".. if this is a max-open-filehandles limitation, you may "
+             "need to rewrite parts of this script, but a workaround "
+             "is to use fewer splits of the data (or change your OS "
+             "ulimits)")
+num_oovs = 0
+try:
+    for name in names:
+        multiplicity = data_weights[name][0]
+        assert multiplicity >= 0
+        for n in range(multiplicity):
+            # 'offset' will be zero for the first copy of any data, and
+            # from there it will increase up to some value less than
+            # args.num_splits.  The point of this offset, which you can
+            # think of as a rotation modulo args.num_splits, is so that
+            # when we write the same data multiple times, we don't end
+            # up writing the same lines to the same file.
+            offset = (n * args.num_splits) // multiplicity
+            assert offset < args.num_splits
+            rotated_files = split_files[offset:] + split_files[:offset]
+            num_oovs += write_integerized(data_sources[name], weights[name],
+                                          rotated_files, pool)
+    for f in split_files:
+        f.close()
+except (IOError, OSError) as e:
+    sys.exit(sys.argv[0] + ": failed to write split file (disk full?): " + str(e))
+except Exception as e:
+    sys.exit(sys.argv[0] + ": failed to convert data to integer form: " + str(e))
 
 
 print(sys.argv[0] + ": converting dev data from text to integer form.")
 
+try:
+    with open("{0}/dev.txt".format(args.split_dir), 'w', encoding="utf-8") as output_file:
+        num_oovs += write_integerized("{0}/dev.txt".format(args.text_dir), '1',
+                                      [output_file], pool)
+except Exception as e:
+    sys.exit(sys.argv[0] + ": failed to convert dev data: " + str(e))
 
-command = "utils/sym2int.pl {unk_opt} {vocab_file} <{input_file} | {awk_command} >{output_file}".format(
-    vocab_file=args.vocab_file,
-    unk_opt=unk_opt,
-    awk_command="awk '{print 1.0, $0;}'",  # this is passed as a variable
-                                           # because it has {}'s awhich would
-                                           # otherwise be interpreted.
-    input_file="{0}/dev.txt".format(args.text_dir),
-    output_file="{0}/dev.txt".format(args.split_dir))
-ret = os.system(command)
-if ret != 0:
-    sys.exit(sys.argv[0] + ": command '{0}' returned with status {1}".format(
-            command, ret))
+if pool is not None:
+    pool.close()
+    pool.join()
 
+if num_oovs > 0:
+    print(sys.argv[0] + ": replaced {0} instances of OOVs with {1}".format(
+        num_oovs, args.unk_word), file=sys.stderr)
 
 print(sys.argv[0] + ": created split data in {0}".format(args.split_dir))
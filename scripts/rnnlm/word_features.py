@@ -0,0 +1,118 @@
+# Copyright  2017  Jian Wang
+# License: Apache 2.0.
+
+# This module enumerates the character n-gram features of a vocabulary, as used
+# by rnnlm/choose_features.py and rnnlm/get_word_features.py.  The n-grams of
+# all words are interned to integer ids and stored as a sparse word-by-ngram
+# count matrix in CSR form (numpy arrays 'indptr', 'indices' and 'counts'), so
+# the statistics over the whole vocabulary can be computed with array
+# operations.  The words are processed in parallel chunks.
+
+from multiprocessing import Pool
+
+import numpy as np
+
+WORDS_PER_CHUNK = 20000
+
+
+# Enumerate the character n-grams of 'word' with orders from min_order to
+# max_order, counting the beginning and end of the word as one position each.
+# Yields pairs (match_type, match), one per occurrence, where match_type is
+# one of 'match', 'initial', 'final', 'word' (see choose_features.py).
+def ngram_occurrences(word, min_order, max_order):
+    for pos in range(len(word) + 1):  # +1 for EOW
+        for order in range(min_order, max_order + 1):
+            start = pos - order + 1
+            end = pos + 1
+
+            if start < -1:
+                continue
+
+            if start < 0 and end > len(word):
+                match_type = 'word'
+                start = 0
+                end = len(word)
+            elif start < 0:
+                match_type = 'initial'
+                start = 0
+            elif end > len(word):
+                match_type = 'final'
+                end = len(word)
+            else:
+                match_type = 'match'
+            if start >= end:
+                continue
+            yield (match_type, word[start:end])
+
+
+# Count the n-grams of a chunk of words.  'task' is a tuple
+# (words, min_order, max_order, include_word_type).
+# Returns (keys, rows, cols, counts) where keys is the list of distinct
+# (match_type, match) pairs of the chunk and (rows, cols, counts) is the
+# COO form of the chunk's word-by-key count matrix.
+def count_ngrams_in_chunk(task):
+    words, min_order, max_order, include_word_type = task
+    key_to_col = {}
+    rows = []
+    cols = []
+    counts = []
+    for row, word in enumerate(words):
+        word_counts = {}
+        for key in ngram_occurrences(word, min_order, max_order):
+            if key[0] == 'word' and not include_word_type:
+                continue
+            col = key_to_col.setdefault(key, len(key_to_col))
+            word_counts[col] = word_counts.get(col, 0) + 1
+        for col, count in word_counts.items():
+            rows.append(row)
+            cols.append(col)
+            counts.append(count)
+    keys = [None] * len(key_to_col)
+    for key, col in key_to_col.items():
+        keys[col] = key
+    return (keys, np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+            np.array(counts, dtype=np.int64))
+
+
+# Build the sparse matrix of n-gram counts of 'words'.
+# returns (keys, indptr, indices, counts), where 'keys' is a list of
+# (match_type, match) pairs indexed by n-gram id, and the n-grams of
+# words[i] are indices[indptr[i]:indptr[i+1]] with the number of their
+# occurrences in counts[indptr[i]:indptr[i+1]].
+def build_ngram_matrix(words, min_order, max_order, include_word_type=True, num_jobs=1):
+    tasks = [(words[i:i + WORDS_PER_CHUNK], min_order, max_order, include_word_type)
+             for i in range(0, len(words), WORDS_PER_CHUNK)]
+    if num_jobs > 1 and len(tasks) > 1:
+        with Pool(min(num_jobs, len(tasks))) as pool:
+            results = pool.map(count_ngrams_in_chunk, tasks)
+    else:
+        results = [count_ngrams_in_chunk(task) for task in tasks]
+
+    # intern the keys of the chunks into global n-gram ids.
+    key_to_id = {}
+    all_rows = []
+    all_cols = []
+    all_counts = []
+    for chunk_index, (chunk_keys, rows, cols, counts) in enumerate(results):
+        local_to_global = np.array([key_to_id.setdefault(key, len(key_to_id))
+                                    for key in chunk_keys], dtype=np.int64)
+        all_rows.append(rows + chunk_index * WORDS_PER_CHUNK)
+        all_cols.append(local_to_global[cols] if len(chunk_keys) > 0 else cols)
+        all_counts.append(counts)
+    keys = [None] * len(key_to_id)
+    for key, key_id in key_to_id.items():
+        keys[key_id] = key
+
+    if len(all_rows) == 0:
+        return keys, np.zeros(len(words) + 1, dtype=np.int64), \
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows = np.concatenate(all_rows)
+    # rows are already sorted since chunks and words within chunks are in order.
+    indptr = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(words)), out=indptr[1:])
+    return keys, indptr, np.concatenate(all_cols), np.concatenate(all_counts)
+
+
+# return the row index of every non-zero element of a CSR matrix.
+def get_csr_rows(indptr):
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
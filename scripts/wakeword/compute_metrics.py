@@ -5,6 +5,16 @@
 # Apache 2.0
 
 """ This script computes several metrics for wake word detection.
+    By default the hypothesis contains the decoded text of each utterance,
+    and the metrics of this single operating point are printed.
+    With --scores, the hypothesis contains a detection score for each
+    utterance instead ("<utt-id> <score>", e.g. the max wake word posterior or
+    a score margin; higher means more likely to contain the wake word), and
+    the whole DET curve is computed at once by sorting the utterances by score:
+    every distinct score is a threshold (an utterance is detected if its score
+    is >= the threshold). The EER and the FNR at the operating points in
+    --fa-per-hour are printed, and the curve can be written to --curve-file,
+    which plot_det.py reads directly.
 """
 
 
@@ -14,6 +24,90 @@ import io
 import sys
 import codecs
 
+
+def read_ref(path):
+    """ Returns a list of (utt-id, text). """
+    f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if path == "-" else codecs.open(path, 'r', encoding='utf-8')
+    ref = []
+    for line in f:
+        fields = line.strip().split(None, 1)
+        if not fields:
+            continue
+        ref.append((fields[0], fields[1] if len(fields) == 2 else ''))
+    f.close()
+    return ref
+
+
+def read_hyp(path):
+    """ Returns a dict from utt-id to the rest of the line. """
+    f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if path == "-" else codecs.open(path, 'r', encoding='utf-8')
+    hyp = {}
+    for line in f:
+        fields = line.strip().split(None, 1)
+        if not fields:
+            continue
+        hyp[fields[0]] = fields[1] if len(fields) == 2 else ""
+    f.close()
+    return hyp
+
+
+def get_metrics(TP, TN, FP, FN, duration):
+    """ Returns (precision, recall, FPR, FNR, FP per hour). """
+    precision = TP / (TP + FP) if TP + FP > 0 else 0.0
+    recall = TP / (TP + FN) if TP + FN > 0 else 0.0
+    false_positive_rate = FP / (FP + TN) if FP + TN > 0 else 0.0
+    false_negative_rate = FN / (FN + TP) if FN + TP > 0 else 0.0
+    false_alarms_per_hour = FP / (duration / 3600) if duration > 0.0 else 0.0
+    return precision, recall, false_positive_rate, false_negative_rate, false_alarms_per_hour
+
+
+def print_metrics(TP, TN, FP, FN, duration, file=sys.stdout):
+    print("precision: %.5f  recall: %.5f  FPR: %.5f  FNR: %.5f  FP per hour: %.5f  total: %d" % (get_metrics(TP, TN, FP, FN, duration) + (TP+TN+FP+FN,)), file=file)
+
+
+def compute_det_curve(scores_and_labels):
+    """ Given a list of (score, is_positive) for all the utterances, returns the
+        points of the DET curve as a list of (threshold, TP, FP), where TP and FP
+        are the numbers of positive and negative utterances whose score is >=
+        threshold. The points are in decreasing order of threshold, starting
+        from +inf (nothing detected). Only the points with the most TP for their
+        FP are kept (the others are never better operating points), plus the
+        last one (everything detected).
+    """
+    scores_and_labels = sorted(scores_and_labels, key=lambda x: x[0], reverse=True)
+    points = [(float('inf'), 0, 0)]
+    TP = FP = 0
+    for i, (score, is_positive) in enumerate(scores_and_labels):
+        if is_positive:
+            TP += 1
+        else:
+            FP += 1
+        if i + 1 < len(scores_and_labels) and scores_and_labels[i + 1][0] == score:
+            continue  # the threshold has to be below all the tied scores
+        if points[-1][2] == FP:
+            points[-1] = (score, TP, FP)
+        else:
+            points.append((score, TP, FP))
+    return points
+
+
+def compute_eer(curve):
+    """ Given the DET curve as a list of (threshold, FPR, FNR) with increasing
+        FPR, returns (EER, threshold), where the EER is found by linear
+        interpolation between the two points at which FNR - FPR changes sign,
+        and the threshold is that of the first of the points with
+        FPR >= FNR.
+    """
+    for i, (threshold, fpr, fnr) in enumerate(curve):
+        if fpr >= fnr:
+            if i == 0:
+                return fpr, threshold
+            prev_fpr, prev_fnr = curve[i - 1][1], curve[i - 1][2]
+            t = (prev_fnr - prev_fpr) / ((prev_fnr - prev_fpr) - (fnr - fpr))
+            return prev_fpr + t * (fpr - prev_fpr), threshold
+    return curve[-1][1], curve[-1][0]
+
+
 def main():
     parser = argparse.ArgumentParser(description="""Computes metrics for evalutuon.""")
     parser.add_argument('ref', type=str,
@@ -25,44 +119,92 @@ def main():
     parser.add_argument('--wake-word', type=str, dest='wake_word', default='嗨小问',
                         help='wake word')
     parser.add_argument('--duration', type=float, dest='duration', default=0.0)
+    parser.add_argument('--scores', action='store_true',
+                        help='If true, the hypothesis contains a detection score '
+                        'for each utterance and the whole DET curve is computed.')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='With --scores, also print the metrics of this '
+                        'threshold in the same format as without --scores.')
+    parser.add_argument('--fa-per-hour', type=str, dest='fa_per_hour', default='0.5,1.0',
+                        help='With --scores, comma-separated false alarms per '
+                        'hour at which to report the FNR (requires --duration).')
+    parser.add_argument('--curve-file', type=str, dest='curve_file', default=None,
+                        help='With --scores, write the DET curve to this file.')
     args = parser.parse_args()
 
-    f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if args.ref == "-" else codecs.open(args.ref, 'r', encoding='utf-8')
-    lines = f.readlines()
-    ref = [line.strip().split(None, 1) if len(line.strip().split(None, 1)) == 2 else [line.strip().split(None, 1)[0], ''] for line in lines]
-    f.close()
-
-    f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if args.hyp == "-" else codecs.open(args.hyp, 'r', encoding='utf-8')
-    lines = f.readlines()
-    hyp = {}
-    for line in lines:
-        hyp[line.strip().split(None, 1)[0]] = line.strip().split(None, 1)[1] if len(line.strip().split(None, 1)) == 2 else ""
-    f.close()
+    ref = read_ref(args.ref)
+    hyp = read_hyp(args.hyp)
 
     if len(ref) != len(hyp):
         print("The lengths of reference and hypothesis do not match. ref: {} vs hyp: {}.".format(len(ref), len(hyp)), file=sys.stderr)
-    TP = TN = FP = FN = 0.0
-    for i in range(len(ref)):
-        if ref[i][0] not in hyp:
-            print("reference {} does not exist in hypothesis.".format(ref[i][0]), file=sys.stderr)
-            continue
-        if ref[i][1] == args.wake_word:
-            if args.wake_word in hyp[ref[i][0]]:
-                TP += 1.
-            else:
-                FN += 1.
-        else:
-            if args.wake_word in hyp[ref[i][0]]:
-                FP += 1.
+
+    if not args.scores:
+        TP = TN = FP = FN = 0.0
+        for utt_id, text in ref:
+            if utt_id not in hyp:
+                print("reference {} does not exist in hypothesis.".format(utt_id), file=sys.stderr)
+                continue
+            if text == args.wake_word:
+                if args.wake_word in hyp[utt_id]:
+                    TP += 1.
+                else:
+                    FN += 1.
             else:
-                TN += 1.
-    precision = TP / (TP + FP) if TP + FP > 0 else 0.0
-    recall = TP / (TP + FN) if TP + FN > 0 else 0.0
-    false_positive_rate = FP / (FP + TN) if FP + TN > 0 else 0.0
-    false_negative_rate = FN / (FN + TP) if FN + TP > 0 else 0.0
-    false_alarms_per_hour = FP / (args.duration / 3600) if args.duration > 0.0 else 0.0
+                if args.wake_word in hyp[utt_id]:
+                    FP += 1.
+                else:
+                    TN += 1.
+        print_metrics(TP, TN, FP, FN, args.duration)
+        return
+
+    scores_and_labels = []
+    for utt_id, text in ref:
+        if utt_id not in hyp:
+            print("reference {} does not exist in hypothesis.".format(utt_id), file=sys.stderr)
+            continue
+        try:
+            score = float(hyp[utt_id])
+        except ValueError:
+            raise Exception("Bad score for utterance {}: '{}'".format(utt_id, hyp[utt_id]))
+        scores_and_labels.append((score, text == args.wake_word))
+
+    num_positives = sum(1 for _, is_positive in scores_and_labels if is_positive)
+    num_negatives = len(scores_and_labels) - num_positives
+    points = compute_det_curve(scores_and_labels)
+
+    if args.threshold is not None:
+        TP = float(sum(1 for score, is_positive in scores_and_labels if is_positive and score >= args.threshold))
+        FP = float(sum(1 for score, is_positive in scores_and_labels if not is_positive and score >= args.threshold))
+        print_metrics(TP, num_negatives - FP, FP, num_positives - TP, args.duration)
+
+    curve = []
+    for threshold, TP, FP in points:
+        curve.append((threshold,) + get_metrics(float(TP), float(num_negatives - FP), float(FP),
+                                                float(num_positives - TP), args.duration))
+
+    eer, eer_threshold = compute_eer([(threshold, fpr, fnr) for threshold, _, _, fpr, fnr, _ in curve])
+    print("EER: %.5f  threshold: %g  total: %d" % (eer, eer_threshold, len(scores_and_labels)))
+
+    if args.duration > 0.0:
+        for target in args.fa_per_hour.split(','):
+            if not target:
+                continue
+            target = float(target)
+            # the point with the lowest FNR whose FP per hour is within the
+            # target; FNR decreases and FP per hour increases along the curve.
+            best = None
+            for point in curve:
+                if point[5] > target:
+                    break
+                best = point
+            print("FP per hour <= %g:  FNR: %.5f  FP per hour: %.5f  threshold: %g" % (target, best[4], best[5], best[0]))
+
+    if args.curve_file is not None:
+        with open(args.curve_file, 'w', encoding='utf-8') as f:
+            print("# threshold precision recall FPR FNR FP-per-hour", file=f)
+            for point in curve:
+                print("%g %.5f %.5f %.5f %.5f %.5f" % point, file=f)
 
-    print("precision: %.5f  recall: %.5f  FPR: %.5f  FNR: %.5f  FP per hour: %.5f  total: %d" % (precision, recall, false_positive_rate, false_negative_rate, false_alarms_per_hour, TP+TN+FP+FN))
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,9 @@
 # Apache 2.0
 
 """ This script plots the DET curves
+    Each input file is either a file with one metrics line (as printed by
+    compute_metrics.py) per operating point, or a DET curve file as written by
+    compute_metrics.py --scores --curve-file.
 """
 
 
@@ -29,7 +32,8 @@ except ImportError:
 def main():
     parser = argparse.ArgumentParser(description="""Computes metrics for evalutuon.""")
     parser.add_argument("comparison_path", type=str, nargs="+",
-                        help="paths to result file, and each line in the file should have the format specfied in pattern variable below.")
+                        help="paths to result file, and each line in the file should have the format specfied in pattern variable below, "
+                        "or paths to DET curve files written by compute_metrics.py --curve-file.")
 
     args = parser.parse_args()
     if (args.comparison_path is not None and len(args.comparison_path) > 6):
@@ -59,6 +63,17 @@ def main():
         FPR = []
         FNR = []
         FP_per_hour = []
+        if lines and lines[0].startswith("# threshold"):
+            # DET curve file: threshold precision recall FPR FNR FP-per-hour
+            for line in lines[1:]:
+                fields = line.split()
+                if len(fields) == 6:
+                    precision.append(float(fields[1]))
+                    recall.append(float(fields[2]))
+                    FPR.append(float(fields[3]))
+                    FNR.append(float(fields[4]))
+                    FP_per_hour.append(float(fields[5]))
+            lines = []
         for line in lines:
             m = prog.match(line)
             if m: